@@ -0,0 +1,33 @@
+import argparse
+import os
+
+from service import archive
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.redis_manager import redis_manager
+
+
+def main():
+    """
+    Move closed opportunities that have not changed for a while into the archive
+    """
+    parser = argparse.ArgumentParser(description="Archive old closed opportunities")
+    parser.add_argument(
+        "--age-days",
+        type=float,
+        default=float(os.getenv("OPPORTUNITY_ARCHIVE_AGE_DAYS", str(archive.DEFAULT_MAX_AGE_DAYS))),
+        help="Days since the last change after which a closed opportunity is archived",
+    )
+    parser.add_argument("--batch-size", type=int, default=500, help="Records read per round trip")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the opportunities that would be archived")
+    args = parser.parse_args()
+
+    count = archive.archive_closed_opportunities(args.age_days, batch_size=args.batch_size, dry_run=args.dry_run)
+    print(f"{'Would archive' if args.dry_run else 'Archived'} {count} closed opportunities older than {args.age_days:g} days")
+
+    rollups = archive.get_rollups()
+    print(f"Archive: {redis_manager.count_archived(OPPORTUNITY_MODEL_TYPE)} opportunities, value {rollups['value']:.2f}")
+    for stage, totals in rollups["stages"].items():
+        print(f"{stage:>12}: {totals['count']:8d}  {totals['value']:14.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Runs in a fresh interpreter for every measurement, so nothing is cached between runs
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+from fastapi.testclient import TestClient
+client_imported = time.perf_counter()
+
+with TestClient(main.app) as client:
+    started = time.perf_counter()
+    response = client.get(sys.argv[1])
+    answered = time.perf_counter()
+    print(json.dumps({
+        "import": imported - start,
+        "lifespan": started - client_imported,
+        "first_request": answered - started,
+        "status": response.status_code,
+    }), flush=True)
+"""
+
+
+def run_once(path, warmup):
+    """
+    Start the application in a new process and time it until the first response.
+    """
+    env = dict(os.environ, STARTUP_WARMUP="1" if warmup else "0")
+    spawned = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-c", CHILD, path],
+        stdout=subprocess.PIPE,
+        env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        text=True,
+    )
+    line = process.stdout.readline()
+    ready = time.perf_counter()
+    process.wait()
+    if not line:
+        raise RuntimeError(f"Application failed to start (exit code {process.returncode})")
+
+    result = json.loads(line)
+    result["time_to_first_ready"] = ready - spawned
+    return result
+
+
+def main():
+    """
+    Measure the import time and time-to-first-ready of the application
+    """
+    parser = argparse.ArgumentParser(description="Measure application startup time")
+    parser.add_argument("--runs", type=int, default=5, help="Number of cold starts to measure")
+    parser.add_argument("--path", default="/hello/benchmark", help="Path of the first request")
+    parser.add_argument("--warmup", action="store_true", help="Warm up Redis connections and caches on startup")
+    args = parser.parse_args()
+
+    print(f"Measuring {args.runs} cold starts (warmup: {'on' if args.warmup else 'off'})...")
+    results = [run_once(args.path, args.warmup) for _ in range(args.runs)]
+
+    statuses = {result["status"] for result in results}
+    print(f"First request: GET {args.path} -> {', '.join(str(s) for s in sorted(statuses))}")
+    for metric in ("import", "lifespan", "first_request", "time_to_first_ready"):
+        values = [result[metric] * 1000 for result in results]
+        print(f"{metric:>20}: median {statistics.median(values):8.1f} ms   min {min(values):8.1f} ms   max {max(values):8.1f} ms")
+
+if __name__ == "__main__":
+    main()
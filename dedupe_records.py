@@ -0,0 +1,42 @@
+import argparse
+import json
+
+from service import contacts, customers, dedupe
+
+
+def main():
+    """
+    Find the clusters of duplicate contacts or customers
+    """
+    parser = argparse.ArgumentParser(description="Find duplicate contacts or customers")
+    parser.add_argument("--model", choices=["contact", "customer"], default="customer", help="The records to dedupe")
+    parser.add_argument("--threshold", type=float, default=dedupe.DEFAULT_THRESHOLD, help="Minimum score of a duplicate pair")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument(
+        "--rebuild-index",
+        action="store_true",
+        help="Also (re)index all records for the possible duplicates check on create",
+    )
+    parser.add_argument("--output", help="Write the clusters to this file as JSON")
+    args = parser.parse_args()
+
+    model_type = contacts.MODEL_TYPE if args.model == "contact" else customers.CUSTOMER_MODEL_TYPE
+    clusters = dedupe.dedupe_collection(model_type, args.threshold, args.workers, args.rebuild_index)
+
+    duplicates = sum(len(cluster.members) for cluster in clusters)
+    print(f"Found {len(clusters)} clusters of duplicate {args.model}s ({duplicates} records)")
+    for cluster in clusters[:20]:
+        members = ", ".join(f"{member.id} ({member.score:.2f})" for member in cluster.members)
+        print(f"{cluster.cluster_id}  score {cluster.score:.2f}: {members}")
+    if len(clusters) > 20:
+        print(f"... and {len(clusters) - 20} more")
+
+    if args.output:
+        # Handle both Pydantic v1 and v2
+        data = [cluster.model_dump() if hasattr(cluster, 'model_dump') else cluster.dict() for cluster in clusters]
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=2)
+        print(f"Wrote the clusters to {args.output}")
+
+if __name__ == "__main__":
+    main()
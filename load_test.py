@@ -0,0 +1,395 @@
+"""
+Load test: replays weighted scenarios built from the request flows in test_main.http.
+
+Each scenario is a sequence of steps. A step names requests of test_main.http by method and
+path: 'GET /customers/{id}' matches every GET of a single customer, with or without a query
+string or conditional headers, and one of them is picked at random. Requests that are
+commented out there because they need the ID of an existing record are replayed too. The
+placeholder ID is replaced by the ID of the last record of that type the scenario created
+or read, and a step is skipped if there is none yet.
+
+The scenarios run against the application in this process, through ASGI and including its
+lifespan, or against a running server (--url, e.g. of uvicorn main:app --port 8000). Either
+way they write to the Redis database the application is configured with, so use a test
+database.
+
+Closed loop (default): --concurrency virtual users run scenarios back to back.
+Open loop (--rate): scenarios start at that rate per second (Poisson arrivals), with at most
+--concurrency running at a time. Arrivals that find every slot taken wait, and are counted
+as delayed.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+try:
+    import httpx
+except ImportError:  # httpx is only needed for load testing (and by fastapi.testclient)
+    httpx = None
+
+HTTP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_main.http")
+
+# The ID test_main.http uses where a request needs an existing record
+PLACEHOLDER_ID = "00000000-0000-0000-0000-000000000000"
+
+# Scenarios by name: (weight, steps)
+SCENARIOS: Dict[str, Tuple[int, List[str]]] = {
+    # Lists, records and re-polls, as the UI loads them
+    "browse": (40, [
+        "GET /customers", "GET /customers/{id}", "GET /customers/{id}/overview",
+        "GET /opportunities", "GET /contacts", "GET /contacts/{id}",
+    ]),
+    "dashboard": (20, [
+        "GET /api/dashboard/stats", "GET /api/dashboard/cards/summary",
+        "GET /analytics/forecast", "GET /opportunities/archive/rollups",
+    ]),
+    "sync": (10, ["GET /sync"]),
+    "new_customer": (10, [
+        "POST /customers/duplicates", "POST /customers", "POST /opportunities",
+        "GET /customers/{id}/opportunities", "POST /activities", "POST /notes",
+    ]),
+    "edit_contact": (15, ["POST /contacts", "GET /contacts/{id}", "PUT /contacts/{id}"]),
+    "cleanup": (5, ["POST /customers", "DELETE /customers/{id}", "POST /contacts", "DELETE /contacts/{id}"]),
+}
+
+_REQUEST_LINE = re.compile(r"^(GET|POST|PUT|PATCH|DELETE|HEAD|OPTIONS)\s+(\S+)")
+_BODY_ID = re.compile(r'"(\w+)_id"(\s*:\s*)"' + PLACEHOLDER_ID + '"')
+_UUID = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+class HttpRequest(NamedTuple):
+    """
+    A request of an .http file.
+    """
+    name: str                # the comment above it
+    method: str
+    path: str                # path and query string
+    headers: Dict[str, str]
+    body: Optional[str]
+
+    @property
+    def route(self) -> str:
+        return f"{self.method} {route_template(self.path)}"
+
+
+def route_template(path: str) -> str:
+    """
+    Get the route of a path: without the query string, with IDs replaced by '{id}'.
+    """
+    segments = urlsplit(path).path.split("/")
+    return "/".join("{id}" if _UUID.match(segment) else segment for segment in segments)
+
+
+def parse_http_file(path: str = HTTP_FILE) -> List[HttpRequest]:
+    """
+    Parse the requests of an .http file, including the commented out ones.
+    """
+    with open(path) as f:
+        blocks = re.split(r"^###.*$", f.read(), flags=re.MULTILINE)
+
+    requests = []
+    for block in blocks:
+        original = block.strip().splitlines()
+        lines = original
+        # Commented out requests are parsed like the others
+        if not any(_REQUEST_LINE.match(line) for line in lines):
+            lines = [re.sub(r"^#\s?", "", line) for line in lines]
+        start = next((i for i, line in enumerate(lines) if _REQUEST_LINE.match(line)), None)
+        if start is None:
+            continue
+
+        comments = [re.sub(r"^#\s?", "", line) for line in original[:start] if line.startswith("#")]
+        method, url = _REQUEST_LINE.match(lines[start]).groups()
+        split = urlsplit(url)
+        headers = {}
+        position = start + 1
+        while position < len(lines) and lines[position].strip() and ":" in lines[position]:
+            name, value = lines[position].split(":", 1)
+            headers[name.strip()] = value.strip()
+            position += 1
+        body = "\n".join(lines[position:]).strip() or None
+        requests.append(HttpRequest(
+            name=comments[-1] if comments else f"{method} {split.path}",
+            method=method,
+            path=split.path + (f"?{split.query}" if split.query else ""),
+            headers=headers,
+            body=body,
+        ))
+    return requests
+
+
+def _resource(segment: str) -> str:
+    # 'opportunities' -> 'opportunity', 'customers' -> 'customer'
+    if segment.endswith("ies"):
+        return segment[:-3] + "y"
+    return segment[:-1] if segment.endswith("s") else segment
+
+
+def prepare_request(request: HttpRequest, ids: Dict[str, str]) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    Replace the placeholder IDs of a request by the IDs of records the scenario saw.
+
+    Returns:
+        The path and body, or None if a record of a needed type was not seen yet
+    """
+    segments = request.path.split("/")
+    for position, segment in enumerate(segments):
+        if segment.split("?")[0] == PLACEHOLDER_ID:
+            id = ids.get(_resource(segments[position - 1]))
+            if id is None:
+                return None
+            segments[position] = segment.replace(PLACEHOLDER_ID, id)
+
+    body = request.body
+    if body is not None:
+        # e.g. "customer_id": "<placeholder>"
+        if any(match.group(1) not in ids for match in _BODY_ID.finditer(body)):
+            return None
+        body = _BODY_ID.sub(lambda match: f'"{match.group(1)}_id"{match.group(2)}"{ids[match.group(1)]}"', body)
+    return "/".join(segments), body
+
+
+def capture_ids(path: str, data: Any, ids: Dict[str, str], rng: random.Random) -> None:
+    """
+    Remember the ID of the record (or of one record of the list) in a response.
+    """
+    names = [segment for segment in urlsplit(path).path.split("/") if segment and not _UUID.match(segment)]
+    if not names:
+        return
+    resource = _resource(names[-1])
+    if isinstance(data, dict) and "id" in data:
+        ids[resource] = str(data["id"])
+    elif isinstance(data, list):
+        records = [item for item in data if isinstance(item, dict) and "id" in item]
+        if records:
+            ids[resource] = str(rng.choice(records)["id"])
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Get a percentile (nearest rank) of sorted values.
+    """
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(len(values) * fraction))
+    return values[rank - 1]
+
+
+class Recorder:
+    """
+    Collects the latency and status of every request, by route.
+    """
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.skipped = 0
+        self.delayed = 0
+        self.scenarios: Counter = Counter()
+
+    def record(self, route: str, status: int, latency: float) -> None:
+        self.latencies[route].append(latency)
+        self.statuses[route][status] += 1
+
+    def report(self, duration: float) -> Dict[str, Dict[str, Any]]:
+        """
+        Summarize the requests per route: count, client and server errors (including failed
+        connections, status 0), throughput and p50/p95/p99 latency in milliseconds.
+        """
+        result = {}
+        for route in sorted(self.latencies, key=lambda route: route.split(" ", 1)[::-1]):
+            latencies = sorted(self.latencies[route])
+            statuses = self.statuses[route]
+            result[route] = {
+                "requests": len(latencies),
+                "client_errors": sum(count for status, count in statuses.items() if 400 <= status < 500),
+                "server_errors": sum(count for status, count in statuses.items() if status >= 500 or status == 0),
+                "throughput": len(latencies) / duration if duration else 0.0,
+                "p50": percentile(latencies, 0.50) * 1000,
+                "p95": percentile(latencies, 0.95) * 1000,
+                "p99": percentile(latencies, 0.99) * 1000,
+            }
+        return result
+
+
+async def run_scenario(
+    client: Any,
+    steps: List[str],
+    requests: Dict[str, List[HttpRequest]],
+    recorder: Recorder,
+    rng: random.Random
+) -> None:
+    """
+    Run the steps of a scenario one after the other.
+    """
+    ids: Dict[str, str] = {}
+    for step in steps:
+        request = rng.choice(requests[step])
+        prepared = prepare_request(request, ids)
+        if prepared is None:
+            recorder.skipped += 1
+            continue
+        path, body = prepared
+
+        start = time.perf_counter()
+        try:
+            response = await client.request(request.method, path, headers=request.headers, content=body)
+        except httpx.HTTPError:
+            recorder.record(step, 0, time.perf_counter() - start)
+            continue
+        recorder.record(step, response.status_code, time.perf_counter() - start)
+        if response.status_code < 300 and response.content and response.headers.get("content-type", "").startswith("application/json"):
+            capture_ids(path, response.json(), ids, rng)
+
+
+async def run_load(
+    client: Any,
+    scenarios: Dict[str, Tuple[int, List[str]]],
+    requests: List[HttpRequest],
+    duration: float,
+    concurrency: int = 10,
+    rate: Optional[float] = None,
+    seed: Optional[int] = None
+) -> Recorder:
+    """
+    Run scenarios, chosen by weight, for duration seconds.
+
+    Args:
+        client: An httpx.AsyncClient for the application
+        scenarios: (weight, steps) by scenario name
+        requests: The requests the steps refer to (see parse_http_file)
+        duration: Seconds during which scenarios are started
+        concurrency: Virtual users (closed loop) or the most scenarios running at a time
+            (open loop)
+        rate: Scenarios started per second, for an open loop
+        seed: Seed of the scenario choice and arrival times
+
+    Returns:
+        The recorded requests; scenarios still running at the end are completed
+    """
+    by_route: Dict[str, List[HttpRequest]] = defaultdict(list)
+    for request in requests:
+        by_route[request.route].append(request)
+    for name, (_, steps) in scenarios.items():
+        missing = [step for step in steps if step not in by_route]
+        if missing:
+            raise ValueError(f"Scenario {name} refers to requests that are not in the .http file: {', '.join(missing)}")
+
+    rng = random.Random(seed)
+    names = list(scenarios)
+    weights = [scenarios[name][0] for name in names]
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    async def run_one() -> None:
+        name = rng.choices(names, weights)[0]
+        recorder.scenarios[name] += 1
+        await run_scenario(client, scenarios[name][1], by_route, recorder, rng)
+
+    if rate is None:
+        async def user() -> None:
+            while time.perf_counter() < deadline:
+                await run_one()
+
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        return recorder
+
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+
+    async def arrival() -> None:
+        if slots.locked():
+            recorder.delayed += 1
+        async with slots:
+            await run_one()
+
+    next_arrival = time.perf_counter()
+    while next_arrival < deadline:
+        await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+        task = asyncio.ensure_future(arrival())
+        running.add(task)
+        task.add_done_callback(running.discard)
+        next_arrival += rng.expovariate(rate)
+    await asyncio.gather(*running)
+    return recorder
+
+
+def print_report(recorder: Recorder, duration: float) -> None:
+    report = recorder.report(duration)
+    print(f"{'route':<44} {'requests':>8} {'4xx':>6} {'5xx':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, stats in report.items():
+        print(
+            f"{route:<44} {stats['requests']:>8} {stats['client_errors']:>6} {stats['server_errors']:>6} "
+            f"{stats['throughput']:>8.1f} {stats['p50']:>8.1f} {stats['p95']:>8.1f} {stats['p99']:>8.1f}"
+        )
+    total = sum(stats["requests"] for stats in report.values())
+    print(f"{total} requests in {duration:.1f} s ({total / duration:.1f} req/s), {sum(recorder.scenarios.values())} scenarios")
+    print(f"Scenarios: {', '.join(f'{name} {count}' for name, count in recorder.scenarios.most_common())}")
+    if recorder.skipped:
+        print(f"{recorder.skipped} steps skipped for lack of a record to refer to")
+    if recorder.delayed:
+        print(f"{recorder.delayed} arrivals waited for a free slot (raise --concurrency)")
+
+
+async def run(args: argparse.Namespace) -> None:
+    requests = parse_http_file(args.http_file)
+    scenarios = SCENARIOS
+    if args.scenarios:
+        scenarios = {name: SCENARIOS[name] for name in args.scenarios.split(",")}
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=httpx.Limits(max_connections=args.concurrency))
+        async with client:
+            start = time.perf_counter()
+            recorder = await run_load(client, scenarios, requests, args.duration, args.concurrency, args.rate, args.seed)
+            elapsed = time.perf_counter() - start
+    else:
+        # Imported here: the application connects to Redis and starts its background tasks
+        import main
+
+        app = main.app
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://load-test", timeout=args.timeout) as client:
+                start = time.perf_counter()
+                recorder = await run_load(client, scenarios, requests, args.duration, args.concurrency, args.rate, args.seed)
+                elapsed = time.perf_counter() - start
+
+    print_report(recorder, elapsed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"duration": elapsed, "scenarios": dict(recorder.scenarios), "routes": recorder.report(elapsed)}, f, indent=2)
+        print(f"Wrote the report to {args.output}")
+
+
+def main():
+    """
+    Replay weighted scenarios from test_main.http and report latency percentiles per route
+    """
+    parser = argparse.ArgumentParser(description="Load test the application with the flows of test_main.http")
+    parser.add_argument("--url", help="Base URL of a running server (default: the application in this process, via ASGI)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds during which scenarios are started")
+    parser.add_argument("--concurrency", type=int, default=10, help="Virtual users, or with --rate the most scenarios running at a time")
+    parser.add_argument("--rate", type=float, help="Scenarios started per second (open loop)")
+    parser.add_argument("--scenarios", help=f"Comma separated scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("--seed", type=int, help="Seed of the scenario choice and arrival times")
+    parser.add_argument("--timeout", type=float, default=30, help="Request timeout in seconds")
+    parser.add_argument("--http-file", default=HTTP_FILE, help="The .http file with the requests")
+    parser.add_argument("--output", help="Write the report to this file as JSON")
+    args = parser.parse_args()
+
+    if httpx is None:
+        parser.error("Load testing needs the httpx package (pip install httpx)")
+    if args.scenarios and not set(args.scenarios.split(",")) <= set(SCENARIOS):
+        parser.error(f"Unknown scenario, expected some of {', '.join(SCENARIOS)}")
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,138 +1,567 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Request
-from fastapi.responses import HTMLResponse
+import asyncio
+import json
+import os
+import sys
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Response, Header, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from typing import List, Dict
+from pydantic import BaseModel
+from typing import Any, Callable, List, Dict, Optional, Type, TypeVar
 from uuid import UUID
-from collections import defaultdict
 
 from models.contact import Contact, ContactCreate, ContactUpdate
-from models.customer import Customer, CustomerCreate, CustomerUpdate, CustomerStatus
-from models.opportunity import Opportunity, OpportunityCreate, OpportunityUpdate, OpportunityStage
+from models.customer import Customer, CustomerCreate, CustomerUpdate
+from models.opportunity import Opportunity, OpportunityCreate, OpportunityUpdate
 from models.activity import Activity, ActivityCreate, ActivityUpdate
 from models.note import Note, NoteCreate, NoteUpdate
 from models.user import User, UserCreate, UserUpdate
+from models.overview import CustomerOverview
+from models.analytics import Forecast
+from models.projection import dump_projection, model_field_names
+from models.sync import SyncResponse
+from models.dedupe import DuplicateMatch
 
-from service import contacts, customers, opportunities, activities, notes, users
-from service.redis_manager import redis_manager
+from middleware import AdmissionControlMiddleware, CompressionMiddleware, MsgPackMiddleware, parse_admission_limits
+from service import contacts, customers, opportunities, activities, notes, users, sync, metrics, dashboard, archive
+from service.dashboard import dashboard_feed
+from service.query import Query as ListQuery, QueryResult, parse_query
+from service.redis_manager import redis_manager, VersionConflictError
+from service.write_behind import QueueFullError
 
-app = FastAPI(title="CRM System API")
+router = APIRouter()
 
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+R = TypeVar('R')
 
 # Set up Jinja2 templates
 templates = Jinja2Templates(directory="templates")
 
 
-@app.get("/", response_class=HTMLResponse)
-async def dashboard(request: Request):
+def warmup() -> None:
     """
-    Render the dashboard with customer and opportunity data.
+    Prepare the worker for its first requests: open pooled Redis connections, preload the
+    Lua scripts, build the reporting snapshot and start refreshing it in the background.
     """
-    # Get all customers
-    all_customers = customers.get_customers()
+    # The analytics stack (NumPy) is only imported when it is first needed
+    from service.snapshot import snapshot_store
 
-    # Get all opportunities
-    all_opportunities = opportunities.get_opportunities()
+    redis_manager.warmup(connections=int(os.getenv("STARTUP_WARMUP_CONNECTIONS", "4")))
+    snapshot_store.refresh()
+    snapshot_store.start()
 
-    # Calculate customer statistics
-    total_customers = len(all_customers)
-    customer_status_counts = defaultdict(int)
-    for customer in all_customers:
-        customer_status_counts[customer.status] = customer_status_counts[customer.status] + 1
 
-    # Calculate opportunity statistics
-    total_opportunities = len(all_opportunities)
-    total_opportunity_value = sum(opp.amount or 0 for opp in all_opportunities)
+def stop_snapshot_refresh() -> None:
+    """
+    Stop refreshing the reporting snapshot, if warmup or an analytics request started it.
+    """
+    # Not imported yet means never started; importing it here would load NumPy for nothing
+    snapshot = sys.modules.get("service.snapshot")
+    if snapshot is not None:
+        snapshot.snapshot_store.stop()
+
+
+def enable_activity_write_behind() -> None:
+    """
+    Enable write-behind of new activities as configured by the ACTIVITY_WRITE_BEHIND*
+    environment variables (see activities.enable_write_behind).
+
+    In redis mode, ACTIVITY_WRITE_BEHIND_QUEUE must name a list of this worker's own: there
+    is no default that every worker would share.
+    """
+    mode = os.getenv("ACTIVITY_WRITE_BEHIND", "").lower()
+    if mode in ("", "0", "false", "no", "off"):
+        return
+    if mode not in ("memory", "redis"):
+        raise ValueError(f"ACTIVITY_WRITE_BEHIND must be 'memory' or 'redis', not {mode!r}")
+    durable_key = os.getenv("ACTIVITY_WRITE_BEHIND_QUEUE") if mode == "redis" else None
+    if mode == "redis" and not durable_key:
+        raise ValueError("ACTIVITY_WRITE_BEHIND=redis needs ACTIVITY_WRITE_BEHIND_QUEUE, a list of each worker's own")
+    activities.enable_write_behind(
+        durable_key=durable_key,
+        max_pending=int(os.getenv("ACTIVITY_WRITE_BEHIND_MAX_PENDING", "10000")),
+        batch_size=int(os.getenv("ACTIVITY_WRITE_BEHIND_BATCH_SIZE", "500")),
+        flush_interval=float(os.getenv("ACTIVITY_WRITE_BEHIND_INTERVAL", "0.05")),
+    )
+
+
+def create_app(warmup_on_startup: Optional[bool] = None, query_plan: Optional[bool] = None) -> FastAPI:
+    """
+    Create the CRM application.
+
+    Redis is connected lazily on first use; with warmup_on_startup (default: the
+    STARTUP_WARMUP environment variable) the worker warms up before it reports ready.
+    With query_plan (default: the QUERY_PLAN environment variable) filtered list responses
+    report their query plan.
+
+    ADMISSION_LIMITS (e.g. "scan=4:16,point=64:256") sets the concurrent and queued
+    requests admitted per route class (see middleware.ROUTE_CLASSES); queued requests
+    wait at most ADMISSION_QUEUE_TIMEOUT seconds.
+    """
+    if warmup_on_startup is None:
+        warmup_on_startup = os.getenv("STARTUP_WARMUP", "").lower() in ("1", "true", "yes")
+    if query_plan is None:
+        query_plan = os.getenv("QUERY_PLAN", "").lower() in ("1", "true", "yes")
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # The reporting snapshot is refreshed in the background from warmup on, or else from
+        # the first analytics request on
+        if warmup_on_startup:
+            await run_in_threadpool(warmup)
+
+        await run_in_threadpool(enable_activity_write_behind)
+        yield
+        dashboard_feed.close()
+        await run_in_threadpool(stop_snapshot_refresh)
+        activities.disable_write_behind()
+        redis_manager.close()
+
+    app = FastAPI(title="CRM System API", lifespan=lifespan)
+    app.state.query_plan = query_plan
+
+    # Negotiated response encoding: MessagePack for callers that ask for it, then
+    # brotli/gzip compression of everything above COMPRESSION_MIN_SIZE bytes
+    app.add_middleware(MsgPackMiddleware)
+    app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")))
+
+    # Outermost: shed requests over the limits of their route class before any work is done
+    admission_limits = os.getenv("ADMISSION_LIMITS")
+    app.add_middleware(
+        AdmissionControlMiddleware,
+        limits=parse_admission_limits(admission_limits) if admission_limits is not None else None,
+        queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1")),
+    )
+
+    # Mount static files
+    app.mount("/static", StaticFiles(directory="static"), name="static")
+
+    app.include_router(router)
+    return app
+
+
+def _etag(version: int) -> str:
+    """
+    Build the ETag header value for a record version.
+    """
+    return f'"{version}"'
+
+
+def _parse_if_match(if_match: Optional[str]) -> Optional[List[int]]:
+    """
+    Get the record versions a client accepts from an If-Match header.
+
+    Returns None when there is no precondition ("*" or no header). ETags that are not ours
+    never match and are left out.
+    """
+    if if_match is None or if_match.strip() == "*":
+        return None
+    versions = []
+    for tag in if_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        try:
+            versions.append(int(tag.strip('"')))
+        except ValueError:
+            pass
+    return versions
+
+
+def _update_if_match(if_match: Optional[str], update: Callable[[Optional[int]], Optional[R]]) -> Optional[R]:
+    """
+    Run a compare-and-set update under the precondition of an If-Match header.
+
+    The update succeeds if the record is at the version of any of the listed entity tags: it
+    is tried with the first one, and again with the current version whenever the conflict
+    reports one that is listed too.
+
+    Raises:
+        VersionConflictError: If the record is at none of the listed versions
+    """
+    versions = _parse_if_match(if_match)
+    if versions is None:
+        return update(None)
+
+    expected = versions[0] if versions else -1
+    tried = set()
+    while True:
+        tried.add(expected)
+        try:
+            return update(expected)
+        except VersionConflictError as e:
+            if e.current_version not in versions or e.current_version in tried:
+                raise
+            expected = e.current_version
+
+
+def _precondition_failed(error: VersionConflictError) -> HTTPException:
+    """
+    Build the 412 response for a stale If-Match or a lost concurrent update.
+    """
+    return HTTPException(
+        status_code=412,
+        detail="Record was modified by another request",
+        headers={"ETag": _etag(error.current_version)},
+    )
+
+
+def _collection_etag(revision: int) -> str:
+    """
+    Build the ETag header value for a collection revision.
+
+    Collection ETags are weak: the order of the items is not guaranteed to be stable.
+    """
+    return f'W/"{revision}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check whether an If-None-Match header names the current ETag (weak comparison).
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    current = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == current:
+            return True
+    return False
+
+
+def _not_modified(etag: str) -> Response:
+    """
+    Build the 304 response telling the client its cached copy is still current.
+    """
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def _parse_fields(fields: str, model_class: Type[BaseModel]) -> List[str]:
+    """
+    Parse a ?fields= list of field names, rejecting names the model does not have.
+    """
+    selected = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    known = model_field_names(model_class)
+    unknown = [name for name in selected if name not in known]
+    if not selected or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(unknown)}" if unknown else "No fields selected",
+        )
+    return selected
+
+
+def _projection_response(model_class: Type[BaseModel], fields: List[str], content: Any, etag: str) -> Response:
+    """
+    Build the response for a ?fields= projection, serialized with a model of just those fields.
+    """
+    return Response(
+        content=dump_projection(model_class, tuple(fields), content),
+        media_type="application/json",
+        headers={"ETag": etag},
+    )
+
+
+def _list_query(model_class: Type[BaseModel]):
+    """
+    Build the dependency parsing the filter, sort, offset and limit parameters of a list route.
+
+    The dependency returns None if none of them is given.
+    """
+    def dependency(
+        filter_: Optional[str] = Query(
+            None, alias="filter", description="Conditions, e.g. stage:proposal|negotiation,amount>=1000"
+        ),
+        sort: Optional[str] = Query(None, description="Field to sort by, prefixed with - for descending order"),
+        offset: int = Query(0, ge=0, description="Number of matching records to skip"),
+        limit: Optional[int] = Query(None, ge=1, description="Maximum number of records to return"),
+    ) -> Optional[ListQuery]:
+        if filter_ is None and sort is None and offset == 0 and limit is None:
+            return None
+        try:
+            return parse_query(model_class, filter_, sort, offset, limit)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    return dependency
+
+
+def _query_headers(request: Request, result: QueryResult) -> Dict[str, str]:
+    """
+    Build the headers of a filtered list response: the number of matches and, if the app
+    reports them, the query plan.
+    """
+    headers = {"X-Total-Count": str(result.total)}
+    if request.app.state.query_plan:
+        headers["X-Query-Plan"] = json.dumps(result.plan)
+    return headers
+
+
+def _duplicates_header(matches: List[DuplicateMatch]) -> str:
+    """
+    Build the X-Possible-Duplicates header of a create response: 'id;score=0.93, ...'.
+    """
+    return ", ".join(f"{match.id};score={match.score:.2f}" for match in matches)
+
+
+@router.get("/", response_class=HTMLResponse)
+async def dashboard_page(request: Request):
+    """
+    Render the dashboard shell; its cards are loaded from /api/dashboard/cards and kept
+    up to date by /dashboard/events.
+    """
+    return templates.TemplateResponse(request, "dashboard.html", {})
+
+
+def _dashboard_etag(revisions: Dict[str, int], *variant: str) -> str:
+    """
+    Build the ETag of dashboard data computed from collections at the given revisions.
+    """
+    return f'W/"{"-".join([*variant, *(str(revision) for revision in revisions.values())])}"'
+
+
+@router.get("/api/dashboard/stats")
+def get_dashboard_stats(if_none_match: Optional[str] = Header(None)):
+    """
+    Get the data of every dashboard card. Answers 304 if no customer or opportunity
+    changed since the ETag sent in If-None-Match.
+    """
+    # Read the revisions and the data from the same replica, so the ETag is never newer than the data
+    with redis_manager.consistent_reads():
+        revisions = dashboard.get_revisions()
+        etag = _dashboard_etag(revisions, "stats")
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        stats = dashboard.get_stats(revisions)
+    return JSONResponse(stats, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+@router.get("/api/dashboard/cards/{card}")
+def get_dashboard_card(
+    request: Request,
+    card: str,
+    format: str = Query("json", description="json, or html for the rendered card"),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Get the data of one dashboard card, or with ?format=html its HTML fragment.
+
+    A card's ETag only depends on the collections it shows, so e.g. the customers card
+    stays cached while opportunities change.
+    """
+    if card not in dashboard.CARDS:
+        raise HTTPException(status_code=404, detail="Card not found")
+    if format not in ("json", "html"):
+        raise HTTPException(status_code=400, detail="format must be json or html")
+
+    with redis_manager.consistent_reads():
+        revisions = dashboard.get_revisions()
+        etag = _dashboard_etag({model_type: revisions[model_type] for model_type in dashboard.CARDS[card]}, card, format)
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        data = dashboard.get_stats(revisions)[card]
 
-    # Calculate win rate
-    closed_opportunities = [opp for opp in all_opportunities if opp.stage in [OpportunityStage.CLOSED_WON, OpportunityStage.CLOSED_LOST]]
-    won_opportunities = [opp for opp in all_opportunities if opp.stage == OpportunityStage.CLOSED_WON]
-    win_rate = round((len(won_opportunities) / len(closed_opportunities) * 100) if closed_opportunities else 0)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if format == "html":
+        return templates.TemplateResponse(request, f"cards/{card}.html", {"card": data}, headers=headers)
+    return JSONResponse(data, headers=headers)
+
+
+@router.get("/dashboard/events", include_in_schema=False)
+async def dashboard_events(request: Request):
+    """
+    Stream the dashboard aggregates as server-sent events: a snapshot, then a delta per
+    batch of customer and opportunity changes (see service.dashboard).
+    """
+    queue = dashboard_feed.subscribe()
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(queue.get(), 15)
+                except asyncio.TimeoutError:
+                    # Keep proxies from closing the idle connection
+                    yield ": keepalive\n\n"
+        finally:
+            dashboard_feed.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/analytics/forecast", response_model=Forecast)
+def get_forecast():
+    """
+    Get the weighted pipeline (amount x probability) by stage, expected close month and
+    customer status.
+    """
+    from service import analytics
 
-    # Calculate opportunity stage data
-    opportunity_stage_data = defaultdict(lambda: {"count": 0, "value": 0})
-    for opp in all_opportunities:
-        opportunity_stage_data[opp.stage]["count"] += 1
-        opportunity_stage_data[opp.stage]["value"] += opp.amount or 0
+    return analytics.get_forecast()
 
-    # Format opportunity stage data for display
-    for stage, data in opportunity_stage_data.items():
-        data["value"] = round(data["value"], 2)
 
-    # Prepare data for pie charts
-    opportunity_stage_labels = [stage.value.replace('_', ' ').capitalize() for stage in OpportunityStage]
-    opportunity_stage_counts = [opportunity_stage_data[stage]["count"] for stage in OpportunityStage]
+@router.get("/sync", response_model=SyncResponse)
+def sync_changes(
+    since: Optional[str] = Query(None, description="The cursor returned by the previous sync"),
+    limit: int = Query(1000, ge=1, le=10000, description="Maximum number of changes per collection")
+):
+    """
+    Get the customers, opportunities and activities changed since the cursor of the
+    previous sync, with tombstones of the deleted ones.
 
-    customer_status_labels = [status.value.capitalize() for status in CustomerStatus]
-    customer_status_counts_list = [customer_status_counts[status] for status in CustomerStatus]
+    Without a cursor (or if it can no longer be continued) all records are returned with
+    reset set. If has_more is set, sync again right away with the returned cursor.
+    """
+    try:
+        return sync.sync(since, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # Get recent customers and opportunities
-    recent_customers = sorted(all_customers, key=lambda x: x.id)[:5]  # In a real app, sort by creation date
-    recent_opportunities = sorted(all_opportunities, key=lambda x: x.id)[:5]  # In a real app, sort by creation date
 
-    return templates.TemplateResponse("dashboard.html", {
-        "request": request,
-        "total_customers": total_customers,
-        "total_opportunities": total_opportunities,
-        "total_opportunity_value": round(total_opportunity_value, 2),
-        "win_rate": win_rate,
-        "customer_status_counts": dict(customer_status_counts),
-        "opportunity_stage_data": dict(opportunity_stage_data),
-        "opportunity_stage_labels": opportunity_stage_labels,
-        "opportunity_stage_counts": opportunity_stage_counts,
-        "customer_status_labels": customer_status_labels,
-        "customer_status_counts_list": customer_status_counts_list,
-        "recent_customers": recent_customers,
-        "recent_opportunities": recent_opportunities
-    })
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """
+    Get the metrics of this worker in the Prometheus text format.
+    """
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
 
 
-@app.get("/hello/{name}")
+@router.get("/hello/{name}")
 async def say_hello(name: str):
     return {"message": f"Hello {name}"}
 
 
-@app.get("/contacts", response_model=List[Contact])
-async def list_contacts():
+@router.get("/contacts", response_model=List[Contact])
+def list_contacts(
+    request: Request,
+    response: Response,
+    fields: Optional[str] = Query(None, description="Comma separated fields to return, e.g. id,name,email"),
+    query: Optional[ListQuery] = Depends(_list_query(Contact)),
+    if_none_match: Optional[str] = Header(None)
+):
     """
     Get all contacts.
-    """
-    return contacts.get_contacts()
-
 
-@app.get("/contacts/{contact_id}", response_model=Contact)
-async def get_contact(contact_id: UUID):
+    With ?filter=, ?sort=, ?offset= and ?limit=, only the matching page is returned (see
+    service.query). With ?fields=, only those fields are read and returned. Answers 304
+    if the contacts did not change since the ETag sent in If-None-Match.
+    """
+    selected = _parse_fields(fields, Contact) if fields is not None else None
+    # Read the revision and the list from the same replica, so the ETag is never newer than the list
+    with redis_manager.consistent_reads():
+        etag = _collection_etag(contacts.get_revision())
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        if query is not None:
+            result = contacts.find_contacts(query, selected)
+            headers = _query_headers(request, result)
+            if selected is not None:
+                projection = _projection_response(Contact, selected, result.items, etag)
+                projection.headers.update(headers)
+                return projection
+            response.headers.update(headers)
+            response.headers["ETag"] = etag
+            return result.items
+        if selected is not None:
+            return _projection_response(Contact, selected, contacts.get_contacts_projection(selected), etag)
+        response.headers["ETag"] = etag
+        return contacts.get_contacts()
+
+
+@router.get("/contacts/{contact_id}", response_model=Contact)
+async def get_contact(
+    contact_id: UUID,
+    response: Response,
+    fields: Optional[str] = Query(None, description="Comma separated fields to return, e.g. id,name,email"),
+    if_none_match: Optional[str] = Header(None)
+):
     """
     Get a specific contact by ID.
+
+    With ?fields=, only those fields are read and returned. Answers 304 without loading
+    the contact if it is still at the version of the ETag sent in If-None-Match.
     """
+    selected = _parse_fields(fields, Contact) if fields is not None else None
+    if if_none_match is not None:
+        version = contacts.get_contact_version(contact_id)
+        if version is not None and _etag_matches(if_none_match, _etag(version)):
+            return _not_modified(_etag(version))
+
+    if selected is not None:
+        projection = contacts.get_contact_projection(contact_id, selected + ["version"])
+        if projection is None:
+            raise HTTPException(status_code=404, detail="Contact not found")
+        etag = _etag(projection["version"] or 0)
+        if "version" not in selected:
+            del projection["version"]
+        return _projection_response(Contact, selected, projection, etag)
+
     contact = contacts.get_contact(contact_id)
     if contact is None:
         raise HTTPException(status_code=404, detail="Contact not found")
+    response.headers["ETag"] = _etag(contact.version)
     return contact
 
 
-@app.post("/contacts", response_model=Contact, status_code=201)
-async def create_contact(contact: ContactCreate):
+@router.post("/contacts", response_model=Contact, status_code=201)
+async def create_contact(contact: ContactCreate, response: Response):
     """
     Create a new contact.
+
+    The contact is created either way; possible duplicates of it are listed in the
+    X-Possible-Duplicates header.
+    """
+    new_contact = contacts.create_contact(contact)
+    matches = contacts.find_possible_duplicates(new_contact)
+    if matches:
+        response.headers["X-Possible-Duplicates"] = _duplicates_header(matches)
+    return new_contact
+
+
+@router.post("/contacts/duplicates", response_model=List[DuplicateMatch])
+async def check_contact_duplicates(contact: ContactCreate):
     """
-    return contacts.create_contact(contact)
+    Get the stored contacts that are possible duplicates of a contact, without creating it.
+    """
+    return contacts.find_possible_duplicates(contact)
 
 
-@app.put("/contacts/{contact_id}", response_model=Contact)
-async def update_contact(contact_id: UUID, contact_update: ContactUpdate):
+@router.put("/contacts/{contact_id}", response_model=Contact)
+async def update_contact(
+    contact_id: UUID,
+    contact_update: ContactUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
     """
     Update an existing contact.
+
+    Send the ETag of the contact you edited in If-Match to get a 412 instead of overwriting
+    a concurrent change.
     """
-    updated_contact = contacts.update_contact(contact_id, contact_update)
+    try:
+        updated_contact = _update_if_match(
+            if_match, lambda version: contacts.update_contact(contact_id, contact_update, version)
+        )
+    except VersionConflictError as e:
+        raise _precondition_failed(e)
     if updated_contact is None:
         raise HTTPException(status_code=404, detail="Contact not found")
+    response.headers["ETag"] = _etag(updated_contact.version)
     return updated_contact
 
 
-@app.delete("/contacts/{contact_id}", status_code=204)
+@router.delete("/contacts/{contact_id}", status_code=204)
 async def delete_contact(contact_id: UUID):
     """
     Delete a contact.
@@ -144,76 +573,206 @@ async def delete_contact(contact_id: UUID):
 
 
 # Customer endpoints
-@app.get("/customers", response_model=List[Customer])
-async def list_customers():
+@router.get("/customers", response_model=List[Customer])
+def list_customers(
+    request: Request,
+    response: Response,
+    fields: Optional[str] = Query(None, description="Comma separated fields to return, e.g. id,name,email"),
+    query: Optional[ListQuery] = Depends(_list_query(Customer)),
+    if_none_match: Optional[str] = Header(None)
+):
     """
     Get all customers.
-    """
-    return customers.get_customers()
 
-
-@app.get("/customers/{customer_id}", response_model=Customer)
-async def get_customer(customer_id: UUID):
+    With ?filter=, ?sort=, ?offset= and ?limit=, only the matching page is returned (see
+    service.query). With ?fields=, only those fields are read and returned. Answers 304
+    if the customers did not change since the ETag sent in If-None-Match.
+    """
+    selected = _parse_fields(fields, Customer) if fields is not None else None
+    with redis_manager.consistent_reads():
+        etag = _collection_etag(customers.get_revision())
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        if query is not None:
+            result = customers.find_customers(query, selected)
+            headers = _query_headers(request, result)
+            if selected is not None:
+                projection = _projection_response(Customer, selected, result.items, etag)
+                projection.headers.update(headers)
+                return projection
+            response.headers.update(headers)
+            response.headers["ETag"] = etag
+            return result.items
+        if selected is not None:
+            return _projection_response(Customer, selected, customers.get_customers_projection(selected), etag)
+        response.headers["ETag"] = etag
+        return customers.get_customers()
+
+
+@router.get("/customers/{customer_id}", response_model=Customer)
+async def get_customer(
+    customer_id: UUID,
+    response: Response,
+    fields: Optional[str] = Query(None, description="Comma separated fields to return, e.g. id,name,email"),
+    if_none_match: Optional[str] = Header(None)
+):
     """
     Get a specific customer by ID.
+
+    With ?fields=, only those fields are read and returned. Answers 304 without loading
+    the customer if it is still at the version of the ETag sent in If-None-Match.
     """
+    selected = _parse_fields(fields, Customer) if fields is not None else None
+    if if_none_match is not None:
+        version = customers.get_customer_version(customer_id)
+        if version is not None and _etag_matches(if_none_match, _etag(version)):
+            return _not_modified(_etag(version))
+
+    if selected is not None:
+        projection = customers.get_customer_projection(customer_id, selected + ["version"])
+        if projection is None:
+            raise HTTPException(status_code=404, detail="Customer not found")
+        etag = _etag(projection["version"] or 0)
+        if "version" not in selected:
+            del projection["version"]
+        return _projection_response(Customer, selected, projection, etag)
+
     customer = customers.get_customer(customer_id)
     if customer is None:
         raise HTTPException(status_code=404, detail="Customer not found")
+    response.headers["ETag"] = _etag(customer.version)
     return customer
 
 
-@app.post("/customers", response_model=Customer, status_code=201)
-async def create_customer(customer: CustomerCreate):
+@router.get("/customers/{customer_id}/overview", response_model=CustomerOverview)
+async def get_customer_overview(customer_id: UUID):
+    """
+    Get a customer with its opportunities, activities, notes and rollup totals in one call.
+    """
+    overview = customers.get_customer_overview(customer_id)
+    if overview is None:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    return overview
+
+
+@router.post("/customers", response_model=Customer, status_code=201)
+async def create_customer(customer: CustomerCreate, response: Response):
     """
     Create a new customer.
+
+    The customer is created either way; possible duplicates of it are listed in the
+    X-Possible-Duplicates header.
     """
-    return customers.create_customer(customer)
+    new_customer = customers.create_customer(customer)
+    matches = customers.find_possible_duplicates(new_customer)
+    if matches:
+        response.headers["X-Possible-Duplicates"] = _duplicates_header(matches)
+    return new_customer
 
 
-@app.put("/customers/{customer_id}", response_model=Customer)
-async def update_customer(customer_id: UUID, customer_update: CustomerUpdate):
+@router.post("/customers/duplicates", response_model=List[DuplicateMatch])
+async def check_customer_duplicates(customer: CustomerCreate):
+    """
+    Get the stored customers that are possible duplicates of a customer, without creating it.
+    """
+    return customers.find_possible_duplicates(customer)
+
+
+@router.put("/customers/{customer_id}", response_model=Customer)
+async def update_customer(
+    customer_id: UUID,
+    customer_update: CustomerUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
     """
     Update an existing customer.
+
+    Send the ETag of the customer you edited in If-Match to get a 412 instead of overwriting
+    a concurrent change.
     """
-    updated_customer = customers.update_customer(customer_id, customer_update)
+    try:
+        updated_customer = _update_if_match(
+            if_match, lambda version: customers.update_customer(customer_id, customer_update, version)
+        )
+    except VersionConflictError as e:
+        raise _precondition_failed(e)
     if updated_customer is None:
         raise HTTPException(status_code=404, detail="Customer not found")
+    response.headers["ETag"] = _etag(updated_customer.version)
     return updated_customer
 
 
-@app.delete("/customers/{customer_id}", status_code=204)
-async def delete_customer(customer_id: UUID):
+@router.delete("/customers/{customer_id}", status_code=204)
+async def delete_customer(customer_id: UUID, cascade: bool = False):
     """
     Delete a customer.
+
+    With ?cascade=true, the customer's opportunities, activities and notes are deleted too.
     """
-    success = customers.delete_customer(customer_id)
+    success = customers.delete_customer(customer_id, cascade=cascade)
     if not success:
         raise HTTPException(status_code=404, detail="Customer not found")
     return None
 
 
 # Opportunity endpoints
-@app.get("/opportunities", response_model=List[Opportunity])
-async def list_opportunities():
+@router.get("/opportunities", response_model=List[Opportunity])
+def list_opportunities(
+    request: Request,
+    response: Response,
+    query: Optional[ListQuery] = Depends(_list_query(Opportunity)),
+    if_none_match: Optional[str] = Header(None)
+):
     """
     Get all opportunities.
+
+    With ?filter=, ?sort=, ?offset= and ?limit=, only the matching page is returned (see
+    service.query). Answers 304 if the opportunities did not change since the ETag sent
+    in If-None-Match.
+    """
+    with redis_manager.consistent_reads():
+        etag = _collection_etag(opportunities.get_revision())
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        response.headers["ETag"] = etag
+        if query is not None:
+            result = opportunities.find_opportunities(query)
+            response.headers.update(_query_headers(request, result))
+            return result.items
+        return opportunities.get_opportunities()
+
+
+@router.get("/opportunities/archive/rollups")
+async def get_archive_rollups():
+    """
+    Get the count and value of the archived opportunities per stage, and per stage and
+    month of closing (see service.archive).
     """
-    return opportunities.get_opportunities()
+    return archive.get_rollups()
 
 
-@app.get("/opportunities/{opportunity_id}", response_model=Opportunity)
-async def get_opportunity(opportunity_id: UUID):
+@router.get("/opportunities/{opportunity_id}", response_model=Opportunity)
+async def get_opportunity(opportunity_id: UUID, response: Response, if_none_match: Optional[str] = Header(None)):
     """
     Get a specific opportunity by ID.
+
+    Answers 304 without loading the opportunity if it is still at the version of the ETag
+    sent in If-None-Match.
     """
+    if if_none_match is not None:
+        version = opportunities.get_opportunity_version(opportunity_id)
+        if version is not None and _etag_matches(if_none_match, _etag(version)):
+            return _not_modified(_etag(version))
+
     opportunity = opportunities.get_opportunity(opportunity_id)
     if opportunity is None:
         raise HTTPException(status_code=404, detail="Opportunity not found")
+    response.headers["ETag"] = _etag(opportunity.version)
     return opportunity
 
 
-@app.get("/customers/{customer_id}/opportunities", response_model=List[Opportunity])
+@router.get("/customers/{customer_id}/opportunities", response_model=List[Opportunity])
 async def list_customer_opportunities(customer_id: UUID):
     """
     Get all opportunities for a specific customer.
@@ -224,37 +783,51 @@ async def list_customer_opportunities(customer_id: UUID):
     return opportunities.get_opportunities_by_customer(customer_id)
 
 
-@app.post("/opportunities", response_model=Opportunity, status_code=201)
+@router.post("/opportunities", response_model=Opportunity, status_code=201)
 async def create_opportunity(opportunity: OpportunityCreate):
     """
     Create a new opportunity.
     """
     # Verify that the customer exists
-    customer = customers.get_customer(opportunity.customer_id)
-    if customer is None:
+    if not customers.customer_exists(opportunity.customer_id):
         raise HTTPException(status_code=404, detail="Customer not found")
 
     return opportunities.create_opportunity(opportunity)
 
 
-@app.put("/opportunities/{opportunity_id}", response_model=Opportunity)
-async def update_opportunity(opportunity_id: UUID, opportunity_update: OpportunityUpdate):
+@router.put("/opportunities/{opportunity_id}", response_model=Opportunity)
+async def update_opportunity(
+    opportunity_id: UUID,
+    opportunity_update: OpportunityUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
     """
     Update an existing opportunity.
+
+    Send the ETag of the opportunity you edited in If-Match to get a 412 instead of overwriting
+    a concurrent change. Archived opportunities are read-only (409).
     """
     # If customer_id is being updated, verify that the customer exists
     if opportunity_update.customer_id is not None:
-        customer = customers.get_customer(opportunity_update.customer_id)
-        if customer is None:
+        if not customers.customer_exists(opportunity_update.customer_id):
             raise HTTPException(status_code=404, detail="Customer not found")
 
-    updated_opportunity = opportunities.update_opportunity(opportunity_id, opportunity_update)
+    try:
+        updated_opportunity = _update_if_match(
+            if_match, lambda version: opportunities.update_opportunity(opportunity_id, opportunity_update, version)
+        )
+    except VersionConflictError as e:
+        raise _precondition_failed(e)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if updated_opportunity is None:
         raise HTTPException(status_code=404, detail="Opportunity not found")
+    response.headers["ETag"] = _etag(updated_opportunity.version)
     return updated_opportunity
 
 
-@app.delete("/opportunities/{opportunity_id}", status_code=204)
+@router.delete("/opportunities/{opportunity_id}", status_code=204)
 async def delete_opportunity(opportunity_id: UUID):
     """
     Delete an opportunity.
@@ -266,26 +839,27 @@ async def delete_opportunity(opportunity_id: UUID):
 
 
 # Activity endpoints
-@app.get("/activities", response_model=List[Activity])
-async def list_activities():
+@router.get("/activities", response_model=List[Activity])
+def list_activities():
     """
     Get all activities.
     """
     return activities.get_activities()
 
 
-@app.get("/activities/{activity_id}", response_model=Activity)
-async def get_activity(activity_id: UUID):
+@router.get("/activities/{activity_id}", response_model=Activity)
+async def get_activity(activity_id: UUID, response: Response):
     """
     Get a specific activity by ID.
     """
     activity = activities.get_activity(activity_id)
     if activity is None:
         raise HTTPException(status_code=404, detail="Activity not found")
+    response.headers["ETag"] = _etag(activity.version)
     return activity
 
 
-@app.get("/customers/{customer_id}/activities", response_model=List[Activity])
+@router.get("/customers/{customer_id}/activities", response_model=List[Activity])
 async def list_customer_activities(customer_id: UUID):
     """
     Get all activities for a specific customer.
@@ -296,7 +870,7 @@ async def list_customer_activities(customer_id: UUID):
     return activities.get_activities_by_customer(customer_id)
 
 
-@app.get("/opportunities/{opportunity_id}/activities", response_model=List[Activity])
+@router.get("/opportunities/{opportunity_id}/activities", response_model=List[Activity])
 async def list_opportunity_activities(opportunity_id: UUID):
     """
     Get all activities for a specific opportunity.
@@ -307,50 +881,76 @@ async def list_opportunity_activities(opportunity_id: UUID):
     return activities.get_activities_by_opportunity(opportunity_id)
 
 
-@app.post("/activities", response_model=Activity, status_code=201)
-async def create_activity(activity: ActivityCreate):
+@router.post("/activities", response_model=Activity, status_code=201)
+async def create_activity(activity: ActivityCreate, response: Response):
     """
     Create a new activity.
-    """
+
+    With write-behind enabled (ACTIVITY_WRITE_BEHIND), the activity is queued and the
+    response is 202 Accepted: it is stored shortly after, unless its customer or
+    opportunity does not exist. A full queue answers 503 with Retry-After.
+    """
+    if activities.activity_writes is not None:
+        try:
+            new_activity = activities.create_activity(activity)
+        except QueueFullError:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many activities waiting to be stored",
+                headers={"Retry-After": "1"},
+            )
+        response.status_code = 202
+        return new_activity
+
     # Verify that the customer exists if customer_id is provided
     if activity.customer_id is not None:
-        customer = customers.get_customer(activity.customer_id)
-        if customer is None:
+        if not customers.customer_exists(activity.customer_id):
             raise HTTPException(status_code=404, detail="Customer not found")
 
     # Verify that the opportunity exists if opportunity_id is provided
     if activity.opportunity_id is not None:
-        opportunity = opportunities.get_opportunity(activity.opportunity_id)
-        if opportunity is None:
+        if not opportunities.opportunity_exists(activity.opportunity_id):
             raise HTTPException(status_code=404, detail="Opportunity not found")
 
     return activities.create_activity(activity)
 
 
-@app.put("/activities/{activity_id}", response_model=Activity)
-async def update_activity(activity_id: UUID, activity_update: ActivityUpdate):
+@router.put("/activities/{activity_id}", response_model=Activity)
+async def update_activity(
+    activity_id: UUID,
+    activity_update: ActivityUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
     """
     Update an existing activity.
+
+    Send the ETag of the activity you edited in If-Match to get a 412 instead of overwriting
+    a concurrent change.
     """
     # If customer_id is being updated, verify that the customer exists
     if activity_update.customer_id is not None:
-        customer = customers.get_customer(activity_update.customer_id)
-        if customer is None:
+        if not customers.customer_exists(activity_update.customer_id):
             raise HTTPException(status_code=404, detail="Customer not found")
 
     # If opportunity_id is being updated, verify that the opportunity exists
     if activity_update.opportunity_id is not None:
-        opportunity = opportunities.get_opportunity(activity_update.opportunity_id)
-        if opportunity is None:
+        if not opportunities.opportunity_exists(activity_update.opportunity_id):
             raise HTTPException(status_code=404, detail="Opportunity not found")
 
-    updated_activity = activities.update_activity(activity_id, activity_update)
+    try:
+        updated_activity = _update_if_match(
+            if_match, lambda version: activities.update_activity(activity_id, activity_update, version)
+        )
+    except VersionConflictError as e:
+        raise _precondition_failed(e)
     if updated_activity is None:
         raise HTTPException(status_code=404, detail="Activity not found")
+    response.headers["ETag"] = _etag(updated_activity.version)
     return updated_activity
 
 
-@app.delete("/activities/{activity_id}", status_code=204)
+@router.delete("/activities/{activity_id}", status_code=204)
 async def delete_activity(activity_id: UUID):
     """
     Delete an activity.
@@ -362,26 +962,27 @@ async def delete_activity(activity_id: UUID):
 
 
 # Note endpoints
-@app.get("/notes", response_model=List[Note])
-async def list_notes():
+@router.get("/notes", response_model=List[Note])
+def list_notes():
     """
     Get all notes.
     """
     return notes.get_notes()
 
 
-@app.get("/notes/{note_id}", response_model=Note)
-async def get_note(note_id: UUID):
+@router.get("/notes/{note_id}", response_model=Note)
+async def get_note(note_id: UUID, response: Response):
     """
     Get a specific note by ID.
     """
     note = notes.get_note(note_id)
     if note is None:
         raise HTTPException(status_code=404, detail="Note not found")
+    response.headers["ETag"] = _etag(note.version)
     return note
 
 
-@app.get("/customers/{customer_id}/notes", response_model=List[Note])
+@router.get("/customers/{customer_id}/notes", response_model=List[Note])
 async def list_customer_notes(customer_id: UUID):
     """
     Get all notes for a specific customer.
@@ -392,7 +993,7 @@ async def list_customer_notes(customer_id: UUID):
     return notes.get_notes_by_customer(customer_id)
 
 
-@app.get("/opportunities/{opportunity_id}/notes", response_model=List[Note])
+@router.get("/opportunities/{opportunity_id}/notes", response_model=List[Note])
 async def list_opportunity_notes(opportunity_id: UUID):
     """
     Get all notes for a specific opportunity.
@@ -403,7 +1004,7 @@ async def list_opportunity_notes(opportunity_id: UUID):
     return notes.get_notes_by_opportunity(opportunity_id)
 
 
-@app.get("/activities/{activity_id}/notes", response_model=List[Note])
+@router.get("/activities/{activity_id}/notes", response_model=List[Note])
 async def list_activity_notes(activity_id: UUID):
     """
     Get all notes for a specific activity.
@@ -414,21 +1015,19 @@ async def list_activity_notes(activity_id: UUID):
     return notes.get_notes_by_activity(activity_id)
 
 
-@app.post("/notes", response_model=Note, status_code=201)
+@router.post("/notes", response_model=Note, status_code=201)
 async def create_note(note: NoteCreate):
     """
     Create a new note.
     """
     # Verify that the customer exists if customer_id is provided
     if note.customer_id is not None:
-        customer = customers.get_customer(note.customer_id)
-        if customer is None:
+        if not customers.customer_exists(note.customer_id):
             raise HTTPException(status_code=404, detail="Customer not found")
 
     # Verify that the opportunity exists if opportunity_id is provided
     if note.opportunity_id is not None:
-        opportunity = opportunities.get_opportunity(note.opportunity_id)
-        if opportunity is None:
+        if not opportunities.opportunity_exists(note.opportunity_id):
             raise HTTPException(status_code=404, detail="Opportunity not found")
 
     # Verify that the activity exists if activity_id is provided
@@ -440,21 +1039,27 @@ async def create_note(note: NoteCreate):
     return notes.create_note(note)
 
 
-@app.put("/notes/{note_id}", response_model=Note)
-async def update_note(note_id: UUID, note_update: NoteUpdate):
+@router.put("/notes/{note_id}", response_model=Note)
+async def update_note(
+    note_id: UUID,
+    note_update: NoteUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
     """
     Update an existing note.
+
+    Send the ETag of the note you edited in If-Match to get a 412 instead of overwriting
+    a concurrent change.
     """
     # If customer_id is being updated, verify that the customer exists
     if note_update.customer_id is not None:
-        customer = customers.get_customer(note_update.customer_id)
-        if customer is None:
+        if not customers.customer_exists(note_update.customer_id):
             raise HTTPException(status_code=404, detail="Customer not found")
 
     # If opportunity_id is being updated, verify that the opportunity exists
     if note_update.opportunity_id is not None:
-        opportunity = opportunities.get_opportunity(note_update.opportunity_id)
-        if opportunity is None:
+        if not opportunities.opportunity_exists(note_update.opportunity_id):
             raise HTTPException(status_code=404, detail="Opportunity not found")
 
     # If activity_id is being updated, verify that the activity exists
@@ -463,13 +1068,17 @@ async def update_note(note_id: UUID, note_update: NoteUpdate):
         if activity is None:
             raise HTTPException(status_code=404, detail="Activity not found")
 
-    updated_note = notes.update_note(note_id, note_update)
+    try:
+        updated_note = _update_if_match(if_match, lambda version: notes.update_note(note_id, note_update, version))
+    except VersionConflictError as e:
+        raise _precondition_failed(e)
     if updated_note is None:
         raise HTTPException(status_code=404, detail="Note not found")
+    response.headers["ETag"] = _etag(updated_note.version)
     return updated_note
 
 
-@app.delete("/notes/{note_id}", status_code=204)
+@router.delete("/notes/{note_id}", status_code=204)
 async def delete_note(note_id: UUID):
     """
     Delete a note.
@@ -481,26 +1090,27 @@ async def delete_note(note_id: UUID):
 
 
 # User endpoints
-@app.get("/users", response_model=List[User])
-async def list_users():
+@router.get("/users", response_model=List[User])
+def list_users():
     """
     Get all users.
     """
     return users.get_users()
 
 
-@app.get("/users/{user_id}", response_model=User)
-async def get_user(user_id: UUID):
+@router.get("/users/{user_id}", response_model=User)
+async def get_user(user_id: UUID, response: Response):
     """
     Get a specific user by ID.
     """
     user = users.get_user(user_id)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
+    response.headers["ETag"] = _etag(user.version)
     return user
 
 
-@app.get("/users/by-username/{username}", response_model=User)
+@router.get("/users/by-username/{username}", response_model=User)
 async def get_user_by_username(username: str):
     """
     Get a user by username.
@@ -511,7 +1121,7 @@ async def get_user_by_username(username: str):
     return user
 
 
-@app.post("/users", response_model=User, status_code=201)
+@router.post("/users", response_model=User, status_code=201)
 async def create_user(user: UserCreate):
     """
     Create a new user.
@@ -522,21 +1132,32 @@ async def create_user(user: UserCreate):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.put("/users/{user_id}", response_model=User)
-async def update_user(user_id: UUID, user_update: UserUpdate):
+@router.put("/users/{user_id}", response_model=User)
+async def update_user(
+    user_id: UUID,
+    user_update: UserUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
     """
     Update an existing user.
+
+    Send the ETag of the user you edited in If-Match to get a 412 instead of overwriting
+    a concurrent change.
     """
     try:
-        updated_user = users.update_user(user_id, user_update)
+        updated_user = _update_if_match(if_match, lambda version: users.update_user(user_id, user_update, version))
         if updated_user is None:
             raise HTTPException(status_code=404, detail="User not found")
+        response.headers["ETag"] = _etag(updated_user.version)
         return updated_user
+    except VersionConflictError as e:
+        raise _precondition_failed(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.delete("/users/{user_id}", status_code=204)
+@router.delete("/users/{user_id}", status_code=204)
 async def delete_user(user_id: UUID):
     """
     Delete a user.
@@ -547,7 +1168,7 @@ async def delete_user(user_id: UUID):
     return None
 
 
-@app.post("/login")
+@router.post("/login")
 async def login(username: str, password: str):
     """
     Authenticate a user.
@@ -560,3 +1181,6 @@ async def login(username: str, password: str):
             headers={"WWW-Authenticate": "Bearer"},
         )
     return {"message": "Login successful", "user": user}
+
+
+app = create_app()
@@ -0,0 +1,51 @@
+import argparse
+
+from service.customers import CUSTOMER_MODEL_TYPE
+from service.contacts import MODEL_TYPE as CONTACT_MODEL_TYPE
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.memory_report import get_node_memory, measure_model, node_capacity
+from service.redis_manager import redis_manager
+
+
+def main():
+    """
+    Report the bytes per record of every model type, as stored now and in the compact encoding
+    """
+    parser = argparse.ArgumentParser(description="Report the Redis memory footprint per record")
+    parser.add_argument("--sample", type=int, default=200, help="Records measured per model type")
+    parser.add_argument(
+        "--models",
+        default=",".join((CUSTOMER_MODEL_TYPE, OPPORTUNITY_MODEL_TYPE, CONTACT_MODEL_TYPE)),
+        help="Comma separated model types",
+    )
+    parser.add_argument(
+        "--node-memory-mb",
+        type=float,
+        help="Memory of a Redis node for records, in MiB (default: maxmemory of the node)",
+    )
+    args = parser.parse_args()
+
+    encoding = "compact" if redis_manager.codec.compact else "json"
+    print(f"Current encoding: {encoding} (compression: {redis_manager.codec.compression}, "
+          f"from {redis_manager.codec.compress_min_size} bytes)")
+    print(f"{'model':>12} {'records':>9} {'sampled':>8} {'value B':>9} {'compact B':>10} {'meta B':>8} {'per record':>11} {'compact':>9} {'saved':>7}")
+
+    usages = []
+    for model_type in args.models.split(","):
+        usage = measure_model(redis_manager, model_type.strip(), args.sample)
+        usages.append(usage)
+        saved = 1 - usage.compact_record_bytes / usage.record_bytes if usage.record_bytes else 0.0
+        print(f"{usage.model_type:>12} {usage.records:>9} {usage.sampled:>8} {usage.value_bytes:>9.0f} "
+              f"{usage.compact_bytes:>10.0f} {usage.meta_bytes:>8.0f} {usage.record_bytes:>11.0f} "
+              f"{usage.compact_record_bytes:>9.0f} {saved:>7.1%}")
+
+    node_memory = int(args.node_memory_mb * 1024 * 1024) if args.node_memory_mb else get_node_memory(redis_manager)
+    if node_memory is None:
+        print("The node has no maxmemory limit: pass --node-memory-mb for a capacity estimate")
+        return
+    capacity = node_capacity(usages, node_memory)
+    print(f"Records per node ({node_memory / 1024 / 1024:.0f} MiB, current mix of models): "
+          f"{capacity['records']:,} now, {capacity['compact_records']:,} compact ({capacity['increase']:+.1%})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+"""
+ASGI middleware for content negotiation of API responses and admission control.
+
+- MsgPackMiddleware re-encodes JSON responses as MessagePack for clients that prefer
+  ``application/msgpack`` in their Accept header.
+- CompressionMiddleware compresses responses above a size threshold with brotli or gzip,
+  whichever the client's Accept-Encoding header prefers.
+- AdmissionControlMiddleware limits the concurrent requests per route class (e.g. full
+  scans) and sheds the excess with 503, so expensive routes cannot starve cheap ones.
+
+All work on the ASGI messages of any route, so handlers keep returning plain models.
+The representations they encode get their own ETags: MsgPackMiddleware appends "-msgpack"
+and CompressionMiddleware "-br" or "-gzip" to the handler's ETag. Both strip their suffix
+from If-None-Match and If-Match before the handler compares them, and put it back on the
+ETag of a 304 answering a tag that had it.
+"""
+import abc
+import asyncio
+import json
+import re
+import time
+import zlib
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from service.metrics import registry
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # without msgpack, responses stay JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+# Responses that must reach the client unbuffered
+STREAMING_MEDIA_TYPES = ("text/event-stream",)
+
+# Route classes of admission control as (route class, methods, path pattern); the first
+# matching rule wins and requests matching none are not limited
+ROUTE_CLASSES: List[Tuple[str, Tuple[str, ...], str]] = [
+    # The dashboard data and whole-collection reads
+    ("scan", ("GET", "HEAD"), r"^/api/dashboard/.+$"),
+    ("scan", ("GET", "HEAD"), r"^/(contacts|customers|opportunities|activities|notes|users)$"),
+    ("scan", ("GET", "HEAD"), r"^/(sync|analytics/.+)$"),
+    # Single records and the records of one parent
+    ("point", ("GET", "HEAD"), r"^/(contacts|customers|opportunities|activities|notes|users)/[^/]+(/[^/]+)?$"),
+    ("write", ("POST", "PUT", "PATCH", "DELETE"), r"^/(contacts|customers|opportunities|activities|notes|users|login)(/.*)?$"),
+]
+
+# Default limits of admission control: {route class: (max concurrent, max queued)}
+DEFAULT_ADMISSION_LIMITS = {"scan": (4, 16)}
+
+_in_flight = registry.gauge("admission_in_flight", "Requests being handled per route class", ("route_class",))
+_queued = registry.gauge("admission_queued", "Requests waiting for admission per route class", ("route_class",))
+_concurrency_limit = registry.gauge("admission_concurrency_limit", "Maximum concurrent requests per route class", ("route_class",))
+_queue_limit = registry.gauge("admission_queue_limit", "Maximum waiting requests per route class", ("route_class",))
+_rejected = registry.counter(
+    "admission_rejected_total", "Requests shed with 503 per route class and reason", ("route_class", "reason")
+)
+_queue_seconds = registry.histogram("admission_queue_seconds", "Time admitted requests waited in the queue", ("route_class",))
+_request_seconds = registry.histogram("http_request_duration_seconds", "Request handling time per route class", ("route_class",))
+
+
+def parse_quality_list(header: str) -> Dict[str, float]:
+    """
+    Parse an Accept or Accept-Encoding header into {token: quality}.
+    """
+    qualities = {}
+    for item in header.split(","):
+        token, *params = [part.strip() for part in item.split(";")]
+        if not token:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[token.lower()] = max(quality, qualities.get(token.lower(), 0.0))
+    return qualities
+
+
+def choose_encoding(accept_encoding: str, available: List[str]) -> Optional[str]:
+    """
+    Choose the content coding the client prefers among the available ones (in server
+    preference order for ties), or None if it accepts none of them.
+    """
+    qualities = parse_quality_list(accept_encoding)
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def prefers_msgpack(accept: str) -> bool:
+    """
+    Check whether an Accept header asks for MessagePack rather than JSON.
+    """
+    qualities = parse_quality_list(accept)
+    msgpack_quality = max(qualities.get(media_type, 0.0) for media_type in MSGPACK_MEDIA_TYPES)
+    json_quality = qualities.get("application/json", 0.0)
+    return msgpack_quality > 0 and msgpack_quality >= json_quality
+
+
+def tag_etag(headers: MutableHeaders, suffix: str) -> None:
+    """
+    Make the ETag of a response specific to a representation by appending a suffix to it.
+    """
+    etag = headers.get("etag")
+    if etag is not None and etag.endswith('"'):
+        headers["etag"] = f'{etag[:-1]}-{suffix}"'
+
+
+def untag_preconditions(scope: Scope, suffix: str) -> Tuple[Scope, bool]:
+    """
+    Remove a representation suffix (see tag_etag) from the entity tags of the If-None-Match
+    and If-Match headers of a request.
+
+    Returns:
+        The request scope with the untagged headers, and whether If-None-Match had the suffix
+    """
+    tagged = f'-{suffix}"'.encode()
+    headers = []
+    revalidating = False
+    for name, value in scope["headers"]:
+        if name in (b"if-none-match", b"if-match"):
+            revalidating = revalidating or (name == b"if-none-match" and tagged in value)
+            value = value.replace(tagged, b'"')
+        headers.append((name, value))
+    return dict(scope, headers=headers), revalidating
+
+
+def parse_admission_limits(value: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Parse admission limits written as ``class=concurrent:queued`` pairs separated by commas,
+    e.g. ``scan=4:16,point=64:256`` (the queue length defaults to 0).
+
+    Raises:
+        ValueError: If the syntax is invalid
+    """
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, limit = item.partition("=")
+        concurrent, _, queued = limit.partition(":")
+        try:
+            limits[name.strip()] = (int(concurrent), int(queued or 0))
+        except ValueError:
+            raise ValueError(f"Invalid admission limit: {item.strip()}")
+        if not name.strip() or min(limits[name.strip()]) < 0:
+            raise ValueError(f"Invalid admission limit: {item.strip()}")
+    return limits
+
+
+class ConcurrencyLimiter:
+    """
+    Admit at most max_concurrent requests at a time; up to max_queued more wait (in
+    arrival order, for at most queue_timeout seconds) for a slot, the rest are rejected.
+    """
+    def __init__(self, name: str, max_concurrent: int, max_queued: int = 0, queue_timeout: float = 1.0):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        _in_flight.set_function(lambda: self.active, route_class=name)
+        _queued.set_function(lambda: len(self._waiters), route_class=name)
+        _concurrency_limit.set(max_concurrent, route_class=name)
+        _queue_limit.set(max_queued, route_class=name)
+
+    async def acquire(self) -> Optional[str]:
+        """
+        Wait for a slot.
+
+        Returns:
+            None once admitted, or why the request was rejected: 'queue_full' or 'timeout'
+        """
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            return None
+        if len(self._waiters) >= self.max_queued:
+            return "queue_full"
+
+        start = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended: pass it on
+                self.release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return "timeout"
+        _queue_seconds.observe(time.perf_counter() - start, route_class=self.name)
+        return None
+
+    def release(self) -> None:
+        """
+        Free a slot, handing it over to the longest waiting request if there is one.
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionControlMiddleware:
+    """
+    Limit the concurrent requests of each route class and answer the excess at once with
+    503 and Retry-After, so that e.g. a few dashboard loads or full collection reads cannot
+    use up a worker that must keep serving point reads.
+
+    Admission runs on the event loop, so the limited routes must not block it: they are
+    plain def handlers, which FastAPI runs in its threadpool.
+
+    Args:
+        app: The ASGI application
+        limits: {route class: (max concurrent, max queued)}; other route classes are not limited
+        route_classes: Rules classifying requests (see ROUTE_CLASSES)
+        queue_timeout: Seconds a queued request waits for a slot before it is rejected
+        retry_after: The Retry-After seconds of rejected requests
+    """
+    def __init__(
+        self,
+        app: ASGIApp,
+        limits: Optional[Dict[str, Tuple[int, int]]] = None,
+        route_classes: Sequence[Tuple[str, Sequence[str], str]] = ROUTE_CLASSES,
+        queue_timeout: float = 1.0,
+        retry_after: int = 1
+    ):
+        self.app = app
+        self.retry_after = retry_after
+        self.route_classes = [(name, tuple(methods), re.compile(pattern)) for name, methods, pattern in route_classes]
+        self.limiters = {
+            name: ConcurrencyLimiter(name, max_concurrent, max_queued, queue_timeout)
+            for name, (max_concurrent, max_queued) in (DEFAULT_ADMISSION_LIMITS if limits is None else limits).items()
+        }
+
+    def classify(self, method: str, path: str) -> Optional[str]:
+        """
+        Get the route class of a request, or None if no rule matches.
+        """
+        for name, methods, pattern in self.route_classes:
+            if method in methods and pattern.match(path):
+                return name
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        route_class = self.classify(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = self.limiters.get(route_class)
+        if limiter is not None:
+            reason = await limiter.acquire()
+            if reason is not None:
+                _rejected.inc(route_class=route_class, reason=reason)
+                await self._reject(send, route_class)
+                return
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if limiter is not None:
+                limiter.release()
+            _request_seconds.observe(time.perf_counter() - start, route_class=route_class)
+
+    async def _reject(self, send: Send, route_class: str) -> None:
+        body = json.dumps({"detail": f"Too many concurrent {route_class} requests, retry later"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(self.retry_after).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+class MsgPackMiddleware:
+    """
+    Re-encode JSON responses as MessagePack when the client prefers it.
+
+    The response body is converted after the handler rendered it, so it works for every
+    route and JSON clients keep FastAPI's fast serialization path.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or msgpack is None or not prefers_msgpack(Headers(scope=scope).get("accept", "")):
+            await self.app(scope, receive, send)
+            return
+
+        scope, revalidating = untag_preconditions(scope, "msgpack")
+        start: Optional[Message] = None
+        body: List[bytes] = []
+
+        async def send_msgpack(message: Message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                if message["status"] == 304 and revalidating:
+                    tag_etag(MutableHeaders(scope=message), "msgpack")
+                elif Headers(raw=message["headers"]).get("content-type", "").startswith("application/json"):
+                    start = message
+                    return
+            elif start is not None and message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+                if message.get("more_body", False):
+                    return
+
+                if not any(body):
+                    # No content (e.g. 204 or HEAD): nothing to re-encode
+                    await send(start)
+                    await send(message)
+                    return
+
+                content = msgpack.packb(json.loads(b"".join(body)))
+                headers = MutableHeaders(scope=start)
+                headers["content-type"] = MSGPACK_MEDIA_TYPES[0]
+                headers["content-length"] = str(len(content))
+                headers.add_vary_header("Accept")
+                tag_etag(headers, "msgpack")
+                await send(start)
+                await send({"type": "http.response.body", "body": content})
+                return
+            await send(message)
+
+        await self.app(scope, receive, send_msgpack)
+
+
+class CompressionMiddleware:
+    """
+    Compress response bodies of at least minimum_size bytes with brotli or gzip.
+
+    Args:
+        app: The ASGI application
+        minimum_size: Smaller responses are sent uncompressed
+        gzip_level: The gzip compression level
+        brotli_quality: The brotli quality (0-11); mid levels compress about as fast as gzip
+    """
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = (["br"] if brotli is not None else []) + ["gzip"]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        encoding = None
+        if scope["type"] == "http":
+            encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        scope, revalidating = untag_preconditions(scope, encoding)
+        start: Optional[Message] = None
+        compressor = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                if message["status"] == 304:
+                    if revalidating:
+                        tag_etag(MutableHeaders(scope=message), encoding)
+                    await send(message)
+                elif "content-encoding" in headers or headers.get("content-type", "").startswith(STREAMING_MEDIA_TYPES):
+                    await send(message)
+                else:
+                    start = message
+                return
+
+            if start is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            headers = MutableHeaders(scope=start)
+
+            if compressor is None:
+                if not more_body and len(body) < self.minimum_size:
+                    # Small complete response: not worth compressing
+                    await send(start)
+                    await send(message)
+                    start = None
+                    return
+
+                compressor = self._compressor(encoding)
+                headers["content-encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                tag_etag(headers, encoding)
+                if not more_body:
+                    content = compressor.compress(body) + compressor.flush()
+                    headers["content-length"] = str(len(content))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": content})
+                    return
+
+                # Streaming response: the length is not known up front
+                del headers["content-length"]
+                await send(start)
+
+            content = compressor.compress(body)
+            if not more_body:
+                content += compressor.flush()
+            await send({"type": "http.response.body", "body": content, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+    def _compressor(self, encoding: str) -> "_Compressor":
+        if encoding == "br":
+            return _BrotliCompressor(self.brotli_quality)
+        return _GzipCompressor(self.gzip_level)
+
+
+class _Compressor(abc.ABC):
+    @abc.abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        """
+        Compress the next chunk, returning the compressed bytes ready so far.
+        """
+
+    @abc.abstractmethod
+    def flush(self) -> bytes:
+        """
+        Finish the stream, returning the remaining compressed bytes.
+        """
+
+
+class _GzipCompressor(_Compressor):
+    def __init__(self, level: int):
+        # wbits=31 writes the gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliCompressor(_Compressor):
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
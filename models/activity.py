@@ -47,6 +47,7 @@ class Activity(ActivityBase):
     id: UUID = Field(default_factory=uuid4)
     created_at: datetime = Field(default_factory=datetime.now)
     completed_at: Optional[datetime] = None
+    version: int = 0
     
     class Config:
         from_attributes = True
\ No newline at end of file
@@ -0,0 +1,19 @@
+from pydantic import BaseModel
+from typing import Dict, List
+
+
+class ForecastGroup(BaseModel):
+    key: str
+    count: int
+    amount: float
+    weighted_amount: float  # Sum of amount x probability
+    amount_percentiles: Dict[str, float] = {}
+
+
+class Forecast(BaseModel):
+    count: int
+    amount: float
+    weighted_amount: float
+    by_stage: List[ForecastGroup]
+    by_close_month: List[ForecastGroup]
+    by_customer_status: List[ForecastGroup]
@@ -20,6 +20,7 @@ class ContactUpdate(ContactBase):
 
 class Contact(ContactBase):
     id: UUID = Field(default_factory=uuid4)
+    version: int = 0
 
     class Config:
         from_attributes = True
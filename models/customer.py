@@ -33,6 +33,7 @@ class CustomerUpdate(CustomerBase):
 
 class Customer(CustomerBase):
     id: UUID = Field(default_factory=uuid4)
+    version: int = 0
     
     class Config:
         from_attributes = True
\ No newline at end of file
@@ -0,0 +1,14 @@
+from pydantic import BaseModel
+from typing import List
+
+
+class DuplicateMatch(BaseModel):
+    id: str
+    score: float  # 0-1, 1 for a certain duplicate
+    reasons: List[str] = []  # Matching signals: 'email', 'phone', 'name'
+
+
+class DuplicateCluster(BaseModel):
+    cluster_id: str  # Smallest member ID, stable across runs
+    score: float  # Lowest member score
+    members: List[DuplicateMatch]  # Score: best match of the member within the cluster
@@ -27,6 +27,7 @@ class Note(NoteBase):
     id: UUID = Field(default_factory=uuid4)
     created_at: datetime = Field(default_factory=datetime.now)
     updated_at: datetime = Field(default_factory=datetime.now)
+    version: int = 0
     
     class Config:
         from_attributes = True
\ No newline at end of file
@@ -0,0 +1,29 @@
+from pydantic import BaseModel
+from typing import Dict, List
+
+from models.activity import Activity
+from models.customer import Customer
+from models.note import Note
+from models.opportunity import Opportunity
+
+
+class CustomerRollup(BaseModel):
+    opportunity_count: int = 0
+    archived_opportunity_count: int = 0  # Counted in the totals, but not listed in opportunities
+    open_opportunity_count: int = 0
+    total_amount: float = 0
+    open_amount: float = 0
+    weighted_amount: float = 0  # Sum of amount x probability of the open opportunities
+    won_amount: float = 0
+    opportunities_by_stage: Dict[str, int] = {}
+    activity_count: int = 0
+    activities_by_status: Dict[str, int] = {}
+    note_count: int = 0
+
+
+class CustomerOverview(BaseModel):
+    customer: Customer
+    opportunities: List[Opportunity]
+    activities: List[Activity]
+    notes: List[Note]
+    rollup: CustomerRollup
@@ -0,0 +1,53 @@
+from functools import lru_cache
+from typing import Any, List, Optional, Sequence, Tuple, Type
+
+from pydantic import BaseModel, create_model
+
+
+def model_field_names(model_class: Type[BaseModel]) -> Sequence[str]:
+    """
+    Get the field names of a model.
+    """
+    # Handle both Pydantic v1 and v2
+    return list(getattr(model_class, 'model_fields', None) or model_class.__fields__)
+
+
+@lru_cache(maxsize=256)
+def projection_model(model_class: Type[BaseModel], fields: Tuple[str, ...]) -> Type[BaseModel]:
+    """
+    Build a model with only the given fields of model_class (once per field set).
+
+    The fields keep their types but are optional, so a projection of a record never fails
+    on a field that was not stored.
+    """
+    # Handle both Pydantic v1 and v2
+    model_fields = getattr(model_class, 'model_fields', None) or model_class.__fields__
+    definitions = {}
+    for name in fields:
+        field = model_fields[name]
+        annotation = field.annotation if hasattr(field, 'annotation') else field.outer_type_
+        definitions[name] = (Optional[annotation], None)
+    return create_model(f"{model_class.__name__}Projection", **definitions)
+
+
+def dump_projection(model_class: Type[BaseModel], fields: Tuple[str, ...], content: Any) -> bytes:
+    """
+    Validate and serialize one projected record (a dict) or a list of them to JSON.
+    """
+    projected = projection_model(model_class, fields)
+    # Handle both Pydantic v1 and v2
+    if hasattr(projected, 'model_validate'):
+        if isinstance(content, list):
+            adapter = _list_adapter(projected)
+            return adapter.dump_json(adapter.validate_python(content))
+        return projected.model_validate(content).model_dump_json().encode()
+    if isinstance(content, list):
+        return ("[" + ",".join(projected(**record).json() for record in content) + "]").encode()
+    return projected(**content).json().encode()
+
+
+@lru_cache(maxsize=256)
+def _list_adapter(projected: Type[BaseModel]) -> Any:
+    from pydantic import TypeAdapter
+
+    return TypeAdapter(List[projected])
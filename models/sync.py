@@ -0,0 +1,24 @@
+from pydantic import BaseModel
+from typing import List
+from uuid import UUID
+
+from models.activity import Activity
+from models.customer import Customer
+from models.opportunity import Opportunity
+
+
+class SyncTombstones(BaseModel):
+    customers: List[UUID] = []
+    opportunities: List[UUID] = []
+    activities: List[UUID] = []
+
+
+class SyncResponse(BaseModel):
+    cursor: str  # Pass as ?since= on the next sync
+    has_more: bool = False  # More changes follow: sync again with the new cursor right away
+    reset: bool = False  # The lists hold all records: replace the local copy instead of merging
+    customers: List[Customer] = []
+    opportunities: List[Opportunity] = []
+    activities: List[Activity] = []
+    deleted: SyncTombstones = SyncTombstones()
+    archived: SyncTombstones = SyncTombstones()  # Moved to the archive: still fetchable by ID, but no longer synced
@@ -38,6 +38,7 @@ class User(UserBase):
     id: UUID = Field(default_factory=uuid4)
     created_at: datetime = Field(default_factory=datetime.now)
     last_login: Optional[datetime] = None
+    version: int = 0
     
     class Config:
         from_attributes = True
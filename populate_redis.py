@@ -7,6 +7,7 @@ from models.customer import Customer, CustomerStatus
 from models.contact import Contact
 from models.opportunity import Opportunity, OpportunityStage
 from service.redis_manager import redis_manager
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
 
 # Initialize Faker for generating random data
 fake = Faker()
@@ -14,7 +15,6 @@ fake = Faker()
 # Model types for Redis keys
 CUSTOMER_MODEL_TYPE = "customer"
 CONTACT_MODEL_TYPE = "contact"
-OPPORTUNITY_MODEL_TYPE = "opportunity"
 
 def create_random_customers(count=10):
     """
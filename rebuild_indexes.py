@@ -0,0 +1,34 @@
+import argparse
+import sys
+
+from service import rebuild
+
+
+def main():
+    """
+    Check the collection sets, indexes and rollups of the stored records and repair them
+    """
+    parser = argparse.ArgumentParser(description="Rebuild the collection sets, indexes and rollups from the stored records")
+    parser.add_argument("--models", default=",".join(rebuild.MODELS), help="Comma separated model types to check")
+    parser.add_argument("--dry-run", action="store_true", help="Only report the problems; exits with status 1 if there are any")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Records or index entries per task and pipeline")
+    args = parser.parse_args()
+
+    consistent = True
+    for model_type in [model.strip() for model in args.models.split(",") if model.strip()]:
+        report = rebuild.rebuild_model(model_type, args.dry_run, args.workers, args.chunk_size)
+        consistent = consistent and report.consistent
+        status = "consistent" if report.consistent else f"{sum(report.issues.values())} problems"
+        print(f"{model_type}: {report.records} records, {status}")
+        for kind, count in report.issues.items():
+            if count:
+                print(f"{count:>10}  {rebuild.ISSUES[kind]}")
+        if not args.dry_run:
+            print(f"{report.repaired:>10}  repaired")
+
+    if args.dry_run and not consistent:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
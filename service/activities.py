@@ -1,18 +1,90 @@
-from typing import List, Optional, Dict
+import logging
+from typing import Iterable, List, NamedTuple, Optional, Dict, Set
 from uuid import UUID
 from datetime import datetime
+from collections import defaultdict
+
+from models.activity import Activity, ActivityCreate, ActivityUpdate, ActivityStatus, ActivityType
+from service.changes import ChangeLog, ChangeSet
+from service.compact_store import CompactStore
+from service.metrics import registry
+from service.redis_manager import VersionConflictError, redis_manager
+from service.write_behind import WriteBehindQueue
+
+logger = logging.getLogger(__name__)
+
+# Model type for the change stream
+ACTIVITY_MODEL_TYPE = "activity"
+
+
+class ActivityRecord(NamedTuple):
+    """
+    Compact in-memory representation of an Activity (see service.compact_store).
+    """
+    id: int
+    title: str
+    description: Optional[str]
+    activity_type: int
+    status: int
+    due_date: Optional[datetime]
+    customer_id: Optional[int]
+    opportunity_id: Optional[int]
+    assigned_to: Optional[str]
+    created_at: datetime
+    completed_at: Optional[datetime]
+    version: int
 
-from models.activity import Activity, ActivityCreate, ActivityUpdate, ActivityStatus
 
 # In-memory storage for activities
-activities_db: Dict[UUID, Activity] = {}
+activities_db: CompactStore[Activity, ActivityRecord] = CompactStore(
+    Activity,
+    ActivityRecord,
+    uuids=("id", "customer_id", "opportunity_id"),
+    enums={"activity_type": ActivityType, "status": ActivityStatus},
+    interned=("assigned_to",),
+)
+
+# Per-parent indexes: activity IDs by customer and by opportunity (as UUID integer values).
+# Read and written under activities_db.lock, like the records: the write-behind flush thread
+# stores activities while request handlers read them.
+activities_by_customer: Dict[int, Set[int]] = defaultdict(set)
+activities_by_opportunity: Dict[int, Set[int]] = defaultdict(set)
+
+# Order of changes for delta sync
+activities_changelog = ChangeLog()
+
+# Queue of create_activity while write-behind is enabled (see enable_write_behind)
+activity_writes: Optional[WriteBehindQueue[Activity]] = None
+_dropped = registry.counter("write_behind_dropped_total", "Queued items dropped when their batch was applied", ("queue",))
+
+
+def _index_activity(record: ActivityRecord) -> None:
+    """
+    Add an activity to the per-parent indexes.
+    """
+    if record.customer_id is not None:
+        activities_by_customer[record.customer_id].add(record.id)
+    if record.opportunity_id is not None:
+        activities_by_opportunity[record.opportunity_id].add(record.id)
+
+
+def _unindex_activity(record: ActivityRecord) -> None:
+    """
+    Remove an activity from the per-parent indexes.
+    """
+    for index, parent_id in ((activities_by_customer, record.customer_id),
+                             (activities_by_opportunity, record.opportunity_id)):
+        if parent_id is not None and parent_id in index:
+            index[parent_id].discard(record.id)
+            if not index[parent_id]:
+                del index[parent_id]
 
 
 def get_activities() -> List[Activity]:
     """
     Get all activities.
     """
-    return list(activities_db.values())
+    return activities_db.models()
 
 
 def get_activity(activity_id: UUID) -> Optional[Activity]:
@@ -22,57 +94,203 @@ def get_activity(activity_id: UUID) -> Optional[Activity]:
     return activities_db.get(activity_id)
 
 
+def get_activity_changes(since: Optional[List[int]], limit: int = 1000) -> ChangeSet:
+    """
+    Get the activities created, updated or deleted since a delta sync cursor (None for all).
+    """
+    # Changes are logged under the lock too, so every updated key is still stored
+    with activities_db.lock:
+        changes = activities_changelog.changes(since, limit) if since is not None else None
+        if changes is None:
+            return ChangeSet(activities_changelog.cursor(), activities_db.models(), [], reset=True)
+        cursor, updated, deleted, has_more = changes
+        records = [activities_db.record_by_key(key) for key in updated]
+    return ChangeSet(
+        cursor,
+        [activities_db.decode(record) for record in records],
+        [str(UUID(int=key)) for key in deleted],
+        has_more,
+    )
+
+
 def get_activities_by_customer(customer_id: UUID) -> List[Activity]:
     """
     Get all activities for a specific customer.
     """
-    return [act for act in activities_db.values() if act.customer_id == customer_id]
+    with activities_db.lock:
+        records = [activities_db.record_by_key(key) for key in activities_by_customer.get(customer_id.int, ())]
+    return [activities_db.decode(record) for record in records]
 
 
 def get_activities_by_opportunity(opportunity_id: UUID) -> List[Activity]:
     """
     Get all activities for a specific opportunity.
     """
-    return [act for act in activities_db.values() if act.opportunity_id == opportunity_id]
+    with activities_db.lock:
+        records = [activities_db.record_by_key(key) for key in activities_by_opportunity.get(opportunity_id.int, ())]
+    return [activities_db.decode(record) for record in records]
 
 
 def create_activity(activity: ActivityCreate) -> Activity:
     """
     Create a new activity.
+
+    While write-behind is enabled, the activity is only queued: it is stored by the next
+    batch flush, which drops it if its customer or opportunity does not exist.
+
+    Raises:
+        QueueFullError: If write-behind is enabled and its queue is full
     """
     # Handle both Pydantic v1 and v2
     activity_data = activity.model_dump() if hasattr(activity, 'model_dump') else activity.dict()
-    new_activity = Activity(**activity_data)
-    activities_db[new_activity.id] = new_activity
+    new_activity = Activity(**activity_data, version=1)
+    queue = activity_writes
+    if queue is not None:
+        queue.submit(new_activity)
+    else:
+        _store_activity(new_activity)
     return new_activity
 
 
-def update_activity(activity_id: UUID, activity_update: ActivityUpdate) -> Optional[Activity]:
+def _store_activity(activity: Activity) -> None:
     """
-    Update an existing activity.
+    Store a new activity and record its creation.
     """
-    if activity_id not in activities_db:
-        return None
+    with activities_db.lock:
+        _index_activity(activities_db.put(activity))
+        activities_changelog.updated(activity.id.int)
+    redis_manager.record_change(ACTIVITY_MODEL_TYPE, "create", activity.id, activity.version)
+
 
-    # Get the existing activity
-    activity = activities_db[activity_id]
+def _store_activities(batch: List[Activity]) -> None:
+    """
+    Store a batch of queued activities whose customer and opportunity exist.
+
+    The references of the whole batch are checked with one pipelined read per model type,
+    on the primary. Dropped activities are logged and counted in write_behind_dropped_total.
+    """
+    # Imported here: the customers service depends on this module
+    from service.customers import CUSTOMER_MODEL_TYPE
+    from service.opportunities import OPPORTUNITY_MODEL_TYPE
 
-    # Update only the fields that are provided
+    customer_ids = redis_manager.get_existing_ids(
+        CUSTOMER_MODEL_TYPE, {activity.customer_id for activity in batch if activity.customer_id is not None}
+    )
+    opportunity_ids = redis_manager.get_existing_ids(
+        OPPORTUNITY_MODEL_TYPE, {activity.opportunity_id for activity in batch if activity.opportunity_id is not None}
+    )
+    for activity in batch:
+        if activity.customer_id is not None and str(activity.customer_id) not in customer_ids:
+            logger.warning("Dropped queued activity %s: customer %s not found", activity.id, activity.customer_id)
+            _dropped.inc(queue=ACTIVITY_MODEL_TYPE)
+        elif activity.opportunity_id is not None and str(activity.opportunity_id) not in opportunity_ids:
+            logger.warning("Dropped queued activity %s: opportunity %s not found", activity.id, activity.opportunity_id)
+            _dropped.inc(queue=ACTIVITY_MODEL_TYPE)
+        elif activities_db.record(activity.id) is None:
+            # A recovered durable queue may repeat activities that were already stored
+            _store_activity(activity)
+
+
+def _encode_activity(activity: Activity) -> str:
+    # Handle both Pydantic v1 and v2
+    return activity.model_dump_json() if hasattr(activity, 'model_dump_json') else activity.json()
+
+
+def _decode_activity(value: str) -> Activity:
+    # Handle both Pydantic v1 and v2
+    return Activity.model_validate_json(value) if hasattr(Activity, 'model_validate_json') else Activity.parse_raw(value)
+
+
+def enable_write_behind(
+    durable_key: Optional[str] = None,
+    max_pending: int = 10000,
+    batch_size: int = 500,
+    flush_interval: float = 0.05
+) -> WriteBehindQueue[Activity]:
+    """
+    Make create_activity queue new activities and store them in batches from a background
+    thread (see service.write_behind).
+
+    Args:
+        durable_key: A Redis list that keeps queued activities across restarts (one per
+            process, see WriteBehindQueue; None keeps them in memory only)
+        max_pending: The maximum number of queued activities
+        batch_size: The number of queued activities that triggers a flush
+        flush_interval: The maximum number of seconds an activity stays queued
+
+    Returns:
+        The queue, already started (activities left in the durable list are requeued)
+
+    Raises:
+        QueueInUseError: If another process holds the durable list
+    """
+    global activity_writes
+    disable_write_behind()
+    queue = WriteBehindQueue(
+        ACTIVITY_MODEL_TYPE,
+        _store_activities,
+        _encode_activity,
+        _decode_activity,
+        manager=redis_manager,
+        durable_key=durable_key,
+        max_pending=max_pending,
+        batch_size=batch_size,
+        flush_interval=flush_interval,
+    )
+    recovered = queue.start()
+    if recovered:
+        logger.info("Requeued %d activities from %s", recovered, durable_key)
+    activity_writes = queue
+    return queue
+
+
+def disable_write_behind() -> None:
+    """
+    Store the queued activities and make create_activity write synchronously again.
+    """
+    global activity_writes
+    queue, activity_writes = activity_writes, None
+    if queue is not None:
+        queue.close()
+
+
+def update_activity(activity_id: UUID, activity_update: ActivityUpdate, expected_version: Optional[int] = None) -> Optional[Activity]:
+    """
+    Update an existing activity.
+
+    If expected_version is given, the update fails with VersionConflictError unless the
+    activity is still at that version.
+    """
     # Handle both Pydantic v1 and v2
     if hasattr(activity_update, 'model_dump'):
         update_data = activity_update.model_dump(exclude_unset=True)
     else:
         update_data = activity_update.dict(exclude_unset=True)
 
-    for field, value in update_data.items():
-        setattr(activity, field, value)
+    with activities_db.lock:
+        record = activities_db.record(activity_id)
+        if record is None:
+            return None
+
+        if expected_version is not None and record.version != expected_version:
+            raise VersionConflictError(ACTIVITY_MODEL_TYPE, activity_id, record.version)
+
+        # Get the existing activity and update only the fields that are provided
+        activity = activities_db.decode(record)
+        for field, value in update_data.items():
+            setattr(activity, field, value)
+
+        # If the activity is being marked as completed, set the completed_at timestamp
+        if activity.status == ActivityStatus.COMPLETED and not activity.completed_at:
+            activity.completed_at = datetime.now()
 
-    # If the activity is being marked as completed, set the completed_at timestamp
-    if activity.status == ActivityStatus.COMPLETED and not activity.completed_at:
-        activity.completed_at = datetime.now()
+        activity.version += 1
 
-    # Save the updated activity
-    activities_db[activity_id] = activity
+        # Save the updated activity
+        _unindex_activity(record)
+        _index_activity(activities_db.put(activity))
+        activities_changelog.updated(activity_id.int)
+    redis_manager.record_change(ACTIVITY_MODEL_TYPE, "update", activity_id, activity.version)
     return activity
 
 
@@ -80,8 +298,28 @@ def delete_activity(activity_id: UUID) -> bool:
     """
     Delete an activity.
     """
-    if activity_id not in activities_db:
-        return False
+    with activities_db.lock:
+        record = activities_db.pop(activity_id)
+        if record is None:
+            return False
+        _unindex_activity(record)
+        activities_changelog.deleted(record.id)
+    redis_manager.record_change(ACTIVITY_MODEL_TYPE, "delete", activity_id, record.version)
+    return True
 
-    del activities_db[activity_id]
-    return True
\ No newline at end of file
+
+def delete_activities_by_customer(customer_id: UUID, opportunity_ids: Iterable[UUID] = ()) -> List[UUID]:
+    """
+    Delete all activities of a customer or of any of the given opportunities.
+    """
+    with activities_db.lock:
+        deleted = set(activities_by_customer.get(customer_id.int, ()))
+        for opportunity_id in opportunity_ids:
+            deleted.update(activities_by_opportunity.get(opportunity_id.int, ()))
+        records = [activities_db.pop(UUID(int=key)) for key in deleted]
+        for record in records:
+            _unindex_activity(record)
+            activities_changelog.deleted(record.id)
+    for record in records:
+        redis_manager.record_change(ACTIVITY_MODEL_TYPE, "delete", UUID(int=record.id), record.version)
+    return [UUID(int=key) for key in deleted]
\ No newline at end of file
@@ -0,0 +1,158 @@
+from typing import Dict, List, NamedTuple, Sequence
+
+import numpy as np
+
+from models.analytics import Forecast, ForecastGroup
+from models.customer import CustomerStatus
+from models.opportunity import OpportunityStage
+from service.customers import CUSTOMER_MODEL_TYPE
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.snapshot import Snapshot, snapshot_store
+
+# Stage and status codes are the positions in these lists
+STAGES = list(OpportunityStage)
+STATUSES = list(CustomerStatus)
+
+# Code used for opportunities whose customer could not be found
+UNKNOWN_STATUS = len(STATUSES)
+
+# Percentiles of the opportunity amount reported per stage
+PERCENTILES = (25, 50, 75, 90)
+
+
+class OpportunityColumns(NamedTuple):
+    """
+    Column-oriented view of all opportunities, one array element per opportunity.
+    """
+    amount: np.ndarray           # float64, 0 where unset
+    probability: np.ndarray      # float64 in [0, 1], 0 where unset
+    stage: np.ndarray            # int8 index into STAGES
+    close_month: np.ndarray      # datetime64[M], NaT where unset
+    customer_status: np.ndarray  # int8 index into STATUSES, UNKNOWN_STATUS if not found
+
+
+def load_opportunity_columns(snapshot: Snapshot) -> OpportunityColumns:
+    """
+    Load the forecast columns of all opportunities from a columnar snapshot.
+
+    The snapshot stores stages and statuses as codes into STAGES and STATUSES; customer
+    status is joined in through the shared string pool codes of the customer IDs.
+    """
+    customer_ids = snapshot.column(CUSTOMER_MODEL_TYPE, "id")
+    opportunity_customer_ids = snapshot.column(OPPORTUNITY_MODEL_TYPE, "customer_id")
+
+    # Status by string pool code; the extra last slot catches opportunities without a customer (-1)
+    pool_size = int(max(customer_ids.max(initial=-1), opportunity_customer_ids.max(initial=-1))) + 2
+    status_by_code = np.full(pool_size, UNKNOWN_STATUS, dtype=np.int8)
+    status_by_code[customer_ids] = snapshot.column(CUSTOMER_MODEL_TYPE, "status")
+    status_by_code[status_by_code < 0] = UNKNOWN_STATUS
+    status_by_code[-1] = UNKNOWN_STATUS
+
+    amount = snapshot.column(OPPORTUNITY_MODEL_TYPE, "amount")
+    probability = snapshot.column(OPPORTUNITY_MODEL_TYPE, "probability")
+    stage = snapshot.column(OPPORTUNITY_MODEL_TYPE, "stage")
+
+    return OpportunityColumns(
+        amount=np.nan_to_num(amount),
+        probability=np.nan_to_num(probability) / 100,
+        stage=np.where(stage < 0, STAGES.index(OpportunityStage.QUALIFICATION), stage).astype(np.int8),
+        close_month=snapshot.column(OPPORTUNITY_MODEL_TYPE, "expected_close_date").astype("datetime64[M]"),
+        customer_status=status_by_code[opportunity_customer_ids],
+    )
+
+
+def compute_forecast(columns: OpportunityColumns) -> Forecast:
+    """
+    Compute the weighted pipeline (amount x probability) by stage, close month and customer status.
+    """
+    weighted = columns.amount * columns.probability
+
+    by_stage = _group(
+        columns.stage, [stage.value for stage in STAGES], columns.amount, weighted, with_percentiles=True
+    )
+
+    has_month = ~np.isnat(columns.close_month)
+    months, month_codes = np.unique(columns.close_month[has_month], return_inverse=True)
+    by_close_month = _group(
+        month_codes, [str(month) for month in months], columns.amount[has_month], weighted[has_month]
+    )
+
+    by_customer_status = _group(
+        columns.customer_status, [status.value for status in STATUSES] + ["unknown"], columns.amount, weighted
+    )
+
+    return Forecast(
+        count=len(columns.amount),
+        amount=round(float(columns.amount.sum()), 2),
+        weighted_amount=round(float(weighted.sum()), 2),
+        by_stage=by_stage,
+        by_close_month=by_close_month,
+        by_customer_status=by_customer_status,
+    )
+
+
+def get_forecast() -> Forecast:
+    """
+    Get the pipeline forecast for all opportunities from the current reporting snapshot.
+    """
+    return compute_forecast(load_opportunity_columns(snapshot_store.current()))
+
+
+def _group(
+    codes: np.ndarray,
+    labels: Sequence[str],
+    amount: np.ndarray,
+    weighted: np.ndarray,
+    with_percentiles: bool = False
+) -> List[ForecastGroup]:
+    """
+    Sum the amounts per group code; groups without opportunities are left out.
+    """
+    codes = codes.astype(np.intp)
+    groups = len(labels)
+    counts = np.bincount(codes, minlength=groups)
+    amounts = np.bincount(codes, weights=amount, minlength=groups)
+    weighted_amounts = np.bincount(codes, weights=weighted, minlength=groups)
+    percentiles = _grouped_percentiles(codes, amount, counts, PERCENTILES) if with_percentiles else {}
+
+    return [
+        ForecastGroup(
+            key=labels[code],
+            count=int(counts[code]),
+            amount=round(float(amounts[code]), 2),
+            weighted_amount=round(float(weighted_amounts[code]), 2),
+            amount_percentiles={f"p{q}": round(float(values[code]), 2) for q, values in percentiles.items()},
+        )
+        for code in np.flatnonzero(counts)
+    ]
+
+
+def _grouped_percentiles(
+    codes: np.ndarray,
+    values: np.ndarray,
+    counts: np.ndarray,
+    percentiles: Sequence[int]
+) -> Dict[int, np.ndarray]:
+    """
+    Compute percentiles of values for every group at once.
+
+    Values are sorted by (group, value) once; each percentile is then a linear interpolation
+    between two positions inside every group's slice, like numpy.percentile's default method.
+    """
+    if len(values) == 0:
+        return {q: np.zeros(len(counts)) for q in percentiles}
+
+    sorted_values = values[np.lexsort((values, codes))]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    last = len(sorted_values) - 1
+
+    result = {}
+    for q in percentiles:
+        position = starts + np.maximum(counts - 1, 0) * (q / 100)
+        low = np.floor(position).astype(np.intp)
+        high = np.ceil(position).astype(np.intp)
+        fraction = position - low
+        low, high = np.clip(low, 0, last), np.clip(high, 0, last)
+        interpolated = sorted_values[low] * (1 - fraction) + sorted_values[high] * fraction
+        result[q] = np.where(counts > 0, interpolated, 0.0)
+    return result
@@ -0,0 +1,236 @@
+"""
+Hot/cold tiering of opportunities.
+
+Closed opportunities (closed_won and closed_lost) that have not changed for a while are
+moved out of the opportunity collection into its archive, a hash of compressed records per
+shard (see RedisManager.archive). The collection and its indexes, and with them every
+get_all, query, sync and dashboard read, then hold only the open pipeline and recently
+closed deals. Archived opportunities
+
+- stay fetchable by ID: opportunities.get_opportunity falls back to the archive,
+- are counted in rollups per stage and per stage and month of closing, which the move
+  updates in the same script, and which the dashboard adds to its aggregates so that
+  stage totals and the win rate stay historical,
+- are read-only, but can be deleted (also by a customer cascade).
+
+A record is compressed with a preset dictionary of the field names and values every
+opportunity repeats, which make up most of a small JSON document, and base64-encoded
+because the Redis connection decodes responses to strings. Rollup fields are named
+'count:<stage>' and 'value:<stage>', plus ':<YYYY-MM>' for the month of closing.
+
+archive_opportunities.py runs archive_closed_opportunities, e.g. nightly from cron.
+"""
+import base64
+import json
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from models.opportunity import Opportunity, OpportunityStage
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.redis_manager import redis_manager
+
+# Stages of opportunities that can be archived
+ARCHIVED_STAGES = (OpportunityStage.CLOSED_WON, OpportunityStage.CLOSED_LOST)
+
+# Days since the last change after which a closed opportunity is archived by default
+DEFAULT_MAX_AGE_DAYS = 90
+
+# Fields the archived records are indexed by
+ARCHIVE_INDEXES = ("customer_id",)
+
+# Prefix of the encoded records, naming the codec
+_CODEC = "z1:"
+
+# Preset compression dictionary: what every serialized opportunity repeats (the most
+# frequent strings last, where they are cheapest to reference)
+_DICTIONARY = (
+    '"description": null, "probability": null, "expected_close_date": null, '
+    '"stage": "closed_lost", "stage": "closed_won", "amount": .0, "version": '
+    '{"name": "", "customer_id": "-4-", "id": "-4-", "created_at": "T:.", "updated_at": "T:."}'
+).encode()
+
+
+def encode_record(record: Dict[str, Any]) -> str:
+    """
+    Encode a raw opportunity record for the archive.
+    """
+    compressor = zlib.compressobj(9, zdict=_DICTIONARY)
+    data = compressor.compress(json.dumps(record, separators=(",", ":")).encode()) + compressor.flush()
+    return _CODEC + base64.b64encode(data).decode()
+
+
+def decode_record(value: str) -> Dict[str, Any]:
+    """
+    Decode an archived opportunity record.
+
+    Raises:
+        ValueError: If the value was not encoded by encode_record
+    """
+    if not value.startswith(_CODEC):
+        raise ValueError(f"Unknown archive encoding: {value[:8]!r}")
+    decompressor = zlib.decompressobj(zdict=_DICTIONARY)
+    data = decompressor.decompress(base64.b64decode(value[len(_CODEC):])) + decompressor.flush()
+    return json.loads(data)
+
+
+def rollup_increments(record: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Get the contribution of a closed opportunity to the archive rollups.
+
+    The last change of a closed opportunity is taken as its closing date.
+    """
+    stage = record["stage"]
+    month = str(record["updated_at"])[:7]
+    amount = float(record.get("amount") or 0)
+    return {
+        f"count:{stage}": 1,
+        f"value:{stage}": amount,
+        f"count:{stage}:{month}": 1,
+        f"value:{stage}:{month}": amount,
+    }
+
+
+def _parse_time(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    # Records are stamped with naive local times; compare aware ones in local time too
+    return parsed.astimezone().replace(tzinfo=None) if parsed.tzinfo is not None else parsed
+
+
+def archive_closed_opportunities(
+    max_age_days: float = DEFAULT_MAX_AGE_DAYS,
+    now: Optional[datetime] = None,
+    batch_size: int = 500,
+    dry_run: bool = False
+) -> int:
+    """
+    Move closed opportunities that have not changed for max_age_days into the archive.
+
+    Candidates are read from the stage index in batches. Each move is compare-and-set on the
+    version that was read, so an opportunity that is reopened concurrently stays in the
+    collection; the next run picks it up if it is still due.
+
+    Args:
+        max_age_days: Days since the last change after which a closed opportunity is archived
+        now: The current time (default: now)
+        batch_size: The number of records read per round trip
+        dry_run: Only count the opportunities that would be archived
+
+    Returns:
+        The number of archived opportunities
+    """
+    cutoff = (now or datetime.now()) - timedelta(days=max_age_days)
+    archived = 0
+    for stage in ARCHIVED_STAGES:
+        ids = redis_manager.get_ids_by_field(OPPORTUNITY_MODEL_TYPE, "stage", stage)
+        for start in range(0, len(ids), batch_size):
+            records = redis_manager.get_many_raw(OPPORTUNITY_MODEL_TYPE, ids[start:start + batch_size])
+            for id, record in records.items():
+                if record.get("stage") != stage.value or _parse_time(record["updated_at"]) >= cutoff:
+                    continue
+                if dry_run:
+                    archived += 1
+                    continue
+                status = redis_manager.archive(
+                    OPPORTUNITY_MODEL_TYPE,
+                    id,
+                    int(record.get("version") or 0),
+                    encode_record(record),
+                    rollup_increments(record),
+                    {field: record.get(field) for field in ARCHIVE_INDEXES},
+                )
+                archived += status == 1
+    return archived
+
+
+def get_archived_opportunity(opportunity_id: UUID) -> Optional[Opportunity]:
+    """
+    Get an archived opportunity by ID.
+    """
+    value = redis_manager.get_archived(OPPORTUNITY_MODEL_TYPE, opportunity_id)
+    if value is None:
+        return None
+    return Opportunity(**decode_record(value))
+
+
+def get_archived_by_customer(customer_id: UUID) -> List[Opportunity]:
+    """
+    Get the archived opportunities of a customer.
+    """
+    ids = redis_manager.get_archived_ids(OPPORTUNITY_MODEL_TYPE, "customer_id", customer_id)
+    values = redis_manager.get_many_archived(OPPORTUNITY_MODEL_TYPE, ids)
+    return [Opportunity(**decode_record(value)) for value in values.values()]
+
+
+def is_archived(opportunity_id: UUID) -> bool:
+    """
+    Check whether an opportunity is archived.
+    """
+    return redis_manager.get_archived(OPPORTUNITY_MODEL_TYPE, opportunity_id) is not None
+
+
+def delete_archived_opportunity(opportunity_id: UUID) -> bool:
+    """
+    Delete an archived opportunity, removing it from the rollups.
+    """
+    value = redis_manager.get_archived(OPPORTUNITY_MODEL_TYPE, opportunity_id)
+    if value is None:
+        return False
+    record = decode_record(value)
+    return redis_manager.delete_archived(
+        OPPORTUNITY_MODEL_TYPE,
+        opportunity_id,
+        int(record.get("version") or 0),
+        rollup_increments(record),
+        {field: record.get(field) for field in ARCHIVE_INDEXES},
+    )
+
+
+def delete_archived_by_customer(customer_id: UUID) -> List[UUID]:
+    """
+    Delete all archived opportunities of a customer.
+
+    Returns:
+        The IDs of the deleted opportunities
+    """
+    ids = redis_manager.get_archived_ids(OPPORTUNITY_MODEL_TYPE, "customer_id", customer_id)
+    return [UUID(id) for id in ids if delete_archived_opportunity(UUID(id))]
+
+
+def group_rollups(rollups: Dict[str, float]) -> Dict[str, Any]:
+    """
+    Group raw rollup fields (see RedisManager.get_rollups) by stage and by month.
+
+    Returns:
+        {"count": n, "value": x, "stages": {stage: {"count", "value"}},
+        "months": {month: {stage: {"count", "value"}}}} with months in order
+    """
+    stages = {stage.value: {"count": 0, "value": 0.0} for stage in ARCHIVED_STAGES}
+    months: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for field, amount in rollups.items():
+        kind, stage, *month = field.split(":")
+        if month:
+            target = months.setdefault(month[0], {}).setdefault(stage, {"count": 0, "value": 0.0})
+        else:
+            target = stages.setdefault(stage, {"count": 0, "value": 0.0})
+        target[kind] = round(amount) if kind == "count" else round(amount, 2)
+
+    # Months whose records were all deleted again
+    months = {
+        month: totals for month, totals in sorted(months.items())
+        if any(stage["count"] for stage in totals.values())
+    }
+    return {
+        "count": sum(stage["count"] for stage in stages.values()),
+        "value": round(sum(stage["value"] for stage in stages.values()), 2),
+        "stages": stages,
+        "months": months,
+    }
+
+
+def get_rollups() -> Dict[str, Any]:
+    """
+    Get the rollups over all archived opportunities (see group_rollups).
+    """
+    return group_rollups(redis_manager.get_rollups(OPPORTUNITY_MODEL_TYPE))
@@ -0,0 +1,363 @@
+"""
+Change data capture: the change streams and their consumers.
+
+Every create, update and delete appends a compact event to the Redis Stream of its model
+type (``{model}:changes``; one stream per shard in cluster mode) with the fields:
+
+    op       'create', 'update', 'delete' or 'archive' (moved to the archive, see service.archive)
+    id       the record ID
+    version  the record version after the change (the last version for deletes)
+
+RedisManager appends the event in the same Lua script as the write, so a stream never
+misses a write nor shows one that failed. The in-memory services (activities, notes, users)
+cannot share a script with Redis: if RedisManager.capture_memory_changes is set, they queue
+their events in a ChangeBuffer, which appends them in write order shortly after the write.
+
+Consumers (search indexes, aggregates, caches) read the streams as members of a consumer
+group with ChangeConsumer: every group sees every change, and changes a crashed consumer
+did not acknowledge can be claimed by another one. The streams are capped at about
+RedisManager.change_stream_max_len entries; RedisManager.trim_changes also drops entries by
+age, but never ones a consumer group has not acknowledged yet.
+
+Delta sync (service.sync) does not replay the streams: it reads the records changed since a
+cursor from per-model indexes ordered by change (RedisManager.get_changes, and a ChangeLog
+for in-memory stores), so its cost depends on the number of changed records only.
+"""
+import logging
+import random
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Change(NamedTuple):
+    """
+    One change event read from a change stream.
+    """
+    model_type: str
+    op: str
+    id: str
+    version: int
+    stream: str
+    entry_id: str
+
+
+class ChangeSet(NamedTuple):
+    """
+    The records of a model type changed since a sync cursor.
+
+    cursor is the position to pass as since next time (one number per shard for Redis
+    models, [epoch, sequence] for in-memory stores). If reset is set, the cursor could not
+    be continued and updated holds all records: the client must replace its copy. archived
+    holds the IDs of records moved to the archive (see service.archive): no longer in the
+    collection, but still fetchable by ID.
+    """
+    cursor: List[int]
+    updated: List[Any]
+    deleted: List[str]
+    has_more: bool = False
+    reset: bool = False
+    archived: List[str] = []
+
+
+class ChangeLog:
+    """
+    Change order of an in-memory store for delta sync.
+
+    Records are kept in the order of their last change, each with its sequence number, and
+    deleted records leave a tombstone (at most max_tombstones, oldest dropped first). Finding
+    the changes since a sequence number walks back from the newest change, so it costs
+    time proportional to the number of changes.
+
+    The epoch identifies this process's store: cursors of an earlier process (whose data
+    is gone) force a full resync.
+
+    Args:
+        max_tombstones: The maximum number of tombstones kept
+    """
+    def __init__(self, max_tombstones: int = 100000):
+        self.max_tombstones = max_tombstones
+        self.epoch = random.getrandbits(31)
+        self.sequence = 0
+        self.horizon = 0
+        self._updated: "OrderedDict[int, int]" = OrderedDict()
+        self._deleted: "OrderedDict[int, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def updated(self, key: int) -> None:
+        """
+        Record that a record was created or updated.
+        """
+        with self._lock:
+            self.sequence += 1
+            self._deleted.pop(key, None)
+            self._updated.pop(key, None)
+            self._updated[key] = self.sequence
+
+    def deleted(self, key: int) -> None:
+        """
+        Record that a record was deleted.
+        """
+        with self._lock:
+            self.sequence += 1
+            self._updated.pop(key, None)
+            self._deleted.pop(key, None)
+            self._deleted[key] = self.sequence
+            while len(self._deleted) > self.max_tombstones:
+                _, self.horizon = self._deleted.popitem(last=False)
+
+    def cursor(self) -> List[int]:
+        """
+        Get the cursor of the current state.
+        """
+        return [self.epoch, self.sequence]
+
+    def changes(self, since: List[int], limit: int) -> Optional[Tuple[List[int], List[int], List[int], bool]]:
+        """
+        Get the keys changed after a cursor, oldest change first.
+
+        Args:
+            since: A cursor returned by cursor() or changes()
+            limit: The maximum number of changes
+
+        Returns:
+            The next cursor and the updated and deleted keys, and whether there are more
+            changes; None if the cursor cannot be continued (other epoch, or tombstones
+            after it were dropped)
+        """
+        with self._lock:
+            if len(since) != 2 or since[0] != self.epoch or not self.horizon <= since[1] <= self.sequence:
+                return None
+            changes = []
+            for entries, deleted in ((self._updated, False), (self._deleted, True)):
+                for key in reversed(entries):
+                    sequence = entries[key]
+                    if sequence <= since[1]:
+                        break
+                    changes.append((sequence, key, deleted))
+            cursor = self.sequence
+
+        changes.sort()
+        has_more = len(changes) > limit
+        if has_more:
+            changes = changes[:limit]
+            cursor = changes[-1][0]
+        updated = [key for _, key, deleted in changes if not deleted]
+        deleted = [key for _, key, deleted in changes if deleted]
+        return [self.epoch, cursor], updated, deleted, has_more
+
+
+class ChangeBuffer:
+    """
+    Append the change events of the in-memory services to the change streams.
+
+    Events are queued in write order and appended by a background thread in pipelined
+    batches, so in-memory writes never wait for Redis. If Redis is unavailable the events
+    stay queued (at most max_pending; the oldest are dropped beyond that) and are retried
+    with backoff; the outage is logged once when it starts and once when it ends.
+
+    Args:
+        manager: The RedisManager whose streams the events are appended to
+        max_pending: The maximum number of queued events
+        flush_interval: Seconds between flushes of the queue
+        batch_size: The maximum number of events per pipeline
+    """
+    def __init__(self, manager: Any, max_pending: int = 100000, flush_interval: float = 0.05, batch_size: int = 500):
+        self.manager = manager
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._pending: Deque[Tuple[str, str, str, int]] = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, model_type: str, op: str, id: Any, version: int) -> None:
+        """
+        Queue a change event; the flush thread is started on first use.
+        """
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append((model_type, op, str(id), version))
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="change-buffer", daemon=True)
+                self._thread.start()
+
+    def flush(self) -> int:
+        """
+        Append all queued events to their streams.
+
+        Returns:
+            The number of appended events
+
+        Raises:
+            redis.exceptions.RedisError: If Redis fails; the unsent events stay queued
+        """
+        flushed = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                if not batch:
+                    return flushed
+                try:
+                    pipe = self.manager.redis_client.pipeline(transaction=False)
+                    for model_type, op, id, version in batch:
+                        self.manager.append_change(pipe, model_type, op, id, version)
+                    pipe.execute()
+                except Exception:
+                    with self._lock:
+                        room = self.max_pending - len(self._pending)
+                        self.dropped += max(len(batch) - room, 0)
+                        self._pending.extendleft(reversed(batch[:max(room, 0)]))
+                    raise
+                flushed += len(batch)
+
+    def close(self) -> None:
+        """
+        Stop the flush thread after a last flush.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Could not flush %d change events", len(self._pending))
+
+    def _run(self) -> None:
+        delay = self.flush_interval
+        while not self._stop.wait(delay):
+            try:
+                self.flush()
+            except Exception:
+                # Back off while Redis is unavailable
+                if delay == self.flush_interval:
+                    logger.warning("Change event flush failed, retrying with backoff", exc_info=True)
+                delay = min(delay * 2, 5.0)
+                continue
+            if delay != self.flush_interval:
+                logger.info("Change event flush recovered (%d events dropped so far)", self.dropped)
+                delay = self.flush_interval
+
+
+class ChangeConsumer:
+    """
+    Read the change streams of some model types as a member of a consumer group.
+
+    Typical loop:
+
+        consumer = ChangeConsumer(redis_manager, "search-index", "worker-1", ["customer"])
+        consumer.create_group()
+        while True:
+            changes = consumer.read(count=100, block=5000)
+            apply(changes)
+            consumer.ack(changes)
+
+    Args:
+        manager: The RedisManager owning the streams
+        group: The consumer group name (one per kind of consumer, e.g. 'search-index')
+        consumer: The name of this consumer within the group
+        model_types: The model types to follow
+    """
+    def __init__(self, manager: Any, group: str, consumer: str, model_types: Iterable[str]):
+        self.manager = manager
+        self.group = group
+        self.consumer = consumer
+        self.streams: Dict[str, str] = {
+            key: model_type
+            for model_type in model_types
+            for key in manager._get_change_stream_keys(model_type)
+        }
+
+    def create_group(self, start_id: str = "$") -> None:
+        """
+        Create the consumer group on every stream if it does not exist yet.
+
+        Args:
+            start_id: '$' to only receive future changes, '0' to also read the retained history
+        """
+        import redis
+
+        client = self.manager.redis_client
+        for key in self.streams:
+            try:
+                client.xgroup_create(key, self.group, id=start_id, mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    def read(self, count: int = 100, block: Optional[int] = None) -> List[Change]:
+        """
+        Read changes that were not delivered to any consumer of the group yet.
+
+        Args:
+            count: The maximum number of changes per stream
+            block: Milliseconds to wait for changes if there are none (single instance only;
+                in cluster mode the streams live in different slots and are polled)
+
+        Returns:
+            The changes, in stream order per stream
+        """
+        client = self.manager.redis_client
+        if not self.manager.cluster:
+            response = client.xreadgroup(
+                self.group, self.consumer, {key: ">" for key in self.streams}, count=count, block=block
+            )
+        else:
+            response = []
+            for key in self.streams:
+                response.extend(client.xreadgroup(self.group, self.consumer, {key: ">"}, count=count) or [])
+        return [
+            change
+            for key, entries in response or []
+            for change in self._changes(key, entries)
+        ]
+
+    def claim(self, min_idle_time: int, count: int = 100) -> List[Change]:
+        """
+        Take over changes that other consumers of the group read but did not acknowledge
+        within min_idle_time milliseconds, e.g. because they crashed.
+
+        Args:
+            min_idle_time: Milliseconds since the change was delivered
+            count: The maximum number of changes per stream
+
+        Returns:
+            The claimed changes
+        """
+        client = self.manager.redis_client
+        changes = []
+        for key in self.streams:
+            _, entries, *_ = client.xautoclaim(key, self.group, self.consumer, min_idle_time, count=count)
+            changes.extend(self._changes(key, entries))
+        return changes
+
+    def ack(self, changes: Iterable[Change]) -> int:
+        """
+        Acknowledge processed changes, so they are not delivered again and can be trimmed.
+
+        Returns:
+            The number of acknowledged changes
+        """
+        by_stream: Dict[str, List[str]] = {}
+        for change in changes:
+            by_stream.setdefault(change.stream, []).append(change.entry_id)
+        client = self.manager.redis_client
+        return sum(client.xack(key, self.group, *entry_ids) for key, entry_ids in by_stream.items())
+
+    def _changes(self, key: str, entries: List[Tuple[str, Optional[Dict[str, str]]]]) -> List[Change]:
+        # Entries trimmed while pending come back without fields
+        return [
+            Change(self.streams[key], fields["op"], fields["id"], int(fields["version"]), key, entry_id)
+            for entry_id, fields in entries
+            if fields
+        ]
@@ -0,0 +1,186 @@
+"""
+Compact in-memory storage for Pydantic models.
+
+Keeping millions of Pydantic instances resident is expensive: every instance carries a
+__dict__, a fields-set and, for every UUID field, a UUID object wrapping an int. A
+CompactStore keeps each record as a plain tuple instead, with
+
+- UUIDs stored as their 128-bit integer value,
+- enum members stored as small integer codes (their position in the Enum), which CPython
+  shares between all records,
+- repeated short strings (e.g. user names) interned.
+
+Plain tuples holding only such atomic values are untracked by the cyclic garbage collector
+(tuple subclasses are not), so a large store adds no GC pressure. Records are read through
+a NamedTuple view of the tuple, and Pydantic models are only built when a record leaves the
+store, i.e. at the API boundary.
+
+Records are written and read from several threads (request handlers in the threadpool, the
+write-behind flush thread). The store's lock is reentrant, so a service can hold it across
+a store call and its own indexes of the records.
+"""
+import sys
+import threading
+from enum import Enum
+from typing import Any, Callable, Dict, Generic, Iterator, List, Optional, Sequence, Tuple, Type, TypeVar
+from uuid import UUID
+
+from pydantic import BaseModel
+
+M = TypeVar('M', bound=BaseModel)
+R = TypeVar('R', bound=tuple)
+
+
+def uuid_to_int(value: Optional[UUID]) -> Optional[int]:
+    """
+    Convert a UUID to its 128-bit integer value.
+    """
+    return None if value is None else value.int
+
+
+def int_to_uuid(value: Optional[int]) -> Optional[UUID]:
+    """
+    Convert a 128-bit integer back to a UUID.
+    """
+    return None if value is None else UUID(int=value)
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return None if value is None else sys.intern(value)
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+class CompactStore(Generic[M, R]):
+    """
+    A store of compact records keyed by the integer value of the record's UUID.
+
+    Args:
+        model_class: The Pydantic model class of the records
+        record_class: A NamedTuple class with the same field names as the model
+        uuids: Fields holding UUIDs
+        enums: Fields holding enum members, with their Enum class
+        interned: String fields whose values repeat a lot
+    """
+    def __init__(
+        self,
+        model_class: Type[M],
+        record_class: Type[R],
+        uuids: Sequence[str] = (),
+        enums: Optional[Dict[str, Type[Enum]]] = None,
+        interned: Sequence[str] = ()
+    ):
+        self.model_class = model_class
+        self.record_class = record_class
+        self._records: Dict[int, tuple] = {}
+        # Guards the records, and the indexes the owning service keeps of them
+        self.lock = threading.RLock()
+
+        enums = enums or {}
+        self._encoders: List[Tuple[str, Callable[[Any], Any]]] = []
+        self._decoders: List[Tuple[str, Callable[[Any], Any]]] = []
+        for name in record_class._fields:
+            if name in uuids:
+                encode, decode = uuid_to_int, int_to_uuid
+            elif name in enums:
+                encode, decode = self._enum_codec(enums[name])
+            elif name in interned:
+                encode, decode = _intern, _identity
+            else:
+                encode, decode = _identity, _identity
+            self._encoders.append((name, encode))
+            self._decoders.append((name, decode))
+
+        # Pydantic v2 uses model_construct, v1 uses construct; both skip validation
+        self._construct = getattr(model_class, 'model_construct', None) or model_class.construct
+
+    @staticmethod
+    def _enum_codec(enum_class: Type[Enum]) -> Tuple[Callable[[Any], Any], Callable[[Any], Any]]:
+        members = list(enum_class)
+        codes = {member: code for code, member in enumerate(members)}
+
+        def encode(value: Any) -> Optional[int]:
+            return None if value is None else codes[enum_class(value)]
+
+        def decode(code: Optional[int]) -> Any:
+            return None if code is None else members[code]
+
+        return encode, decode
+
+    def encode(self, model: M) -> R:
+        """
+        Convert a model into a compact record.
+        """
+        return self.record_class(*[encode(getattr(model, name)) for name, encode in self._encoders])
+
+    def decode(self, record: R) -> M:
+        """
+        Build the model of a compact record; the record is trusted, so it is not re-validated.
+        """
+        return self._construct(**{name: decode(value) for (name, decode), value in zip(self._decoders, record)})
+
+    def put(self, model: M) -> R:
+        """
+        Store a model, replacing any record with the same ID.
+        """
+        record = self.encode(model)
+        with self.lock:
+            self._records[record.id] = tuple(record)
+        return record
+
+    def get(self, id: UUID) -> Optional[M]:
+        """
+        Get the model of a record by ID.
+        """
+        values = self._records.get(id.int)
+        return None if values is None else self.decode(values)
+
+    def record(self, id: UUID) -> Optional[R]:
+        """
+        Get the compact record by ID without building a model.
+        """
+        return self._view(self._records.get(id.int))
+
+    def record_by_key(self, key: int) -> R:
+        """
+        Get a compact record by the integer value of its ID.
+        """
+        return self._view(self._records[key])
+
+    def pop(self, id: UUID) -> Optional[R]:
+        """
+        Remove a record by ID and return it.
+        """
+        with self.lock:
+            return self._view(self._records.pop(id.int, None))
+
+    def records(self) -> Iterator[R]:
+        """
+        Iterate over the compact records (as of the call).
+        """
+        with self.lock:
+            values = list(self._records.values())
+        return map(self._view, values)
+
+    def models(self) -> List[M]:
+        """
+        Build the models of all records.
+        """
+        with self.lock:
+            values = list(self._records.values())
+        return [self.decode(record) for record in values]
+
+    def _view(self, values: Optional[tuple]) -> Optional[R]:
+        return None if values is None else tuple.__new__(self.record_class, values)
+
+    def __contains__(self, id: UUID) -> bool:
+        return id.int in self._records
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[int]:
+        with self.lock:
+            return iter(list(self._records))
@@ -1,12 +1,18 @@
-from typing import List, Optional, Dict
+from typing import Any, List, Optional, Dict, Union
 from uuid import UUID
 
 from models.contact import Contact, ContactCreate, ContactUpdate
+from models.dedupe import DuplicateMatch
+from service import dedupe
+from service.query import Query, QueryResult
 from service.redis_manager import redis_manager
 
 # Model type for Redis keys
 MODEL_TYPE = "contact"
 
+# Field dictionary of the compact value encoding; append new fields at the end
+redis_manager.register_fields(MODEL_TYPE, ["id", "version", "name", "email", "phone", "address"])
+
 
 def get_contacts() -> List[Contact]:
     """
@@ -15,6 +21,13 @@ def get_contacts() -> List[Contact]:
     return redis_manager.get_all(MODEL_TYPE, Contact)
 
 
+def find_contacts(query: Query, fields: Optional[List[str]] = None) -> QueryResult:
+    """
+    Get the contacts (or only the given fields of them) matching a filter/sort query.
+    """
+    return redis_manager.find(MODEL_TYPE, Contact, query, fields)
+
+
 def get_contact(contact_id: UUID) -> Optional[Contact]:
     """
     Get a contact by ID.
@@ -22,6 +35,34 @@ def get_contact(contact_id: UUID) -> Optional[Contact]:
     return redis_manager.get(MODEL_TYPE, contact_id, Contact)
 
 
+def get_contacts_projection(fields: List[str]) -> List[Dict[str, Any]]:
+    """
+    Get only the given fields of all contacts.
+    """
+    return redis_manager.get_all_fields(MODEL_TYPE, fields)
+
+
+def get_contact_projection(contact_id: UUID, fields: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    Get only the given fields of a contact.
+    """
+    return redis_manager.get_fields(MODEL_TYPE, contact_id, fields)
+
+
+def get_contact_version(contact_id: UUID) -> Optional[int]:
+    """
+    Get the version of a contact without loading it (None if it does not exist).
+    """
+    return redis_manager.get_version(MODEL_TYPE, contact_id)
+
+
+def get_revision() -> int:
+    """
+    Get the change counter of all contacts.
+    """
+    return redis_manager.get_revision(MODEL_TYPE)
+
+
 def create_contact(contact: ContactCreate) -> Contact:
     """
     Create a new contact.
@@ -29,12 +70,24 @@ def create_contact(contact: ContactCreate) -> Contact:
     # Handle both Pydantic v1 and v2
     contact_data = contact.model_dump() if hasattr(contact, 'model_dump') else contact.dict()
     new_contact = Contact(**contact_data)
-    return redis_manager.create(MODEL_TYPE, new_contact)
+    created = redis_manager.create(MODEL_TYPE, new_contact)
+    dedupe.index_record(MODEL_TYPE, created)
+    return created
+
+
+def find_possible_duplicates(contact: Union[ContactCreate, Contact]) -> List[DuplicateMatch]:
+    """
+    Find the stored contacts that are possible duplicates of a contact (see service.dedupe).
+    """
+    return dedupe.find_duplicates(MODEL_TYPE, contact)
 
 
-def update_contact(contact_id: UUID, contact_update: ContactUpdate) -> Optional[Contact]:
+def update_contact(contact_id: UUID, contact_update: ContactUpdate, expected_version: Optional[int] = None) -> Optional[Contact]:
     """
     Update an existing contact.
+
+    If expected_version is given, the update fails with VersionConflictError unless the
+    contact is still at that version.
     """
     # Handle both Pydantic v1 and v2
     if hasattr(contact_update, 'model_dump'):
@@ -42,11 +95,17 @@ def update_contact(contact_id: UUID, contact_update: ContactUpdate) -> Optional[
     else:
         update_data = contact_update.dict(exclude_unset=True)
 
-    return redis_manager.update(MODEL_TYPE, contact_id, update_data, Contact)
+    updated = redis_manager.update(MODEL_TYPE, contact_id, update_data, Contact, expected_version)
+    if updated is not None:
+        dedupe.index_record(MODEL_TYPE, updated)
+    return updated
 
 
 def delete_contact(contact_id: UUID) -> bool:
     """
     Delete a contact.
     """
-    return redis_manager.delete(MODEL_TYPE, contact_id)
+    deleted = redis_manager.delete(MODEL_TYPE, contact_id)
+    if deleted:
+        dedupe.remove_record(MODEL_TYPE, contact_id)
+    return deleted
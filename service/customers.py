@@ -1,12 +1,29 @@
-from typing import List, Optional, Dict
+from typing import Any, List, Optional, Dict, Union
 from uuid import UUID
+from collections import Counter
 
 from models.customer import Customer, CustomerCreate, CustomerUpdate
+from models.dedupe import DuplicateMatch
+from models.opportunity import Opportunity, OpportunityStage
+from models.overview import CustomerOverview, CustomerRollup
+from service import activities, archive, dedupe, notes
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.changes import ChangeSet
+from service.query import Query, QueryResult
 from service.redis_manager import redis_manager
 
 # Model type for Redis keys
 CUSTOMER_MODEL_TYPE = "customer"
 
+# Index customers by status for filtering the customer list
+redis_manager.register_index(CUSTOMER_MODEL_TYPE, "status")
+
+# Field dictionary of the compact value encoding; append new fields at the end
+redis_manager.register_fields(CUSTOMER_MODEL_TYPE, [
+    "id", "version", "name", "email", "phone", "address", "company", "status", "source",
+    "notes"
+])
+
 
 def get_customers() -> List[Customer]:
     """
@@ -15,6 +32,13 @@ def get_customers() -> List[Customer]:
     return redis_manager.get_all(CUSTOMER_MODEL_TYPE, Customer)
 
 
+def find_customers(query: Query, fields: Optional[List[str]] = None) -> QueryResult:
+    """
+    Get the customers (or only the given fields of them) matching a filter/sort query.
+    """
+    return redis_manager.find(CUSTOMER_MODEL_TYPE, Customer, query, fields)
+
+
 def get_customer(customer_id: UUID) -> Optional[Customer]:
     """
     Get a customer by ID.
@@ -22,6 +46,48 @@ def get_customer(customer_id: UUID) -> Optional[Customer]:
     return redis_manager.get(CUSTOMER_MODEL_TYPE, customer_id, Customer)
 
 
+def customer_exists(customer_id: UUID) -> bool:
+    """
+    Check on the primary whether a customer exists, before storing a record that references it.
+    """
+    return bool(redis_manager.get_existing_ids(CUSTOMER_MODEL_TYPE, [customer_id]))
+
+
+def get_customers_projection(fields: List[str]) -> List[Dict[str, Any]]:
+    """
+    Get only the given fields of all customers.
+    """
+    return redis_manager.get_all_fields(CUSTOMER_MODEL_TYPE, fields)
+
+
+def get_customer_projection(customer_id: UUID, fields: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    Get only the given fields of a customer.
+    """
+    return redis_manager.get_fields(CUSTOMER_MODEL_TYPE, customer_id, fields)
+
+
+def get_customer_changes(since: Optional[List[int]], limit: int = 1000) -> ChangeSet:
+    """
+    Get the customers created, updated or deleted since a delta sync cursor (None for all).
+    """
+    return redis_manager.get_changes(CUSTOMER_MODEL_TYPE, Customer, since, limit)
+
+
+def get_customer_version(customer_id: UUID) -> Optional[int]:
+    """
+    Get the version of a customer without loading it (None if it does not exist).
+    """
+    return redis_manager.get_version(CUSTOMER_MODEL_TYPE, customer_id)
+
+
+def get_revision() -> int:
+    """
+    Get the change counter of all customers.
+    """
+    return redis_manager.get_revision(CUSTOMER_MODEL_TYPE)
+
+
 def create_customer(customer: CustomerCreate) -> Customer:
     """
     Create a new customer.
@@ -29,12 +95,24 @@ def create_customer(customer: CustomerCreate) -> Customer:
     # Handle both Pydantic v1 and v2
     customer_data = customer.model_dump() if hasattr(customer, 'model_dump') else customer.dict()
     new_customer = Customer(**customer_data)
-    return redis_manager.create(CUSTOMER_MODEL_TYPE, new_customer)
+    created = redis_manager.create(CUSTOMER_MODEL_TYPE, new_customer)
+    dedupe.index_record(CUSTOMER_MODEL_TYPE, created)
+    return created
+
+
+def find_possible_duplicates(customer: Union[CustomerCreate, Customer]) -> List[DuplicateMatch]:
+    """
+    Find the stored customers that are possible duplicates of a customer (see service.dedupe).
+    """
+    return dedupe.find_duplicates(CUSTOMER_MODEL_TYPE, customer)
 
 
-def update_customer(customer_id: UUID, customer_update: CustomerUpdate) -> Optional[Customer]:
+def update_customer(customer_id: UUID, customer_update: CustomerUpdate, expected_version: Optional[int] = None) -> Optional[Customer]:
     """
     Update an existing customer.
+
+    If expected_version is given, the update fails with VersionConflictError unless the
+    customer is still at that version.
     """
     # Handle both Pydantic v1 and v2
     if hasattr(customer_update, 'model_dump'):
@@ -42,11 +120,84 @@ def update_customer(customer_id: UUID, customer_update: CustomerUpdate) -> Optio
     else:
         update_data = customer_update.dict(exclude_unset=True)
 
-    return redis_manager.update(CUSTOMER_MODEL_TYPE, customer_id, update_data, Customer)
+    updated = redis_manager.update(CUSTOMER_MODEL_TYPE, customer_id, update_data, Customer, expected_version)
+    if updated is not None:
+        dedupe.index_record(CUSTOMER_MODEL_TYPE, updated)
+    return updated
 
 
-def delete_customer(customer_id: UUID) -> bool:
+def delete_customer(customer_id: UUID, cascade: bool = False) -> bool:
     """
     Delete a customer.
+
+    With cascade, the customer's opportunities are deleted server-side in bounded batches,
+    then its archived opportunities, followed by the activities and notes of the customer
+    and of those opportunities.
+    """
+    if not cascade:
+        deleted = redis_manager.delete(CUSTOMER_MODEL_TYPE, customer_id)
+        if deleted:
+            dedupe.remove_record(CUSTOMER_MODEL_TYPE, customer_id)
+        return deleted
+
+    deleted = redis_manager.delete_cascade(
+        CUSTOMER_MODEL_TYPE, customer_id, [(OPPORTUNITY_MODEL_TYPE, "customer_id")]
+    )
+    if deleted is None:
+        return False
+    dedupe.remove_record(CUSTOMER_MODEL_TYPE, customer_id)
+
+    opportunity_ids = [UUID(id) for id in deleted[OPPORTUNITY_MODEL_TYPE]]
+    opportunity_ids += archive.delete_archived_by_customer(customer_id)
+    activity_ids = activities.delete_activities_by_customer(customer_id, opportunity_ids)
+    notes.delete_notes_by_customer(customer_id, opportunity_ids, activity_ids)
+    return True
+
+
+def get_customer_overview(customer_id: UUID) -> Optional[CustomerOverview]:
     """
-    return redis_manager.delete(CUSTOMER_MODEL_TYPE, customer_id)
+    Get a customer with its opportunities, activities, notes and rollup totals.
+
+    The customer and its opportunities are read in one pipelined round trip through the
+    opportunity customer_id index; activities and notes come from their per-customer indexes.
+    Archived opportunities (see service.archive) are not listed, but count in the totals.
+    """
+    customer, related = redis_manager.get_with_dependents(
+        CUSTOMER_MODEL_TYPE, customer_id, Customer, [(OPPORTUNITY_MODEL_TYPE, "customer_id", Opportunity)]
+    )
+    if customer is None:
+        return None
+
+    customer_opportunities = related[OPPORTUNITY_MODEL_TYPE]
+    # Read after the collection, so an opportunity archived in between is found in both
+    hot_ids = {opp.id for opp in customer_opportunities}
+    archived = [opp for opp in archive.get_archived_by_customer(customer_id) if opp.id not in hot_ids]
+    customer_activities = activities.get_activities_by_customer(customer_id)
+    customer_notes = notes.get_notes_by_customer(customer_id)
+
+    rollup = CustomerRollup(
+        opportunity_count=len(customer_opportunities) + len(archived),
+        archived_opportunity_count=len(archived),
+        opportunities_by_stage=dict(Counter(opp.stage.value for opp in customer_opportunities + archived)),
+        activity_count=len(customer_activities),
+        activities_by_status=dict(Counter(act.status.value for act in customer_activities)),
+        note_count=len(customer_notes),
+    )
+    closed_stages = (OpportunityStage.CLOSED_WON, OpportunityStage.CLOSED_LOST)
+    for opp in customer_opportunities + archived:
+        amount = opp.amount or 0
+        rollup.total_amount += amount
+        if opp.stage == OpportunityStage.CLOSED_WON:
+            rollup.won_amount += amount
+        elif opp.stage not in closed_stages:
+            rollup.open_opportunity_count += 1
+            rollup.open_amount += amount
+            rollup.weighted_amount += amount * (opp.probability or 0) / 100
+
+    return CustomerOverview(
+        customer=customer,
+        opportunities=customer_opportunities,
+        activities=customer_activities,
+        notes=customer_notes,
+        rollup=rollup,
+    )
\ No newline at end of file
@@ -0,0 +1,457 @@
+"""
+Live dashboard aggregates, pushed to open dashboards as server-sent events.
+
+Each worker runs one DashboardFeed: a single background thread follows the customer and
+opportunity change streams (service.changes) and keeps the dashboard aggregates (customers
+per status, opportunities and their value per stage) up to date. Every batch of changes
+becomes one delta, encoded once and fanned out to all connected clients:
+
+    event: snapshot
+    data: {"seq": 41, "customers": {"total": 12, "status": {"lead": 5, ...}},
+           "opportunities": {"total": 7, "value": 81000.0, "stages": {"proposal": {"count": 2, "value": 30000.0}, ...}}}
+
+    event: delta
+    data: {"seq": 42, "customers": {"total": 1, "status": {"lead": 1}},
+           "opportunities": {"total": 0, "value": 500.0, "stages": {"proposal": {"count": -1, "value": -2000.0}, ...}}}
+
+A client first receives a snapshot and then adds up the deltas, skipping deltas whose seq
+is not above the seq of the last snapshot (they are already included). A client that falls
+too far behind gets a new snapshot instead of the deltas it missed.
+
+Change events only carry record IDs, so the feed reads the changed records once per batch
+and keeps each record's last contribution (status, or stage and amount) to compute the
+difference. The feed runs while at least one client is connected and rebuilds its
+aggregates from a full read when it starts.
+
+Archived opportunities (service.archive) are counted from the archive rollups: the feed
+reads them again whenever a batch archives or deletes opportunities, so archiving a record
+moves its contribution from the record to the rollups without a visible change.
+
+The page itself is a static shell that loads its cards separately (GET /api/dashboard/stats
+and /api/dashboard/cards/{card}). get_stats computes all cards in one pass over the raw
+records and keeps the result until the customer or opportunity revision changes, so
+concurrent card requests and unchanged reloads do not read the collections again.
+"""
+import asyncio
+import json
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from models.customer import CustomerStatus
+from models.opportunity import OpportunityStage
+from service import archive
+from service.customers import CUSTOMER_MODEL_TYPE
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.redis_manager import redis_manager
+
+
+# The dashboard cards and the model types each one is computed from
+CARDS: Dict[str, Tuple[str, ...]] = {
+    "summary": (CUSTOMER_MODEL_TYPE, OPPORTUNITY_MODEL_TYPE),
+    "customers": (CUSTOMER_MODEL_TYPE,),
+    "opportunities": (OPPORTUNITY_MODEL_TYPE,),
+    "recent_customers": (CUSTOMER_MODEL_TYPE,),
+    "recent_opportunities": (OPPORTUNITY_MODEL_TYPE,),
+}
+
+# Rows of the recent customers and opportunities cards
+RECENT_ITEMS = 5
+
+_stats_lock = threading.Lock()
+_stats_cache: Optional[Tuple[Dict[str, int], Dict[str, Any]]] = None
+
+
+def get_revisions() -> Dict[str, int]:
+    """
+    Get the revisions of the collections the dashboard is computed from.
+    """
+    return {model_type: redis_manager.get_revision(model_type) for model_type in (CUSTOMER_MODEL_TYPE, OPPORTUNITY_MODEL_TYPE)}
+
+
+def compute_stats(
+    customer_records: Iterable[Dict[str, Any]],
+    opportunity_records: Iterable[Dict[str, Any]],
+    archived: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Compute the data of every dashboard card from raw customer and opportunity records.
+
+    Args:
+        customer_records: The raw customer records
+        opportunity_records: The raw opportunity records of the collection
+        archived: The rollups of the archived opportunities (see archive.get_rollups),
+            which are added to the opportunity counts and values
+    """
+    customer_records = list(customer_records)
+    opportunity_records = list(opportunity_records)
+    archived = archived or {"count": 0, "value": 0.0, "stages": {}}
+
+    status_counts = {status.value: 0 for status in CustomerStatus}
+    for customer in customer_records:
+        status_counts[customer["status"]] = status_counts.get(customer["status"], 0) + 1
+
+    stages = {stage.value: {"count": 0, "value": 0.0} for stage in OpportunityStage}
+    for opportunity in opportunity_records:
+        stage = stages.setdefault(opportunity["stage"], {"count": 0, "value": 0.0})
+        stage["count"] += 1
+        stage["value"] += opportunity.get("amount") or 0
+    for name, rollup in archived["stages"].items():
+        stage = stages.setdefault(name, {"count": 0, "value": 0.0})
+        stage["count"] += rollup["count"]
+        stage["value"] += rollup["value"]
+    for stage in stages.values():
+        stage["value"] = round(stage["value"], 2)
+
+    won = stages[OpportunityStage.CLOSED_WON.value]["count"]
+    closed = won + stages[OpportunityStage.CLOSED_LOST.value]["count"]
+
+    # In a real app, sort by creation date
+    recent_customers = sorted(customer_records, key=lambda record: record["id"])[:RECENT_ITEMS]
+    recent_opportunities = sorted(opportunity_records, key=lambda record: record["id"])[:RECENT_ITEMS]
+
+    return {
+        "summary": {
+            "total_customers": len(customer_records),
+            "total_opportunities": len(opportunity_records) + archived["count"],
+            "total_opportunity_value": round(
+                sum(opportunity.get("amount") or 0 for opportunity in opportunity_records) + archived["value"], 2
+            ),
+            "win_rate": round(won / closed * 100) if closed else 0,
+        },
+        "customers": status_counts,
+        "opportunities": stages,
+        "recent_customers": [
+            {field: customer.get(field) for field in ("id", "name", "status", "email")}
+            for customer in recent_customers
+        ],
+        "recent_opportunities": [
+            {field: opportunity.get(field) for field in ("id", "name", "stage", "amount")}
+            for opportunity in recent_opportunities
+        ],
+    }
+
+
+def get_stats(revisions: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """
+    Get the data of every dashboard card, computed again only if the customers or
+    opportunities changed since the last call.
+
+    The data is at least as new as the revisions, if the caller read them inside the same
+    redis_manager.consistent_reads() block (replicas lag by different amounts).
+
+    Args:
+        revisions: The current revisions (see get_revisions), if the caller already read them
+    """
+    global _stats_cache
+    if revisions is None:
+        revisions = get_revisions()
+    # Concurrent requests wait for one computation instead of each reading everything
+    with _stats_lock:
+        if _stats_cache is not None and _stats_cache[0] == revisions:
+            return _stats_cache[1]
+        # The cache key is read from the same client right before the records, so the
+        # cached data is never older than its key
+        with redis_manager.consistent_reads():
+            current = get_revisions()
+            stats = compute_stats(
+                redis_manager.get_all_raw(CUSTOMER_MODEL_TYPE),
+                redis_manager.get_all_raw(OPPORTUNITY_MODEL_TYPE),
+                archive.get_rollups(),
+            )
+        _stats_cache = (current, stats)
+        return stats
+
+
+def format_event(event: str, data: Dict[str, Any]) -> str:
+    """
+    Encode a server-sent event.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class DashboardAggregates:
+    """
+    The dashboard aggregates with the contribution of every record to them.
+    """
+    def __init__(self):
+        # Number of deltas applied
+        self.sequence = 0
+        self.customers: Dict[str, str] = {}
+        self.opportunities: Dict[str, Tuple[str, float]] = {}
+        self.status_counts: Counter = Counter()
+        self.stage_counts: Counter = Counter()
+        self.stage_values: Dict[str, float] = defaultdict(float)
+        # Count and value of the archived opportunities per stage
+        self.archived: Dict[str, Tuple[int, float]] = {}
+
+    def apply(self, model_type: str, id: str, record: Optional[Dict[str, Any]], delta: Dict[str, Any]) -> None:
+        """
+        Set the current state of a record (None if it was deleted), adding the change of
+        the aggregates to delta (see new_delta).
+        """
+        if model_type == CUSTOMER_MODEL_TYPE:
+            old = self.customers.pop(id, None)
+            new = record.get("status") if record is not None else None
+            if new is not None:
+                self.customers[id] = new
+            for status, sign in ((old, -1), (new, 1)):
+                if status is not None:
+                    self.status_counts[status] += sign
+                    delta["customers"]["total"] += sign
+                    delta["customers"]["status"][status] = delta["customers"]["status"].get(status, 0) + sign
+        else:
+            old = self.opportunities.pop(id, None)
+            new = (record["stage"], float(record.get("amount") or 0)) if record is not None else None
+            if new is not None:
+                self.opportunities[id] = new
+            for contribution, sign in ((old, -1), (new, 1)):
+                if contribution is None:
+                    continue
+                stage, amount = contribution
+                self.stage_counts[stage] += sign
+                self.stage_values[stage] += sign * amount
+                totals = delta["opportunities"]
+                totals["total"] += sign
+                totals["value"] += sign * amount
+                stage_delta = totals["stages"].setdefault(stage, {"count": 0, "value": 0.0})
+                stage_delta["count"] += sign
+                stage_delta["value"] += sign * amount
+
+    def set_archived(self, stages: Dict[str, Dict[str, Any]], delta: Dict[str, Any]) -> None:
+        """
+        Set the rollups of the archived opportunities per stage (see archive.get_rollups),
+        adding the change of the aggregates to delta.
+        """
+        old, self.archived = self.archived, {stage: (rollup["count"], rollup["value"]) for stage, rollup in stages.items()}
+        totals = delta["opportunities"]
+        for stage in old.keys() | self.archived.keys():
+            count = self.archived.get(stage, (0, 0.0))[0] - old.get(stage, (0, 0.0))[0]
+            value = self.archived.get(stage, (0, 0.0))[1] - old.get(stage, (0, 0.0))[1]
+            if not count and not value:
+                continue
+            self.stage_counts[stage] += count
+            self.stage_values[stage] += value
+            totals["total"] += count
+            totals["value"] += value
+            stage_delta = totals["stages"].setdefault(stage, {"count": 0, "value": 0.0})
+            stage_delta["count"] += count
+            stage_delta["value"] += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get the current aggregates, with every status and stage.
+        """
+        return {
+            "seq": self.sequence,
+            "customers": {
+                "total": len(self.customers),
+                "status": {status.value: self.status_counts[status.value] for status in CustomerStatus},
+            },
+            "opportunities": {
+                "total": len(self.opportunities) + sum(count for count, _ in self.archived.values()),
+                "value": round(sum(self.stage_values.values()), 2),
+                "stages": {
+                    stage.value: {"count": self.stage_counts[stage.value], "value": round(self.stage_values[stage.value], 2)}
+                    for stage in OpportunityStage
+                },
+            },
+        }
+
+
+def new_delta() -> Dict[str, Any]:
+    """
+    Create an empty delta of the dashboard aggregates.
+    """
+    return {
+        "customers": {"total": 0, "status": {}},
+        "opportunities": {"total": 0, "value": 0.0, "stages": {}},
+    }
+
+
+def is_empty(delta: Dict[str, Any]) -> bool:
+    """
+    Check whether a delta changes nothing (e.g. an update that kept status, stage and
+    amount), rounding its values to cents.
+    """
+    opportunities = delta["opportunities"]
+    opportunities["value"] = round(opportunities["value"], 2)
+    for stage in opportunities["stages"].values():
+        stage["value"] = round(stage["value"], 2)
+    return (
+        not any(delta["customers"]["status"].values())
+        and not any(stage["count"] or stage["value"] for stage in opportunities["stages"].values())
+    )
+
+
+class DashboardFeed:
+    """
+    One subscription to the customer and opportunity changes per worker, fanned out to
+    the connected dashboards.
+
+    Args:
+        manager: The RedisManager owning the change streams
+        block: Milliseconds a stream read waits for changes
+        max_backlog: Events queued for a client before it is sent a new snapshot instead
+    """
+    model_types = (CUSTOMER_MODEL_TYPE, OPPORTUNITY_MODEL_TYPE)
+
+    def __init__(self, manager: Any = redis_manager, block: int = 1000, max_backlog: int = 100):
+        self.manager = manager
+        self.block = block
+        self.max_backlog = max_backlog
+        self.aggregates = DashboardAggregates()
+        self._clients: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = set()
+        self._stream_types: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._ready = False
+        self._closed = threading.Event()
+
+    def subscribe(self) -> "asyncio.Queue[str]":
+        """
+        Connect a client: the returned queue receives the encoded events, starting with a
+        snapshot. Call from the event loop of the client.
+        """
+        queue: asyncio.Queue = asyncio.Queue(self.max_backlog)
+        with self._lock:
+            self._clients.add((asyncio.get_running_loop(), queue))
+            if self._thread is None:
+                self._closed.clear()
+                self._thread = threading.Thread(target=self._run, name="dashboard-feed", daemon=True)
+                self._thread.start()
+            elif self._ready:
+                queue.put_nowait(format_event("snapshot", self.aggregates.snapshot()))
+            # Otherwise the feed sends the snapshot once it has read the records
+        return queue
+
+    def unsubscribe(self, queue: "asyncio.Queue[str]") -> None:
+        """
+        Disconnect a client; the feed stops after the last one left.
+        """
+        with self._lock:
+            self._clients = {client for client in self._clients if client[1] is not queue}
+
+    def close(self) -> None:
+        """
+        Stop the feed.
+        """
+        self._closed.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self) -> None:
+        positions = None
+        while True:
+            with self._lock:
+                if not self._clients or self._closed.is_set():
+                    self._thread = None
+                    self._ready = False
+                    return
+            try:
+                if positions is None:
+                    positions = self._start()
+                else:
+                    self._follow(positions)
+            except Exception as e:
+                # Start over from a full read once Redis is back
+                print(f"Dashboard feed failed: {e}")
+                positions = None
+                with self._lock:
+                    self._ready = False
+                self._closed.wait(5.0)
+
+    def _start(self) -> Dict[str, str]:
+        """
+        Rebuild the aggregates and send every client a snapshot.
+
+        Returns:
+            The stream positions the aggregates include
+        """
+        client = self.manager.redis_client
+        positions = {}
+        for model_type in self.model_types:
+            for key in self.manager._get_change_stream_keys(model_type):
+                # Changes made while the records are read are applied again; that is harmless
+                last = client.xrevrange(key, count=1)
+                positions[key] = last[0][0] if last else "0-0"
+                self._stream_types[key] = model_type
+
+        aggregates = DashboardAggregates()
+        delta = new_delta()
+        for model_type in self.model_types:
+            for record in self.manager.get_all_raw(model_type):
+                aggregates.apply(model_type, record["id"], record, delta)
+        aggregates.set_archived(archive.get_rollups()["stages"], delta)
+        with self._lock:
+            aggregates.sequence = self.aggregates.sequence + 1
+            self.aggregates = aggregates
+            self._ready = True
+            self._broadcast(format_event("snapshot", aggregates.snapshot()), snapshot=True)
+        return positions
+
+    def _follow(self, positions: Dict[str, str]) -> None:
+        """
+        Read the next changes, apply them and send their delta to every client.
+        """
+        client = self.manager.redis_client
+        if not self.manager.cluster:
+            response = client.xread(positions, block=self.block) or []
+        else:
+            # The streams live in different slots: poll them one by one
+            response = []
+            for key, position in positions.items():
+                response.extend(client.xread({key: position}) or [])
+            if not response:
+                self._closed.wait(self.block / 1000)
+
+        changed: Dict[str, List[str]] = defaultdict(list)
+        archive_changed = False
+        for key, entries in response:
+            positions[key] = entries[-1][0]
+            model_type = self._stream_types[key]
+            for _, fields in entries:
+                if fields:
+                    changed[model_type].append(fields["id"])
+                    archive_changed |= model_type == OPPORTUNITY_MODEL_TYPE and fields["op"] in ("archive", "delete")
+        if not changed:
+            return
+
+        # The current state of every changed record, read once per batch
+        records = {model_type: self.manager.get_many_raw(model_type, set(ids)) for model_type, ids in changed.items()}
+        rollups = archive.get_rollups()["stages"] if archive_changed else None
+        delta = new_delta()
+        with self._lock:
+            for model_type, ids in changed.items():
+                for id in dict.fromkeys(ids):
+                    self.aggregates.apply(model_type, id, records[model_type].get(id), delta)
+            if rollups is not None:
+                self.aggregates.set_archived(rollups, delta)
+            if not is_empty(delta):
+                self.aggregates.sequence += 1
+                self._broadcast(format_event("delta", {"seq": self.aggregates.sequence, **delta}))
+
+    def _broadcast(self, event: str, snapshot: bool = False) -> None:
+        # Called with the lock held; queues are only touched from their own event loop
+        for loop, queue in self._clients:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, event, snapshot)
+            except RuntimeError:
+                # The client's event loop is closed
+                pass
+
+    def _deliver(self, queue: "asyncio.Queue[str]", event: str, snapshot: bool) -> None:
+        if snapshot or queue.full():
+            # A snapshot makes everything queued before it obsolete; deltas that follow a
+            # newer snapshot carry a seq the client skips
+            while not queue.empty():
+                queue.get_nowait()
+            if not snapshot:
+                with self._lock:
+                    event = format_event("snapshot", self.aggregates.snapshot())
+        queue.put_nowait(event)
+
+
+# The feed of this worker
+dashboard_feed = DashboardFeed()
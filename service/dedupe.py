@@ -0,0 +1,399 @@
+"""
+Duplicate detection for contacts and customers.
+
+Comparing every record with every other one is quadratic, so candidates are found by
+blocking first: two records are only compared if they share a blocking key,
+
+- 'email:<address>': the normalized email (lowercase, without '+tags', and for Gmail without
+  dots in the local part),
+- 'phone:<digits>': the last 10 digits of the phone number,
+- 'lsh:<band>:<hash>': a band of the MinHash signature of the name and address shingles
+  (character 3-grams). With 16 bands of 4 rows, records whose shingle sets have a Jaccard
+  similarity of 0.5 share a band with a probability of about 0.64, at 0.8 of about 1.
+
+Candidates are then scored from 0 to 1 (see score): an equal email counts as 1, an equal
+phone number as 0.9, and otherwise the Jaccard similarity of the name (and address)
+shingles.
+
+Online: every create or update indexes the record's blocking keys in Redis sets
+('<model>:dedupe:<blocking key>', plus '<model>:dedupe:keys:<id>' for removing them again,
+under the model type's key prefix, see RedisManager._get_prefix), and find_duplicates looks
+up the records sharing a key with a new one. Stale entries only cost a lookup, since
+candidates are always read and scored again; service.rebuild removes those of deleted records.
+
+Batch: find_clusters computes the signatures and scores the candidate pairs of a whole
+collection in a process pool and joins the pairs above the threshold into clusters.
+dedupe_records.py runs it and can rebuild the online index for existing records.
+"""
+import random
+import re
+import unicodedata
+import zlib
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
+
+from pydantic import BaseModel
+
+from models.dedupe import DuplicateCluster, DuplicateMatch
+from service.redis_manager import redis_manager
+
+# MinHash signature: BANDS bands of ROWS hash values
+BANDS = 16
+ROWS = 4
+SHINGLE_SIZE = 3
+
+# Minimum score of a possible duplicate
+DEFAULT_THRESHOLD = 0.6
+
+# Most candidates read and scored per online check
+MAX_CANDIDATES = 200
+
+# Blocking keys shared by more records are skipped by the batch job (e.g. a common name)
+MAX_BUCKET_SIZE = 200
+
+# Words left out of names, so that "Acme Inc" and "ACME, Inc." match "Acme"
+NAME_STOPWORDS = frozenset({"inc", "incorporated", "llc", "ltd", "limited", "corp", "corporation", "co", "gmbh", "the"})
+
+# Providers that ignore dots in the local part of an address
+DOTLESS_EMAIL_DOMAINS = frozenset({"gmail.com", "googlemail.com"})
+
+# Universal hashing h(x) = (a * x + b) mod p over 32-bit shingle hashes; fixed seed, so
+# signatures agree between processes and runs
+_PRIME = 4294967291
+_random = random.Random(5381)
+_COEFFICIENTS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(BANDS * ROWS)]
+
+
+class Features(NamedTuple):
+    """
+    What a record is compared by.
+    """
+    id: str
+    email: Optional[str]
+    phone: Optional[str]
+    name: FrozenSet[str]     # name shingles
+    address: FrozenSet[str]  # address shingles
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    """
+    Normalize an email address for exact matching.
+    """
+    if not email or "@" not in email:
+        return None
+    local, domain = email.strip().lower().rsplit("@", 1)
+    local = local.split("+", 1)[0]
+    if domain in DOTLESS_EMAIL_DOMAINS:
+        local = local.replace(".", "")
+    return f"{local}@{domain}"
+
+
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    """
+    Normalize a phone number to its last 10 digits, ignoring country codes and formatting
+    (None for fewer than 7 digits).
+    """
+    digits = re.sub(r"\D", "", phone or "")
+    if len(digits) < 7:
+        return None
+    return digits[-10:]
+
+
+def normalize_text(value: Optional[str], stopwords: FrozenSet[str] = frozenset()) -> str:
+    """
+    Lowercase a text and strip accents, punctuation, stopwords and repeated whitespace.
+    """
+    value = unicodedata.normalize("NFKD", value or "")
+    value = "".join(char for char in value if not unicodedata.combining(char)).lower()
+    return " ".join(word for word in re.findall(r"[a-z0-9]+", value) if word not in stopwords)
+
+
+def shingles(text: str) -> FrozenSet[str]:
+    """
+    Get the character shingles of a normalized text (the text itself if it is shorter).
+    """
+    if len(text) <= SHINGLE_SIZE:
+        return frozenset({text}) if text else frozenset()
+    return frozenset(text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1))
+
+
+def get_features(record: Union[Dict[str, Any], BaseModel]) -> Features:
+    """
+    Extract the features of a contact or customer (a model or a raw record).
+    """
+    if isinstance(record, BaseModel):
+        # Handle both Pydantic v1 and v2
+        record = record.model_dump() if hasattr(record, 'model_dump') else record.dict()
+    name = " ".join(str(record[field]) for field in ("name", "company") if record.get(field))
+    return Features(
+        id=str(record.get("id") or ""),
+        email=normalize_email(record.get("email")),
+        phone=normalize_phone(record.get("phone")),
+        name=shingles(normalize_text(name, NAME_STOPWORDS)),
+        address=shingles(normalize_text(record.get("address"))),
+    )
+
+
+def minhash(items: Iterable[str]) -> List[int]:
+    """
+    Compute the MinHash signature (BANDS * ROWS values) of a set of strings.
+    """
+    # NumPy is only imported when signatures are first computed
+    import numpy as np
+
+    hashes = np.fromiter((zlib.crc32(item.encode()) for item in items), dtype=np.uint64)
+    if len(hashes) == 0:
+        return []
+    a = np.array([a for a, _ in _COEFFICIENTS], dtype=np.uint64)[:, None]
+    b = np.array([b for _, b in _COEFFICIENTS], dtype=np.uint64)[:, None]
+    # a, b, x < 2**32, so a * x + b fits into 64 bits
+    return ((a * hashes[None, :] + b) % np.uint64(_PRIME)).min(axis=1).tolist()
+
+
+def blocking_keys(features: Features) -> List[str]:
+    """
+    Get the blocking keys of a record: records are compared if they share one.
+    """
+    keys = []
+    if features.email:
+        keys.append(f"email:{features.email}")
+    if features.phone:
+        keys.append(f"phone:{features.phone}")
+    signature = minhash({f"n:{item}" for item in features.name} | {f"a:{item}" for item in features.address})
+    for band in range(BANDS if signature else 0):
+        rows = ",".join(str(value) for value in signature[band * ROWS:(band + 1) * ROWS])
+        keys.append(f"lsh:{band}:{zlib.crc32(rows.encode()):08x}")
+    return keys
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def score(a: Features, b: Features) -> Tuple[float, List[str]]:
+    """
+    Score how likely two records are duplicates.
+
+    Returns:
+        The score from 0 to 1 and the matching signals ('email', 'phone', 'name')
+    """
+    result, reasons = 0.0, []
+    if a.email and a.email == b.email:
+        result = 1.0
+        reasons.append("email")
+    if a.phone and a.phone == b.phone:
+        result = max(result, 0.9)
+        reasons.append("phone")
+
+    similarity = jaccard(a.name, b.name)
+    if a.address and b.address:
+        similarity = 0.7 * similarity + 0.3 * jaccard(a.address, b.address)
+    if similarity >= 0.5:
+        reasons.append("name")
+    return round(max(result, similarity), 3), reasons
+
+
+def _index_key(model_type: str, key: str) -> str:
+    # A blocking set holds records of every shard; in cluster mode it is placed by its key
+    return f"{redis_manager._get_prefix(model_type, redis_manager._get_shard(key))}dedupe:{key}"
+
+
+def _record_keys_key(model_type: str, id: str) -> str:
+    return f"{redis_manager._get_prefix(model_type, redis_manager._get_shard(id))}dedupe:keys:{id}"
+
+
+def find_duplicates(
+    model_type: str,
+    record: Union[Dict[str, Any], BaseModel],
+    threshold: float = DEFAULT_THRESHOLD,
+    limit: int = 10
+) -> List[DuplicateMatch]:
+    """
+    Find the stored records that are possible duplicates of a record.
+
+    Args:
+        model_type: 'contact' or 'customer'
+        record: The record (a model or a raw record), stored or not; records without an ID
+            (e.g. a ContactCreate) are compared with all stored records
+        threshold: The minimum score
+        limit: The maximum number of matches
+
+    Returns:
+        The matches, best first
+    """
+    features = get_features(record)
+    keys = [_index_key(model_type, key) for key in blocking_keys(features)]
+    pipe = redis_manager.redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.smembers(key)
+
+    # Records sharing the most blocking keys first
+    hits = Counter(id for members in pipe.execute() for id in members if id != features.id)
+    candidates = [id for id, _ in hits.most_common(MAX_CANDIDATES)]
+
+    matches = []
+    for id, candidate in redis_manager.get_many_raw(model_type, candidates).items():
+        match_score, reasons = score(features, get_features(candidate))
+        if match_score >= threshold:
+            matches.append(DuplicateMatch(id=id, score=match_score, reasons=reasons))
+    matches.sort(key=lambda match: (-match.score, match.id))
+    return matches[:limit]
+
+
+def index_record(model_type: str, record: Union[Dict[str, Any], BaseModel]) -> None:
+    """
+    Add (or move) a stored record to the blocking sets of the online check.
+    """
+    features = get_features(record)
+    index_records(model_type, [(features.id, blocking_keys(features))])
+
+
+def index_records(model_type: str, entries: Sequence[Tuple[str, List[str]]]) -> None:
+    """
+    Set the blocking keys of several records, replacing the keys they were indexed by.
+    """
+    client = redis_manager.redis_client
+    pipe = client.pipeline(transaction=False)
+    for id, _ in entries:
+        pipe.smembers(_record_keys_key(model_type, id))
+    previous = pipe.execute()
+
+    pipe = client.pipeline(transaction=False)
+    for (id, keys), old_keys in zip(entries, previous):
+        for key in old_keys - set(keys):
+            pipe.srem(_index_key(model_type, key), id)
+        for key in keys:
+            pipe.sadd(_index_key(model_type, key), id)
+        pipe.delete(_record_keys_key(model_type, id))
+        if keys:
+            pipe.sadd(_record_keys_key(model_type, id), *keys)
+    pipe.execute()
+
+
+def remove_record(model_type: str, id: Any) -> None:
+    """
+    Remove a record from the blocking sets of the online check.
+    """
+    index_records(model_type, [(str(id), [])])
+
+
+def _compute_keys(records: List[Dict[str, Any]]) -> List[Tuple[Features, List[str]]]:
+    # Runs in the worker processes
+    result = []
+    for record in records:
+        features = get_features(record)
+        result.append((features, blocking_keys(features)))
+    return result
+
+
+def _score_pairs(pairs: List[Tuple[Features, Features]]) -> List[Tuple[str, str, float, List[str]]]:
+    # Runs in the worker processes
+    return [(a.id, b.id, *score(a, b)) for a, b in pairs]
+
+
+def find_clusters(
+    records: Sequence[Dict[str, Any]],
+    threshold: float = DEFAULT_THRESHOLD,
+    workers: Optional[int] = None,
+    chunk_size: int = 1000,
+    max_bucket_size: int = MAX_BUCKET_SIZE,
+    keys: Optional[Dict[str, List[str]]] = None
+) -> List[DuplicateCluster]:
+    """
+    Find the clusters of duplicates in a set of records.
+
+    Signatures and pair scores are computed in a process pool. Pairs scoring at least
+    threshold are joined into clusters (transitively, so A ~ B and B ~ C put A, B and C into
+    one cluster).
+
+    Args:
+        records: Raw contact or customer records
+        threshold: The minimum score of a duplicate pair
+        workers: The number of worker processes (default: one per CPU)
+        chunk_size: The records or pairs per task
+        max_bucket_size: Blocking keys shared by more records are skipped
+        keys: If given, filled with the blocking keys by record ID (e.g. for index_records)
+
+    Returns:
+        The clusters with at least two records, largest first
+    """
+    with ProcessPoolExecutor(workers) as pool:
+        chunks = [list(records[start:start + chunk_size]) for start in range(0, len(records), chunk_size)]
+        computed = [item for chunk in pool.map(_compute_keys, chunks) for item in chunk]
+        if keys is not None:
+            keys.update((features.id, record_keys) for features, record_keys in computed)
+
+        buckets: Dict[str, List[int]] = defaultdict(list)
+        for position, (_, record_keys) in enumerate(computed):
+            for key in record_keys:
+                buckets[key].append(position)
+        pairs: Set[Tuple[int, int]] = set()
+        for positions in buckets.values():
+            if 1 < len(positions) <= max_bucket_size:
+                pairs.update(combinations(positions, 2))
+
+        pair_list = [(computed[a][0], computed[b][0]) for a, b in sorted(pairs)]
+        pair_chunks = [pair_list[start:start + chunk_size] for start in range(0, len(pair_list), chunk_size)]
+        scored = [item for chunk in pool.map(_score_pairs, pair_chunks) for item in chunk]
+
+    return cluster_pairs((a, b, pair_score, reasons) for a, b, pair_score, reasons in scored if pair_score >= threshold)
+
+
+def cluster_pairs(pairs: Iterable[Tuple[str, str, float, List[str]]]) -> List[DuplicateCluster]:
+    """
+    Join scored duplicate pairs (id, id, score, reasons) into clusters.
+    """
+    parent: Dict[str, str] = {}
+
+    def root(id: str) -> str:
+        parent.setdefault(id, id)
+        while parent[id] != id:
+            parent[id] = parent[parent[id]]
+            id = parent[id]
+        return id
+
+    best: Dict[str, Tuple[float, Set[str]]] = {}
+    for a, b, pair_score, reasons in pairs:
+        parent[max(root(a), root(b))] = min(root(a), root(b))
+        for id in (a, b):
+            member_score, member_reasons = best.get(id, (0.0, set()))
+            best[id] = (max(member_score, pair_score), member_reasons | set(reasons))
+
+    members: Dict[str, List[DuplicateMatch]] = defaultdict(list)
+    for id, (member_score, reasons) in sorted(best.items()):
+        members[root(id)].append(DuplicateMatch(id=id, score=member_score, reasons=sorted(reasons)))
+
+    clusters = [
+        DuplicateCluster(cluster_id=cluster_id, score=min(member.score for member in cluster), members=cluster)
+        for cluster_id, cluster in members.items()
+    ]
+    clusters.sort(key=lambda cluster: (-len(cluster.members), -cluster.score, cluster.cluster_id))
+    return clusters
+
+
+def dedupe_collection(
+    model_type: str,
+    threshold: float = DEFAULT_THRESHOLD,
+    workers: Optional[int] = None,
+    rebuild_index: bool = False
+) -> List[DuplicateCluster]:
+    """
+    Find the clusters of duplicates among all records of a model type.
+
+    Args:
+        model_type: 'contact' or 'customer'
+        threshold: The minimum score of a duplicate pair
+        workers: The number of worker processes (default: one per CPU)
+        rebuild_index: Also (re)index all records for the online check
+    """
+    keys: Dict[str, List[str]] = {}
+    clusters = find_clusters(redis_manager.get_all_raw(model_type), threshold, workers, keys=keys)
+    if rebuild_index:
+        entries = list(keys.items())
+        for start in range(0, len(entries), 500):
+            index_records(model_type, entries[start:start + 500])
+    return clusters
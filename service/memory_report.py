@@ -0,0 +1,142 @@
+"""
+Memory footprint of the records stored in Redis, before and after the compact encoding.
+
+For a random sample of the records of each model type, MEMORY USAGE reports the bytes of
+the record key as it is stored now and of its meta hash. Every sampled record is then
+re-encoded with the compact encoding (service.value_codec) into a temporary key next to
+it, which is measured the same way and deleted right away, so the comparison is made by
+Redis itself, allocator overhead included. Index and collection entries are not counted,
+since the encoding does not change them.
+
+memory_report.py prints the report.
+"""
+import math
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from service.redis_manager import RedisManager
+
+# Suffix of the temporary keys holding the re-encoded records
+TEMPORARY_SUFFIX = ":memory-report"
+
+
+class ModelMemoryUsage(NamedTuple):
+    """
+    Average bytes per record of a model type, measured on a sample.
+    """
+    model_type: str
+    records: int          # number of records in the collection
+    sampled: int          # number of records measured
+    value_bytes: float    # record key, as stored now
+    compact_bytes: float  # record key, in the compact encoding
+    meta_bytes: float     # meta hash (version and index entries)
+
+    @property
+    def record_bytes(self) -> float:
+        return self.value_bytes + self.meta_bytes
+
+    @property
+    def compact_record_bytes(self) -> float:
+        return self.compact_bytes + self.meta_bytes
+
+
+def measure_model(manager: RedisManager, model_type: str, sample_size: int = 200) -> ModelMemoryUsage:
+    """
+    Measure the memory usage of a sample of the records of a model type.
+
+    Args:
+        manager: The RedisManager storing the records
+        model_type: The type of model (e.g., 'customer')
+        sample_size: The number of records to measure
+
+    Returns:
+        The average bytes per record, now and in the compact encoding
+    """
+    client = manager.redis_client
+    codec = manager.codec.compact_variant()
+    keys = manager._get_collection_keys(model_type)
+
+    records = sum(client.scard(key) for key in keys)
+    per_shard = math.ceil(sample_size / len(keys))
+    ids: List[str] = []
+    for key in keys:
+        ids.extend(client.srandmember(key, per_shard) or [])
+    ids = ids[:sample_size]
+
+    totals = {"value": 0, "compact": 0, "meta": 0}
+    sampled = 0
+    for start in range(0, len(ids), 100):
+        chunk = ids[start:start + 100]
+        record_keys = [manager._get_key(model_type, id) for id in chunk]
+        values = manager._mget(record_keys)
+
+        measured = [(id, key, value) for id, key, value in zip(chunk, record_keys, values) if value is not None]
+        pipe = client.pipeline(transaction=False)
+        for id, key, value in measured:
+            compact = codec.encode(model_type, manager._decode(model_type, value))
+            # Expires on its own should the report be interrupted
+            pipe.set(key + TEMPORARY_SUFFIX, compact, px=60000)
+        for id, key, _ in measured:
+            pipe.memory_usage(key)
+            pipe.memory_usage(key + TEMPORARY_SUFFIX)
+            pipe.memory_usage(manager._get_meta_key(model_type, id))
+        for _, key, _ in measured:
+            pipe.delete(key + TEMPORARY_SUFFIX)
+        results = pipe.execute()
+
+        usages = results[len(measured):len(measured) * 4]
+        for index in range(len(measured)):
+            value_bytes, compact_bytes, meta_bytes = usages[index * 3:index * 3 + 3]
+            if value_bytes is None or compact_bytes is None:
+                # Deleted while it was measured
+                continue
+            totals["value"] += value_bytes
+            totals["compact"] += compact_bytes
+            totals["meta"] += meta_bytes or 0
+            sampled += 1
+
+    divisor = max(sampled, 1)
+    return ModelMemoryUsage(
+        model_type=model_type,
+        records=records,
+        sampled=sampled,
+        value_bytes=totals["value"] / divisor,
+        compact_bytes=totals["compact"] / divisor,
+        meta_bytes=totals["meta"] / divisor,
+    )
+
+
+def node_capacity(usages: List[ModelMemoryUsage], node_memory: int) -> Dict[str, Any]:
+    """
+    Estimate how many records fit into the memory of a node, in the current mix of model types.
+
+    Args:
+        usages: The measured model types
+        node_memory: The memory available for records, in bytes
+
+    Returns:
+        {"records": n, "compact_records": n, "increase": fraction} for the records counted
+        by the report (value and meta keys only)
+    """
+    records = sum(usage.records for usage in usages)
+    if not records:
+        return {"records": 0, "compact_records": 0, "increase": 0.0}
+    average = sum(usage.record_bytes * usage.records for usage in usages) / records
+    compact_average = sum(usage.compact_record_bytes * usage.records for usage in usages) / records
+    capacity = int(node_memory / average) if average else 0
+    compact_capacity = int(node_memory / compact_average) if compact_average else 0
+    return {
+        "records": capacity,
+        "compact_records": compact_capacity,
+        "increase": compact_capacity / capacity - 1 if capacity else 0.0,
+    }
+
+
+def get_node_memory(manager: RedisManager) -> Optional[int]:
+    """
+    Get the maxmemory limit of the Redis node (None if it has none, or in cluster mode,
+    where the nodes may differ).
+    """
+    if manager.cluster:
+        return None
+    limit = int(manager.redis_client.info("memory").get("maxmemory", 0))
+    return limit or None
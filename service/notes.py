@@ -1,18 +1,76 @@
-from typing import List, Optional, Dict
+from typing import Iterable, List, NamedTuple, Optional, Dict, Set
 from uuid import UUID
 from datetime import datetime
+from collections import defaultdict
 
 from models.note import Note, NoteCreate, NoteUpdate
+from service.compact_store import CompactStore
+from service.redis_manager import VersionConflictError, redis_manager
+
+# Model type for the change stream
+NOTE_MODEL_TYPE = "note"
+
+
+class NoteRecord(NamedTuple):
+    """
+    Compact in-memory representation of a Note (see service.compact_store).
+    """
+    id: int
+    content: str
+    customer_id: Optional[int]
+    opportunity_id: Optional[int]
+    activity_id: Optional[int]
+    created_by: Optional[str]
+    created_at: datetime
+    updated_at: datetime
+    version: int
+
 
 # In-memory storage for notes
-notes_db: Dict[UUID, Note] = {}
+notes_db: CompactStore[Note, NoteRecord] = CompactStore(
+    Note,
+    NoteRecord,
+    uuids=("id", "customer_id", "opportunity_id", "activity_id"),
+    interned=("created_by",),
+)
+
+# Per-parent indexes: note IDs by customer, by opportunity and by activity (as UUID integer
+# values). Read and written under notes_db.lock, like the records.
+notes_by_customer: Dict[int, Set[int]] = defaultdict(set)
+notes_by_opportunity: Dict[int, Set[int]] = defaultdict(set)
+notes_by_activity: Dict[int, Set[int]] = defaultdict(set)
+
+
+def _index_note(record: NoteRecord) -> None:
+    """
+    Add a note to the per-parent indexes.
+    """
+    if record.customer_id is not None:
+        notes_by_customer[record.customer_id].add(record.id)
+    if record.opportunity_id is not None:
+        notes_by_opportunity[record.opportunity_id].add(record.id)
+    if record.activity_id is not None:
+        notes_by_activity[record.activity_id].add(record.id)
+
+
+def _unindex_note(record: NoteRecord) -> None:
+    """
+    Remove a note from the per-parent indexes.
+    """
+    for index, parent_id in ((notes_by_customer, record.customer_id),
+                             (notes_by_opportunity, record.opportunity_id),
+                             (notes_by_activity, record.activity_id)):
+        if parent_id is not None and parent_id in index:
+            index[parent_id].discard(record.id)
+            if not index[parent_id]:
+                del index[parent_id]
 
 
 def get_notes() -> List[Note]:
     """
     Get all notes.
     """
-    return list(notes_db.values())
+    return notes_db.models()
 
 
 def get_note(note_id: UUID) -> Optional[Note]:
@@ -26,21 +84,27 @@ def get_notes_by_customer(customer_id: UUID) -> List[Note]:
     """
     Get all notes for a specific customer.
     """
-    return [note for note in notes_db.values() if note.customer_id == customer_id]
+    with notes_db.lock:
+        records = [notes_db.record_by_key(key) for key in notes_by_customer.get(customer_id.int, ())]
+    return [notes_db.decode(record) for record in records]
 
 
 def get_notes_by_opportunity(opportunity_id: UUID) -> List[Note]:
     """
     Get all notes for a specific opportunity.
     """
-    return [note for note in notes_db.values() if note.opportunity_id == opportunity_id]
+    with notes_db.lock:
+        records = [notes_db.record_by_key(key) for key in notes_by_opportunity.get(opportunity_id.int, ())]
+    return [notes_db.decode(record) for record in records]
 
 
 def get_notes_by_activity(activity_id: UUID) -> List[Note]:
     """
     Get all notes for a specific activity.
     """
-    return [note for note in notes_db.values() if note.activity_id == activity_id]
+    with notes_db.lock:
+        records = [notes_db.record_by_key(key) for key in notes_by_activity.get(activity_id.int, ())]
+    return [notes_db.decode(record) for record in records]
 
 
 def create_note(note: NoteCreate) -> Note:
@@ -49,36 +113,47 @@ def create_note(note: NoteCreate) -> Note:
     """
     # Handle both Pydantic v1 and v2
     note_data = note.model_dump() if hasattr(note, 'model_dump') else note.dict()
-    new_note = Note(**note_data)
-    notes_db[new_note.id] = new_note
+    new_note = Note(**note_data, version=1)
+    with notes_db.lock:
+        _index_note(notes_db.put(new_note))
+    redis_manager.record_change(NOTE_MODEL_TYPE, "create", new_note.id, new_note.version)
     return new_note
 
 
-def update_note(note_id: UUID, note_update: NoteUpdate) -> Optional[Note]:
+def update_note(note_id: UUID, note_update: NoteUpdate, expected_version: Optional[int] = None) -> Optional[Note]:
     """
     Update an existing note.
-    """
-    if note_id not in notes_db:
-        return None
 
-    # Get the existing note
-    note = notes_db[note_id]
-
-    # Update only the fields that are provided
+    If expected_version is given, the update fails with VersionConflictError unless the
+    note is still at that version.
+    """
     # Handle both Pydantic v1 and v2
     if hasattr(note_update, 'model_dump'):
         update_data = note_update.model_dump(exclude_unset=True)
     else:
         update_data = note_update.dict(exclude_unset=True)
 
-    for field, value in update_data.items():
-        setattr(note, field, value)
+    with notes_db.lock:
+        record = notes_db.record(note_id)
+        if record is None:
+            return None
+
+        if expected_version is not None and record.version != expected_version:
+            raise VersionConflictError(NOTE_MODEL_TYPE, note_id, record.version)
 
-    # Update the updated_at timestamp
-    note.updated_at = datetime.now()
+        # Get the existing note and update only the fields that are provided
+        note = notes_db.decode(record)
+        for field, value in update_data.items():
+            setattr(note, field, value)
 
-    # Save the updated note
-    notes_db[note_id] = note
+        # Update the updated_at timestamp and the version
+        note.updated_at = datetime.now()
+        note.version += 1
+
+        # Save the updated note
+        _unindex_note(record)
+        _index_note(notes_db.put(note))
+    redis_manager.record_change(NOTE_MODEL_TYPE, "update", note_id, note.version)
     return note
 
 
@@ -86,8 +161,32 @@ def delete_note(note_id: UUID) -> bool:
     """
     Delete a note.
     """
-    if note_id not in notes_db:
-        return False
-
-    del notes_db[note_id]
-    return True
\ No newline at end of file
+    with notes_db.lock:
+        record = notes_db.pop(note_id)
+        if record is None:
+            return False
+        _unindex_note(record)
+    redis_manager.record_change(NOTE_MODEL_TYPE, "delete", note_id, record.version)
+    return True
+
+
+def delete_notes_by_customer(
+    customer_id: UUID,
+    opportunity_ids: Iterable[UUID] = (),
+    activity_ids: Iterable[UUID] = ()
+) -> List[UUID]:
+    """
+    Delete all notes of a customer or of any of the given opportunities or activities.
+    """
+    with notes_db.lock:
+        deleted = set(notes_by_customer.get(customer_id.int, ()))
+        for opportunity_id in opportunity_ids:
+            deleted.update(notes_by_opportunity.get(opportunity_id.int, ()))
+        for activity_id in activity_ids:
+            deleted.update(notes_by_activity.get(activity_id.int, ()))
+        records = [notes_db.pop(UUID(int=key)) for key in deleted]
+        for record in records:
+            _unindex_note(record)
+    for record in records:
+        redis_manager.record_change(NOTE_MODEL_TYPE, "delete", UUID(int=record.id), record.version)
+    return [UUID(int=key) for key in deleted]
\ No newline at end of file
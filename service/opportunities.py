@@ -3,11 +3,27 @@ from uuid import UUID
 from datetime import datetime
 
 from models.opportunity import Opportunity, OpportunityCreate, OpportunityUpdate
+from service.changes import ChangeSet
+from service.query import Query, QueryResult
 from service.redis_manager import redis_manager
 
 # Model type for Redis keys
 OPPORTUNITY_MODEL_TYPE = "opportunity"
 
+# Index opportunities by customer so per-customer lookups don't scan the collection
+redis_manager.register_index(OPPORTUNITY_MODEL_TYPE, "customer_id")
+
+# Indexes for filtering and sorting the opportunity list
+redis_manager.register_index(OPPORTUNITY_MODEL_TYPE, "stage")
+for field in ("amount", "probability", "expected_close_date"):
+    redis_manager.register_sorted_index(OPPORTUNITY_MODEL_TYPE, field)
+
+# Field dictionary of the compact value encoding; append new fields at the end
+redis_manager.register_fields(OPPORTUNITY_MODEL_TYPE, [
+    "id", "version", "name", "customer_id", "amount", "stage", "expected_close_date",
+    "probability", "description", "created_at", "updated_at"
+])
+
 
 def get_opportunities() -> List[Opportunity]:
     """
@@ -16,11 +32,38 @@ def get_opportunities() -> List[Opportunity]:
     return redis_manager.get_all(OPPORTUNITY_MODEL_TYPE, Opportunity)
 
 
+def find_opportunities(query: Query) -> QueryResult:
+    """
+    Get the opportunities matching a filter/sort query.
+    """
+    return redis_manager.find(OPPORTUNITY_MODEL_TYPE, Opportunity, query)
+
+
 def get_opportunity(opportunity_id: UUID) -> Optional[Opportunity]:
     """
-    Get an opportunity by ID.
+    Get an opportunity by ID, from the archive if it was archived.
     """
-    return redis_manager.get(OPPORTUNITY_MODEL_TYPE, opportunity_id, Opportunity)
+    # service.archive builds on this module
+    from service import archive
+
+    opportunity = redis_manager.get(OPPORTUNITY_MODEL_TYPE, opportunity_id, Opportunity)
+    if opportunity is None:
+        opportunity = archive.get_archived_opportunity(opportunity_id)
+    return opportunity
+
+
+def opportunity_exists(opportunity_id: UUID) -> bool:
+    """
+    Check on the primary whether an opportunity exists, archived or not, before storing a
+    record that references it.
+    """
+    # service.archive builds on this module
+    from service import archive
+
+    if redis_manager.get_existing_ids(OPPORTUNITY_MODEL_TYPE, [opportunity_id]):
+        return True
+    with redis_manager.consistent_reads(primary=True):
+        return archive.is_archived(opportunity_id)
 
 
 def get_opportunities_by_customer(customer_id: UUID) -> List[Opportunity]:
@@ -30,6 +73,27 @@ def get_opportunities_by_customer(customer_id: UUID) -> List[Opportunity]:
     return redis_manager.get_by_field(OPPORTUNITY_MODEL_TYPE, "customer_id", customer_id, Opportunity)
 
 
+def get_opportunity_changes(since: Optional[List[int]], limit: int = 1000) -> ChangeSet:
+    """
+    Get the opportunities created, updated or deleted since a delta sync cursor (None for all).
+    """
+    return redis_manager.get_changes(OPPORTUNITY_MODEL_TYPE, Opportunity, since, limit)
+
+
+def get_opportunity_version(opportunity_id: UUID) -> Optional[int]:
+    """
+    Get the version of an opportunity without loading it (None if it does not exist).
+    """
+    return redis_manager.get_version(OPPORTUNITY_MODEL_TYPE, opportunity_id)
+
+
+def get_revision() -> int:
+    """
+    Get the change counter of all opportunities.
+    """
+    return redis_manager.get_revision(OPPORTUNITY_MODEL_TYPE)
+
+
 def create_opportunity(opportunity: OpportunityCreate) -> Opportunity:
     """
     Create a new opportunity.
@@ -40,10 +104,16 @@ def create_opportunity(opportunity: OpportunityCreate) -> Opportunity:
     return redis_manager.create(OPPORTUNITY_MODEL_TYPE, new_opportunity)
 
 
-def update_opportunity(opportunity_id: UUID, opportunity_update: OpportunityUpdate) -> Optional[Opportunity]:
+def update_opportunity(opportunity_id: UUID, opportunity_update: OpportunityUpdate, expected_version: Optional[int] = None) -> Optional[Opportunity]:
     """
     Update an existing opportunity.
+
+    If expected_version is given, the update fails with VersionConflictError unless the
+    opportunity is still at that version. Archived opportunities are read-only: updating one
+    raises ValueError.
     """
+    from service import archive
+
     # Handle both Pydantic v1 and v2
     if hasattr(opportunity_update, 'model_dump'):
         update_data = opportunity_update.model_dump(exclude_unset=True)
@@ -53,11 +123,16 @@ def update_opportunity(opportunity_id: UUID, opportunity_update: OpportunityUpda
     # Add updated_at to the update data
     update_data["updated_at"] = datetime.now()
 
-    return redis_manager.update(OPPORTUNITY_MODEL_TYPE, opportunity_id, update_data, Opportunity)
+    updated = redis_manager.update(OPPORTUNITY_MODEL_TYPE, opportunity_id, update_data, Opportunity, expected_version)
+    if updated is None and archive.is_archived(opportunity_id):
+        raise ValueError("Archived opportunities are read-only")
+    return updated
 
 
 def delete_opportunity(opportunity_id: UUID) -> bool:
     """
-    Delete an opportunity.
+    Delete an opportunity, also if it was archived.
     """
-    return redis_manager.delete(OPPORTUNITY_MODEL_TYPE, opportunity_id)
+    from service import archive
+
+    return redis_manager.delete(OPPORTUNITY_MODEL_TYPE, opportunity_id) or archive.delete_archived_opportunity(opportunity_id)
@@ -0,0 +1,165 @@
+"""
+Filter and sort queries on the list routes.
+
+The syntax of the ``filter`` and ``sort`` query parameters:
+
+    filter=stage:proposal|negotiation,amount>=1000,amount<5000&sort=-amount
+
+Conditions are separated by commas and must all hold. ``field:value`` matches a value
+(values separated by ``|`` match any of them), ``field>value``, ``>=``, ``<`` and ``<=``
+compare. ``sort`` names a field, with a leading ``-`` for descending order. Records without
+a value for the sort field come first in ascending order.
+
+RedisManager.query plans and runs a Query against the indexes of a model type.
+"""
+import operator
+import re
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Type
+
+from pydantic import BaseModel
+
+from models.projection import model_field_names, projection_model
+
+# Comparison operators, longest first so that '>=' is not read as '>'
+OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    ">": operator.gt,
+    "<": operator.lt,
+}
+
+_CONDITION = re.compile(r"^\s*(\w+)\s*(>=|<=|>|<|:)(.*)$")
+
+
+class Condition(NamedTuple):
+    """
+    One condition of a filter: field op value, where op ':' matches any of the values.
+    """
+    field: str
+    op: str
+    values: Tuple[Any, ...]
+
+    def __str__(self) -> str:
+        return f"{self.field}{self.op}{'|'.join(format_value(value) for value in self.values)}"
+
+
+class Query(NamedTuple):
+    """
+    A parsed filter/sort query with its page.
+    """
+    conditions: Tuple[Condition, ...] = ()
+    sort: Optional[str] = None
+    descending: bool = False
+    offset: int = 0
+    limit: Optional[int] = None
+
+
+class QueryResult(NamedTuple):
+    """
+    The page of a query, the number of matching records and the plan that was used.
+    """
+    items: List[Any]
+    total: int
+    plan: Dict[str, Any]
+
+
+def format_value(value: Any) -> str:
+    """
+    Format a condition value the way it is written in a filter.
+    """
+    if isinstance(value, Enum):
+        return str(value.value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def score(value: Any) -> float:
+    """
+    Convert a field value to its score in a sorted index.
+
+    Raises:
+        ValueError: If the value has no numeric order
+    """
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, date):
+        return float(value.toordinal())
+    if isinstance(value, (int, float)):
+        return float(value)
+    raise ValueError(f"{value!r} cannot be stored in a sorted index")
+
+
+def typed_values(model_class: Type[BaseModel], values: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Validate raw field values with the field types of model_class.
+
+    Raises:
+        ValueError: If a value is not valid for its field
+    """
+    projected = projection_model(model_class, tuple(values))
+    instance = projected(**values)
+    return {field: getattr(instance, field) for field in values}
+
+
+def matches(condition: Condition, value: Any) -> bool:
+    """
+    Check whether a (typed) field value satisfies a condition.
+    """
+    if condition.op == ":":
+        return value in condition.values
+    if value is None:
+        return False
+    return OPERATORS[condition.op](value, condition.values[0])
+
+
+def sort_key(value: Any) -> Tuple[bool, Any]:
+    """
+    Sort key of a field value that puts missing values first.
+    """
+    return (value is not None, value)
+
+
+def parse_query(
+    model_class: Type[BaseModel],
+    filter: Optional[str] = None,
+    sort: Optional[str] = None,
+    offset: int = 0,
+    limit: Optional[int] = None
+) -> Query:
+    """
+    Parse the filter and sort parameters of a list route.
+
+    Raises:
+        ValueError: If the syntax is invalid, a field is unknown or a value does not
+            match the type of its field
+    """
+    fields = model_field_names(model_class)
+    conditions = []
+    for expression in (filter or "").split(","):
+        if not expression.strip():
+            continue
+        match = _CONDITION.match(expression)
+        if match is None:
+            raise ValueError(f"Invalid condition: {expression}")
+        field, op, raw = match.group(1), match.group(2), match.group(3).strip()
+        if field not in fields:
+            raise ValueError(f"Unknown field: {field}")
+        raws = raw.split("|") if op == ":" else [raw]
+        values = tuple(typed_values(model_class, {field: value})[field] for value in raws)
+        conditions.append(Condition(field, op, values))
+
+    descending = False
+    if sort:
+        sort = sort.strip()
+        descending = sort.startswith("-")
+        sort = sort.lstrip("-+")
+        if sort not in fields:
+            raise ValueError(f"Unknown sort field: {sort}")
+
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("offset and limit must not be negative")
+
+    return Query(tuple(conditions), sort or None, descending, offset, limit)
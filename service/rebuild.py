@@ -0,0 +1,394 @@
+"""
+Consistency check and rebuild of the keys derived from the stored records.
+
+The record keys ('<model>:<id>') are the source of truth. Everything else is derived from
+them and kept in sync by the scripts of every write: the meta hashes, the collection sets,
+the index sets and sorted indexes, the delta sync sets, and the archive rollups. Bulk loads
+that bypass the Redis Manager, partial restores or evicted keys can make them drift.
+rebuild_model walks the keyspace of a model type with SCAN and
+
+1. checks every record against its derived keys and repairs what is missing or stale
+   (RedisManager.repair),
+2. purges the meta hashes, collection and delta sync entries of records that no longer
+   exist, leaving tombstones so that sync clients drop them (RedisManager.purge),
+3. removes index entries that the meta hashes do not name (RedisManager.unindex),
+4. corrects archive rollups that differ from the archived records,
+5. removes the duplicate check index entries (service.dedupe) of records that no longer exist.
+
+Records and index keys are split into chunks that a process pool checks in parallel. Each
+worker has its own connections and reads and writes with pipelines. Every repair is a
+script that re-checks what it was computed from, so the rebuild can run while the
+application writes. Repairs count as changes: they increment the revision and are recorded
+in the change stream, so caches, sync clients and the live dashboard pick them up.
+
+With dry_run nothing is written, and the report only counts the problems. rebuild_indexes.py
+runs the rebuild. The blocking keys of the duplicate check index are recomputed by
+dedupe_records.py.
+"""
+import zlib
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Type
+
+from pydantic import BaseModel
+
+from models.contact import Contact
+from models.customer import Customer
+from models.opportunity import Opportunity
+from service import archive, contacts, customers, dedupe
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.redis_manager import redis_manager
+
+# Model classes of the model types stored by the Redis Manager
+MODELS: Dict[str, Type[BaseModel]] = {
+    contacts.MODEL_TYPE: Contact,
+    customers.CUSTOMER_MODEL_TYPE: Customer,
+    OPPORTUNITY_MODEL_TYPE: Opportunity,
+}
+
+# Problems the check counts, by kind
+ISSUES = {
+    "unreadable": "records that cannot be decoded or validated (left alone)",
+    "misplaced": "records stored under another shard, e.g. after the shard count changed (left alone)",
+    "not_in_collection": "records missing from the collection set",
+    "not_in_updated": "records missing from the delta sync set",
+    "tombstoned": "records with a tombstone",
+    "no_version": "records without a version counter",
+    "stale_meta": "records whose meta hash names the wrong index key",
+    "missing_index_entry": "records missing from an index, or with the wrong score",
+    "orphaned": "meta hashes, collection or delta sync entries of records that do not exist",
+    "stale_index_entry": "index entries that the meta hashes do not name",
+    "rollup_drift": "archive rollup fields that differ from the archived records",
+    "stale_dedupe_entry": "duplicate check index entries of records that do not exist",
+}
+
+# Keys of a model type (after the prefix) that hold no record
+_NOT_RECORDS = frozenset({"all", "revision", "changes", "updated", "deleted", "archive"})
+
+# Rollups are sums of floats
+_ROLLUP_TOLERANCE = 1e-6
+
+
+class Keyspace(NamedTuple):
+    """
+    The keys of a model type found by SCAN.
+    """
+    records: Dict[Optional[int], List[str]]        # record IDs by shard
+    metas: Dict[Optional[int], Set[str]]           # IDs with a meta hash by shard
+    indexes: List[Tuple[Optional[int], str, str]]  # (shard, index key, meta field)
+    misplaced: int                                 # record keys under another shard's prefix
+    dedupe_sets: List[str]                         # blocking sets of the duplicate check
+    dedupe_records: List[str]                      # IDs with a blocking key list
+
+
+class RebuildReport(NamedTuple):
+    """
+    The result of checking (and repairing) the derived keys of a model type.
+    """
+    model_type: str
+    records: int            # record keys found
+    issues: Dict[str, int]  # problems found, by kind (see ISSUES)
+    repaired: int           # records, entries and rollup fields repaired (0 for a dry run)
+
+    @property
+    def consistent(self) -> bool:
+        return not any(self.issues.values())
+
+
+def scan_keyspace(model_type: str, count: int = 1000) -> Keyspace:
+    """
+    Find the record, meta, index and duplicate check keys of a model type with SCAN.
+
+    Args:
+        model_type: The type of model (e.g., 'opportunity')
+        count: The SCAN batch size hint
+    """
+    index_fields = set(redis_manager.indexes.get(model_type, []))
+    sorted_fields = set(redis_manager.sorted_indexes.get(model_type, []))
+    records: Dict[Optional[int], List[str]] = defaultdict(list)
+    metas: Dict[Optional[int], Set[str]] = defaultdict(set)
+    indexes = []
+    misplaced = 0
+    dedupe_sets, dedupe_records = [], []
+
+    for key in redis_manager.redis_client.scan_iter(match=f"{model_type}:*", count=count):
+        split = redis_manager._split_key(model_type, key)
+        if split is None:
+            continue
+        shard, rest = split
+        head, _, tail = rest.partition(":")
+        if not tail:
+            if rest in _NOT_RECORDS:
+                continue
+            if redis_manager._get_shard(rest) != shard:
+                misplaced += 1
+                continue
+            records[shard].append(rest)
+        elif tail == "meta":
+            if redis_manager._get_shard(head) == shard:
+                metas[shard].add(head)
+        elif head == "sorted" and tail in sorted_fields:
+            indexes.append((shard, key, f"zidx:{tail}"))
+        elif head in index_fields:
+            indexes.append((shard, key, f"idx:{head}"))
+        elif head == "dedupe":
+            if tail.startswith("keys:"):
+                dedupe_records.append(tail[len("keys:"):])
+            else:
+                dedupe_sets.append(key)
+    return Keyspace(dict(records), dict(metas), indexes, misplaced, dedupe_sets, dedupe_records)
+
+
+def _check_records(model_type: str, ids: List[str], dry_run: bool) -> Counter:
+    # Runs in the worker processes
+    manager = redis_manager
+    issues: Counter = Counter()
+    values = manager._mget([manager._get_key(model_type, id) for id in ids])
+
+    pipe = manager.redis_client.pipeline(transaction=False)
+    for id in ids:
+        shard = manager._get_shard(id)
+        pipe.hgetall(manager._get_meta_key(model_type, id))
+        pipe.sismember(manager._get_collection_key(model_type, shard), id)
+        pipe.zscore(manager._get_updated_key(model_type, shard), id)
+        pipe.zscore(manager._get_tombstone_key(model_type, shard), id)
+    states = pipe.execute()
+
+    checked = []
+    for position, (id, value) in enumerate(zip(ids, values)):
+        if value is None:
+            # Deleted since the scan
+            continue
+        try:
+            model = manager._deserialize(model_type, value, MODELS[model_type])
+        except (ValueError, zlib.error):
+            issues["unreadable"] += 1
+            continue
+        args = manager._index_args(model_type, model)
+        checked.append((model, value, states[position * 4:position * 4 + 4], list(zip(args[0::3], args[1::3], args[2::3]))))
+
+    # The entries the meta hashes name, or should name
+    pipe = manager.redis_client.pipeline(transaction=False)
+    for model, _, _, entries in checked:
+        for field, key, score in entries:
+            if not key:
+                continue
+            if field.startswith("zidx:"):
+                pipe.zscore(key, str(model.id))
+            else:
+                pipe.sismember(key, str(model.id))
+    found = iter(pipe.execute())
+
+    for model, value, (meta, in_collection, updated, tombstone), entries in checked:
+        problems = set()
+        if not in_collection:
+            problems.add("not_in_collection")
+        if updated is None:
+            problems.add("not_in_updated")
+        if tombstone is not None:
+            problems.add("tombstoned")
+        if "version" not in meta:
+            problems.add("no_version")
+        for field, key, score in entries:
+            if meta.get(field, "") != key:
+                problems.add("stale_meta")
+            if not key:
+                continue
+            entry = next(found)
+            if field.startswith("zidx:"):
+                missing = entry is None or abs(entry - float(score)) > 1e-9
+            else:
+                missing = not entry
+            if missing:
+                problems.add("missing_index_entry")
+        issues.update(problems)
+        if problems and not dry_run:
+            issues["repaired"] += manager.repair(model_type, model, value)
+    return issues
+
+
+def _find_orphans(model_type: str, keyspace: Keyspace) -> Dict[Optional[int], List[str]]:
+    """
+    Find the IDs in the collection, delta sync set and meta hashes of each shard whose
+    record does not exist.
+    """
+    shards = redis_manager._get_shards()
+    pipe = redis_manager.redis_client.pipeline(transaction=False)
+    for shard in shards:
+        pipe.smembers(redis_manager._get_collection_key(model_type, shard))
+        pipe.zrange(redis_manager._get_updated_key(model_type, shard), 0, -1)
+    results = pipe.execute()
+
+    orphans = {}
+    for position, shard in enumerate(shards):
+        referenced = set(results[position * 2]) | set(results[position * 2 + 1]) | keyspace.metas.get(shard, set())
+        # Entries of another shard cannot be purged in one script with this shard's keys
+        missing = {id for id in referenced if redis_manager._get_shard(id) == shard}
+        missing -= set(keyspace.records.get(shard, []))
+        # Created since the scan
+        missing -= redis_manager.get_existing_ids(model_type, missing)
+        if missing:
+            orphans[shard] = sorted(missing)
+    return orphans
+
+
+def _purge(model_type: str, shard: Optional[int], ids: List[str]) -> int:
+    # Runs in the worker processes
+    return redis_manager.purge(model_type, shard, ids)
+
+
+def _check_index(model_type: str, shard: Optional[int], key: str, meta_field: str, dry_run: bool, chunk_size: int) -> Counter:
+    # Runs in the worker processes
+    manager = redis_manager
+    client = manager.redis_client
+    issues: Counter = Counter()
+    if meta_field.startswith("zidx:"):
+        members = (member for member, _ in client.zscan_iter(key, count=chunk_size))
+    else:
+        members = client.sscan_iter(key, count=chunk_size)
+
+    # Collected before removing anything, since SCAN may return an entry twice
+    ids = sorted(set(members))
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        # An entry of another shard cannot belong to this shard's index
+        foreign = [id for id in chunk if manager._get_shard(id) != shard]
+        local = [id for id in chunk if manager._get_shard(id) == shard]
+        pipe = client.pipeline(transaction=False)
+        for id in local:
+            pipe.hget(manager._get_meta_key(model_type, id), meta_field)
+        stale = [id for id, named in zip(local, pipe.execute()) if named != key]
+
+        issues["stale_index_entry"] += len(foreign) + len(stale)
+        if dry_run:
+            continue
+        if foreign:
+            issues["repaired"] += client.zrem(key, *foreign) if meta_field.startswith("zidx:") else client.srem(key, *foreign)
+        if stale:
+            issues["repaired"] += manager.unindex(model_type, key, meta_field, stale)
+    return issues
+
+
+def _check_dedupe_set(model_type: str, key: str, dry_run: bool, chunk_size: int) -> Counter:
+    # Runs in the worker processes
+    manager = redis_manager
+    issues: Counter = Counter()
+    ids = sorted(set(manager.redis_client.sscan_iter(key, count=chunk_size)))
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        missing = set(chunk) - manager.get_existing_ids(model_type, chunk)
+        issues["stale_dedupe_entry"] += len(missing)
+        if missing and not dry_run:
+            issues["repaired"] += manager.redis_client.srem(key, *missing)
+    return issues
+
+
+def _check_dedupe_records(model_type: str, ids: List[str], dry_run: bool) -> Counter:
+    # Runs in the worker processes
+    issues: Counter = Counter()
+    missing = set(ids) - redis_manager.get_existing_ids(model_type, ids)
+    issues["stale_dedupe_entry"] += len(missing)
+    if missing and not dry_run:
+        # Also removes the record from the blocking sets its list names
+        dedupe.index_records(model_type, [(id, []) for id in sorted(missing)])
+        issues["repaired"] += len(missing)
+    return issues
+
+
+def _check_rollups(model_type: str, dry_run: bool) -> Counter:
+    """
+    Compare the archive rollups of each shard with the archived records, and correct them.
+    """
+    issues: Counter = Counter()
+    for shard in redis_manager._get_shards():
+        archived, rollups = redis_manager.get_archive_snapshot(model_type, shard)
+        expected: Counter = Counter()
+        for value in archived.values():
+            expected.update(archive.rollup_increments(archive.decode_record(value)))
+
+        # Applied as increments, which stay right if records are archived in the meantime
+        corrections = {
+            field: expected.get(field, 0.0) - rollups.get(field, 0.0)
+            for field in set(expected) | set(rollups)
+        }
+        corrections = {field: delta for field, delta in corrections.items() if abs(delta) > _ROLLUP_TOLERANCE}
+        issues["rollup_drift"] += len(corrections)
+        if corrections and not dry_run:
+            redis_manager.adjust_rollups(model_type, shard, corrections)
+            issues["repaired"] += len(corrections)
+    return issues
+
+
+def _chunks(items: List[str], size: int) -> List[List[str]]:
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def rebuild_model(
+    model_type: str,
+    dry_run: bool = False,
+    workers: Optional[int] = None,
+    chunk_size: int = 500
+) -> RebuildReport:
+    """
+    Check the derived keys of a model type against its records and repair them.
+
+    Args:
+        model_type: One of the model types in MODELS
+        dry_run: Only count the problems
+        workers: The number of worker processes (default: one per CPU)
+        chunk_size: The records or index entries per task and pipeline
+
+    Returns:
+        The problems found and the number of repairs
+    """
+    if model_type not in MODELS:
+        raise ValueError(f"Unknown model type {model_type!r}, expected one of {', '.join(MODELS)}")
+
+    keyspace = scan_keyspace(model_type)
+    issues: Counter = Counter({"misplaced": keyspace.misplaced})
+    with ProcessPoolExecutor(workers) as pool:
+        # Records first: afterwards their meta hashes are right and the rest can be checked against them
+        tasks = [
+            pool.submit(_check_records, model_type, chunk, dry_run)
+            for ids in keyspace.records.values() for chunk in _chunks(ids, chunk_size)
+        ]
+        for task in tasks:
+            issues.update(task.result())
+
+        orphans = _find_orphans(model_type, keyspace)
+        issues["orphaned"] += sum(len(ids) for ids in orphans.values())
+        if not dry_run:
+            tasks = [
+                pool.submit(_purge, model_type, shard, chunk)
+                for shard, ids in orphans.items() for chunk in _chunks(ids, chunk_size)
+            ]
+            issues["repaired"] += sum(task.result() for task in tasks)
+
+        tasks = [
+            pool.submit(_check_index, model_type, shard, key, meta_field, dry_run, chunk_size)
+            for shard, key, meta_field in keyspace.indexes
+        ]
+        tasks += [
+            pool.submit(_check_dedupe_records, model_type, chunk, dry_run)
+            for chunk in _chunks(keyspace.dedupe_records, chunk_size)
+        ]
+        for task in tasks:
+            issues.update(task.result())
+
+        # After the record lists, whose removal already cleans up most blocking sets
+        tasks = [
+            pool.submit(_check_dedupe_set, model_type, key, dry_run, chunk_size)
+            for key in keyspace.dedupe_sets
+        ]
+        for task in tasks:
+            issues.update(task.result())
+
+    if model_type == OPPORTUNITY_MODEL_TYPE:
+        issues.update(_check_rollups(model_type, dry_run))
+
+    return RebuildReport(
+        model_type=model_type,
+        records=sum(len(ids) for ids in keyspace.records.values()),
+        issues={kind: issues[kind] for kind in ISSUES},
+        repaired=issues["repaired"],
+    )
@@ -1,18 +1,82 @@
+import heapq
 import json
+import math
 import os
-import redis
-from typing import Any, Dict, List, Optional, Type, TypeVar, Generic, Union
-from uuid import UUID
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Type, TypeVar, Generic, Union
+from uuid import UUID, uuid4
 from pydantic import BaseModel
 
+from service import redis_scripts
+from service.changes import ChangeBuffer, ChangeSet
+from service.query import Condition, Query, QueryResult, matches, score, sort_key, typed_values
+from service.value_codec import ValueCodec
+
 # Type variable for Pydantic models
 T = TypeVar('T', bound=BaseModel)
+R = TypeVar('R')
+
+# Prefix of the tombstones of archived records: they left the collection, but are still
+# fetchable by ID, so sync reports them apart from deleted ones
+ARCHIVED_TOMBSTONE = "archived:"
+
+# Monotonic time of the last write made in the current context (e.g. request), used to send
+# reads that must see that write to the primary instead of a replica
+_last_write: ContextVar[float] = ContextVar("last_write", default=float("-inf"))
+
+# The client serving all reads of the current context inside consistent_reads()
+_pinned_read_client: ContextVar[Optional[Any]] = ContextVar("pinned_read_client", default=None)
+
+
+class VersionConflictError(Exception):
+    """
+    Raised when a write is based on a stale version of a record.
+    """
+    def __init__(self, model_type: str, model_id: Union[UUID, str], current_version: int):
+        super().__init__(f"{model_type} {model_id} was modified concurrently (current version: {current_version})")
+        self.model_type = model_type
+        self.model_id = model_id
+        self.current_version = current_version
+
+
+def parse_endpoints(value: str) -> List[Tuple[str, int]]:
+    """
+    Parse a comma separated list of host:port endpoints (the port defaults to 6379).
+    """
+    endpoints = []
+    for endpoint in value.split(","):
+        endpoint = endpoint.strip()
+        if endpoint:
+            host, _, port = endpoint.partition(":")
+            endpoints.append((host, int(port or 6379)))
+    return endpoints
+
 
 class RedisManager:
     """
     A Redis Manager component to manage all CRUD operations with Redis.
     """
-    def __init__(self, host: str = None, port: int = None, db: int = 0, password: Optional[str] = None):
+    def __init__(
+        self,
+        host: str = None,
+        port: int = None,
+        db: int = 0,
+        password: Optional[str] = None,
+        max_connections: Optional[int] = None,
+        cluster: Optional[bool] = None,
+        cluster_shards: Optional[int] = None,
+        replicas: Optional[List[Tuple[str, int]]] = None,
+        max_replica_lag: Optional[float] = None,
+        change_stream_max_len: Optional[int] = None,
+        value_encoding: Optional[str] = None,
+        capture_memory_changes: Optional[bool] = None
+    ):
         """
         Initialize the Redis Manager with connection parameters.
 
@@ -20,34 +84,327 @@ class RedisManager:
         - REDIS__HOST: Redis server host (default: 'localhost')
         - REDIS_PORT: Redis server port (default: 6379)
         - REDIS_PASSWORD: Redis server password (default: None)
+        - REDIS_MAX_CONNECTIONS: Size limit of the connection pool (default: unlimited)
+        - REDIS_CLUSTER: Set to 1 to connect to a Redis Cluster (default: single instance)
+        - REDIS_CLUSTER_SHARDS: Number of slot shards per model type in cluster mode (default: 16)
+        - REDIS_REPLICAS: Comma separated host:port read replicas (default: none)
+        - REDIS_REPLICA_MAX_LAG: Maximum staleness in seconds of replica reads (default: 5)
+        - REDIS_CHANGES_MAX_LEN: Approximate cap of each change stream, 0 for none (default: 100000)
+        - REDIS_CAPTURE_MEMORY_CHANGES: Set to 1 to append the changes of the in-memory services
+          to change streams too (default: off, see record_change)
+        - REDIS_VALUE_ENCODING: 'json' or 'compact' (default: 'json', see service.value_codec)
+        - REDIS_COMPRESS_MIN_SIZE: Size in bytes from which compact values are compressed, 0 for never (default: 256)
+        - REDIS_COMPRESSION: 'zstd' or 'zlib' (default: zstd if the zstandard package is installed)
 
         Explicitly passed parameters take precedence over environment variables.
 
+        No connection is made here: the client and its connection pool are created on
+        first use (or by connect()/warmup()).
+
+        In cluster mode every model type is split into cluster_shards shards. A record, its
+        meta hash, its entry in the collection set and its secondary index entries all carry
+        the hash tag of the record's shard, so they live in one slot and every mutation stays
+        a single atomic script. Collections and index sets are therefore stored per shard and
+        read from all shards. Changing the shard count requires rebuilding the keys.
+
+        With replicas, get, get_all, get_by_field, get_with_dependents and the raw/bulk reads
+        are served by a healthy replica that is at most max_replica_lag seconds behind (see
+        service.replicas). Writes, the compare-and-set reads of update and any read made
+        within max_replica_lag seconds after a write in the same context (e.g. the same
+        request) go to the primary, so callers always read their own writes.
+
         Args:
             host: Redis server host (overrides REDIS__HOST)
             port: Redis server port (overrides REDIS_PORT)
             db: Redis database number
             password: Redis server password (overrides REDIS_PASSWORD)
+            max_connections: Size limit of the connection pool (overrides REDIS_MAX_CONNECTIONS)
+            cluster: Whether to connect to a Redis Cluster (overrides REDIS_CLUSTER)
+            cluster_shards: Number of slot shards per model type (overrides REDIS_CLUSTER_SHARDS)
+            replicas: (host, port) pairs of read replicas (overrides REDIS_REPLICAS)
+            max_replica_lag: Maximum staleness of replica reads (overrides REDIS_REPLICA_MAX_LAG)
+            change_stream_max_len: Approximate cap of each change stream (overrides REDIS_CHANGES_MAX_LEN)
+            capture_memory_changes: Whether record_change appends to the change streams
+                (overrides REDIS_CAPTURE_MEMORY_CHANGES)
+            value_encoding: 'json' or 'compact' (overrides REDIS_VALUE_ENCODING)
         """
         # Get connection parameters from environment variables if not explicitly provided
         self.env_host = os.getenv("REDIS_HOST") or os.getenv("REDIS__HOST", "localhost")
         env_port = os.getenv("REDIS_PORT", "6379")
         env_password = os.getenv("REDIS_PASSWORD", "password")
-        print(self.env_host)
+        env_max_connections = os.getenv("REDIS_MAX_CONNECTIONS")
         # Use explicitly passed parameters if provided, otherwise use environment variables if available,
         # otherwise use default values
         final_host = host if host is not None else (self.env_host if self.env_host is not None else 'localhost')
         final_port = port if port is not None else (int(env_port) if env_port is not None else 6379)
         final_password = password if password is not None else env_password
+        if max_connections is None and env_max_connections:
+            max_connections = int(env_max_connections)
+        if cluster is None:
+            cluster = os.getenv("REDIS_CLUSTER", "").lower() in ("1", "true", "yes")
+        if cluster_shards is None:
+            cluster_shards = int(os.getenv("REDIS_CLUSTER_SHARDS", "16"))
 
-        self.redis_client = redis.Redis(
-            host=final_host,
-            port=final_port,
-            db=db,
-            password=final_password,
-            decode_responses=True
+        if replicas is None:
+            replicas = parse_endpoints(os.getenv("REDIS_REPLICAS", ""))
+        if max_replica_lag is None:
+            max_replica_lag = float(os.getenv("REDIS_REPLICA_MAX_LAG", "5"))
+        if cluster and replicas:
+            raise ValueError("Replica endpoints cannot be used in cluster mode")
+        if change_stream_max_len is None:
+            change_stream_max_len = int(os.getenv("REDIS_CHANGES_MAX_LEN", "100000"))
+        if capture_memory_changes is None:
+            capture_memory_changes = os.getenv("REDIS_CAPTURE_MEMORY_CHANGES", "").lower() in ("1", "true", "yes")
+        if value_encoding is None:
+            value_encoding = os.getenv("REDIS_VALUE_ENCODING", "json").lower()
+        if value_encoding not in ("json", "compact"):
+            raise ValueError(f"Unknown value encoding {value_encoding!r}, expected 'json' or 'compact'")
+
+        self.cluster = cluster
+        self.cluster_shards = cluster_shards
+        self.replica_endpoints = replicas
+        self.max_replica_lag = max_replica_lag
+        self.change_stream_max_len = change_stream_max_len
+        self.capture_memory_changes = capture_memory_changes
+
+        self.connection_kwargs: Dict[str, Any] = {
+            "host": final_host,
+            "port": final_port,
+            "password": final_password,
+            "decode_responses": True,
+        }
+        # A cluster only has database 0
+        if not cluster:
+            self.connection_kwargs["db"] = db
+        if max_connections is not None:
+            self.connection_kwargs["max_connections"] = max_connections
+
+        self._client = None
+        self._scripts: Dict[str, Any] = {}
+        self.replicas = None
+        self._connect_lock = threading.Lock()
+
+        # Secondary indexes (set of IDs per field value), keyed by model type
+        self.indexes: Dict[str, List[str]] = {}
+        # Sorted indexes (IDs scored by a numeric or date field), keyed by model type
+        self.sorted_indexes: Dict[str, List[str]] = {}
+
+        # How records are encoded for storage; stored values of every encoding are readable
+        self.codec = ValueCodec(
+            compact=value_encoding == "compact",
+            compress_min_size=int(os.getenv("REDIS_COMPRESS_MIN_SIZE", "256")),
+            compression=os.getenv("REDIS_COMPRESSION") or None,
+            json_default=self._json_default,
         )
 
+        # Change events of the in-memory services, appended to the change streams in the background
+        self.changes = ChangeBuffer(self)
+
+        # How often update() re-reads and retries after losing a compare-and-set race
+        # when the caller did not ask for a specific version
+        self.max_update_retries = 5
+
+    @property
+    def redis_client(self):
+        """
+        The Redis client, connected on first use.
+        """
+        if self._client is None:
+            self.connect()
+        return self._client
+
+    def connect(self):
+        """
+        Create the Redis client and its connection pool if they do not exist yet.
+
+        Returns:
+            The Redis client
+        """
+        with self._connect_lock:
+            if self._client is None:
+                # Imported here so that importing this module stays cheap
+                import redis
+
+                if self.cluster:
+                    from redis.cluster import RedisCluster
+                    client = RedisCluster(**self.connection_kwargs)
+                else:
+                    client = redis.Redis(**self.connection_kwargs)
+
+                # Lua scripts for atomic mutations. redis-py calls them through EVALSHA and
+                # reloads them automatically if the script cache was flushed (e.g. after a restart).
+                self._scripts = {
+                    name: client.register_script(script) for name, script in redis_scripts.SCRIPTS.items()
+                }
+
+                if self.replica_endpoints:
+                    from service.replicas import ReplicaSet
+
+                    kwargs = {key: value for key, value in self.connection_kwargs.items() if key not in ("host", "port")}
+                    replica_set = ReplicaSet(
+                        self.replica_endpoints,
+                        kwargs,
+                        max_lag=self.max_replica_lag,
+                        check_interval=min(1.0, self.max_replica_lag / 5),
+                    )
+                    replica_set.connect(client)
+                    self.replicas = replica_set
+
+                self._client = client
+        return self._client
+
+    def warmup(self, connections: int = 4) -> None:
+        """
+        Prepare the connection for the first requests.
+
+        Opens the given number of pooled connections up front (in cluster mode: one to
+        every node) and preloads the Lua scripts, so that neither the TCP/AUTH handshakes nor
+        the script loading land on request latency.
+
+        Args:
+            connections: The number of pooled connections to establish
+        """
+        client = self.redis_client
+        if self.cluster:
+            client.ping(target_nodes=client.ALL_NODES)
+            self.load_scripts()
+            return
+
+        pool = client.connection_pool
+        opened = []
+        try:
+            for _ in range(connections):
+                # Handle both redis-py < 5.3 (command name required) and later versions
+                try:
+                    connection = pool.get_connection()
+                except TypeError:
+                    connection = pool.get_connection("PING")
+                opened.append(connection)
+        finally:
+            for connection in opened:
+                pool.release(connection)
+
+        self.load_scripts()
+
+    def register_index(self, model_type: str, field: str) -> None:
+        """
+        Maintain a secondary index on a model field.
+
+        Every record is added to the set ``{model_type}:{field}:{value}`` for its current
+        field value. The index is kept up to date by create, update and delete, and is used
+        by get_by_field instead of scanning the whole collection.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            field: The field to index (e.g., 'customer_id')
+        """
+        fields = self.indexes.setdefault(model_type, [])
+        if field not in fields:
+            fields.append(field)
+
+    def register_sorted_index(self, model_type: str, field: str) -> None:
+        """
+        Maintain a sorted index on a numeric, date or datetime model field.
+
+        Every record with a value for the field is stored in the sorted set
+        ``{model_type}:sorted:{field}`` with the value as score. The index is kept up to date
+        by create, update and delete, and is used by query for range conditions and sorting.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            field: The field to index (e.g., 'amount')
+        """
+        fields = self.sorted_indexes.setdefault(model_type, [])
+        if field not in fields:
+            fields.append(field)
+
+    def register_fields(self, model_type: str, fields: List[str]) -> None:
+        """
+        Register the field dictionary of a model type for the compact value encoding.
+
+        Args:
+            model_type: The type of model (e.g., 'customer')
+            fields: The field names; append-only, since stored records refer to the fields
+                by position (see service.value_codec)
+        """
+        self.codec.register_fields(model_type, fields)
+
+    def load_scripts(self) -> None:
+        """
+        Preload the Lua scripts into the Redis script cache.
+
+        This is optional: scripts are loaded on first use (and reloaded after a Redis
+        restart) automatically, but preloading avoids the extra round trip on the first write.
+        """
+        client = self.redis_client
+        for script in self._scripts.values():
+            script.sha = client.script_load(script.script)
+
+    def _get_shard(self, id: Union[UUID, str]) -> Optional[int]:
+        """
+        Get the cluster shard of a model instance.
+
+        Args:
+            id: The UUID or string ID of the model instance
+
+        Returns:
+            The shard number, or None when not in cluster mode
+        """
+        if not self.cluster:
+            return None
+        return zlib.crc32(str(id).encode()) % self.cluster_shards
+
+    def _get_shards(self) -> List[Optional[int]]:
+        """
+        Get all shards of a model type.
+
+        Returns:
+            The shard numbers, or [None] when not in cluster mode
+        """
+        if not self.cluster:
+            return [None]
+        return list(range(self.cluster_shards))
+
+    def _get_prefix(self, model_type: str, shard: Optional[int]) -> str:
+        """
+        Generate the key prefix of a model type and shard.
+
+        In cluster mode the prefix contains the hash tag of the shard (e.g.
+        'opportunity:{opportunity:7}:'), which pins all keys of the shard to one slot.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            shard: The shard number, or None when not in cluster mode
+
+        Returns:
+            The key prefix
+        """
+        if shard is None:
+            return f"{model_type}:"
+        return f"{model_type}:{{{model_type}:{shard}}}:"
+
+    def _split_key(self, model_type: str, key: str) -> Optional[Tuple[Optional[int], str]]:
+        """
+        Split a key of a model type into its shard and the part after the prefix.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            key: The key (e.g. 'opportunity:{opportunity:7}:all')
+
+        Returns:
+            The shard (None when not in cluster mode) and the rest of the key (e.g. 'all'),
+            or None if the key does not belong to the model type
+        """
+        if not key.startswith(f"{model_type}:"):
+            return None
+        rest = key[len(model_type) + 1:]
+        if not self.cluster:
+            return None, rest
+        tag, separator, rest = rest.partition("}:")
+        if not separator or not tag.startswith(f"{{{model_type}:") or not tag[len(model_type) + 2:].isdigit():
+            return None
+        return int(tag[len(model_type) + 2:]), rest
+
     def _get_key(self, model_type: str, id: Union[UUID, str]) -> str:
         """
         Generate a Redis key for a specific model and ID.
@@ -59,233 +416,1902 @@ class RedisManager:
         Returns:
             A formatted Redis key
         """
-        return f"{model_type}:{str(id)}"
+        return f"{self._get_prefix(model_type, self._get_shard(id))}{str(id)}"
 
-    def _get_collection_key(self, model_type: str) -> str:
+    def _get_collection_key(self, model_type: str, shard: Optional[int] = None) -> str:
         """
         Generate a Redis key for a collection of models.
 
         Args:
             model_type: The type of model (e.g., 'contact', 'customer')
+            shard: The shard of the collection in cluster mode
 
         Returns:
             A formatted Redis key for the collection
         """
-        return f"{model_type}:all"
+        return f"{self._get_prefix(model_type, shard)}all"
 
-    def _serialize(self, obj: Any) -> str:
+    def _get_collection_keys(self, model_type: str) -> List[str]:
         """
-        Serialize an object to a JSON string.
+        Generate the Redis keys of all shards of a collection.
 
         Args:
-            obj: The object to serialize
+            model_type: The type of model (e.g., 'contact', 'customer')
 
         Returns:
-            A JSON string representation of the object
+            The collection keys (a single key when not in cluster mode)
         """
-        if isinstance(obj, BaseModel):
-            # Handle both Pydantic v1 and v2
-            if hasattr(obj, 'model_dump'):
-                obj_dict = obj.model_dump()
-            else:
-                obj_dict = obj.dict()
+        return [self._get_collection_key(model_type, shard) for shard in self._get_shards()]
 
-            # Convert UUID to string for JSON serialization
-            for key, value in obj_dict.items():
-                if isinstance(value, UUID):
-                    obj_dict[key] = str(value)
+    def _get_revision_key(self, model_type: str, shard: Optional[int] = None) -> str:
+        """
+        Generate the Redis key of the revision counter of a collection.
 
-            return json.dumps(obj_dict)
-        elif isinstance(obj, dict):
-            # Convert UUID to string for JSON serialization
-            obj_dict = obj.copy()
-            for key, value in obj_dict.items():
-                if isinstance(value, UUID):
-                    obj_dict[key] = str(value)
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            shard: The shard of the collection in cluster mode
 
-            return json.dumps(obj_dict)
-        else:
-            return json.dumps(obj)
+        Returns:
+            A formatted Redis key for the revision counter
+        """
+        return f"{self._get_prefix(model_type, shard)}revision"
 
-    def _deserialize(self, json_str: str, model_class: Type[T]) -> T:
+    def _get_change_stream_key(self, model_type: str, shard: Optional[int] = None) -> str:
         """
-        Deserialize a JSON string to a Pydantic model instance.
+        Generate the Redis key of the change stream of a model type.
 
         Args:
-            json_str: The JSON string to deserialize
-            model_class: The Pydantic model class
+            model_type: The type of model (e.g., 'contact', 'customer')
+            shard: The shard of the stream in cluster mode
 
         Returns:
-            An instance of the Pydantic model
+            A formatted Redis key for the change stream
         """
-        data = json.loads(json_str)
-        return model_class(**data)
+        return f"{self._get_prefix(model_type, shard)}changes"
 
-    def create(self, model_type: str, model: BaseModel) -> BaseModel:
+    def _get_change_stream_keys(self, model_type: str) -> List[str]:
         """
-        Create a new model instance in Redis.
+        Generate the Redis keys of all shards of the change stream of a model type.
 
         Args:
             model_type: The type of model (e.g., 'contact', 'customer')
-            model: The Pydantic model instance to create
 
         Returns:
-            The created model instance
+            The change stream keys (a single key when not in cluster mode)
         """
-        # Get the ID from the model
-        model_id = getattr(model, 'id')
+        return [self._get_change_stream_key(model_type, shard) for shard in self._get_shards()]
 
-        # Create the Redis key
-        key = self._get_key(model_type, model_id)
+    def _get_updated_key(self, model_type: str, shard: Optional[int] = None) -> str:
+        """
+        Generate the Redis key of the sorted set of record IDs by the revision of their last change.
 
-        # Serialize the model
-        model_json = self._serialize(model)
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            shard: The shard of the set in cluster mode
 
-        # Store the model in Redis
-        self.redis_client.set(key, model_json)
+        Returns:
+            A formatted Redis key for the updated set
+        """
+        return f"{self._get_prefix(model_type, shard)}updated"
 
-        # Add the ID to the collection set
-        collection_key = self._get_collection_key(model_type)
-        self.redis_client.sadd(collection_key, str(model_id))
+    def _get_tombstone_key(self, model_type: str, shard: Optional[int] = None) -> str:
+        """
+        Generate the Redis key of the sorted set of deleted record IDs by the revision of their deletion.
 
-        return model
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            shard: The shard of the set in cluster mode
 
-    def get(self, model_type: str, model_id: Union[UUID, str], model_class: Type[T]) -> Optional[T]:
+        Returns:
+            A formatted Redis key for the tombstone set
         """
-        Get a model instance from Redis by ID.
+        return f"{self._get_prefix(model_type, shard)}deleted"
+
+    def _get_archive_key(self, model_type: str, shard: Optional[int] = None) -> str:
+        """
+        Generate the Redis key of the hash of archived records (ID -> encoded record).
 
         Args:
-            model_type: The type of model (e.g., 'contact', 'customer')
-            model_id: The UUID or string ID of the model instance
-            model_class: The Pydantic model class
+            model_type: The type of model (e.g., 'opportunity')
+            shard: The shard of the archive in cluster mode
 
         Returns:
-            The model instance if found, None otherwise
+            A formatted Redis key for the archive hash
         """
-        # Create the Redis key
-        key = self._get_key(model_type, model_id)
+        return f"{self._get_prefix(model_type, shard)}archive"
 
-        # Get the model from Redis
-        model_json = self.redis_client.get(key)
+    def _get_rollup_key(self, model_type: str, shard: Optional[int] = None) -> str:
+        """
+        Generate the Redis key of the hash of rollups over the archived records.
 
-        if model_json is None:
-            return None
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            shard: The shard of the archive in cluster mode
 
-        # Deserialize the model
-        return self._deserialize(model_json, model_class)
+        Returns:
+            A formatted Redis key for the rollup hash
+        """
+        return f"{self._get_prefix(model_type, shard)}archive:rollups"
 
-    def get_all(self, model_type: str, model_class: Type[T]) -> List[T]:
+    def _get_archive_index_key(self, model_type: str, field: str, value: Any, shard: Optional[int] = None) -> str:
         """
-        Get all model instances of a specific type from Redis.
+        Generate the Redis key of the set of archived record IDs with a field value.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            field: The indexed field (e.g., 'customer_id')
+            value: The field value
+            shard: The shard of the archive in cluster mode
+
+        Returns:
+            A formatted Redis key for the archive index set
+        """
+        return f"{self._get_prefix(model_type, shard)}archive:{field}:{self._index_value(value)}"
+
+    def _get_meta_key(self, model_type: str, id: Union[UUID, str]) -> str:
+        """
+        Generate the Redis key of the meta hash stored next to a model instance.
 
         Args:
             model_type: The type of model (e.g., 'contact', 'customer')
-            model_class: The Pydantic model class
+            id: The UUID or string ID of the model instance
 
         Returns:
-            A list of model instances
+            A formatted Redis key for the meta hash
         """
-        # Get the collection key
-        collection_key = self._get_collection_key(model_type)
+        return f"{self._get_key(model_type, id)}:meta"
 
-        # Get all IDs from the collection set
-        ids = self.redis_client.smembers(collection_key)
+    def _get_index_key(self, model_type: str, field: str, value: Any, shard: Optional[int] = None) -> str:
+        """
+        Generate the Redis key of the index set for a field value.
 
-        # Get all models
-        models = []
-        for id in ids:
-            model = self.get(model_type, id, model_class)
-            if model:
-                models.append(model)
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            field: The indexed field (e.g., 'customer_id')
+            value: The field value
+            shard: The shard of the index set in cluster mode
 
-        return models
+        Returns:
+            A formatted Redis key for the index set
+        """
+        return f"{self._get_prefix(model_type, shard)}{field}:{self._index_value(value)}"
 
-    def update(self, model_type: str, model_id: Union[UUID, str], update_data: Dict[str, Any], model_class: Type[T]) -> Optional[T]:
+    def _get_sorted_index_key(self, model_type: str, field: str, shard: Optional[int] = None) -> str:
         """
-        Update a model instance in Redis.
+        Generate the Redis key of the sorted index of a field.
 
         Args:
-            model_type: The type of model (e.g., 'contact', 'customer')
-            model_id: The UUID or string ID of the model instance
-            update_data: A dictionary of fields to update
-            model_class: The Pydantic model class
+            model_type: The type of model (e.g., 'opportunity')
+            field: The field with a sorted index (e.g., 'amount')
+            shard: The shard of the sorted index in cluster mode
 
         Returns:
-            The updated model instance if found, None otherwise
+            A formatted Redis key for the sorted index
         """
-        # Get the existing model
-        model = self.get(model_type, model_id, model_class)
+        return f"{self._get_prefix(model_type, shard)}sorted:{field}"
 
-        if model is None:
-            return None
+    def _get_index_keys(self, model_type: str, field: str, value: Any) -> List[str]:
+        """
+        Generate the Redis keys of all shards of the index set for a field value.
 
-        # Update the model
-        for field, value in update_data.items():
-            if hasattr(model, field):
-                setattr(model, field, value)
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            field: The indexed field (e.g., 'customer_id')
+            value: The field value
 
-        # Create the Redis key
-        key = self._get_key(model_type, model_id)
+        Returns:
+            The index set keys (a single key when not in cluster mode)
+        """
+        return [self._get_index_key(model_type, field, value, shard) for shard in self._get_shards()]
 
-        # Serialize the updated model
-        model_json = self._serialize(model)
+    def _get_members(self, keys: List[str], client: Any = None) -> List[str]:
+        """
+        Get the union of several sets, reading each set (possibly in different slots) in
+        one pipeline.
 
-        # Store the updated model in Redis
-        self.redis_client.set(key, model_json)
+        Args:
+            keys: The set keys
+            client: The client to read from (default: the primary)
 
-        return model
+        Returns:
+            The members of all sets
+        """
+        client = client or self.redis_client
+        if len(keys) == 1:
+            return list(client.smembers(keys[0]))
 
-    def delete(self, model_type: str, model_id: Union[UUID, str]) -> bool:
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.smembers(key)
+        return [member for members in pipe.execute() for member in members]
+
+    def _mget(self, keys: List[str], client: Any = None) -> List[Optional[str]]:
         """
-        Delete a model instance from Redis.
+        Get the values of several keys; in cluster mode the keys are split by slot.
 
         Args:
-            model_type: The type of model (e.g., 'contact', 'customer')
-            model_id: The UUID or string ID of the model instance
+            keys: The keys to read
+            client: The client to read from (default: the primary)
 
         Returns:
-            True if the model was deleted, False otherwise
+            The values in key order (None for missing keys)
         """
-        # Create the Redis key
-        key = self._get_key(model_type, model_id)
+        client = client or self.redis_client
+        if self.cluster:
+            return client.mget_nonatomic(keys)
+        return client.mget(keys)
+
+    def _get_read_client(self) -> Any:
+        """
+        Choose the client for a read that may be served by a replica.
 
-        # Check if the model exists
-        if not self.redis_client.exists(key):
-            return False
+        Returns:
+            A healthy replica, or the primary if there is none or the current context
+            wrote recently enough that a replica might not have the write yet
+        """
+        client = self.redis_client
+        pinned = _pinned_read_client.get()
+        if pinned is not None:
+            return pinned
+        if self.replicas is None or time.monotonic() - _last_write.get() <= self.max_replica_lag:
+            return client
+        return self.replicas.choose() or client
 
-        # Delete the model from Redis
-        self.redis_client.delete(key)
+    @contextmanager
+    def consistent_reads(self, primary: bool = False):
+        """
+        Serve all reads of the block from the same client.
 
-        # Remove the ID from the collection set
-        collection_key = self._get_collection_key(model_type)
-        self.redis_client.srem(collection_key, str(model_id))
+        Replicas lag by different amounts, so reads spread over several of them can see
+        different states. Read a revision first and the data it describes next inside this
+        block, and the data is at least as new as the revision: if the replica fails midway,
+        the remaining reads go to the primary, which is ahead of it.
 
-        return True
+        Args:
+            primary: Serve the reads from the primary, e.g. because what to read was decided
+                by a script, which always runs on the primary
+        """
+        token = _pinned_read_client.set(self.redis_client if primary else self._get_read_client())
+        try:
+            yield
+        finally:
+            _pinned_read_client.reset(token)
 
-    def get_by_field(self, model_type: str, field: str, value: Any, model_class: Type[T]) -> List[T]:
+    def _read(self, operation: Callable[[Any], R]) -> R:
         """
-        Get model instances by a specific field value.
+        Run a read on a replica if possible, falling back to the primary if the replica fails.
 
         Args:
-            model_type: The type of model (e.g., 'contact', 'customer')
-            field: The field to filter by
-            value: The value to filter for
-            model_class: The Pydantic model class
+            operation: A function running the read on the client it is given
 
         Returns:
-            A list of model instances matching the field value
+            The result of the read
         """
-        # Get all models of this type
-        all_models = self.get_all(model_type, model_class)
+        client = self._get_read_client()
+        if client is self._client:
+            return operation(client)
+        try:
+            return operation(client)
+        except self.replicas.errors:
+            self.replicas.mark_unhealthy(client)
+            if _pinned_read_client.get() is client:
+                _pinned_read_client.set(self.redis_client)
+            return operation(self.redis_client)
 
-        # Filter models by the specified field value
-        return [model for model in all_models if getattr(model, field, None) == value]
+    def _index_value(self, value: Any) -> str:
+        """
+        Convert a field value to the string used in index keys.
+
+        Args:
+            value: The field value
+
+        Returns:
+            The string form of the value
+        """
+        if isinstance(value, Enum):
+            return str(value.value)
+        return str(value)
+
+    def _index_args(self, model_type: str, model: BaseModel) -> List[str]:
+        """
+        Build the (meta field, index key, score) script arguments for a model instance.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            model: The Pydantic model instance
+
+        Returns:
+            A flat list of meta fields, index keys ("" for unset fields) and scores ("" for
+            index sets and unset fields)
+        """
+        shard = self._get_shard(getattr(model, 'id'))
+        args = []
+        for field in self.indexes.get(model_type, []):
+            value = getattr(model, field, None)
+            args.append(f"idx:{field}")
+            args.append(self._get_index_key(model_type, field, value, shard) if value is not None else "")
+            args.append("")
+        for field in self.sorted_indexes.get(model_type, []):
+            value = getattr(model, field, None)
+            args.append(f"zidx:{field}")
+            if value is None:
+                args.extend(["", ""])
+            else:
+                args.extend([self._get_sorted_index_key(model_type, field, shard), repr(score(value))])
+        return args
+
+    def _json_default(self, value: Any) -> Any:
+        """
+        Convert values that the json module cannot serialize natively.
+
+        Args:
+            value: The value to convert
+
+        Returns:
+            A JSON serializable representation of the value
+        """
+        if isinstance(value, UUID):
+            return str(value)
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    def _serialize(self, obj: Any) -> str:
+        """
+        Serialize an object to a JSON string.
+
+        Args:
+            obj: The object to serialize
+
+        Returns:
+            A JSON string representation of the object
+        """
+        if isinstance(obj, BaseModel):
+            # Handle both Pydantic v1 and v2
+            if hasattr(obj, 'model_dump'):
+                obj_dict = obj.model_dump()
+            else:
+                obj_dict = obj.dict()
+
+            # Convert UUID to string for JSON serialization
+            for key, value in obj_dict.items():
+                if isinstance(value, UUID):
+                    obj_dict[key] = str(value)
+
+            return json.dumps(obj_dict, default=self._json_default)
+        elif isinstance(obj, dict):
+            # Convert UUID to string for JSON serialization
+            obj_dict = obj.copy()
+            for key, value in obj_dict.items():
+                if isinstance(value, UUID):
+                    obj_dict[key] = str(value)
+
+            return json.dumps(obj_dict, default=self._json_default)
+        else:
+            return json.dumps(obj, default=self._json_default)
+
+    def _encode(self, model_type: str, model: BaseModel) -> str:
+        """
+        Serialize a model instance for storage, in the configured value encoding.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model: The Pydantic model instance
+
+        Returns:
+            The value to store
+        """
+        if not self.codec.compact:
+            return self._serialize(model)
+        # Handle both Pydantic v1 and v2
+        data = model.model_dump() if hasattr(model, 'model_dump') else model.dict()
+        return self.codec.encode(model_type, data)
+
+    def _decode(self, model_type: str, value: str) -> Dict[str, Any]:
+        """
+        Decode a stored record, whatever its encoding.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            value: The stored value
+
+        Returns:
+            The record as a dictionary
+        """
+        if value[:1] == "{":
+            return json.loads(value)
+        return self.codec.decode(model_type, value)
+
+    def _deserialize(self, model_type: str, value: str, model_class: Type[T]) -> T:
+        """
+        Deserialize a stored record to a Pydantic model instance.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            value: The stored value
+            model_class: The Pydantic model class
+
+        Returns:
+            An instance of the Pydantic model
+        """
+        return model_class(**self._decode(model_type, value))
+
+    def create(self, model_type: str, model: BaseModel) -> BaseModel:
+        """
+        Create a new model instance in Redis.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model: The Pydantic model instance to create
+
+        Returns:
+            The created model instance
+
+        Raises:
+            VersionConflictError: If a model instance with the same ID already exists
+        """
+        # Get the ID from the model
+        model_id = getattr(model, 'id')
+
+        # New records start at version 1
+        if hasattr(model, 'version'):
+            model.version = 1
+
+        # Serialize the model
+        model_json = self._encode(model_type, model)
+
+        # Store the model, its collection membership and index entries in one atomic call
+        status, version = self._save(model_type, model_id, model, model_json, "create", 0)
+        if status != 1:
+            raise VersionConflictError(model_type, model_id, version)
+
+        return model
+
+    def get(self, model_type: str, model_id: Union[UUID, str], model_class: Type[T]) -> Optional[T]:
+        """
+        Get a model instance from Redis by ID.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_id: The UUID or string ID of the model instance
+            model_class: The Pydantic model class
+
+        Returns:
+            The model instance if found, None otherwise
+        """
+        # Create the Redis key
+        key = self._get_key(model_type, model_id)
+
+        # Get the model from Redis (or a replica)
+        model_json = self._read(lambda client: client.get(key))
+
+        if model_json is None:
+            return None
+
+        # Deserialize the model
+        return self._deserialize(model_type, model_json, model_class)
+
+    def get_with_version(self, model_type: str, model_id: Union[UUID, str], model_class: Type[T]) -> Tuple[Optional[T], int]:
+        """
+        Get a model instance and its version counter in one round trip.
+
+        This always reads the primary: the version is the base of compare-and-set writes
+        and of ETags, so it must not be stale.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_id: The UUID or string ID of the model instance
+            model_class: The Pydantic model class
+
+        Returns:
+            The model instance (None if not found) and its version (0 if never versioned)
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(self._get_key(model_type, model_id))
+        pipe.hget(self._get_meta_key(model_type, model_id), "version")
+        model_json, version = pipe.execute()
+
+        if model_json is None:
+            return None, 0
+
+        model = self._deserialize(model_type, model_json, model_class)
+        version = int(version or 0)
+        if hasattr(model, 'version'):
+            model.version = version
+        return model, version
+
+    def _get_for_update(
+        self,
+        model_type: str,
+        model_id: Union[UUID, str],
+        model_class: Type[T]
+    ) -> Tuple[Optional[T], int, Dict[str, str]]:
+        """
+        Get a model instance, its version counter and the index keys its meta hash names in
+        one round trip on the primary, as the base of a compare-and-set write.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_id: The UUID or string ID of the model instance
+            model_class: The Pydantic model class
+
+        Returns:
+            The model instance (None if not found), its version (0 if never versioned) and
+            the index keys by meta field
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(self._get_key(model_type, model_id))
+        pipe.hgetall(self._get_meta_key(model_type, model_id))
+        model_json, meta = pipe.execute()
+
+        if model_json is None:
+            return None, 0, {}
+
+        model = self._deserialize(model_type, model_json, model_class)
+        version = int(meta.get("version") or 0)
+        if hasattr(model, 'version'):
+            model.version = version
+        return model, version, self._get_index_fields(meta)
+
+    def _get_index_fields(self, meta: Dict[str, str]) -> Dict[str, str]:
+        """
+        Get the index keys named by a meta hash.
+
+        Args:
+            meta: The fields of the meta hash
+
+        Returns:
+            The index keys by meta field ('idx:<field>' or 'zidx:<field>')
+        """
+        return {field: key for field, key in meta.items() if field.startswith(("idx:", "zidx:"))}
+
+    def get_version(self, model_type: str, model_id: Union[UUID, str]) -> Optional[int]:
+        """
+        Get the version counter of a model instance without reading the record.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_id: The UUID or string ID of the model instance
+
+        Returns:
+            The version of the model instance, or None if it does not exist
+        """
+        key = self._get_meta_key(model_type, model_id)
+        version = self._read(lambda client: client.hget(key, "version"))
+        return None if version is None else int(version)
+
+    def get_revision(self, model_type: str) -> int:
+        """
+        Get the revision counter of a model type, which changes whenever any instance of
+        the type is created, updated or deleted.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+
+        Returns:
+            The revision (in cluster mode: the sum of the per-shard counters, which only grow)
+        """
+        keys = [self._get_revision_key(model_type, shard) for shard in self._get_shards()]
+        return sum(int(value or 0) for value in self._read(lambda client: self._mget(keys, client)))
+
+    def get_all(self, model_type: str, model_class: Type[T]) -> List[T]:
+        """
+        Get all model instances of a specific type from Redis.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_class: The Pydantic model class
+
+        Returns:
+            A list of model instances
+        """
+        # Get all IDs from the collection set
+        keys = self._get_collection_keys(model_type)
+        ids = self._read(lambda client: self._get_members(keys, client))
+
+        # Get all models
+        models = []
+        for id in ids:
+            model = self.get(model_type, id, model_class)
+            if model:
+                models.append(model)
+
+        return models
+
+    def get_all_raw(self, model_type: str, chunk_size: int = 1000) -> List[Dict[str, Any]]:
+        """
+        Get all instances of a model type as plain dictionaries.
+
+        This skips building Pydantic models and reads the records with chunked MGETs, for
+        callers that only need a few columns of every record (e.g. analytics).
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            chunk_size: The maximum number of keys per MGET
+
+        Returns:
+            A list of decoded records
+        """
+        keys = self._get_collection_keys(model_type)
+        ids = self._read(lambda client: self._get_members(keys, client))
+        return list(self.get_many_raw(model_type, ids, chunk_size).values())
+
+    def get_many_raw(self, model_type: str, ids: Any, chunk_size: int = 1000) -> Dict[str, Dict[str, Any]]:
+        """
+        Get several model instances as plain dictionaries with chunked MGETs.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            ids: The IDs of the model instances
+            chunk_size: The maximum number of keys per MGET
+
+        Returns:
+            The decoded records that exist, keyed by ID
+        """
+        ids = [str(id) for id in ids]
+
+        records = {}
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            keys = [self._get_key(model_type, id) for id in chunk]
+            values = self._read(lambda client: self._mget(keys, client))
+            records.update((id, self._decode(model_type, value)) for id, value in zip(chunk, values) if value is not None)
+
+        return records
+
+    def get_existing_ids(self, model_type: str, ids: Any) -> Set[str]:
+        """
+        Check which of several model instances exist, with one pipelined EXISTS per key.
+
+        The check always reads the primary: callers decide from it what to write or drop,
+        which a replica that has not seen a recent create must not decide.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            ids: The IDs to check
+
+        Returns:
+            The IDs (as strings) of the instances that exist
+        """
+        ids = list(dict.fromkeys(str(id) for id in ids))
+        if not ids:
+            return set()
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for id in ids:
+            pipe.exists(self._get_key(model_type, id))
+        return {id for id, exists in zip(ids, pipe.execute()) if exists}
+
+    def get_fields(self, model_type: str, model_id: Union[UUID, str], fields: List[str]) -> Optional[Dict[str, Any]]:
+        """
+        Get only some fields of a model instance, without building the model.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_id: The UUID or string ID of the model instance
+            fields: The fields to return
+
+        Returns:
+            The stored values of the fields (None for fields that are not stored), or None if
+            the model instance was not found
+        """
+        key = self._get_key(model_type, model_id)
+        model_json = self._read(lambda client: client.get(key))
+        if model_json is None:
+            return None
+        return self._project(self._decode(model_type, model_json), fields)
+
+    def get_all_fields(self, model_type: str, fields: List[str], chunk_size: int = 1000) -> List[Dict[str, Any]]:
+        """
+        Get only some fields of all instances of a model type, without building models.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            fields: The fields to return
+            chunk_size: The maximum number of keys per MGET
+
+        Returns:
+            The stored values of the fields of every model instance
+        """
+        keys = self._get_collection_keys(model_type)
+        ids = self._read(lambda client: self._get_members(keys, client))
+
+        records = []
+        for start in range(0, len(ids), chunk_size):
+            chunk_keys = [self._get_key(model_type, id) for id in ids[start:start + chunk_size]]
+            values = self._read(lambda client: self._mget(chunk_keys, client))
+            records.extend(self._project(self._decode(model_type, value), fields) for value in values if value is not None)
+        return records
+
+    def _project(self, record: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+        """
+        Keep only the given fields of a decoded record.
+
+        Args:
+            record: The decoded record
+            fields: The fields to keep
+
+        Returns:
+            The values of the fields (None for fields that are not stored)
+        """
+        return {field: record.get(field) for field in fields}
+
+    def get_versions(self, model_type: str, chunk_size: int = 1000) -> Dict[str, int]:
+        """
+        Get the version counter of every instance of a model type.
+
+        Only the small meta hashes are read, so callers that keep a copy of the records can
+        cheaply find out which ones changed.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            chunk_size: The maximum number of commands per pipeline
+
+        Returns:
+            The version of every model instance, keyed by ID
+        """
+        keys = self._get_collection_keys(model_type)
+        ids = self._read(lambda client: self._get_members(keys, client))
+
+        def read_versions(client: Any) -> List[Optional[str]]:
+            pipe = client.pipeline(transaction=False)
+            for id in chunk:
+                pipe.hget(self._get_meta_key(model_type, id), "version")
+            return pipe.execute()
+
+        versions = {}
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            versions.update((id, int(version or 0)) for id, version in zip(chunk, self._read(read_versions)))
+
+        return versions
+
+    def update(
+        self,
+        model_type: str,
+        model_id: Union[UUID, str],
+        update_data: Dict[str, Any],
+        model_class: Type[T],
+        expected_version: Optional[int] = None
+    ) -> Optional[T]:
+        """
+        Update a model instance in Redis.
+
+        The write is a compare-and-set on the record's version counter, so a concurrent
+        update is never silently overwritten. If expected_version is given, the update only
+        succeeds if the record is still at that version. Otherwise the update is re-applied
+        to the fresh record up to max_update_retries times when another writer got there first.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_id: The UUID or string ID of the model instance
+            update_data: A dictionary of fields to update
+            model_class: The Pydantic model class
+            expected_version: The version the update is based on (e.g. from an If-Match header)
+
+        Returns:
+            The updated model instance if found, None otherwise
+
+        Raises:
+            VersionConflictError: If the record is not at the expected version, or the
+                retries were exhausted
+        """
+        version = 0
+        for _ in range(self.max_update_retries):
+            # Get the existing model, its version and index keys
+            model, version, index = self._get_for_update(model_type, model_id, model_class)
+
+            if model is None:
+                return None
+
+            if expected_version is not None and version != expected_version:
+                raise VersionConflictError(model_type, model_id, version)
+
+            # Update the model
+            for field, value in update_data.items():
+                if hasattr(model, field):
+                    setattr(model, field, value)
+            if hasattr(model, 'version'):
+                model.version = version + 1
+
+            # Serialize the updated model
+            model_json = self._encode(model_type, model)
+
+            # Store the updated model if nobody else wrote it in the meantime, and move its
+            # index entries if indexed fields changed
+            status, version = self._save(model_type, model_id, model, model_json, "update", version, index)
+            if status == 1:
+                return model
+            if status == 0:
+                return None
+            # Another writer got there first: the next read shows whether the record is still
+            # at the expected version
+
+        raise VersionConflictError(model_type, model_id, version)
+
+    def delete(self, model_type: str, model_id: Union[UUID, str]) -> bool:
+        """
+        Delete a model instance from Redis.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_id: The UUID or string ID of the model instance
+
+        Returns:
+            True if the model was deleted, False otherwise
+
+        Raises:
+            VersionConflictError: If concurrent writes kept moving the record's index entries
+                for max_update_retries attempts
+        """
+        shard = self._get_shard(model_id)
+        meta_key = self._get_meta_key(model_type, model_id)
+        for _ in range(self.max_update_retries):
+            # The script must be given the index keys the meta hash names
+            index = self._get_index_fields(self.redis_client.hgetall(meta_key))
+
+            # Delete the model, its meta hash, collection membership and index entries
+            # in one atomic call
+            keys = [
+                self._get_key(model_type, model_id),
+                meta_key,
+                self._get_collection_key(model_type, shard),
+                self._get_revision_key(model_type, shard),
+                self._get_change_stream_key(model_type, shard),
+                self._get_updated_key(model_type, shard),
+                self._get_tombstone_key(model_type, shard),
+            ]
+            keys += index.values()
+            status = int(self._run_script("delete", keys, [str(model_id), self.change_stream_max_len, *index]))
+            if status != -1:
+                return bool(status)
+
+        raise VersionConflictError(model_type, model_id, self.get_version(model_type, model_id) or 0)
+
+    def archive(
+        self,
+        model_type: str,
+        model_id: Union[UUID, str],
+        expected_version: int,
+        value: str,
+        rollups: Dict[str, float],
+        indexed: Optional[Dict[str, Any]] = None
+    ) -> int:
+        """
+        Move a model instance out of its collection into the archive of its model type.
+
+        The record, its meta hash, collection membership and index entries are removed and
+        the encoded record is stored in the archive hash, in one atomic call that also adds
+        the record's contribution to the archive rollups.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            model_id: The UUID or string ID of the model instance
+            expected_version: The version the record must currently be at
+            value: The encoded record to archive
+            rollups: Increments of rollup fields (e.g. {'count:closed_won': 1})
+            indexed: Field values to index the archived record by (e.g. {'customer_id': ...})
+
+        Returns:
+            1 if the record was archived, 0 if it does not exist and -1 if it is no longer
+            at the expected version (or its index entries kept moving, see delete)
+        """
+        shard = self._get_shard(model_id)
+        meta_key = self._get_meta_key(model_type, model_id)
+        archive_indexes = [
+            self._get_archive_index_key(model_type, field, field_value, shard)
+            for field, field_value in (indexed or {}).items()
+        ]
+        increments = [arg for field, increment in rollups.items() for arg in (field, repr(float(increment)))]
+        for _ in range(self.max_update_retries):
+            # The script must be given the index keys the meta hash names
+            index = self._get_index_fields(self.redis_client.hgetall(meta_key))
+            keys = [
+                self._get_key(model_type, model_id),
+                meta_key,
+                self._get_collection_key(model_type, shard),
+                self._get_revision_key(model_type, shard),
+                self._get_change_stream_key(model_type, shard),
+                self._get_updated_key(model_type, shard),
+                self._get_tombstone_key(model_type, shard),
+                self._get_archive_key(model_type, shard),
+                self._get_rollup_key(model_type, shard),
+                *archive_indexes,
+                *index.values(),
+            ]
+            args = [
+                str(model_id), expected_version, value, self.change_stream_max_len, f"{ARCHIVED_TOMBSTONE}{model_id}",
+                len(archive_indexes), len(index), *index, *increments,
+            ]
+            status = int(self._run_script("archive", keys, args))
+            if status != -2:
+                return status
+        return -1
+
+    def get_archived(self, model_type: str, model_id: Union[UUID, str]) -> Optional[str]:
+        """
+        Get the encoded form of an archived model instance.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            model_id: The UUID or string ID of the model instance
+
+        Returns:
+            The encoded record, or None if it is not archived
+        """
+        key = self._get_archive_key(model_type, self._get_shard(model_id))
+        return self._read(lambda client: client.hget(key, str(model_id)))
+
+    def get_many_archived(self, model_type: str, ids: Any) -> Dict[str, str]:
+        """
+        Get the encoded forms of several archived model instances in one pipelined read.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            ids: The IDs of the model instances
+
+        Returns:
+            The encoded records by ID, of the instances that are archived
+        """
+        ids = [str(id) for id in ids]
+
+        def read(client: Any) -> List[Optional[str]]:
+            pipe = client.pipeline(transaction=False)
+            for id in ids:
+                pipe.hget(self._get_archive_key(model_type, self._get_shard(id)), id)
+            return pipe.execute()
+
+        values = self._read(read) if ids else []
+        return {id: value for id, value in zip(ids, values) if value is not None}
+
+    def get_archived_ids(self, model_type: str, field: str, value: Any) -> List[str]:
+        """
+        Get the IDs of the archived model instances with a field value.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            field: A field the records were archived with an index for (e.g. 'customer_id')
+            value: The field value
+
+        Returns:
+            The IDs of the archived model instances
+        """
+        keys = [self._get_archive_index_key(model_type, field, value, shard) for shard in self._get_shards()]
+        return self._read(lambda client: self._get_members(keys, client))
+
+    def delete_archived(
+        self,
+        model_type: str,
+        model_id: Union[UUID, str],
+        version: int,
+        rollups: Dict[str, float],
+        indexed: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """
+        Delete an archived model instance and subtract its contribution from the rollups.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            model_id: The UUID or string ID of the model instance
+            version: The version of the archived record
+            rollups: The increments the record added to the rollup fields when it was archived
+            indexed: The field values the record was indexed by when it was archived
+
+        Returns:
+            True if the archived record was deleted, False if it was not archived
+        """
+        shard = self._get_shard(model_id)
+        keys = [
+            self._get_archive_key(model_type, shard),
+            self._get_rollup_key(model_type, shard),
+            self._get_revision_key(model_type, shard),
+            self._get_change_stream_key(model_type, shard),
+            self._get_tombstone_key(model_type, shard),
+        ]
+        keys += [self._get_archive_index_key(model_type, field, field_value, shard) for field, field_value in (indexed or {}).items()]
+        args = [str(model_id), version, self.change_stream_max_len, f"{ARCHIVED_TOMBSTONE}{model_id}"]
+        for field, increment in rollups.items():
+            args += [field, repr(-float(increment))]
+        return bool(self._run_script("delete_archived", keys, args))
+
+    def get_rollups(self, model_type: str) -> Dict[str, float]:
+        """
+        Get the rollups over the archived instances of a model type, summed over all shards.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+
+        Returns:
+            The rollup values by field
+        """
+        keys = [self._get_rollup_key(model_type, shard) for shard in self._get_shards()]
+
+        def read(client: Any) -> List[Dict[str, str]]:
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            return pipe.execute()
+
+        rollups: Dict[str, float] = {}
+        for shard_rollups in self._read(read):
+            for field, value in shard_rollups.items():
+                rollups[field] = rollups.get(field, 0.0) + float(value)
+        return rollups
+
+    def count_archived(self, model_type: str) -> int:
+        """
+        Count the archived instances of a model type.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+
+        Returns:
+            The number of archived records
+        """
+        keys = [self._get_archive_key(model_type, shard) for shard in self._get_shards()]
+        return self._read(lambda client: sum(client.hlen(key) for key in keys))
+
+    def get_archive_snapshot(self, model_type: str, shard: Optional[int] = None) -> Tuple[Dict[str, str], Dict[str, float]]:
+        """
+        Read the archived records of a shard together with their rollups, atomically.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            shard: The shard of the archive in cluster mode
+
+        Returns:
+            The encoded records by ID and the rollup values by field
+        """
+        keys = [self._get_archive_key(model_type, shard), self._get_rollup_key(model_type, shard)]
+        archived, rollups = self._run_read_script("archive_snapshot", keys, [])
+        return (
+            dict(zip(archived[0::2], archived[1::2])),
+            {field: float(value) for field, value in zip(rollups[0::2], rollups[1::2])},
+        )
+
+    def adjust_rollups(self, model_type: str, shard: Optional[int], increments: Dict[str, float]) -> None:
+        """
+        Add corrections to the rollups of a shard of an archive (see service.rebuild).
+
+        The revision is incremented too, so that cached aggregates are recomputed.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            shard: The shard of the archive in cluster mode
+            increments: The corrections by rollup field
+        """
+        # Reads in this context must now see the write
+        _last_write.set(time.monotonic())
+        pipe = self.redis_client.pipeline(transaction=False)
+        for field, increment in increments.items():
+            pipe.hincrbyfloat(self._get_rollup_key(model_type, shard), field, increment)
+        pipe.incr(self._get_revision_key(model_type, shard))
+        pipe.execute()
+
+    def repair(self, model_type: str, model: BaseModel, value: str) -> bool:
+        """
+        Restore the meta hash, index entries, collection membership and delta sync entries
+        of a stored model instance from its record (see service.rebuild).
+
+        The record counts as changed: the revision is incremented and an 'update' event
+        recorded, so that caches, sync clients and change stream consumers pick it up.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            model: The model instance as decoded from value
+            value: The stored record the model was decoded from
+
+        Returns:
+            True if the record was repaired, False if it changed or was deleted since it
+            was read (or its index entries kept moving, see delete)
+        """
+        model_id = getattr(model, 'id')
+        shard = self._get_shard(model_id)
+        meta_key = self._get_meta_key(model_type, model_id)
+        index_args = self._index_args(model_type, model)
+        for _ in range(self.max_update_retries):
+            # The script must be given the index keys the meta hash names
+            index = self._get_index_fields(self.redis_client.hgetall(meta_key))
+            keys = [
+                self._get_key(model_type, model_id),
+                meta_key,
+                self._get_collection_key(model_type, shard),
+                self._get_revision_key(model_type, shard),
+                self._get_change_stream_key(model_type, shard),
+                self._get_updated_key(model_type, shard),
+                self._get_tombstone_key(model_type, shard),
+            ]
+
+            def position(key: Optional[str]) -> int:
+                # Every index key the script touches is passed in KEYS
+                if not key:
+                    return 0
+                keys.append(key)
+                return len(keys)
+
+            args = [str(model_id), value, getattr(model, 'version', None) or 1, self.change_stream_max_len]
+            for field, new_key, index_score in zip(index_args[0::3], index_args[1::3], index_args[2::3]):
+                args += [field, position(index.get(field)), position(new_key), index_score]
+            status = int(self._run_script("repair", keys, args))
+            if status != -1:
+                return bool(status)
+        return False
+
+    def purge(self, model_type: str, shard: Optional[int], ids: List[str]) -> int:
+        """
+        Remove the meta hashes, index entries, collection membership and delta sync entries
+        left behind by records that no longer exist (see service.rebuild).
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            shard: The shard of the records in cluster mode
+            ids: The IDs of the records, all of the shard
+
+        Returns:
+            The number of purged records (records that exist are left alone)
+        """
+        # The script must be given the index keys the meta hashes name
+        pipe = self.redis_client.pipeline(transaction=False)
+        for id in ids:
+            pipe.hgetall(self._get_meta_key(model_type, id))
+        metas = pipe.execute()
+
+        keys = [
+            self._get_collection_key(model_type, shard),
+            self._get_revision_key(model_type, shard),
+            self._get_change_stream_key(model_type, shard),
+            self._get_updated_key(model_type, shard),
+            self._get_tombstone_key(model_type, shard),
+        ]
+        args: List[Any] = [self.change_stream_max_len]
+        for id, meta in zip(ids, metas):
+            index = self._get_index_fields(meta)
+            keys += [self._get_key(model_type, id), self._get_meta_key(model_type, id), *index.values()]
+            args += [id, len(index), *index]
+        return int(self._run_script("purge", keys, args))
+
+    def unindex(self, model_type: str, index_key: str, meta_field: str, ids: List[str]) -> int:
+        """
+        Remove stale entries from an index set or sorted index (see service.rebuild).
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            index_key: The key of the index set or sorted index
+            meta_field: The meta field of the index ('idx:<field>' or 'zidx:<field>')
+            ids: The IDs to remove unless their meta hash names index_key, all of the
+                shard of the index
+
+        Returns:
+            The number of removed entries
+        """
+        keys = [index_key] + [self._get_meta_key(model_type, id) for id in ids]
+        return int(self._run_script("unindex", keys, [meta_field] + list(ids)))
+
+    def delete_cascade(
+        self,
+        model_type: str,
+        model_id: Union[UUID, str],
+        dependents: List[Tuple[str, str]],
+        batch_size: int = 500
+    ) -> Optional[Dict[str, List[str]]]:
+        """
+        Delete a model instance together with all records that reference it.
+
+        Dependent records are found through their secondary index on the referencing field
+        and deleted server-side, including their own index entries, in batches of at most
+        batch_size records per script call so that huge accounts never block Redis for long.
+        The parent is deleted last, so an interrupted cascade can simply be retried.
+
+        Args:
+            model_type: The type of model (e.g., 'customer')
+            model_id: The UUID or string ID of the model instance
+            dependents: (model type, indexed field) pairs of the dependent records,
+                e.g. [('opportunity', 'customer_id')]
+            batch_size: The maximum number of dependent records deleted per script call
+
+        Returns:
+            The IDs of the deleted dependent records by model type, or None if the model
+            instance was not found
+        """
+        if not self.redis_client.exists(self._get_key(model_type, model_id)):
+            return None
+
+        deleted: Dict[str, List[str]] = {}
+        for child_type, field in dependents:
+            if field not in self.indexes.get(child_type, []):
+                raise ValueError(f"{child_type}.{field} is not indexed")
+
+            child_ids = deleted.setdefault(child_type, [])
+            for shard in self._get_shards():
+                index_key = self._get_index_key(child_type, field, model_id, shard)
+                while True:
+                    batch = self.redis_client.srandmember(index_key, batch_size)
+                    if not batch:
+                        break
+
+                    # The script must be given every key it touches: read the index keys the
+                    # meta hashes of the batch name
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    for id in batch:
+                        pipe.hgetall(self._get_meta_key(child_type, id))
+                    keys = [
+                        index_key,
+                        self._get_collection_key(child_type, shard),
+                        self._get_revision_key(child_type, shard),
+                        self._get_change_stream_key(child_type, shard),
+                        self._get_updated_key(child_type, shard),
+                        self._get_tombstone_key(child_type, shard),
+                    ]
+                    args: List[Any] = [self.change_stream_max_len, f"idx:{field}"]
+                    for id, meta in zip(batch, pipe.execute()):
+                        index = self._get_index_fields(meta)
+                        keys += [self._get_key(child_type, id), self._get_meta_key(child_type, id), *index.values()]
+                        args += [id, len(index), *index]
+
+                    child_ids.extend(self._run_script("delete_children", keys, args))
+
+        self.delete(model_type, model_id)
+        return deleted
+
+    def get_ids_by_field(self, model_type: str, field: str, value: Any) -> List[str]:
+        """
+        Get the IDs of the model instances with a field value from its secondary index.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            field: An indexed field (e.g., 'stage')
+            value: The value to filter for
+
+        Returns:
+            The IDs of the matching model instances
+
+        Raises:
+            ValueError: If the field is not indexed
+        """
+        if field not in self.indexes.get(model_type, []):
+            raise ValueError(f"{model_type}.{field} is not indexed")
+        keys = self._get_index_keys(model_type, field, value)
+        return self._read(lambda client: self._get_members(keys, client))
+
+    def get_by_field(self, model_type: str, field: str, value: Any, model_class: Type[T]) -> List[T]:
+        """
+        Get model instances by a specific field value.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            field: The field to filter by
+            value: The value to filter for
+            model_class: The Pydantic model class
+
+        Returns:
+            A list of model instances matching the field value
+        """
+        # Use the secondary index if the field is indexed
+        if field in self.indexes.get(model_type, []):
+            return self._get_many(model_type, self.get_ids_by_field(model_type, field, value), model_class)
+
+        # Get all models of this type
+        all_models = self.get_all(model_type, model_class)
+
+        # Filter models by the specified field value
+        return [model for model in all_models if getattr(model, field, None) == value]
+
+    def query(self, model_type: str, model_class: Type[T], query: Query) -> QueryResult:
+        """
+        Find the IDs of the model instances matching a filter/sort query.
+
+        The plan answers as much as possible from the indexes, server-side: ':' conditions on
+        fields with an index set are intersected (SINTER semantics, several values are united
+        first), conditions on fields with a sorted index become score ranges, and a sort
+        field with a sorted index gives the order. The QUERY script combines them with
+        ZINTERSTORE in one call per shard. Only conditions and sorts without an index fall
+        back to scanning the candidate records; without any, Redis returns just the page.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            model_class: The Pydantic model class, for typing the scanned field values
+            query: The parsed query (see service.query.parse_query)
+
+        Returns:
+            The IDs of the page in order, the number of matching instances and the plan
+        """
+        set_fields = self.indexes.get(model_type, [])
+        sorted_fields = self.sorted_indexes.get(model_type, [])
+
+        sets: List[Condition] = []
+        ranges: List[Condition] = []
+        scan: List[Condition] = []
+        bounds: Dict[str, Tuple[Tuple[float, bool], Tuple[float, bool]]] = {}
+        for condition in query.conditions:
+            if condition.op == ":" and condition.field in set_fields:
+                sets.append(condition)
+            elif condition.field in sorted_fields and (condition.op != ":" or len(condition.values) == 1):
+                ranges.append(condition)
+                bounds[condition.field] = self._narrow_bounds(bounds.get(condition.field), condition)
+            else:
+                scan.append(condition)
+
+        index_sort = query.sort if query.sort in sorted_fields else None
+        scan_sort = query.sort if query.sort is not None and index_sort is None else None
+
+        # Redis returns just the page unless records still have to be scanned
+        paged = not scan and scan_sort is None
+        shards = self._get_shards()
+        offset, count = 0, -1
+        if paged and query.limit is not None:
+            count = query.offset + query.limit
+        if paged and len(shards) == 1:
+            offset, count = query.offset, (-1 if query.limit is None else query.limit)
+
+        token = uuid4().hex
+        total = 0
+        pages = []
+        for shard in shards:
+            shard_total, page = self._run_query(
+                model_type, shard, token, sets, bounds, index_sort, query.descending, offset, count
+            )
+            total += shard_total
+            pages.append(page)
+        entries = heapq.merge(*pages, reverse=query.descending) if len(pages) > 1 else pages[0]
+        ids = [id for _, id in entries]
+
+        plan: Dict[str, Any] = {
+            "index": [str(condition) for condition in sets + ranges],
+            "scan": [str(condition) for condition in scan],
+            "sort": None,
+            "shards": len(shards),
+        }
+        if query.sort is not None:
+            plan["sort"] = {
+                "field": query.sort,
+                "order": "desc" if query.descending else "asc",
+                "using": "index" if index_sort else "scan",
+            }
+
+        if paged:
+            if len(shards) > 1:
+                end = None if query.limit is None else query.offset + query.limit
+                ids = ids[query.offset:end]
+            plan["scanned"] = 0
+            return QueryResult(ids, total, plan)
+
+        # Fallback: check the remaining conditions (and sort) on the candidate records
+        scan_fields = list(dict.fromkeys([condition.field for condition in scan] + ([scan_sort] if scan_sort else [])))
+        records = self.get_many_raw(model_type, ids)
+        matched = []
+        for id, record in records.items():
+            values = typed_values(model_class, {field: record.get(field) for field in scan_fields})
+            if all(matches(condition, values[condition.field]) for condition in scan):
+                matched.append((id, values))
+        if scan_sort is not None:
+            matched.sort(key=lambda entry: sort_key(entry[1][scan_sort]), reverse=query.descending)
+
+        plan["scanned"] = len(records)
+        end = None if query.limit is None else query.offset + query.limit
+        return QueryResult([id for id, _ in matched[query.offset:end]], len(matched), plan)
+
+    def find(
+        self,
+        model_type: str,
+        model_class: Type[T],
+        query: Query,
+        fields: Optional[List[str]] = None
+    ) -> QueryResult:
+        """
+        Run a filter/sort query and load the page of model instances.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            model_class: The Pydantic model class
+            query: The parsed query (see service.query.parse_query)
+            fields: Only load these fields, as plain dicts (see get_fields)
+
+        Returns:
+            The model instances (or projections) of the page, the number of matching
+            instances and the plan
+        """
+        result = self.query(model_type, model_class, query)
+        if fields is None:
+            return result._replace(items=self._get_many(model_type, result.items, model_class))
+
+        records = self.get_many_raw(model_type, result.items)
+        return result._replace(items=[self._project(records[id], fields) for id in result.items if id in records])
+
+    def _narrow_bounds(
+        self,
+        bounds: Optional[Tuple[Tuple[float, bool], Tuple[float, bool]]],
+        condition: Condition
+    ) -> Tuple[Tuple[float, bool], Tuple[float, bool]]:
+        """
+        Narrow the score range of a sorted index by a condition.
+
+        Args:
+            bounds: The current (low, high) bounds as (score, exclusive) pairs, or None
+            condition: A comparison, or a ':' condition with a single value
+
+        Returns:
+            The narrowed bounds
+        """
+        low, high = bounds or ((-math.inf, False), (math.inf, False))
+        value = score(condition.values[0])
+        if condition.op in (":", ">", ">="):
+            low = max(low, (value, condition.op == ">"))
+        if condition.op in (":", "<", "<="):
+            high = min(high, (value, condition.op == "<"), key=lambda bound: (bound[0], not bound[1]))
+        return low, high
+
+    def _score_bound(self, bound: Tuple[float, bool]) -> str:
+        """
+        Format a (score, exclusive) bound as a Redis score range argument.
+
+        Args:
+            bound: The score and whether it is excluded
+
+        Returns:
+            The bound, e.g. '(1000.0', '5.0' or '-inf'
+        """
+        value, exclusive = bound
+        if math.isinf(value):
+            return "+inf" if value > 0 else "-inf"
+        return f"{'(' if exclusive else ''}{value!r}"
+
+    def _run_query(
+        self,
+        model_type: str,
+        shard: Optional[int],
+        token: str,
+        sets: List[Condition],
+        bounds: Dict[str, Tuple[Tuple[float, bool], Tuple[float, bool]]],
+        sort: Optional[str],
+        descending: bool,
+        offset: int,
+        count: int
+    ) -> Tuple[int, List[Tuple[float, str]]]:
+        """
+        Run the indexed part of a query plan on one shard with the QUERY script.
+
+        Args:
+            model_type: The type of model (e.g., 'opportunity')
+            shard: The shard, or None when not in cluster mode
+            token: Unique name part of the temporary keys of this query
+            sets: ':' conditions on fields with an index set
+            bounds: Score ranges by field with a sorted index
+            sort: The sort field with a sorted index, or None
+            descending: Whether to sort in descending order
+            offset: The number of matches to skip
+            count: The number of matches to return (-1 for all)
+
+        Returns:
+            The number of matches on the shard and the (score, ID) pairs of the page
+        """
+        range_fields = [field for field in bounds if field != sort]
+        unions = [condition for condition in sets if len(condition.values) > 1]
+        nulls = sort is not None and sort not in bounds
+        temporary = 1 + nulls + len(range_fields) + len(unions)
+
+        # The temporary keys come first and carry the shard's hash tag, like every key used
+        prefix = self._get_prefix(model_type, shard)
+        keys = [f"{prefix}query:{token}:{n}" for n in range(temporary)]
+        scratch = iter(range(2, temporary + 1))
+
+        def key(name: str) -> int:
+            keys.append(name)
+            return len(keys)
+
+        plan: Dict[str, Any] = {
+            "base": key(self._get_collection_key(model_type, shard)),
+            "ranges": [],
+            "sets": [],
+            "min": "-inf",
+            "max": "+inf",
+            "desc": descending,
+            "offset": offset,
+            "count": count,
+            "temporary": temporary,
+        }
+        if sort is not None:
+            plan["sort"] = key(self._get_sorted_index_key(model_type, sort, shard))
+            if nulls:
+                plan["nulls"] = next(scratch)
+            else:
+                low, high = bounds[sort]
+                plan["min"], plan["max"] = self._score_bound(low), self._score_bound(high)
+        for field in range_fields:
+            low, high = bounds[field]
+            plan["ranges"].append([
+                next(scratch),
+                key(self._get_sorted_index_key(model_type, field, shard)),
+                self._score_bound(low),
+                self._score_bound(high),
+            ])
+        for condition in sets:
+            union = next(scratch) if len(condition.values) > 1 else 0
+            plan["sets"].append([union] + [
+                key(self._get_index_key(model_type, condition.field, value, shard)) for value in condition.values
+            ])
+
+        # The temporary keys need the primary, but unlike the other scripts this is no write
+        # that later reads of the caller have to see
+        total, page = self._run_read_script("query", keys, [json.dumps(plan)])
+        return int(total), [(float(page[i + 1]), page[i]) for i in range(0, len(page), 2)]
+
+    def get_with_dependents(
+        self,
+        model_type: str,
+        model_id: Union[UUID, str],
+        model_class: Type[T],
+        dependents: List[Tuple[str, str, Type[BaseModel]]]
+    ) -> Tuple[Optional[T], Dict[str, List[BaseModel]]]:
+        """
+        Get a model instance together with the records that reference it, in one round trip.
+
+        The parent record and, for each dependent type, all records listed in its secondary
+        index on the referencing field are fetched in a single pipeline (the dependent
+        records through SORT ... BY nosort GET, which dereferences the index server-side).
+        In cluster mode the dependent records may live in other slots, so they are read with
+        a second, slot-split round trip instead.
+
+        Args:
+            model_type: The type of model (e.g., 'customer')
+            model_id: The UUID or string ID of the model instance
+            model_class: The Pydantic model class
+            dependents: (model type, indexed field, model class) triples of the dependent
+                records, e.g. [('opportunity', 'customer_id', Opportunity)]
+
+        Returns:
+            The model instance (None if not found) and the dependent records by model type
+        """
+        for child_type, field, _ in dependents:
+            if field not in self.indexes.get(child_type, []):
+                raise ValueError(f"{child_type}.{field} is not indexed")
+
+        if self.cluster:
+            model = self.get(model_type, model_id, model_class)
+            if model is None:
+                return None, {}
+            return model, {
+                child_type: self.get_by_field(child_type, field, model_id, child_class)
+                for child_type, field, child_class in dependents
+            }
+
+        def read(client: Any) -> List[Any]:
+            pipe = client.pipeline(transaction=False)
+            pipe.get(self._get_key(model_type, model_id))
+            for child_type, field, _ in dependents:
+                pipe.sort(
+                    self._get_index_key(child_type, field, model_id),
+                    by="nosort",
+                    get=self._get_key(child_type, "*"),
+                )
+            return pipe.execute()
+
+        model_json, *children = self._read(read)
+
+        if model_json is None:
+            return None, {}
+
+        related = {
+            child_type: [self._deserialize(child_type, value, child_class) for value in values if value is not None]
+            for (child_type, _, child_class), values in zip(dependents, children)
+        }
+        return self._deserialize(model_type, model_json, model_class), related
+
+    def _save(
+        self,
+        model_type: str,
+        model_id: Union[UUID, str],
+        model: BaseModel,
+        model_json: str,
+        mode: str,
+        expected_version: int,
+        index: Optional[Dict[str, str]] = None
+    ) -> Tuple[int, int]:
+        """
+        Store a serialized model together with its collection membership and index entries.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_id: The UUID or string ID of the model instance
+            model: The Pydantic model instance
+            model_json: The serialized model
+            mode: 'create' if the record must not exist yet, 'update' if it must exist
+            expected_version: The version the record must currently be at
+            index: The index keys the meta hash names, by meta field (none for a new record)
+
+        Returns:
+            The script status (1 written, 0 not found, -1 version conflict or changed index
+            keys) and the new or current version
+        """
+        keys = [
+            self._get_key(model_type, model_id),
+            self._get_meta_key(model_type, model_id),
+            self._get_collection_key(model_type, self._get_shard(model_id)),
+            self._get_revision_key(model_type, self._get_shard(model_id)),
+            self._get_change_stream_key(model_type, self._get_shard(model_id)),
+            self._get_updated_key(model_type, self._get_shard(model_id)),
+            self._get_tombstone_key(model_type, self._get_shard(model_id)),
+        ]
+
+        def position(key: Optional[str]) -> int:
+            # Every index key the script touches is passed in KEYS
+            if not key:
+                return 0
+            keys.append(key)
+            return len(keys)
+
+        args = [str(model_id), model_json, mode, expected_version, self.change_stream_max_len]
+        index_args = self._index_args(model_type, model)
+        for field, new_key, index_score in zip(index_args[0::3], index_args[1::3], index_args[2::3]):
+            args += [field, position((index or {}).get(field)), position(new_key), index_score]
+        status, version = self._run_script("save", keys, args)
+        return int(status), int(version)
+
+    def _run_script(self, name: str, keys: List[str], args: List[Any]) -> Any:
+        """
+        Run one of the registered Lua scripts.
+
+        Args:
+            name: The script name in redis_scripts.SCRIPTS
+            keys: The Redis keys the script accesses
+            args: The script arguments
+
+        Returns:
+            The script result
+        """
+        if self._client is None:
+            self.connect()
+        # All scripts write; reads in this context must now see the write
+        _last_write.set(time.monotonic())
+        return self._scripts[name](keys=keys, args=args)
+
+    def _run_read_script(self, name: str, keys: List[str], args: List[Any]) -> Any:
+        """
+        Run one of the registered Lua scripts that only reads (or only writes temporary keys).
+
+        It runs on the primary like every script, but unlike _run_script does not send
+        the later reads of the current context to the primary.
+
+        Args:
+            name: The script name in redis_scripts.SCRIPTS
+            keys: The Redis keys the script accesses
+            args: The script arguments
+
+        Returns:
+            The script result
+        """
+        if self._client is None:
+            self.connect()
+        return self._scripts[name](keys=keys, args=args)
+
+    def _get_many(self, model_type: str, ids: Any, model_class: Type[T]) -> List[T]:
+        """
+        Get several model instances with a single MGET.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            ids: The IDs of the model instances
+            model_class: The Pydantic model class
+
+        Returns:
+            A list of the model instances that exist
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+
+        keys = [self._get_key(model_type, id) for id in ids]
+        values = self._read(lambda client: self._mget(keys, client))
+        return [self._deserialize(model_type, value, model_class) for value in values if value is not None]
+
+    def record_change(self, model_type: str, op: str, model_id: Union[UUID, str], version: int) -> None:
+        """
+        Record a change of a record that is not stored by the Redis Manager (e.g. the in-memory
+        services) in the change stream of its model type.
+
+        Only if capture_memory_changes is set: the in-memory services otherwise run without
+        Redis. The event is appended in the background, shortly after the write (see
+        service.changes.ChangeBuffer); writes through the Redis Manager record their changes
+        atomically themselves.
+
+        Args:
+            model_type: The type of model (e.g., 'activity')
+            op: 'create', 'update' or 'delete'
+            model_id: The UUID or string ID of the changed record
+            version: The record version after the change (the last version for deletes)
+        """
+        if self.capture_memory_changes:
+            self.changes.record(model_type, op, model_id, version)
+
+    def append_change(self, pipe: Any, model_type: str, op: str, model_id: Union[UUID, str], version: int) -> None:
+        """
+        Queue the XADD of a change event on a pipeline.
+
+        Args:
+            pipe: The pipeline
+            model_type: The type of model (e.g., 'activity')
+            op: 'create', 'update' or 'delete'
+            model_id: The UUID or string ID of the changed record
+            version: The record version after the change
+        """
+        pipe.xadd(
+            self._get_change_stream_key(model_type, self._get_shard(model_id)),
+            {"op": op, "id": str(model_id), "version": version},
+            maxlen=self.change_stream_max_len or None,
+            approximate=True,
+        )
+
+    def lease(self, key: str, token: str, seconds: float) -> bool:
+        """
+        Take or renew the lease of a process on a resource, or release it.
+
+        Args:
+            key: The Redis key of the lease
+            token: A token unique to the process
+            seconds: The lease duration, or 0 to release the lease
+
+        Returns:
+            Whether the process holds the lease now (or released it); False if another
+            process holds it
+        """
+        return bool(self._run_script("lease", [key], [token, int(seconds * 1000)]))
+
+    def trim_changes(self, model_type: str, max_age: float) -> int:
+        """
+        Drop change events older than max_age seconds, except those that a consumer group
+        has not read or not acknowledged yet.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            max_age: The retention in seconds
+
+        Returns:
+            The number of dropped events (approximately: whole stream nodes are trimmed)
+        """
+        seconds, microseconds = self.redis_client.time()
+        oldest = (int((seconds + microseconds / 1e6 - max_age) * 1000), 0)
+
+        trimmed = 0
+        for key in self._get_change_stream_keys(model_type):
+            if not self.redis_client.exists(key):
+                continue
+            min_id = oldest
+            for group in self.redis_client.xinfo_groups(key):
+                # Entries after the last delivered one are unread; pending ones unacknowledged
+                min_id = min(min_id, self._parse_stream_id(group["last-delivered-id"]))
+                pending = self.redis_client.xpending(key, group["name"])
+                if pending["pending"]:
+                    min_id = min(min_id, self._parse_stream_id(pending["min"]))
+            trimmed += self.redis_client.xtrim(key, minid=f"{min_id[0]}-{min_id[1]}", approximate=True)
+        return trimmed
+
+    def get_sync_cursor(self, model_type: str) -> List[int]:
+        """
+        Get the delta sync cursor of the current state of a model type.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+
+        Returns:
+            The revision of every shard
+        """
+        keys = [self._get_revision_key(model_type, shard) for shard in self._get_shards()]
+        return [int(value or 0) for value in self._mget(keys)]
+
+    def get_changes(
+        self,
+        model_type: str,
+        model_class: Type[T],
+        since: Optional[List[int]],
+        limit: int = 1000
+    ) -> ChangeSet:
+        """
+        Get the model instances created, updated or deleted since a delta sync cursor.
+
+        Every write stores the record's ID in a sorted set scored by the revision of the
+        change (and deletes and archiving leave a tombstone scored the same way), so this
+        reads only the changed records, however large the collection. Records changed again after the
+        returned cursor may already show that newer state; the change is then sent again
+        with the next cursor.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            model_class: The Pydantic model class
+            since: A cursor from get_sync_cursor or a previous ChangeSet, or None for all
+            limit: The maximum number of changes per shard (the rest follow with has_more)
+
+        Returns:
+            The changed model instances, the IDs of deleted and of archived ones and the
+            next cursor. If the cursor cannot be continued (tombstones after it were trimmed,
+            or it is ahead of the data), all model instances with reset set.
+        """
+        # The cursor is read on the primary, so are the records: a lagging replica could miss
+        # changes the cursor already moves past
+        with self.consistent_reads(primary=True):
+            return self._get_changes(model_type, model_class, since, limit)
+
+    def _get_changes(
+        self,
+        model_type: str,
+        model_class: Type[T],
+        since: Optional[List[int]],
+        limit: int
+    ) -> ChangeSet:
+        shards = self._get_shards()
+        if since is not None and len(since) == len(shards):
+            cursor, updated_ids, deleted, archived, has_more = [], [], [], [], False
+            for shard, position in zip(shards, since):
+                keys = [
+                    self._get_revision_key(model_type, shard),
+                    self._get_updated_key(model_type, shard),
+                    self._get_tombstone_key(model_type, shard),
+                    self._get_tombstone_key(model_type, shard) + ":horizon",
+                ]
+                result = self._run_read_script("changes_since", keys, [position, limit])
+                if result[0] == -1:
+                    break
+                shard_cursor, revision, shard_updated, shard_deleted = result
+                cursor.append(int(shard_cursor))
+                updated_ids.extend(shard_updated)
+                for id in shard_deleted:
+                    if id.startswith(ARCHIVED_TOMBSTONE):
+                        archived.append(id[len(ARCHIVED_TOMBSTONE):])
+                    else:
+                        deleted.append(id)
+                has_more = has_more or int(shard_cursor) < int(revision)
+            else:
+                return ChangeSet(cursor, self._get_many(model_type, updated_ids, model_class), deleted, has_more, archived=archived)
+
+        # Full resync; reading the cursor first means nothing written meanwhile is missed
+        cursor = self.get_sync_cursor(model_type)
+        return ChangeSet(cursor, self.get_all(model_type, model_class), [], reset=True)
+
+    def trim_tombstones(self, model_type: str, keep: int) -> int:
+        """
+        Drop the oldest tombstones of a model type beyond keep per shard.
+
+        Clients whose cursor is older than a dropped tombstone get a full resync.
+
+        Args:
+            model_type: The type of model (e.g., 'contact', 'customer')
+            keep: The number of tombstones to keep per shard
+
+        Returns:
+            The number of dropped tombstones
+        """
+        dropped = 0
+        for shard in self._get_shards():
+            key = self._get_tombstone_key(model_type, shard)
+            dropped += self._run_script("trim_tombstones", [key, key + ":horizon"], [keep])
+        return dropped
+
+    def _parse_stream_id(self, entry_id: str) -> Tuple[int, int]:
+        """
+        Split a stream entry ID into its (milliseconds, sequence) parts, for comparing IDs.
+
+        Args:
+            entry_id: The entry ID, e.g. '1700000000000-0'
+
+        Returns:
+            The milliseconds and sequence number
+        """
+        milliseconds, _, sequence = entry_id.partition("-")
+        return int(milliseconds), int(sequence or 0)
 
     def close(self):
         """
-        Close the Redis connection.
+        Close the Redis connection and its pool; the next use reconnects.
         """
-        self.redis_client.close()
+        # Append the change events still queued while the connection is open
+        self.changes.close()
+        with self._connect_lock:
+            if self.replicas is not None:
+                self.replicas.close()
+                self.replicas = None
+            if self._client is not None:
+                self._client.close()
+                if not self.cluster:
+                    self._client.connection_pool.disconnect()
+                self._client = None
 
 # Create a singleton instance of the Redis Manager
 # This will use environment variables if available, otherwise default values
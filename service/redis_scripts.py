@@ -0,0 +1,631 @@
+"""
+Lua scripts used by the Redis Manager.
+
+Each mutation runs as a single script so that the record, its collection set and its
+secondary index entries are always changed together in one round trip. The scripts are
+registered with redis-py, which calls them through EVALSHA and transparently reloads the
+script cache (SCRIPT LOAD) if Redis answers NOSCRIPT, e.g. after a restart.
+
+Every record has a small meta hash next to it. For each indexed field the meta hash stores
+the index key the record is currently a member of (field name ``idx:<field>`` for index
+sets, ``zidx:<field>`` for sorted indexes), so that stale index entries can be removed
+without having to parse the stored JSON. The meta hash also holds the record's version
+counter (field ``version``).
+
+Redis (and Redis Cluster in particular) requires a script to declare every key it accesses
+in KEYS. The caller therefore reads the meta hash first and passes the index keys it names
+as KEYS; SAVE and DELETE check that the meta hash still names exactly those keys and
+otherwise change nothing and report a conflict, after which the caller reads it again.
+
+Every model type also has a revision counter (``{model}:revision``) that the scripts
+increment on each change to the collection, so that readers can tell whether anything
+changed without reading the records.
+
+Every change is also appended to the model type's change stream (``{model}:changes``, see
+service.changes) in the same script, so consumers never miss a write or see one that failed.
+
+For delta sync, the sorted set ``{model}:updated`` holds the IDs of all records scored by
+the revision of their last change, and ``{model}:deleted`` the tombstones of deleted records
+scored by the revision of their deletion.
+
+Archived records (see service.archive) live in the hash ``{model}:archive`` (ID -> encoded
+record) with their rollups in ``{model}:archive:rollups`` and index sets
+``{model}:archive:<field>:<value>``; they are no longer part of the collection.
+
+Everything but the record keys can be derived from them again: service.rebuild checks
+and repairs the derived keys with REPAIR, PURGE, UNINDEX and ARCHIVE_SNAPSHOT.
+"""
+
+# Shared by the mutation scripts: append a change event to a change stream, capped at about
+# max_len entries (0 for no cap)
+_RECORD_CHANGE = """
+local function record_change(stream, max_len, op, id, version)
+    if tonumber(max_len) > 0 then
+        redis.call('XADD', stream, 'MAXLEN', '~', max_len, '*', 'op', op, 'id', id, 'version', version)
+    else
+        redis.call('XADD', stream, '*', 'op', op, 'id', id, 'version', version)
+    end
+end
+"""
+
+# Shared by the delete scripts: remove a record from the index keys its meta hash names.
+# index maps the meta fields to the declared index keys; if the meta hash names any other
+# key, nothing is removed and false is returned. Otherwise returns the record version.
+_UNINDEX_RECORD = """
+local function unindex_record(meta_key, id, index)
+    local meta = redis.call('HGETALL', meta_key)
+    local version = 0
+    for i = 1, #meta, 2 do
+        if meta[i] == 'version' then
+            version = meta[i + 1]
+        elseif string.sub(meta[i], 1, 4) == 'idx:' or string.sub(meta[i], 1, 5) == 'zidx:' then
+            if index[meta[i]] ~= meta[i + 1] then
+                return false
+            end
+        end
+    end
+    for i = 1, #meta, 2 do
+        if string.sub(meta[i], 1, 4) == 'idx:' then
+            redis.call('SREM', meta[i + 1], id)
+        elseif string.sub(meta[i], 1, 5) == 'zidx:' then
+            redis.call('ZREM', meta[i + 1], id)
+        end
+    end
+    return version
+end
+"""
+
+# Store a record and keep its collection set and secondary indexes in sync.
+#
+# Writes are compare-and-set on the record's version counter, which lives in the meta hash
+# (field ``version``, 0 when missing). A write only succeeds if the current version equals
+# the expected version, and then increments it.
+#
+# KEYS[1] record key, KEYS[2] meta key, KEYS[3] collection key, KEYS[4] revision key,
+# KEYS[5] change stream key, KEYS[6] updated set key, KEYS[7] tombstone set key,
+# KEYS[8..] the old and new index keys of the record
+# ARGV[1] record id, ARGV[2] serialized record,
+# ARGV[3] mode: 'create' (record must not exist) or 'update' (record must exist),
+# ARGV[4] expected version, ARGV[5] change stream max length,
+# ARGV[6..] quadruples of (meta field, position in KEYS of the index key the meta hash
+# names or 0 for none, position in KEYS of the new index key or 0 when the field is unset,
+# score): the meta field is 'idx:<field>' for an index set and 'zidx:<field>' for a sorted
+# index, which stores the record with the score (empty for index sets)
+#
+# Returns {1, new version} on success, {0, 0} if an updated record does not exist and
+# {-1, current version} on a version conflict or if the meta hash no longer names the
+# declared old index keys.
+SAVE = _RECORD_CHANGE + """
+local function declared(position)
+    position = tonumber(position)
+    return position > 0 and KEYS[position]
+end
+
+local exists = redis.call('EXISTS', KEYS[1]) == 1
+local current = tonumber(redis.call('HGET', KEYS[2], 'version') or '0')
+if ARGV[3] == 'update' and not exists then
+    return {0, 0}
+end
+if (ARGV[3] == 'create' and exists) or current ~= tonumber(ARGV[4]) then
+    return {-1, current}
+end
+for i = 6, #ARGV, 4 do
+    if redis.call('HGET', KEYS[2], ARGV[i]) ~= declared(ARGV[i + 1]) then
+        return {-1, current}
+    end
+end
+for i = 6, #ARGV, 4 do
+    local field = ARGV[i]
+    local old_key = declared(ARGV[i + 1])
+    local new_key = declared(ARGV[i + 2])
+    if string.sub(field, 1, 5) == 'zidx:' then
+        -- The score may change while the key stays the same
+        if old_key and old_key ~= new_key then
+            redis.call('ZREM', old_key, ARGV[1])
+        end
+        if new_key then
+            redis.call('ZADD', new_key, ARGV[i + 3], ARGV[1])
+            redis.call('HSET', KEYS[2], field, new_key)
+        else
+            redis.call('HDEL', KEYS[2], field)
+        end
+    elseif old_key ~= new_key then
+        if old_key then
+            redis.call('SREM', old_key, ARGV[1])
+        end
+        if new_key then
+            redis.call('SADD', new_key, ARGV[1])
+            redis.call('HSET', KEYS[2], field, new_key)
+        else
+            redis.call('HDEL', KEYS[2], field)
+        end
+    end
+end
+redis.call('HSET', KEYS[2], 'version', current + 1)
+redis.call('SET', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[3], ARGV[1])
+local revision = redis.call('INCR', KEYS[4])
+redis.call('ZADD', KEYS[6], revision, ARGV[1])
+redis.call('ZREM', KEYS[7], ARGV[1])
+record_change(KEYS[5], ARGV[5], ARGV[3], ARGV[1], current + 1)
+return {1, current + 1}
+"""
+
+# Delete a record together with its meta hash, collection membership and index entries.
+#
+# KEYS[1] record key, KEYS[2] meta key, KEYS[3] collection key, KEYS[4] revision key,
+# KEYS[5] change stream key, KEYS[6] updated set key, KEYS[7] tombstone set key,
+# KEYS[8..] the index keys the meta hash names
+# ARGV[1] record id, ARGV[2] change stream max length, ARGV[3..] the meta fields of the
+# index keys, in the same order
+#
+# Returns 1 if the record existed, 0 otherwise and -1 if the meta hash no longer names the
+# declared index keys.
+DELETE = _RECORD_CHANGE + _UNINDEX_RECORD + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local index = {}
+for n = 8, #KEYS do
+    index[ARGV[n - 5]] = KEYS[n]
+end
+local version = unindex_record(KEYS[2], ARGV[1], index)
+if not version then
+    return -1
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('SREM', KEYS[3], ARGV[1])
+local revision = redis.call('INCR', KEYS[4])
+redis.call('ZREM', KEYS[6], ARGV[1])
+redis.call('ZADD', KEYS[7], revision, ARGV[1])
+record_change(KEYS[5], ARGV[2], 'delete', ARGV[1], version)
+return 1
+"""
+
+# Move a record into the archive: remove it like DELETE and store its encoded form in the
+# archive hash, adding its contribution to the rollups in the same step.
+#
+# The move is compare-and-set on the record version, so a record that changed after it was
+# selected for archiving stays where it is. Sync clients see an archived tombstone (ARGV[5],
+# so that they do not drop a record that is still fetchable), change stream consumers an
+# 'archive' event.
+#
+# KEYS[1] record key, KEYS[2] meta key, KEYS[3] collection key, KEYS[4] revision key,
+# KEYS[5] change stream key, KEYS[6] updated set key, KEYS[7] tombstone set key,
+# KEYS[8] archive hash key, KEYS[9] rollup hash key, KEYS[10..9+n] the n archive index sets,
+# KEYS[10+n..] the index keys the meta hash names
+# ARGV[1] record id, ARGV[2] expected version, ARGV[3] encoded record,
+# ARGV[4] change stream max length, ARGV[5] archived tombstone member, ARGV[6] n,
+# ARGV[7] the number m of index keys, ARGV[8..7+m] the meta fields of the index keys, in the
+# same order, ARGV[8+m..] pairs of (rollup field, increment)
+#
+# Returns 1 if the record was archived, 0 if it does not exist, -1 on a version conflict and
+# -2 if the meta hash no longer names the declared index keys.
+ARCHIVE = _RECORD_CHANGE + _UNINDEX_RECORD + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local version = redis.call('HGET', KEYS[2], 'version') or '0'
+if tonumber(version) ~= tonumber(ARGV[2]) then
+    return -1
+end
+local archive_indexes = tonumber(ARGV[6])
+local indexes = tonumber(ARGV[7])
+local index = {}
+for n = 1, indexes do
+    index[ARGV[7 + n]] = KEYS[9 + archive_indexes + n]
+end
+if not unindex_record(KEYS[2], ARGV[1], index) then
+    return -2
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('SREM', KEYS[3], ARGV[1])
+local revision = redis.call('INCR', KEYS[4])
+redis.call('ZREM', KEYS[6], ARGV[1])
+redis.call('ZADD', KEYS[7], revision, ARGV[5])
+redis.call('HSET', KEYS[8], ARGV[1], ARGV[3])
+for i = 10, 9 + archive_indexes do
+    redis.call('SADD', KEYS[i], ARGV[1])
+end
+for i = 8 + indexes, #ARGV, 2 do
+    redis.call('HINCRBYFLOAT', KEYS[9], ARGV[i], ARGV[i + 1])
+end
+record_change(KEYS[5], ARGV[4], 'archive', ARGV[1], version)
+return 1
+"""
+
+# Delete an archived record, subtracting its contribution from the rollups. Its archived
+# tombstone is replaced by a regular one.
+#
+# KEYS[1] archive hash key, KEYS[2] rollup hash key, KEYS[3] revision key,
+# KEYS[4] change stream key, KEYS[5] tombstone set key, KEYS[6..] archive index sets
+# ARGV[1] record id, ARGV[2] record version, ARGV[3] change stream max length,
+# ARGV[4] archived tombstone member, ARGV[5..] pairs of (rollup field, increment)
+#
+# Returns 1 if the record was archived, 0 otherwise (e.g. it was deleted concurrently).
+DELETE_ARCHIVED = _RECORD_CHANGE + """
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+for i = 6, #KEYS do
+    redis.call('SREM', KEYS[i], ARGV[1])
+end
+for i = 5, #ARGV, 2 do
+    redis.call('HINCRBYFLOAT', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+local revision = redis.call('INCR', KEYS[3])
+redis.call('ZREM', KEYS[5], ARGV[4])
+redis.call('ZADD', KEYS[5], revision, ARGV[1])
+record_change(KEYS[4], ARGV[3], 'delete', ARGV[1], ARGV[2])
+return 1
+"""
+
+# Delete one batch of dependent records listed in a parent's index set.
+#
+# KEYS[1] parent index set (e.g. opportunity:customer_id:<customer id>), KEYS[2] child collection key,
+# KEYS[3] child revision key, KEYS[4] child change stream key, KEYS[5] child updated set key,
+# KEYS[6] child tombstone set key, KEYS[7..] per child: its record key, its meta key and the
+# index keys its meta hash names
+# ARGV[1] change stream max length, ARGV[2] meta field of the parent index set
+# (e.g. idx:customer_id), ARGV[3..] per child: its id, the number n of its index keys and
+# the n meta fields of the index keys, in the order of KEYS
+#
+# Returns the ids of the deleted children. Children that left the parent's index set or whose
+# meta hash changed since it was read are skipped; stale entries of children that do not
+# reference the parent are removed from the index set.
+DELETE_CHILDREN = _RECORD_CHANGE + _UNINDEX_RECORD + """
+local deleted = {}
+local revision
+local k = 7
+local a = 3
+while a <= #ARGV do
+    local id = ARGV[a]
+    local record_key, meta_key = KEYS[k], KEYS[k + 1]
+    local index = {}
+    for n = 1, tonumber(ARGV[a + 1]) do
+        index[ARGV[a + 1 + n]] = KEYS[k + 1 + n]
+    end
+    k = k + 2 + tonumber(ARGV[a + 1])
+    a = a + 2 + tonumber(ARGV[a + 1])
+    if redis.call('SISMEMBER', KEYS[1], id) == 0 then
+        -- Moved to another parent or deleted since the batch was read
+    elseif index[ARGV[2]] ~= KEYS[1] then
+        -- A stale entry (see service.rebuild): the child does not reference the parent
+        redis.call('SREM', KEYS[1], id)
+    else
+        local version = unindex_record(meta_key, id, index)
+        if version then
+            revision = revision or redis.call('INCR', KEYS[3])
+            redis.call('DEL', record_key, meta_key)
+            redis.call('SREM', KEYS[2], id)
+            redis.call('ZREM', KEYS[5], id)
+            redis.call('ZADD', KEYS[6], revision, id)
+            record_change(KEYS[4], ARGV[1], 'delete', id, version)
+            table.insert(deleted, id)
+        end
+    end
+end
+return deleted
+"""
+
+# Repair the derived keys of a stored record (see service.rebuild): its index entries and
+# meta hash, collection membership, delta sync entries and version counter.
+#
+# The repair is computed from the value that was read, and only applied if the record still
+# has that value; a record written in between went through SAVE and is consistent anyway.
+#
+# KEYS[1] record key, KEYS[2] meta key, KEYS[3] collection key, KEYS[4] revision key,
+# KEYS[5] change stream key, KEYS[6] updated set key, KEYS[7] tombstone set key,
+# KEYS[8..] the old and new index keys of the record
+# ARGV[1] record id, ARGV[2] the record value the repair was computed from,
+# ARGV[3] version to set if the meta hash has none, ARGV[4] change stream max length,
+# ARGV[5..] quadruples of (meta field, position in KEYS of the index key the meta hash names
+# or 0 for none, position in KEYS of the new index key or 0 when the field is unset, score)
+# as in SAVE
+#
+# Returns 1 if the record was repaired, 0 if it changed or was deleted since it was read and
+# -1 if the meta hash no longer names the declared old index keys.
+REPAIR = _RECORD_CHANGE + """
+local function declared(position)
+    position = tonumber(position)
+    return position > 0 and KEYS[position]
+end
+
+if redis.call('GET', KEYS[1]) ~= ARGV[2] then
+    return 0
+end
+for i = 5, #ARGV, 4 do
+    if redis.call('HGET', KEYS[2], ARGV[i]) ~= declared(ARGV[i + 1]) then
+        return -1
+    end
+end
+for i = 5, #ARGV, 4 do
+    local field = ARGV[i]
+    local old_key = declared(ARGV[i + 1])
+    local new_key = declared(ARGV[i + 2])
+    local sorted = string.sub(field, 1, 5) == 'zidx:'
+    if old_key and old_key ~= new_key then
+        redis.call(sorted and 'ZREM' or 'SREM', old_key, ARGV[1])
+    end
+    -- Added even if the meta hash already names the key: the entry itself may be missing
+    if not new_key then
+        redis.call('HDEL', KEYS[2], field)
+    elseif sorted then
+        redis.call('ZADD', new_key, ARGV[i + 3], ARGV[1])
+        redis.call('HSET', KEYS[2], field, new_key)
+    else
+        redis.call('SADD', new_key, ARGV[1])
+        redis.call('HSET', KEYS[2], field, new_key)
+    end
+end
+redis.call('HSETNX', KEYS[2], 'version', ARGV[3])
+local version = redis.call('HGET', KEYS[2], 'version')
+redis.call('SADD', KEYS[3], ARGV[1])
+local revision = redis.call('INCR', KEYS[4])
+redis.call('ZADD', KEYS[6], revision, ARGV[1])
+redis.call('ZREM', KEYS[7], ARGV[1])
+record_change(KEYS[5], ARGV[4], 'update', ARGV[1], version)
+return 1
+"""
+
+# Remove what is left of records whose record key is gone (see service.rebuild): meta hash,
+# index entries, collection membership and delta sync entries. Each purged record gets a
+# tombstone and a 'delete' event, so that clients and consumers that saw it drop it.
+#
+# KEYS[1] collection key, KEYS[2] revision key, KEYS[3] change stream key,
+# KEYS[4] updated set key, KEYS[5] tombstone set key, KEYS[6..] per record: its record key,
+# its meta key and the index keys its meta hash names
+# ARGV[1] change stream max length, ARGV[2..] per record: its id, the number n of its index
+# keys and the n meta fields of the index keys, in the order of KEYS
+#
+# Returns the number of purged records; records that exist (again) are left alone, as are
+# records whose meta hash no longer names the declared index keys (the next rebuild purges them).
+PURGE = _RECORD_CHANGE + _UNINDEX_RECORD + """
+local purged = 0
+local k = 6
+local a = 2
+while a <= #ARGV do
+    local id = ARGV[a]
+    local record_key, meta_key = KEYS[k], KEYS[k + 1]
+    local index = {}
+    for n = 1, tonumber(ARGV[a + 1]) do
+        index[ARGV[a + 1 + n]] = KEYS[k + 1 + n]
+    end
+    k = k + 2 + tonumber(ARGV[a + 1])
+    a = a + 2 + tonumber(ARGV[a + 1])
+    if redis.call('EXISTS', record_key) == 0 then
+        local version = unindex_record(meta_key, id, index)
+        if version then
+            redis.call('DEL', meta_key)
+            redis.call('SREM', KEYS[1], id)
+            redis.call('ZREM', KEYS[4], id)
+            local revision = redis.call('INCR', KEYS[2])
+            redis.call('ZADD', KEYS[5], revision, id)
+            record_change(KEYS[3], ARGV[1], 'delete', id, version)
+            purged = purged + 1
+        end
+    end
+end
+return purged
+"""
+
+# Remove stale entries from an index set or sorted index (see service.rebuild): ids whose
+# meta hash does not name the index key (any more).
+#
+# KEYS[1] index key, KEYS[2..] the meta keys of the ids
+# ARGV[1] meta field of the index ('idx:<field>' or 'zidx:<field>'), ARGV[2..] the ids, in
+# the order of the meta keys
+#
+# Returns the number of removed entries.
+UNINDEX = """
+local command = string.sub(ARGV[1], 1, 5) == 'zidx:' and 'ZREM' or 'SREM'
+local removed = 0
+for n = 2, #ARGV do
+    if redis.call('HGET', KEYS[n], ARGV[1]) ~= KEYS[1] then
+        removed = removed + redis.call(command, KEYS[1], ARGV[n])
+    end
+end
+return removed
+"""
+
+# Read an archive hash and its rollups at the same instant (see service.rebuild), so that
+# the rollups can be checked against the archived records while records are archived.
+#
+# KEYS[1] archive hash key, KEYS[2] rollup hash key
+#
+# Returns {archive fields and values, rollup fields and values}.
+ARCHIVE_SNAPSHOT = """
+return {redis.call('HGETALL', KEYS[1]), redis.call('HGETALL', KEYS[2])}
+"""
+
+# Run a filter/sort query plan (see RedisManager.query) against the indexes of one shard.
+#
+# The candidates are the intersection (ZINTERSTORE) of the sorted index of the sort field,
+# the score ranges of sorted indexes (ZRANGESTORE) and index sets or unions of index sets
+# (SUNIONSTORE), scored by the sort field. The page is then read with ZRANGEBYSCORE, which
+# also applies the range condition on the sort field itself. All temporary keys are
+# deleted before the script returns.
+#
+# KEYS[1] result key, KEYS[2..] temporary keys and the index keys referenced by the plan
+# ARGV[1] JSON plan with key positions in KEYS:
+#   base: the collection key, used when there is nothing to intersect
+#   sort: the sorted index of the sort field (optional)
+#   nulls: temporary key for adding records without a sort value with score -inf (optional)
+#   ranges: [temporary key, sorted index, min, max] entries
+#   sets: [temporary key, index set, ...] entries; the union of several index sets is
+#         stored in the temporary key
+#   min, max: score range of the sort field; desc: descending order
+#   offset, count: the page (count -1 for all)
+#
+# Returns {total, {id, score, id, score, ...}} for the page.
+QUERY = """
+local plan = cjson.decode(ARGV[1])
+local args = {}
+local weights = {}
+
+local sorted = plan.sort and KEYS[plan.sort]
+if sorted and plan.nulls then
+    redis.call('ZUNIONSTORE', KEYS[plan.nulls], 2, KEYS[plan.base], sorted,
+        'WEIGHTS', '-inf', 1, 'AGGREGATE', 'MAX')
+    sorted = KEYS[plan.nulls]
+end
+if sorted then
+    table.insert(args, sorted)
+    table.insert(weights, 1)
+end
+for _, range in ipairs(plan.ranges) do
+    redis.call('ZRANGESTORE', KEYS[range[1]], KEYS[range[2]], range[3], range[4], 'BYSCORE')
+    table.insert(args, KEYS[range[1]])
+    table.insert(weights, 0)
+end
+for _, set in ipairs(plan.sets) do
+    if #set == 2 then
+        table.insert(args, KEYS[set[2]])
+    else
+        local union = {}
+        for i = 2, #set do
+            table.insert(union, KEYS[set[i]])
+        end
+        redis.call('SUNIONSTORE', KEYS[set[1]], unpack(union))
+        table.insert(args, KEYS[set[1]])
+    end
+    table.insert(weights, 0)
+end
+if #args == 0 then
+    table.insert(args, KEYS[plan.base])
+    table.insert(weights, 0)
+end
+
+local command = {'ZINTERSTORE', KEYS[1], #args}
+for _, key in ipairs(args) do
+    table.insert(command, key)
+end
+table.insert(command, 'WEIGHTS')
+for _, weight in ipairs(weights) do
+    table.insert(command, weight)
+end
+redis.call(unpack(command))
+
+local total = redis.call('ZCOUNT', KEYS[1], plan.min, plan.max)
+local page
+if plan.desc then
+    page = redis.call('ZREVRANGEBYSCORE', KEYS[1], plan.max, plan.min, 'WITHSCORES', 'LIMIT', plan.offset, plan.count)
+else
+    page = redis.call('ZRANGEBYSCORE', KEYS[1], plan.min, plan.max, 'WITHSCORES', 'LIMIT', plan.offset, plan.count)
+end
+for i = 1, plan.temporary do
+    redis.call('DEL', KEYS[i])
+end
+return {total, page}
+"""
+
+# Read the changes of one shard since a revision, for delta sync.
+#
+# The returned cursor is the highest revision up to which all changes are returned: the
+# current revision, or, if there are more than ARGV[2] changes, the revision of the
+# ARGV[2]-th oldest change (all changes with that revision are returned together).
+#
+# KEYS[1] revision key, KEYS[2] updated set key, KEYS[3] tombstone set key,
+# KEYS[4] tombstone horizon key
+# ARGV[1] revision of the last sync, ARGV[2] maximum number of changes
+#
+# Returns {-1} if tombstones newer than ARGV[1] were trimmed or ARGV[1] is ahead of the
+# revision (e.g. the data was restored from an older backup), in which case the client must
+# resync fully; otherwise {cursor, revision, updated ids, deleted ids}.
+CHANGES_SINCE = """
+local revision = tonumber(redis.call('GET', KEYS[1]) or '0')
+local horizon = tonumber(redis.call('GET', KEYS[4]) or '0')
+if tonumber(ARGV[1]) < horizon or tonumber(ARGV[1]) > revision then
+    return {-1}
+end
+local since = '(' .. ARGV[1]
+local limit = tonumber(ARGV[2])
+local cursor = revision
+if redis.call('ZCOUNT', KEYS[2], since, revision) + redis.call('ZCOUNT', KEYS[3], since, revision) > limit then
+    local scores = {}
+    for _, key in ipairs({KEYS[2], KEYS[3]}) do
+        local entries = redis.call('ZRANGEBYSCORE', key, since, revision, 'WITHSCORES', 'LIMIT', 0, limit)
+        for i = 2, #entries, 2 do
+            table.insert(scores, tonumber(entries[i]))
+        end
+    end
+    table.sort(scores)
+    cursor = scores[limit]
+end
+return {
+    cursor,
+    revision,
+    redis.call('ZRANGEBYSCORE', KEYS[2], since, cursor),
+    redis.call('ZRANGEBYSCORE', KEYS[3], since, cursor),
+}
+"""
+
+# Drop the oldest tombstones beyond a count, remembering the newest dropped revision as the
+# horizon before which delta sync is no longer possible.
+#
+# KEYS[1] tombstone set key, KEYS[2] tombstone horizon key
+# ARGV[1] number of tombstones to keep
+#
+# Returns the number of dropped tombstones.
+TRIM_TOMBSTONES = """
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[1])
+if excess <= 0 then
+    return 0
+end
+local last = redis.call('ZRANGE', KEYS[1], excess - 1, excess - 1, 'WITHSCORES')
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+redis.call('SET', KEYS[2], last[2])
+return excess
+"""
+
+
+# Stamp the heartbeat key with the current server time, for measuring replica lag.
+#
+# KEYS[1] heartbeat key
+#
+# Returns the stamped time in seconds as a string.
+HEARTBEAT = """
+local time = redis.call('TIME')
+local now = time[1] .. '.' .. string.format('%06d', time[2])
+redis.call('SET', KEYS[1], now)
+return now
+"""
+
+
+# Take, renew or release the lease of a process on a resource (e.g. a write-behind list).
+#
+# KEYS[1] lease key
+# ARGV[1] token of the process, ARGV[2] lease duration in milliseconds (0 to release)
+#
+# Returns 1 if the process holds the lease afterwards (or released it), 0 if another
+# process holds it.
+LEASE = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) == 0 then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+end
+return 1
+"""
+
+
+# All scripts by name, registered by RedisManager when it connects
+SCRIPTS = {
+    "save": SAVE,
+    "delete": DELETE,
+    "delete_children": DELETE_CHILDREN,
+    "archive": ARCHIVE,
+    "delete_archived": DELETE_ARCHIVED,
+    "repair": REPAIR,
+    "purge": PURGE,
+    "unindex": UNINDEX,
+    "archive_snapshot": ARCHIVE_SNAPSHOT,
+    "query": QUERY,
+    "changes_since": CHANGES_SINCE,
+    "trim_tombstones": TRIM_TOMBSTONES,
+    "lease": LEASE,
+}
@@ -0,0 +1,123 @@
+"""
+Read replica selection for the Redis Manager.
+
+Replicas are only used while they are known to be healthy and fresh. A background thread
+checks them every check_interval seconds: it stamps a heartbeat key on the primary with the
+primary's clock (HEARTBEAT script) and reads the key back from every replica. A replica whose
+heartbeat could be more than max_lag seconds behind by the next check, or that cannot be
+reached, is not used until a later check finds it fresh again. A replica holds everything the primary had written when it
+stamped the heartbeat the replica returns, so max_lag bounds the staleness of replica reads.
+"""
+import logging
+import random
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+
+from service import redis_scripts
+
+# Key stamped with the primary's time on every health check
+HEARTBEAT_KEY = "replication:heartbeat"
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaSet:
+    """
+    The read replicas of a primary and their health.
+
+    Args:
+        endpoints: (host, port) pairs of the replicas
+        connection_kwargs: Connection parameters shared with the primary (password, db, ...)
+        max_lag: The maximum staleness in seconds of a replica that is still used for reads
+        check_interval: Seconds between health checks; must be well below max_lag
+    """
+    # Errors after which a read is retried on the primary
+    errors = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+    def __init__(
+        self,
+        endpoints: List[Tuple[str, int]],
+        connection_kwargs: Dict[str, Any],
+        max_lag: float = 5.0,
+        check_interval: float = 1.0
+    ):
+        self.endpoints = endpoints
+        self.connection_kwargs = connection_kwargs
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.clients: List[redis.Redis] = []
+        self.lag: Dict[int, Optional[float]] = {}
+        self._healthy: List[redis.Redis] = []
+        self._heartbeat = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def connect(self, primary: redis.Redis) -> None:
+        """
+        Create the replica clients, check them once and start the health check thread.
+        """
+        self._heartbeat = primary.register_script(redis_scripts.HEARTBEAT)
+        self.clients = [
+            redis.Redis(**dict(self.connection_kwargs, host=host, port=port)) for host, port in self.endpoints
+        ]
+        self.check()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="replica-health", daemon=True)
+        self._thread.start()
+
+    def check(self) -> None:
+        """
+        Measure the lag of every replica and update the set of healthy replicas.
+        """
+        try:
+            now = float(self._heartbeat(keys=[HEARTBEAT_KEY]))
+        except self.errors:
+            # Without the primary's clock the lag cannot be bounded
+            self._healthy = []
+            return
+
+        healthy = []
+        for index, client in enumerate(self.clients):
+            try:
+                stamp = client.get(HEARTBEAT_KEY)
+            except self.errors:
+                stamp = None
+            lag = None if stamp is None else max(now - float(stamp), 0.0)
+            self.lag[index] = lag
+            # The lag keeps growing until the next check, so leave room for one interval
+            if lag is not None and lag + self.check_interval <= self.max_lag:
+                healthy.append(client)
+        self._healthy = healthy
+
+    def choose(self) -> Optional[redis.Redis]:
+        """
+        Pick a random healthy replica, or None if there is none.
+        """
+        healthy = self._healthy
+        return random.choice(healthy) if healthy else None
+
+    def mark_unhealthy(self, client: redis.Redis) -> None:
+        """
+        Stop using a replica until the next health check finds it fresh.
+        """
+        self._healthy = [replica for replica in self._healthy if replica is not client]
+
+    def close(self) -> None:
+        """
+        Stop the health checks and close the replica connections.
+        """
+        self._stop.set()
+        for client in self.clients:
+            client.close()
+        self.clients = []
+        self._healthy = []
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Replica health check failed")
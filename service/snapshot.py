@@ -0,0 +1,410 @@
+"""
+Columnar snapshot store for reporting queries.
+
+A snapshot is a single file holding opportunities, customers and activities as fixed-width
+column arrays plus one dictionary-encoded string pool. Reports open it with mmap and read the
+columns as zero-copy NumPy views, so they never parse JSON or talk to Redis.
+
+File layout (little-endian):
+
+    8 bytes   magic b"CRMSNAP1"
+    4 bytes   header length
+    n bytes   header (JSON): row counts, column dtypes and offsets, string pool offsets
+    ...       column data, each array aligned to 8 bytes; offsets are relative to the end
+              of the header rounded up to 8 bytes
+
+String columns store int32 codes into the string pool (-1 for None); the pool itself is an
+int64 offsets array (count + 1 entries) followed by the UTF-8 bytes of all strings. Enum
+columns store int8 codes (the position of the member in its Enum, -1 for None), times are
+datetime64[s] (NaT for None) and floats use NaN for None.
+
+The SnapshotBuilder refreshes incrementally: it keeps the rows of the previous snapshot and
+applies only the changes since then, read with the delta sync cursors of the tables (see
+service.sync). When nothing changed, the current file is kept; otherwise it is rewritten
+from the rows in memory, without reading any unchanged record.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from models.activity import ActivityStatus, ActivityType
+from models.customer import CustomerStatus
+from models.opportunity import OpportunityStage
+from service import activities, customers, opportunities
+from service.customers import CUSTOMER_MODEL_TYPE
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CRMSNAP1"
+ALIGNMENT = 8
+
+ACTIVITY_TABLE = "activity"
+
+# Column kinds: "str" (string pool code), "f8" (float), "i8" (integer), "time" (datetime)
+# or an Enum class (member code)
+ColumnKind = Union[str, type]
+
+TABLES: Dict[str, List[Tuple[str, ColumnKind]]] = {
+    OPPORTUNITY_MODEL_TYPE: [
+        ("id", "str"),
+        ("name", "str"),
+        ("customer_id", "str"),
+        ("amount", "f8"),
+        ("probability", "f8"),
+        ("stage", OpportunityStage),
+        ("expected_close_date", "time"),
+        ("created_at", "time"),
+        ("updated_at", "time"),
+        ("version", "i8"),
+    ],
+    CUSTOMER_MODEL_TYPE: [
+        ("id", "str"),
+        ("name", "str"),
+        ("company", "str"),
+        ("status", CustomerStatus),
+        ("source", "str"),
+        ("version", "i8"),
+    ],
+    ACTIVITY_TABLE: [
+        ("id", "str"),
+        ("title", "str"),
+        ("activity_type", ActivityType),
+        ("status", ActivityStatus),
+        ("due_date", "time"),
+        ("customer_id", "str"),
+        ("opportunity_id", "str"),
+        ("assigned_to", "str"),
+        ("created_at", "time"),
+        ("completed_at", "time"),
+        ("version", "i8"),
+    ],
+}
+
+
+# How to get the changes of each table since a delta sync cursor
+SOURCES = {
+    OPPORTUNITY_MODEL_TYPE: opportunities.get_opportunity_changes,
+    CUSTOMER_MODEL_TYPE: customers.get_customer_changes,
+    ACTIVITY_TABLE: activities.get_activity_changes,
+}
+
+# The maximum number of changes read per table and round trip
+CHANGES_PER_READ = 1000
+
+
+def _dtype(kind: ColumnKind) -> str:
+    """
+    Get the NumPy dtype used to store a column kind.
+    """
+    if kind == "str":
+        return "<i4"
+    if kind == "f8":
+        return "<f8"
+    if kind == "i8":
+        return "<i8"
+    if kind == "time":
+        return "<M8[s]"
+    return "i1"
+
+
+def _cell(kind: ColumnKind, value: Any) -> Any:
+    """
+    Normalize a record value to what is stored in a row of the builder.
+    """
+    if value is None:
+        return None
+    if kind == "str":
+        return str(value)
+    if kind == "f8":
+        return float(value)
+    if kind == "i8":
+        return int(value)
+    if kind == "time":
+        # Wall-clock time to the second; the snapshot is for reporting, not for round trips
+        text = value.isoformat() if isinstance(value, datetime) else str(value)
+        return text[:19]
+    return list(kind).index(kind(value.value if isinstance(value, Enum) else value))
+
+
+def make_row(table: str, record: Dict[str, Any]) -> tuple:
+    """
+    Convert a decoded record into a snapshot row.
+    """
+    return tuple(_cell(kind, record.get(name)) for name, kind in TABLES[table])
+
+
+def write_snapshot(path: str, tables: Dict[str, Sequence[tuple]]) -> None:
+    """
+    Write rows of every table to a snapshot file.
+
+    The file is written next to the target and renamed into place, so readers that still
+    have the previous snapshot mapped keep a consistent view.
+    """
+    strings: Dict[str, int] = {}
+
+    def encode(value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        code = strings.get(value)
+        if code is None:
+            code = strings[value] = len(strings)
+        return code
+
+    arrays: List[np.ndarray] = []
+    header: Dict[str, Any] = {"created_at": time.time(), "tables": {}}
+    offset = 0
+
+    def add(array: np.ndarray) -> Dict[str, Any]:
+        nonlocal offset
+        entry = {"dtype": array.dtype.str, "offset": offset, "count": len(array)}
+        arrays.append(array)
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        return entry
+
+    for table, columns in TABLES.items():
+        rows = tables.get(table, [])
+        table_header = {"rows": len(rows), "columns": {}}
+        for position, (name, kind) in enumerate(columns):
+            values = [row[position] for row in rows]
+            if kind == "str":
+                array = np.fromiter((encode(value) for value in values), dtype=_dtype(kind), count=len(values))
+            elif kind == "f8":
+                array = np.array([np.nan if value is None else value for value in values], dtype=_dtype(kind))
+            elif kind == "i8":
+                array = np.array([value or 0 for value in values], dtype=_dtype(kind))
+            elif kind == "time":
+                array = np.array(["NaT" if value is None else value for value in values], dtype=_dtype(kind))
+            else:
+                array = np.array([-1 if value is None else value for value in values], dtype=_dtype(kind))
+            table_header["columns"][name] = add(array)
+        header["tables"][table] = table_header
+
+    encoded = [value.encode("utf-8") for value in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+    np.cumsum([len(value) for value in encoded], out=string_offsets[1:])
+    header["strings"] = {
+        "offsets": add(string_offsets),
+        "data": add(np.frombuffer(b"".join(encoded), dtype="u1")),
+    }
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = -(-(len(MAGIC) + 4 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b"\0" * (data_start - f.tell()))
+            for array in arrays:
+                data = array.tobytes()
+                f.write(data)
+                f.write(b"\0" * (-len(data) % ALIGNMENT))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class Snapshot:
+    """
+    A read-only, memory-mapped snapshot file.
+
+    Columns are returned as NumPy arrays that point straight into the mapping, so opening a
+    snapshot and reading columns does not copy or parse any data.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a snapshot file")
+        (header_length,) = struct.unpack_from("<I", self._mm, len(MAGIC))
+        header_start = len(MAGIC) + 4
+        self.header = json.loads(self._mm[header_start:header_start + header_length])
+        self._data_start = -(-(header_start + header_length) // ALIGNMENT) * ALIGNMENT
+        self._string_codes: Optional[Dict[str, int]] = None
+
+        self._string_offsets = self._array(self.header["strings"]["offsets"])
+        self._string_data = self._array(self.header["strings"]["data"])
+
+    @property
+    def created_at(self) -> float:
+        return self.header["created_at"]
+
+    def _array(self, entry: Dict[str, Any]) -> np.ndarray:
+        return np.frombuffer(
+            self._mm, dtype=entry["dtype"], count=entry["count"], offset=self._data_start + entry["offset"]
+        )
+
+    def rows(self, table: str) -> int:
+        """
+        Get the number of rows of a table.
+        """
+        return self.header["tables"][table]["rows"]
+
+    def column(self, table: str, name: str) -> np.ndarray:
+        """
+        Get a column of a table as a zero-copy NumPy array.
+        """
+        return self._array(self.header["tables"][table]["columns"][name])
+
+    def string(self, code: int) -> Optional[str]:
+        """
+        Decode a string pool code.
+        """
+        if code < 0:
+            return None
+        start, end = self._string_offsets[code], self._string_offsets[code + 1]
+        return self._string_data[start:end].tobytes().decode("utf-8")
+
+    def strings(self, codes: np.ndarray) -> List[Optional[str]]:
+        """
+        Decode an array of string pool codes.
+        """
+        return [self.string(code) for code in codes.tolist()]
+
+    def string_code(self, value: str) -> int:
+        """
+        Get the string pool code of a value, or -1 if the snapshot does not contain it.
+        """
+        if self._string_codes is None:
+            self._string_codes = {self.string(code): code for code in range(len(self._string_offsets) - 1)}
+        return self._string_codes.get(value, -1)
+
+
+class SnapshotBuilder:
+    """
+    Builds snapshot files, reading only the records that changed since the last build.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        # Previous rows per table by ID, and the delta sync cursors they are current at
+        self._rows: Dict[str, Dict[str, tuple]] = {table: {} for table in TABLES}
+        self._cursors: Dict[str, Optional[List[int]]] = {table: None for table in TABLES}
+        self._built = False
+
+    def build(self) -> Optional[Snapshot]:
+        """
+        Apply the changes since the last build to the rows and, if there were any, write the
+        snapshot file and open it.
+
+        Returns:
+            The new snapshot, or None if nothing changed since the last build
+        """
+        changed = [self._apply_changes(table) for table in TABLES]
+        if not any(changed) and self._built:
+            return None
+        self._built = True
+
+        write_snapshot(self.path, {table: list(rows.values()) for table, rows in self._rows.items()})
+        return Snapshot(self.path)
+
+    def _apply_changes(self, table: str) -> bool:
+        """
+        Bring the rows of a table up to date with the changes since its cursor.
+
+        Returns:
+            Whether any row was added, changed or removed
+        """
+        rows = self._rows[table]
+        changed = False
+        while True:
+            changes = SOURCES[table](self._cursors[table], CHANGES_PER_READ)
+            if changes.reset:
+                rows.clear()
+            for model in changes.updated:
+                # Handle both Pydantic v1 and v2
+                record = model.model_dump() if hasattr(model, 'model_dump') else model.dict()
+                rows[str(model.id)] = make_row(table, record)
+            # Archived records are left out like in a full build
+            for id in (*changes.deleted, *changes.archived):
+                rows.pop(id, None)
+            changed = changed or changes.reset or bool(changes.updated or changes.deleted or changes.archived)
+            self._cursors[table] = changes.cursor
+            if not changes.has_more:
+                return changed
+
+
+class SnapshotStore:
+    """
+    Holds the current snapshot and refreshes it periodically in a background thread.
+    """
+    def __init__(self, path: str, refresh_seconds: float):
+        self.builder = SnapshotBuilder(path)
+        self.refresh_seconds = refresh_seconds
+        self._snapshot: Optional[Snapshot] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def current(self) -> Snapshot:
+        """
+        Get the current snapshot, building the first one and starting the refresher if they
+        have not been yet.
+        """
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self.builder.build()
+        self.start()
+        return self._snapshot
+
+    def refresh(self) -> Snapshot:
+        """
+        Bring the snapshot up to date now; a new one is only built if anything changed.
+        """
+        with self._lock:
+            snapshot = self.builder.build()
+            if snapshot is not None:
+                self._snapshot = snapshot
+        return self._snapshot
+
+    def start(self) -> None:
+        """
+        Start refreshing the snapshot every refresh_seconds in a daemon thread.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="snapshot-refresh", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the refresher thread, waiting for a refresh in progress to finish.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopped.set()
+        if thread is not None:
+            thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.refresh_seconds):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Snapshot refresh failed")
+
+
+# Each worker process keeps its own snapshot: activities live in process memory
+snapshot_store = SnapshotStore(
+    os.getenv("SNAPSHOT_PATH", os.path.join(tempfile.gettempdir(), f"crm_snapshot_{os.getpid()}.bin")),
+    float(os.getenv("SNAPSHOT_REFRESH_SECONDS", "60")),
+)
@@ -0,0 +1,84 @@
+"""
+Delta sync for offline clients.
+
+A sync returns the customers, opportunities and activities created or updated since a
+cursor, and tombstones (IDs) of the deleted and of the archived ones, read from indexes
+ordered by change (see RedisManager.get_changes and service.changes.ChangeLog). The cursor
+is opaque to clients: it holds the position of every model type (per shard in cluster mode).
+
+Without a cursor, or if a model type cannot continue from it (e.g. its tombstones were
+trimmed), the sync resets: it returns all records and the client replaces its local copy.
+"""
+import base64
+import json
+from typing import Dict, List, Optional
+
+from models.sync import SyncResponse, SyncTombstones
+from service import activities, customers, opportunities
+from service.changes import ChangeSet
+
+# The synced collections (response field names) and how to get their changes
+SOURCES = {
+    "customers": customers.get_customer_changes,
+    "opportunities": opportunities.get_opportunity_changes,
+    "activities": activities.get_activity_changes,
+}
+
+
+def encode_cursor(positions: Dict[str, List[int]]) -> str:
+    """
+    Encode the positions of all collections as an opaque, URL safe cursor.
+    """
+    data = json.dumps(positions, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, List[int]]:
+    """
+    Decode a cursor made by encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid sync cursor") from e
+    if not isinstance(positions, dict) or not all(
+        isinstance(position, list) and all(isinstance(value, int) for value in position)
+        for position in positions.values()
+    ):
+        raise ValueError("Invalid sync cursor")
+    return positions
+
+
+def sync(since: Optional[str] = None, limit: int = 1000) -> SyncResponse:
+    """
+    Get the changes of all synced collections since a cursor.
+
+    Args:
+        since: The cursor of the previous sync, or None for a full sync
+        limit: The maximum number of changes per collection (and shard); if a collection
+            has more, has_more is set and the rest follows with the returned cursor
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    positions = decode_cursor(since) if since else {}
+
+    changes: Dict[str, ChangeSet] = {
+        name: get_changes(positions.get(name), limit) for name, get_changes in SOURCES.items()
+    }
+    # A reset replaces the client's whole copy, so if one collection has to start over,
+    # all of them do
+    if any(change.reset for change in changes.values()) and not all(change.reset for change in changes.values()):
+        changes = {name: get_changes(None, limit) for name, get_changes in SOURCES.items()}
+
+    return SyncResponse(
+        cursor=encode_cursor({name: change.cursor for name, change in changes.items()}),
+        has_more=any(change.has_more for change in changes.values()),
+        reset=all(change.reset for change in changes.values()),
+        deleted=SyncTombstones(**{name: change.deleted for name, change in changes.items()}),
+        archived=SyncTombstones(**{name: change.archived for name, change in changes.items()}),
+        **{name: change.updated for name, change in changes.items()},
+    )
@@ -5,6 +5,10 @@ import hashlib
 import secrets
 
 from models.user import User, UserCreate, UserUpdate, UserInDB
+from service.redis_manager import VersionConflictError, redis_manager
+
+# Model type for the change stream
+USER_MODEL_TYPE = "user"
 
 # In-memory storage for users
 users_db: Dict[UUID, UserInDB] = {}
@@ -68,22 +72,28 @@ def create_user(user: UserCreate) -> User:
     user_data.pop('password')
     
     # Create the user with hashed password
-    new_user = UserInDB(**user_data, hashed_password=hashed_password)
+    new_user = UserInDB(**user_data, hashed_password=hashed_password, version=1)
     users_db[new_user.id] = new_user
+    redis_manager.record_change(USER_MODEL_TYPE, "create", new_user.id, new_user.version)
     
     # Return the user without the hashed password
     return User(**{k: v for k, v in new_user.__dict__.items() if k != 'hashed_password'})
 
 
-def update_user(user_id: UUID, user_update: UserUpdate) -> Optional[User]:
+def update_user(user_id: UUID, user_update: UserUpdate, expected_version: Optional[int] = None) -> Optional[User]:
     """
     Update an existing user.
+
+    If expected_version is given, the update fails with VersionConflictError unless the
+    user is still at that version.
     """
     if user_id not in users_db:
         return None
 
     # Get the existing user
     user = users_db[user_id]
+    if expected_version is not None and user.version != expected_version:
+        raise VersionConflictError(USER_MODEL_TYPE, user_id, user.version)
 
     # Handle both Pydantic v1 and v2
     if hasattr(user_update, 'model_dump'):
@@ -108,9 +118,11 @@ def update_user(user_id: UUID, user_update: UserUpdate) -> Optional[User]:
     # Update other fields
     for field, value in update_data.items():
         setattr(user, field, value)
+    user.version += 1
 
     # Save the updated user
     users_db[user_id] = user
+    redis_manager.record_change(USER_MODEL_TYPE, "update", user_id, user.version)
     
     # Return the user without the hashed password
     return User(**{k: v for k, v in user.__dict__.items() if k != 'hashed_password'})
@@ -123,7 +135,8 @@ def delete_user(user_id: UUID) -> bool:
     if user_id not in users_db:
         return False
 
-    del users_db[user_id]
+    user = users_db.pop(user_id)
+    redis_manager.record_change(USER_MODEL_TYPE, "delete", user_id, user.version)
     return True
 
 
@@ -135,7 +148,9 @@ def authenticate_user(username: str, password: str) -> Optional[User]:
         if user.username == username and _verify_password(password, user.hashed_password):
             # Update last login time
             user.last_login = datetime.now()
+            user.version += 1
             users_db[user.id] = user
+            redis_manager.record_change(USER_MODEL_TYPE, "update", user.id, user.version)
             return User(**{k: v for k, v in user.__dict__.items() if k != 'hashed_password'})
     return None
 
@@ -0,0 +1,147 @@
+"""
+Encoding of the records stored by the Redis Manager.
+
+By default a record is stored as JSON with its full field names. With the compact encoding
+(REDIS_VALUE_ENCODING=compact) it is stored as
+
+    #{"0":"Acme","1":"info@acme.example","5":"lead","8":"6f1c1b8e-...","9":3}
+
+i.e. JSON without whitespace, with every field name replaced by its code in the field
+dictionary of the model type and None values left out. Fields without a code keep their
+name. Values of at least compress_min_size bytes are compressed as well, with zstd if the
+zstandard package is installed and zlib otherwise, and base64-encoded because the Redis
+connection decodes responses to strings:
+
+    z<zlib data>    s<zstd data>
+
+A value is only compressed if that makes it smaller, base64 included.
+
+Decoding recognizes every form, plain JSON included, so switching the encoding needs no
+migration: records are re-encoded when they are next written. Field dictionaries are
+append-only, since a field's code is its position: add new fields at the end and leave
+removed fields in place.
+"""
+import base64
+import json
+import zlib
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional; zlib is always available
+    zstandard = None
+
+# First character of each value form; plain JSON values start with '{'
+COMPACT = "#"
+ZLIB = "z"
+ZSTD = "s"
+
+
+class ValueCodec:
+    """
+    Encodes records for storage and decodes stored values of any form.
+
+    Args:
+        compact: Whether to encode with the field dictionaries (and compress)
+        compress_min_size: The size in bytes from which compact values are compressed,
+            0 to never compress
+        compression: 'zstd' or 'zlib' (default: zstd if zstandard is installed)
+        json_default: Converts values the json module cannot serialize natively
+    """
+    def __init__(
+        self,
+        compact: bool = False,
+        compress_min_size: int = 256,
+        compression: Optional[str] = None,
+        json_default: Optional[Callable[[Any], Any]] = None
+    ):
+        if compression is None:
+            compression = "zstd" if zstandard is not None else "zlib"
+        if compression not in ("zstd", "zlib"):
+            raise ValueError(f"Unknown compression {compression!r}, expected 'zstd' or 'zlib'")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+
+        self.compact = compact
+        self.compress_min_size = compress_min_size
+        self.compression = compression
+        self.json_default = json_default
+        # Field names by code and codes by field name, per model type
+        self._fields: Dict[str, Tuple[str, ...]] = {}
+        self._codes: Dict[str, Dict[str, str]] = {}
+
+    def register_fields(self, model_type: str, fields: Sequence[str]) -> None:
+        """
+        Set the field dictionary of a model type.
+
+        Args:
+            model_type: The type of model (e.g., 'customer')
+            fields: The field names in code order; append-only (see the module docstring)
+        """
+        fields = tuple(fields)
+        previous = self._fields.get(model_type, ())
+        if fields[:len(previous)] != previous:
+            raise ValueError(f"The field dictionary of {model_type} can only be extended")
+        self._fields[model_type] = fields
+        self._codes[model_type] = {field: str(code) for code, field in enumerate(fields)}
+
+    def compact_variant(self) -> "ValueCodec":
+        """
+        Get a codec with the same field dictionaries and compression that encodes compactly.
+        """
+        codec = ValueCodec(True, self.compress_min_size, self.compression, self.json_default)
+        codec._fields = self._fields
+        codec._codes = self._codes
+        return codec
+
+    def encode(self, model_type: str, record: Dict[str, Any]) -> str:
+        """
+        Encode a record in the compact form, compressed if it is large.
+
+        Args:
+            model_type: The type of model (e.g., 'customer')
+            record: The record as a dictionary of JSON serializable values
+
+        Returns:
+            The encoded value
+        """
+        codes = self._codes.get(model_type, {})
+        coded = {codes.get(field, field): value for field, value in record.items() if value is not None}
+        value = COMPACT + json.dumps(coded, separators=(",", ":"), default=self.json_default)
+        if self.compress_min_size and len(value) >= self.compress_min_size:
+            compressed = self._compress(value.encode())
+            if len(compressed) < len(value):
+                return compressed
+        return value
+
+    def decode(self, model_type: str, value: str) -> Dict[str, Any]:
+        """
+        Decode a stored value of any form.
+
+        Args:
+            model_type: The type of model (e.g., 'customer')
+            value: The stored value
+
+        Returns:
+            The record; fields of the dictionary that were left out are None
+        """
+        marker = value[:1]
+        if marker == ZLIB:
+            value = zlib.decompress(base64.b64decode(value[1:])).decode()
+        elif marker == ZSTD:
+            if zstandard is None:
+                raise ValueError("Reading zstd compressed records needs the zstandard package")
+            value = zstandard.ZstdDecompressor().decompress(base64.b64decode(value[1:])).decode()
+        if value[:1] != COMPACT:
+            return json.loads(value)
+
+        fields = self._fields.get(model_type, ())
+        record = dict.fromkeys(fields)
+        for key, field_value in json.loads(value[1:]).items():
+            record[fields[int(key)] if key.isdigit() else key] = field_value
+        return record
+
+    def _compress(self, data: bytes) -> str:
+        if self.compression == "zstd":
+            return ZSTD + base64.b64encode(zstandard.ZstdCompressor(level=3).compress(data)).decode()
+        return ZLIB + base64.b64encode(zlib.compress(data, 6)).decode()
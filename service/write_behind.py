@@ -0,0 +1,277 @@
+"""
+Write-behind queues: acknowledge writes before they are applied.
+
+A WriteBehindQueue takes items (e.g. new activities) from request handlers and applies
+them in batches from a background thread, as soon as batch_size items are pending or
+flush_interval seconds after the last flush. A handler only pays for appending to the queue;
+the checks and writes of a batch are done together (e.g. one pipelined Redis read for the
+references of all items).
+
+The queue is bounded: submit raises QueueFullError when max_pending items are waiting,
+so callers can push back (e.g. with 503 Retry-After) instead of buffering without limit.
+
+Durability:
+
+- Without durable_key, pending items live in process memory only and are lost if the
+  process dies before they are applied.
+- With durable_key, submit also appends the item to a Redis list before returning, and a
+  batch is removed from the list once it was applied. start() re-applies the items a
+  previous process left in the list, so every acknowledged item is applied at least once.
+  Each process needs its own list, since items are removed from the list in queue order:
+  start() takes a lease on the list (renewed by the flush thread, released by close) and
+  raises QueueInUseError if another live process holds it. The lease of a crashed process
+  expires after lease_seconds, so its successor waits at most that long.
+
+Queue metrics (labelled with the queue name) are published in service.metrics.registry:
+submitted, rejected and flushed items, pending items, flush duration, batch size and the
+delay between submit and apply.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Generic, List, Optional, Tuple, TypeVar
+from uuid import uuid4
+
+from service.metrics import registry
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+_submitted = registry.counter("write_behind_submitted_total", "Items accepted by a write-behind queue", ("queue",))
+_rejected = registry.counter("write_behind_rejected_total", "Items rejected because the queue was full", ("queue",))
+_flushed = registry.counter("write_behind_flushed_total", "Items passed to apply by write-behind flushes", ("queue",))
+_failures = registry.counter("write_behind_flush_failures_total", "Write-behind flushes that failed and were retried", ("queue",))
+_pending = registry.gauge("write_behind_pending", "Items waiting in a write-behind queue", ("queue",))
+_flush_seconds = registry.histogram("write_behind_flush_seconds", "Duration of write-behind batch flushes", ("queue",))
+_delay_seconds = registry.histogram("write_behind_delay_seconds", "Time from submit until the item was applied", ("queue",))
+_batch_size = registry.histogram(
+    "write_behind_batch_size", "Items per write-behind flush", ("queue",),
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+
+
+class QueueFullError(Exception):
+    """
+    Exception raised when a write-behind queue has no room for another item.
+    """
+    def __init__(self, name: str, pending: int):
+        self.name = name
+        self.pending = pending
+        super().__init__(f"Write-behind queue {name} is full ({pending} pending items)")
+
+
+class QueueInUseError(Exception):
+    """
+    Exception raised when the durable list of a write-behind queue is held by another process.
+    """
+    def __init__(self, name: str, durable_key: str):
+        self.name = name
+        self.durable_key = durable_key
+        super().__init__(f"The durable list {durable_key} of write-behind queue {name} is in use by another process")
+
+
+class WriteBehindQueue(Generic[T]):
+    """
+    A bounded queue of items applied in batches by a background thread.
+
+    Args:
+        name: The queue name, used as metrics label
+        apply: Applies a batch of items, in submit order; if it raises, the batch stays
+            queued and is retried with backoff
+        encode: Converts an item to the string stored in the durable list
+        decode: Converts a string of the durable list back to an item
+        manager: The RedisManager holding the durable list
+        durable_key: The Redis list that makes pending items survive a restart (None: memory only)
+        max_pending: The maximum number of pending items
+        batch_size: The number of pending items that triggers a flush, and the maximum batch
+        flush_interval: The maximum number of seconds an item waits for a flush
+        lease_seconds: How long the lease on the durable list outlives a crashed process
+    """
+    def __init__(
+        self,
+        name: str,
+        apply: Callable[[List[T]], Any],
+        encode: Callable[[T], str],
+        decode: Callable[[str], T],
+        manager: Any = None,
+        durable_key: Optional[str] = None,
+        max_pending: int = 10000,
+        batch_size: int = 500,
+        flush_interval: float = 0.05,
+        lease_seconds: float = 10.0
+    ):
+        if durable_key is not None and manager is None:
+            raise ValueError("A durable queue needs a RedisManager")
+        self.name = name
+        self.apply = apply
+        self.encode = encode
+        self.decode = decode
+        self.manager = manager
+        self.durable_key = durable_key
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lease_seconds = lease_seconds
+        self._token = uuid4().hex
+        self._renewed = 0.0
+        self._pending: Deque[Tuple[float, T]] = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        _pending.set_function(lambda: len(self._pending), queue=name)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> int:
+        """
+        Start the flush thread, after taking the lease on the durable list and queueing the
+        items a previous process left in it.
+
+        Returns:
+            The number of recovered items
+
+        Raises:
+            QueueInUseError: If another process still holds the durable list after
+                lease_seconds
+        """
+        recovered = 0
+        if self.durable_key is not None:
+            self._acquire_lease()
+            values = self.manager.redis_client.lrange(self.durable_key, 0, -1)
+            now = time.monotonic()
+            with self._lock:
+                # Items of the list come before anything submitted since
+                self._pending.extendleft(reversed([(now, self.decode(value)) for value in values]))
+            recovered = len(values)
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.name}", daemon=True)
+            self._thread.start()
+        return recovered
+
+    def submit(self, item: T) -> None:
+        """
+        Queue an item; with a durable list, it is stored in Redis before this returns.
+
+        Raises:
+            QueueFullError: If max_pending items are waiting
+            redis.exceptions.RedisError: If the item cannot be stored in the durable list
+        """
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                _rejected.inc(queue=self.name)
+                raise QueueFullError(self.name, len(self._pending))
+            # Appended under the lock, so the list keeps the order of the queue
+            if self.durable_key is not None:
+                self.manager.redis_client.rpush(self.durable_key, self.encode(item))
+            self._pending.append((time.monotonic(), item))
+            full = len(self._pending) >= self.batch_size
+        _submitted.inc(queue=self.name)
+        if full:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """
+        Apply all pending items, in batches of at most batch_size.
+
+        Returns:
+            The number of applied items
+
+        Raises:
+            Exception: Whatever apply raised; the unapplied items stay queued
+        """
+        flushed = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                if not batch:
+                    return flushed
+                start = time.perf_counter()
+                try:
+                    self.apply([item for _, item in batch])
+                except Exception:
+                    with self._lock:
+                        self._pending.extendleft(reversed(batch))
+                    _failures.inc(queue=self.name)
+                    raise
+                if self.durable_key is not None:
+                    self.manager.redis_client.ltrim(self.durable_key, len(batch), -1)
+
+                now = time.monotonic()
+                _flush_seconds.observe(time.perf_counter() - start, queue=self.name)
+                _batch_size.observe(len(batch), queue=self.name)
+                _flushed.inc(len(batch), queue=self.name)
+                for submitted, _ in batch:
+                    _delay_seconds.observe(now - submitted, queue=self.name)
+                flushed += len(batch)
+
+    def close(self) -> None:
+        """
+        Stop the flush thread after applying the pending items.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Could not apply %d pending %s items", len(self._pending), self.name)
+            return
+        if self.durable_key is not None:
+            # Only released once the list is empty; otherwise it expires for the next process
+            self.manager.lease(f"{self.durable_key}:owner", self._token, 0)
+
+    def _acquire_lease(self) -> None:
+        deadline = time.monotonic() + self.lease_seconds
+        while not self.manager.lease(f"{self.durable_key}:owner", self._token, self.lease_seconds):
+            if time.monotonic() > deadline:
+                raise QueueInUseError(self.name, self.durable_key)
+            time.sleep(min(0.1, self.lease_seconds / 10))
+        self._renewed = time.monotonic()
+
+    def _renew_lease(self) -> None:
+        if time.monotonic() - self._renewed < self.lease_seconds / 3:
+            return
+        try:
+            held = self.manager.lease(f"{self.durable_key}:owner", self._token, self.lease_seconds)
+        except Exception:
+            logger.warning("Could not renew the lease of %s", self.durable_key, exc_info=True)
+            return
+        if held:
+            self._renewed = time.monotonic()
+        else:
+            logger.error("Write-behind queue %s lost its durable list %s to another process", self.name, self.durable_key)
+
+    def _run(self) -> None:
+        # With a durable list, wake up often enough to renew its lease in time
+        tick = self.flush_interval
+        if self.durable_key is not None:
+            tick = min(tick, self.lease_seconds / 3)
+        last_flush = time.monotonic()
+        while not self._stop.is_set():
+            woken = self._wakeup.wait(tick)
+            self._wakeup.clear()
+            if self.durable_key is not None:
+                self._renew_lease()
+            if not woken and time.monotonic() - last_flush < self.flush_interval:
+                continue
+            last_flush = time.monotonic()
+            delay = max(self.flush_interval, 0.01)
+            while not self._stop.is_set():
+                try:
+                    self.flush()
+                    break
+                except Exception:
+                    # Back off while the batch cannot be applied (e.g. Redis is unavailable)
+                    if delay == max(self.flush_interval, 0.01):
+                        logger.warning("Write-behind flush of %s failed, retrying with backoff", self.name, exc_info=True)
+                    delay = min(delay * 2, 5.0)
+                    self._stop.wait(delay)
@@ -0,0 +1,43 @@
+import numpy as np
+from service.analytics import OpportunityColumns, compute_forecast, STAGES, STATUSES
+
+def test_compute_forecast():
+    """
+    Test the vectorised forecast against straightforward per-group computations.
+    """
+    print("Testing forecast analytics...")
+
+    rng = np.random.default_rng(42)
+    count = 1000
+    columns = OpportunityColumns(
+        amount=rng.uniform(1000, 100000, count).round(2),
+        probability=rng.integers(0, 101, count) / 100,
+        stage=rng.integers(0, len(STAGES), count).astype(np.int8),
+        close_month=np.array(["2024-01", "2024-02", "NaT"], dtype="datetime64[M]")[rng.integers(0, 3, count)],
+        customer_status=rng.integers(0, len(STATUSES) + 1, count).astype(np.int8),
+    )
+
+    forecast = compute_forecast(columns)
+    print(f"Total: {forecast.count} opportunities, weighted {forecast.weighted_amount}")
+
+    weighted = columns.amount * columns.probability
+    assert forecast.count == count
+    assert abs(forecast.weighted_amount - weighted.sum()) < 0.01
+
+    for group in forecast.by_stage:
+        mask = columns.stage == [stage.value for stage in STAGES].index(group.key)
+        assert group.count == mask.sum()
+        assert abs(group.weighted_amount - weighted[mask].sum()) < 0.01
+        for q in (25, 50, 75, 90):
+            expected = np.percentile(columns.amount[mask], q)
+            assert abs(group.amount_percentiles[f"p{q}"] - expected) < 0.01, (group.key, q)
+
+    print(f"By month: {[(group.key, group.count) for group in forecast.by_close_month]}")
+    assert [group.key for group in forecast.by_close_month] == ["2024-01", "2024-02"]
+    assert sum(group.count for group in forecast.by_close_month) == (~np.isnat(columns.close_month)).sum()
+    assert sum(group.count for group in forecast.by_customer_status) == count
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_compute_forecast()
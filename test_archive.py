@@ -0,0 +1,143 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from main import app
+from service import archive
+from service.archive import decode_record, encode_record, group_rollups, rollup_increments
+from service.dashboard import DashboardAggregates, compute_stats, is_empty, new_delta
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.redis_manager import redis_manager
+
+def test_archive_records():
+    """
+    Test the encoding and rollups of archived opportunities.
+    """
+    print("Testing archived opportunities...")
+
+    record = {
+        "name": "Renewal", "customer_id": "6f1c1b8e-3b9a-4a43-9f3c-7d6a4f1e2b3c", "amount": 1200.5,
+        "stage": "closed_won", "expected_close_date": None, "probability": None, "description": None,
+        "id": "4a96617c-37e6-4173-8a1d-16ceaab9cdd0", "created_at": "2024-01-03T10:00:00.000001",
+        "updated_at": "2024-02-10T12:30:00.000002", "version": 3,
+    }
+    encoded = encode_record(record)
+    print(f"Encoded {len(json.dumps(record))} bytes of JSON as {len(encoded)}")
+    assert decode_record(encoded) == record
+    assert len(encoded) < len(json.dumps(record)) * 0.7
+
+    increments = rollup_increments(record)
+    assert increments == {
+        "count:closed_won": 1, "value:closed_won": 1200.5,
+        "count:closed_won:2024-02": 1, "value:closed_won:2024-02": 1200.5,
+    }
+
+    lost = dict(record, stage="closed_lost", amount=None, updated_at="2024-01-20T08:00:00")
+    rollups = {}
+    for increments in (rollup_increments(record), rollup_increments(lost)):
+        for field, value in increments.items():
+            rollups[field] = rollups.get(field, 0.0) + value
+    grouped = group_rollups(rollups)
+    print(f"Rollups: {grouped}")
+    assert grouped["count"] == 2 and grouped["value"] == 1200.5
+    assert list(grouped["months"]) == ["2024-01", "2024-02"]
+
+    # Archived opportunities count in the dashboard; archiving one changes nothing there
+    stats = compute_stats([], [{"id": "1", "stage": "proposal", "amount": 10}], grouped)
+    assert stats["summary"]["total_opportunities"] == 3
+    assert stats["summary"]["win_rate"] == 50
+    assert stats["opportunities"]["closed_won"] == {"count": 1, "value": 1200.5}
+
+    aggregates = DashboardAggregates()
+    aggregates.apply("opportunity", record["id"], record, new_delta())
+    delta = new_delta()
+    aggregates.apply("opportunity", record["id"], None, delta)
+    aggregates.set_archived(group_rollups(rollup_increments(record))["stages"], delta)
+    assert is_empty(delta) and delta["opportunities"]["total"] == 0
+    assert aggregates.snapshot()["opportunities"]["total"] == 1
+
+    print("Test completed.")
+
+def test_archive_in_redis():
+    """
+    Test moving an opportunity into the archive and deleting it there: reads by ID, the
+    read-only 409, rollups and what delta sync reports.
+    """
+    print("Testing the opportunity archive in Redis...")
+
+    client = TestClient(app)
+    customer = client.post("/customers", json={"name": "Archive Customer"}).json()
+    opportunity = client.post("/opportunities", json={
+        "name": "Archived Deal", "customer_id": customer["id"], "stage": "closed_won", "amount": 250.0,
+    }).json()
+    id = opportunity["id"]
+    url = f"/opportunities/{id}"
+    cursor = client.get("/sync").json()["cursor"]
+    before = archive.get_rollups()
+
+    def move(version):
+        record = redis_manager.get_many_raw(OPPORTUNITY_MODEL_TYPE, [id]).get(id, opportunity)
+        return redis_manager.archive(
+            OPPORTUNITY_MODEL_TYPE, id, version, encode_record(record), rollup_increments(record),
+            {"customer_id": record["customer_id"]},
+        )
+
+    # Compare-and-set on the version: a record that changed since it was read stays
+    assert move(opportunity["version"] + 1) == -1
+    assert client.get(url).json()["version"] == opportunity["version"]
+
+    # The script only touches the index keys it is given, and archive follows the meta hash
+    meta_key = redis_manager._get_meta_key(OPPORTUNITY_MODEL_TYPE, id)
+    stage_key = redis_manager.redis_client.hget(meta_key, "idx:stage")
+    keys = [
+        redis_manager._get_key(OPPORTUNITY_MODEL_TYPE, id), meta_key,
+        *(key(OPPORTUNITY_MODEL_TYPE, redis_manager._get_shard(id)) for key in (
+            redis_manager._get_collection_key, redis_manager._get_revision_key, redis_manager._get_change_stream_key,
+            redis_manager._get_updated_key, redis_manager._get_tombstone_key, redis_manager._get_archive_key,
+            redis_manager._get_rollup_key,
+        )),
+    ]
+    status = redis_manager._run_script("archive", keys, [id, opportunity["version"], "", 0, f"archived:{id}", 0, 0])
+    print(f"Archive with undeclared index keys: {status}")
+    assert status == -2 and id in redis_manager.redis_client.smembers(stage_key)
+    moved_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "stage", "closed_lost", redis_manager._get_shard(id))
+    redis_manager.redis_client.smove(stage_key, moved_key, id)
+    redis_manager.redis_client.hset(meta_key, "idx:stage", moved_key)
+    assert move(opportunity["version"]) == 1
+    assert not redis_manager.redis_client.sismember(moved_key, id)
+    assert move(opportunity["version"]) == 0
+
+    # Gone from the collection and its indexes, but still fetchable and read-only
+    assert id not in {record["id"] for record in redis_manager.get_all_raw(OPPORTUNITY_MODEL_TYPE)}
+    response = client.get(url)
+    print(f"GET archived: {response.status_code}")
+    assert response.status_code == 200 and response.json()["name"] == "Archived Deal"
+    response = client.put(url, json={"name": "Reopened"})
+    print(f"PUT archived: {response.status_code}")
+    assert response.status_code == 409
+    assert redis_manager.get_archived_ids(OPPORTUNITY_MODEL_TYPE, "customer_id", customer["id"]) == [id]
+    after = archive.get_rollups()
+    assert after["stages"]["closed_won"]["count"] == before["stages"]["closed_won"]["count"] + 1
+    assert after["stages"]["closed_won"]["value"] == round(before["stages"]["closed_won"]["value"] + 250.0, 2)
+
+    # Sync reports the archived opportunity apart from the deleted ones
+    changes = client.get("/sync", params={"since": cursor}).json()
+    print(f"Sync after archiving: archived {changes['archived']['opportunities']}, deleted {changes['deleted']['opportunities']}")
+    assert changes["archived"]["opportunities"] == [id] and changes["deleted"]["opportunities"] == []
+
+    # Deleting it from the archive subtracts it from the rollups and leaves a regular tombstone
+    assert client.delete(url).status_code == 204
+    assert client.get(url).status_code == 404
+    assert archive.get_rollups()["stages"] == before["stages"]
+    assert not redis_manager.get_archived_ids(OPPORTUNITY_MODEL_TYPE, "customer_id", customer["id"])
+    changes = client.get("/sync", params={"since": cursor}).json()
+    assert changes["archived"]["opportunities"] == [] and changes["deleted"]["opportunities"] == [id]
+
+    # Clean up
+    client.delete(f"/customers/{customer['id']}")
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_archive_records()
+    test_archive_in_redis()
@@ -0,0 +1,105 @@
+from uuid import UUID
+from fastapi.testclient import TestClient
+
+from main import app
+from models.customer import Customer
+from models.opportunity import Opportunity, OpportunityStage
+from service import activities, notes
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.redis_manager import redis_manager
+
+def test_delete_cascade():
+    """
+    Test that a cascading delete removes the dependent records with all their index entries,
+    in batches.
+    """
+    print("Testing cascading delete...")
+
+    client = redis_manager.redis_client
+    customer = redis_manager.create("customer", Customer(name="Cascade Test Customer"))
+    deals = [
+        redis_manager.create(
+            OPPORTUNITY_MODEL_TYPE,
+            Opportunity(name=f"Deal {n}", customer_id=customer.id, amount=100 * n, stage=OpportunityStage.PROPOSAL),
+        )
+        for n in range(5)
+    ]
+    ids = {str(deal.id) for deal in deals}
+    index_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "customer_id", customer.id)
+    stage_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "stage", OpportunityStage.PROPOSAL)
+    amount_key = redis_manager._get_sorted_index_key(OPPORTUNITY_MODEL_TYPE, "amount")
+
+    # A stale index entry of an opportunity of another customer is dropped, not the opportunity
+    other = redis_manager.create("customer", Customer(name="Other Cascade Customer"))
+    kept = redis_manager.create(OPPORTUNITY_MODEL_TYPE, Opportunity(name="Kept", customer_id=other.id))
+    client.sadd(index_key, str(kept.id))
+
+    revision = redis_manager.get_revision(OPPORTUNITY_MODEL_TYPE)
+    deleted = redis_manager.delete_cascade("customer", customer.id, [(OPPORTUNITY_MODEL_TYPE, "customer_id")], batch_size=2)
+    print(f"Deleted: {deleted}")
+    assert set(deleted[OPPORTUNITY_MODEL_TYPE]) == ids
+
+    # One revision per batch: six entries in batches of two, each with at least one opportunity
+    batches = redis_manager.get_revision(OPPORTUNITY_MODEL_TYPE) - revision
+    print(f"Batches: {batches}")
+    assert batches == 3
+
+    assert not client.exists(index_key)
+    for id in ids:
+        assert not client.exists(redis_manager._get_key(OPPORTUNITY_MODEL_TYPE, id))
+        assert not client.exists(redis_manager._get_meta_key(OPPORTUNITY_MODEL_TYPE, id))
+        assert not client.sismember(stage_key, id)
+        assert client.zscore(amount_key, id) is None
+        assert client.zscore(redis_manager._get_tombstone_key(OPPORTUNITY_MODEL_TYPE), id) is not None
+    assert redis_manager.get("customer", customer.id, Customer) is None
+    assert redis_manager.get(OPPORTUNITY_MODEL_TYPE, kept.id, Opportunity) is not None
+    assert redis_manager.delete_cascade("customer", customer.id, [(OPPORTUNITY_MODEL_TYPE, "customer_id")]) is None
+
+    # Clean up
+    redis_manager.delete(OPPORTUNITY_MODEL_TYPE, kept.id)
+    redis_manager.delete("customer", other.id)
+
+    print("Test completed.")
+
+def test_delete_customer_cascade_endpoint():
+    """
+    Test that DELETE /customers/{id}?cascade=true also deletes the activities and notes of the
+    customer and of its opportunities.
+    """
+    print("Testing DELETE /customers/{id}?cascade=true...")
+
+    client = TestClient(app)
+    customer = client.post("/customers", json={"name": "Cascade Endpoint Customer", "email": "cascade@example.com"}).json()
+    opportunity = client.post("/opportunities", json={"name": "Deal", "customer_id": customer["id"]}).json()
+    activity = client.post(
+        "/activities", json={"title": "Call", "activity_type": "call", "opportunity_id": opportunity["id"]}
+    ).json()
+    customer_note = client.post("/notes", json={"content": "Customer note", "customer_id": customer["id"]}).json()
+    activity_note = client.post("/notes", json={"content": "Activity note", "activity_id": activity["id"]}).json()
+
+    # Without cascade the customer is deleted alone
+    kept = client.post("/customers", json={"name": "Cascade Kept Customer"}).json()
+    kept_opportunity = client.post("/opportunities", json={"name": "Kept deal", "customer_id": kept["id"]}).json()
+    assert client.delete(f"/customers/{kept['id']}").status_code == 204
+    assert client.get(f"/opportunities/{kept_opportunity['id']}").status_code == 200
+
+    response = client.delete(f"/customers/{customer['id']}?cascade=true")
+    print(f"Cascading delete: {response.status_code}")
+    assert response.status_code == 204
+    assert client.get(f"/customers/{customer['id']}").status_code == 404
+    assert client.get(f"/opportunities/{opportunity['id']}").status_code == 404
+    assert client.get(f"/activities/{activity['id']}").status_code == 404
+    assert client.get(f"/notes/{customer_note['id']}").status_code == 404
+    assert client.get(f"/notes/{activity_note['id']}").status_code == 404
+    assert activities.get_activities_by_opportunity(UUID(opportunity["id"])) == []
+    assert notes.get_notes_by_customer(UUID(customer["id"])) == []
+    assert client.delete(f"/customers/{customer['id']}?cascade=true").status_code == 404
+
+    # Clean up
+    client.delete(f"/opportunities/{kept_opportunity['id']}")
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_delete_cascade()
+    test_delete_customer_cascade_endpoint()
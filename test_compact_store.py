@@ -0,0 +1,73 @@
+import threading
+from uuid import uuid4
+
+from models.activity import ActivityCreate, ActivityUpdate, ActivityType, ActivityStatus
+from service import activities
+
+def test_compact_activity_store():
+    """
+    Test that activities round-trip through the compact store and its indexes.
+    """
+    print("Testing compact activity store...")
+
+    customer_id = uuid4()
+    created = activities.create_activity(ActivityCreate(
+        title="Call", activity_type=ActivityType.CALL, customer_id=customer_id, assigned_to="alice"
+    ))
+    record = activities.activities_db.record(created.id)
+    print(f"Record: {record}")
+
+    assert record.id == created.id.int
+    assert isinstance(record.activity_type, int)
+
+    fetched = activities.get_activity(created.id)
+    assert fetched == created
+    assert [a.id for a in activities.get_activities_by_customer(customer_id)] == [created.id]
+
+    updated = activities.update_activity(created.id, ActivityUpdate(status=ActivityStatus.COMPLETED, customer_id=None))
+    assert updated.status == ActivityStatus.COMPLETED and updated.completed_at is not None
+    assert updated.version == 2
+    assert activities.get_activities_by_customer(customer_id) == []
+
+    assert activities.delete_activity(created.id)
+    assert activities.get_activity(created.id) is None
+
+    print("Test completed.")
+
+def test_concurrent_activity_reads():
+    """
+    Test that activities and their indexes can be read while another thread stores
+    activities, as the write-behind flush thread does.
+    """
+    print("Testing concurrent activity reads and writes...")
+
+    customer_id = uuid4()
+    stop = threading.Event()
+    created = []
+
+    def write():
+        while not stop.is_set() and len(created) < 20000:
+            created.append(activities.create_activity(ActivityCreate(
+                title="Logged call", activity_type=ActivityType.CALL, customer_id=customer_id
+            )))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(200):
+            activities.get_activities()
+            activities.get_activities_by_customer(customer_id)
+    finally:
+        stop.set()
+        writer.join()
+    print(f"Read while {len(created)} activities were stored")
+    assert len(activities.get_activities_by_customer(customer_id)) == len(created)
+
+    # Clean up
+    activities.delete_activities_by_customer(customer_id)
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_compact_activity_store()
+    test_concurrent_activity_reads()
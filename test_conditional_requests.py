@@ -0,0 +1,69 @@
+import redis
+from fastapi.testclient import TestClient
+
+from main import _collection_etag, _parse_if_match, app
+from service.redis_manager import redis_manager
+from service.replicas import ReplicaSet
+
+def test_if_match_entity_tag_list():
+    """
+    Test that a PUT with an If-Match list succeeds if any of its entity tags is current.
+    """
+    print("Testing If-Match lists...")
+
+    assert _parse_if_match(None) is None and _parse_if_match(" * ") is None
+    assert _parse_if_match('"3", W/"4", "other"') == [3, 4]
+    assert _parse_if_match('"other"') == []
+
+    client = TestClient(app)
+    customer = client.post("/customers", json={"name": "If-Match Customer"}).json()
+    url = f"/customers/{customer['id']}"
+    assert client.put(url, json={"name": "Second"}).headers["ETag"] == '"2"'
+
+    # The current version is the second tag of the list
+    response = client.put(url, json={"name": "Third"}, headers={"If-Match": '"1", "2"'})
+    print(f"If-Match \"1\", \"2\" at version 2: {response.status_code}")
+    assert response.status_code == 200 and response.headers["ETag"] == '"3"'
+
+    response = client.put(url, json={"name": "Stale"}, headers={"If-Match": '"1", "2", "foreign"'})
+    assert response.status_code == 412 and response.headers["ETag"] == '"3"'
+    assert client.put(url, json={"name": "Stale"}, headers={"If-Match": '"foreign"'}).status_code == 412
+    assert client.put(url, json={"name": "Fourth"}, headers={"If-Match": '"3", "9"'}).status_code == 200
+    assert client.get(url).json()["name"] == "Fourth"
+
+    # Clean up
+    client.delete(url)
+
+    print("Test completed.")
+
+def test_list_etag_with_lagging_replica():
+    """
+    Test that a list read while one replica lags never carries an ETag newer than its body.
+    """
+    print("Testing list ETags with a lagging replica...")
+
+    client = TestClient(app)
+    customer = client.post("/customers", json={"name": "Replica ETag Customer"}).json()
+
+    # One replica is up to date, the other has not replicated any customer yet
+    fresh = redis.Redis(**redis_manager.connection_kwargs)
+    lagging = redis.Redis(**dict(redis_manager.connection_kwargs, db=14))
+    replicas = ReplicaSet([], {}, max_lag=5.0)
+    replicas.clients = replicas._healthy = [fresh, lagging]
+    redis_manager.replicas = replicas
+    try:
+        for _ in range(20):
+            response = client.get("/customers")
+            stale = response.headers["ETag"] == _collection_etag(0)
+            assert stale == (response.json() == []), "ETag and body read from different replicas"
+    finally:
+        redis_manager.replicas = None
+
+    # Clean up
+    client.delete(f"/customers/{customer['id']}")
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_if_match_entity_tag_list()
+    test_list_etag_with_lagging_replica()
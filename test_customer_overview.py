@@ -0,0 +1,107 @@
+from fastapi.testclient import TestClient
+from uuid import uuid4
+
+from main import app
+from models.customer import Customer
+from models.opportunity import Opportunity
+from service.archive import encode_record, rollup_increments
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.redis_manager import redis_manager
+
+def test_get_with_dependents():
+    """
+    Test that a record and the records referencing it are read together.
+    """
+    print("Testing get_with_dependents...")
+
+    customer = redis_manager.create("customer", Customer(name="Dependents Customer"))
+    other = redis_manager.create("customer", Customer(name="Other Dependents Customer"))
+    deals = [
+        redis_manager.create(OPPORTUNITY_MODEL_TYPE, Opportunity(name=f"Deal {n}", customer_id=customer.id))
+        for n in range(3)
+    ]
+    redis_manager.create(OPPORTUNITY_MODEL_TYPE, Opportunity(name="Other deal", customer_id=other.id))
+    dependents = [(OPPORTUNITY_MODEL_TYPE, "customer_id", Opportunity)]
+
+    found, related = redis_manager.get_with_dependents("customer", customer.id, Customer, dependents)
+    print(f"Found {found.name} with {len(related[OPPORTUNITY_MODEL_TYPE])} opportunities")
+    assert found.id == customer.id
+    assert {opp.id for opp in related[OPPORTUNITY_MODEL_TYPE]} == {deal.id for deal in deals}
+
+    assert redis_manager.get_with_dependents("customer", uuid4(), Customer, dependents) == (None, {})
+    try:
+        redis_manager.get_with_dependents("customer", customer.id, Customer, [(OPPORTUNITY_MODEL_TYPE, "name", Opportunity)])
+    except ValueError as e:
+        print(f"Unindexed field: {e}")
+    else:
+        raise AssertionError("Unindexed dependent field accepted")
+
+    # Clean up
+    redis_manager.delete_cascade("customer", customer.id, [(OPPORTUNITY_MODEL_TYPE, "customer_id")])
+    redis_manager.delete_cascade("customer", other.id, [(OPPORTUNITY_MODEL_TYPE, "customer_id")])
+
+    print("Test completed.")
+
+def test_customer_overview():
+    """
+    Test the opportunities, activities, notes and rollup totals of GET /customers/{id}/overview.
+    """
+    print("Testing customer overview...")
+
+    client = TestClient(app)
+    customer = client.post("/customers", json={"name": "Overview Customer"}).json()
+    for name, amount, stage, probability in [
+        ("Open deal", 1000, "proposal", 50),
+        ("Won deal", 400, "closed_won", 100),
+        ("Lost deal", 300, "closed_lost", 0),
+    ]:
+        client.post("/opportunities", json={
+            "name": name, "customer_id": customer["id"], "amount": amount, "stage": stage, "probability": probability
+        })
+    client.post("/activities", json={"title": "Call", "activity_type": "call", "customer_id": customer["id"]})
+    client.post("/activities", json={
+        "title": "Meeting", "activity_type": "meeting", "status": "completed", "customer_id": customer["id"]
+    })
+    client.post("/notes", json={"content": "Met the buyer", "customer_id": customer["id"]})
+
+    response = client.get(f"/customers/{customer['id']}/overview")
+    overview = response.json()
+    print(f"Rollup: {overview['rollup']}")
+    assert response.status_code == 200
+    assert overview["customer"]["id"] == customer["id"]
+    assert len(overview["opportunities"]) == 3 and len(overview["activities"]) == 2 and len(overview["notes"]) == 1
+    assert overview["rollup"] == {
+        "opportunity_count": 3,
+        "archived_opportunity_count": 0,
+        "open_opportunity_count": 1,
+        "total_amount": 1700,
+        "open_amount": 1000,
+        "weighted_amount": 500,
+        "won_amount": 400,
+        "opportunities_by_stage": {"proposal": 1, "closed_won": 1, "closed_lost": 1},
+        "activity_count": 2,
+        "activities_by_status": {"planned": 1, "completed": 1},
+        "note_count": 1,
+    }
+    assert client.get(f"/customers/{uuid4()}/overview").status_code == 404
+
+    # Archiving the won deal takes it out of the list, but not out of the totals
+    won = next(opp for opp in overview["opportunities"] if opp["stage"] == "closed_won")
+    record = redis_manager.get_many_raw(OPPORTUNITY_MODEL_TYPE, [won["id"]])[won["id"]]
+    assert redis_manager.archive(
+        OPPORTUNITY_MODEL_TYPE, won["id"], won["version"], encode_record(record), rollup_increments(record),
+        {"customer_id": record["customer_id"]},
+    ) == 1
+    archived = client.get(f"/customers/{customer['id']}/overview").json()
+    print(f"Rollup after archiving: {archived['rollup']}")
+    assert won["id"] not in {opp["id"] for opp in archived["opportunities"]}
+    assert archived["rollup"] == dict(overview["rollup"], archived_opportunity_count=1)
+
+    # Clean up
+    client.delete(f"/customers/{customer['id']}?cascade=true")
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_get_with_dependents()
+    test_customer_overview()
@@ -0,0 +1,105 @@
+import redis
+from fastapi.testclient import TestClient
+
+from main import app
+from service import dashboard
+from service.dashboard import DashboardAggregates, compute_stats, is_empty, new_delta
+from service.redis_manager import redis_manager
+from service.replicas import ReplicaSet
+
+def test_dashboard_deltas():
+    """
+    Test the aggregate deltas pushed to live dashboards.
+    """
+    print("Testing dashboard deltas...")
+
+    aggregates = DashboardAggregates()
+    delta = new_delta()
+    aggregates.apply("customer", "c1", {"id": "c1", "status": "lead"}, delta)
+    aggregates.apply("opportunity", "o1", {"id": "o1", "stage": "proposal", "amount": 100.1}, delta)
+    assert delta["customers"] == {"total": 1, "status": {"lead": 1}}
+    assert delta["opportunities"]["stages"] == {"proposal": {"count": 1, "value": 100.1}}
+
+    # A stage change moves the amount; an update that changes nothing is no delta
+    delta = new_delta()
+    aggregates.apply("opportunity", "o1", {"id": "o1", "stage": "closed_won", "amount": 100.1}, delta)
+    print(f"Stage change: {delta}")
+    assert delta["opportunities"]["total"] == 0 and not is_empty(delta)
+    assert delta["opportunities"]["stages"]["proposal"]["count"] == -1
+    delta = new_delta()
+    aggregates.apply("customer", "c1", {"id": "c1", "status": "lead"}, delta)
+    assert is_empty(delta)
+
+    # Deletes remove the last contribution of the record
+    delta = new_delta()
+    aggregates.apply("customer", "c1", None, delta)
+    assert delta["customers"] == {"total": -1, "status": {"lead": -1}}
+
+    snapshot = aggregates.snapshot()
+    assert snapshot["customers"]["total"] == 0
+    assert snapshot["opportunities"]["stages"]["closed_won"] == {"count": 1, "value": 100.1}
+
+    print("Test completed.")
+
+def test_dashboard_stats():
+    """
+    Test the card data of the dashboard stats API.
+    """
+    print("Testing dashboard stats...")
+
+    customers = [{"id": "2", "name": "B", "status": "customer"}, {"id": "1", "name": "A", "status": "lead"}]
+    opportunities = [
+        {"id": "1", "name": "Won", "stage": "closed_won", "amount": 100.5},
+        {"id": "2", "name": "Lost", "stage": "closed_lost", "amount": None},
+        {"id": "3", "name": "Open", "stage": "proposal", "amount": 50},
+    ]
+    stats = compute_stats(customers, opportunities)
+    print(f"Summary: {stats['summary']}")
+    assert stats["summary"] == {
+        "total_customers": 2, "total_opportunities": 3, "total_opportunity_value": 150.5, "win_rate": 50,
+    }
+    assert stats["customers"] == {"lead": 1, "prospect": 0, "customer": 1, "inactive": 0}
+    assert stats["opportunities"]["closed_won"] == {"count": 1, "value": 100.5}
+    assert stats["opportunities"]["negotiation"] == {"count": 0, "value": 0.0}
+    assert [customer["name"] for customer in stats["recent_customers"]] == ["A", "B"]
+
+    print("Test completed.")
+
+def test_dashboard_stats_with_lagging_replica():
+    """
+    Test that dashboard stats read while one replica lags never carry an ETag newer than
+    their data, and are never cached under a newer revision.
+    """
+    print("Testing dashboard stats with a lagging replica...")
+
+    client = TestClient(app)
+    customer = client.post("/customers", json={"name": "Replica Stats Customer"}).json()
+
+    # One replica is up to date, the other has not replicated any customer yet
+    fresh = redis.Redis(**redis_manager.connection_kwargs)
+    lagging = redis.Redis(**dict(redis_manager.connection_kwargs, db=14))
+    replicas = ReplicaSet([], {}, max_lag=5.0)
+    replicas.clients = replicas._healthy = [fresh, lagging]
+    redis_manager.replicas = replicas
+    try:
+        for attempt in range(20):
+            if attempt % 2 == 0:
+                dashboard._stats_cache = None
+            response = client.get("/api/dashboard/stats")
+            customer_revision = response.headers["ETag"].strip('W/"').split("-")[1]
+            stale = customer_revision == "0"
+            assert stale == (response.json()["summary"]["total_customers"] == 0), \
+                "ETag and data read from different replicas"
+    finally:
+        redis_manager.replicas = None
+        dashboard._stats_cache = None
+
+    # Clean up
+    client.delete(f"/customers/{customer['id']}")
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_dashboard_deltas()
+    test_dashboard_stats()
+    test_dashboard_stats_with_lagging_replica()
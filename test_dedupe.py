@@ -0,0 +1,103 @@
+from uuid import UUID, uuid4
+
+from fastapi.testclient import TestClient
+
+from main import app
+from models.customer import CustomerUpdate
+from service import customers, dedupe
+from service.customers import CUSTOMER_MODEL_TYPE
+from service.dedupe import (
+    blocking_keys, cluster_pairs, find_clusters, get_features, normalize_email, normalize_phone, score
+)
+from service.redis_manager import redis_manager
+
+def test_dedupe():
+    """
+    Test the normalization, scoring and clustering of duplicate detection.
+    """
+    print("Testing dedupe...")
+
+    assert normalize_email(" John.Doe+crm@GMail.com") == "johndoe@gmail.com"
+    assert normalize_email("john.doe@example.com") == "john.doe@example.com"
+    assert normalize_email("not an address") is None
+    assert normalize_phone("+1 (555) 123-4567") == normalize_phone("555.123.4567") == "5551234567"
+    assert normalize_phone("123") is None
+
+    acme = get_features({"id": "a", "name": "Acme Corporation", "email": "info@acme.com", "address": "789 Corporate Ave"})
+    acme_inc = get_features({"id": "b", "name": "ACME, Inc.", "phone": "555-123-4567", "address": "789 Corporate Avenue"})
+    other = get_features({"id": "c", "name": "Startup Inc", "email": "INFO@acme.com"})
+    print(f"Acme vs Acme Inc: {score(acme, acme_inc)}")
+
+    assert score(acme, other) == (1.0, ["email"])
+    acme_score, reasons = score(acme, acme_inc)
+    assert acme_score >= 0.6 and reasons == ["name"]
+    assert score(acme, get_features({"id": "d", "name": "Globex"}))[0] < 0.3
+
+    # Near-identical names share a MinHash band
+    assert set(blocking_keys(acme)) & set(blocking_keys(acme_inc))
+
+    clusters = cluster_pairs([("b", "a", 0.8, ["name"]), ("c", "b", 0.9, ["phone"]), ("x", "y", 1.0, ["email"])])
+    print(f"Clusters: {[(cluster.cluster_id, cluster.score, len(cluster.members)) for cluster in clusters]}")
+    assert [cluster.cluster_id for cluster in clusters] == ["a", "x"]
+    assert clusters[0].score == 0.8
+    assert {member.id: member.score for member in clusters[0].members} == {"a": 0.8, "b": 0.9, "c": 0.9}
+
+    records = [
+        {"id": "1", "name": "Jane Smith", "email": "jane.smith@example.com"},
+        {"id": "2", "name": "Jane Smith", "email": "jane.smith+news@example.com"},
+        {"id": "3", "name": "John Doe", "phone": "123-456-7890"},
+        {"id": "4", "name": "Jonathan Doe", "phone": "(123) 456 7890"},
+        {"id": "5", "name": "Globex"},
+    ]
+    keys = {}
+    clusters = find_clusters(records, workers=2, chunk_size=2, keys=keys)
+    assert [[member.id for member in cluster.members] for cluster in clusters] == [["1", "2"], ["3", "4"]]
+    assert set(keys) == {"1", "2", "3", "4", "5"}
+
+    print("Test completed.")
+
+def test_dedupe_online():
+    """
+    Test the online duplicate check: indexing on create, update and delete, and the
+    X-Possible-Duplicates header.
+    """
+    print("Testing the online duplicate check...")
+
+    client = TestClient(app)
+    token = uuid4().hex[:8]
+    email = f"{token}@initech.example"
+    first = client.post("/customers", json={"name": f"Initech {token}", "email": email})
+    assert first.status_code == 201 and "X-Possible-Duplicates" not in first.headers
+    first = first.json()
+
+    # The blocking sets live under the model type's key prefix (with its hash tag in cluster mode)
+    email_key = dedupe._index_key(CUSTOMER_MODEL_TYPE, f"email:{email}")
+    keys_key = dedupe._record_keys_key(CUSTOMER_MODEL_TYPE, first["id"])
+    assert keys_key.startswith(redis_manager._get_prefix(CUSTOMER_MODEL_TYPE, redis_manager._get_shard(first["id"])))
+    assert redis_manager.redis_client.smembers(email_key) == {first["id"]}
+    assert f"email:{email}" in redis_manager.redis_client.smembers(keys_key)
+
+    second = client.post("/customers", json={"name": f"Umbrella {uuid4().hex[:8]}", "email": email.replace("@", "+crm@").upper()})
+    print(f"X-Possible-Duplicates: {second.headers.get('X-Possible-Duplicates')}")
+    assert second.headers["X-Possible-Duplicates"] == f"{first['id']};score=1.00"
+    second = second.json()
+
+    # An update moves the record to its new blocking sets
+    customers.update_customer(UUID(first["id"]), CustomerUpdate(email=f"{token}@other.example"))
+    assert first["id"] not in redis_manager.redis_client.smembers(email_key)
+    assert dedupe.find_duplicates(CUSTOMER_MODEL_TYPE, second) == []
+
+    # A delete removes it from all of them
+    client.delete(f"/customers/{first['id']}")
+    assert not redis_manager.redis_client.exists(keys_key)
+    assert redis_manager.redis_client.smembers(email_key) == {second["id"]}
+
+    # Clean up
+    client.delete(f"/customers/{second['id']}")
+    assert not redis_manager.redis_client.exists(email_key)
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_dedupe()
+    test_dedupe_online()
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import random
+
+import httpx
+
+from load_test import (
+    PLACEHOLDER_ID, SCENARIOS, capture_ids, parse_http_file, percentile, prepare_request, run_load
+)
+
+async def _app(scope, receive, send):
+    # Stands in for the application: creates answer with a record, everything else with a list
+    if scope["type"] != "http":
+        return
+    await receive()
+    method, path = scope["method"], scope["path"]
+    id = "11111111-1111-1111-1111-111111111111"
+    status, body = (201, {"id": id}) if method == "POST" else (200, [{"id": id, "path": path}])
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": json.dumps(body).encode()})
+
+def test_load_test():
+    """
+    Test the .http parsing, ID substitution, percentiles and scenario runs of the load test.
+    """
+    print("Testing load test...")
+
+    requests = parse_http_file()
+    routes = {request.route for request in requests}
+    print(f"Parsed {len(requests)} requests, {len(routes)} routes")
+    for _, steps in SCENARIOS.values():
+        assert set(steps) <= routes
+
+    # Commented out requests are parsed too, with their IDs as placeholders
+    update = next(request for request in requests if request.route == "PUT /contacts/{id}")
+    assert update.path == f"/contacts/{PLACEHOLDER_ID}" and json.loads(update.body)["name"] == "John Doe Updated"
+    assert prepare_request(update, {}) is None
+    assert prepare_request(update, {"contact": "c1"}) == ("/contacts/c1", update.body)
+
+    delete = next(request for request in requests if request.route == "DELETE /customers/{id}")
+    assert prepare_request(delete, {"customer": "c2"})[0] == "/customers/c2?cascade=true"
+
+    activity = next(request for request in requests if request.route == "POST /activities")
+    assert prepare_request(activity, {"customer": "c3"}) is None
+    body = json.loads(prepare_request(activity, {"customer": "c3", "opportunity": "o3"})[1])
+    assert (body["customer_id"], body["opportunity_id"]) == ("c3", "o3")
+
+    ids = {}
+    capture_ids("/customers/c3/opportunities", [{"id": "o4"}], ids, random.Random(0))
+    capture_ids("/customers", {"id": "c4"}, ids, random.Random(0))
+    assert ids == {"opportunity": "o4", "customer": "c4"}
+
+    values = sorted(float(value) for value in range(1, 101))
+    assert (percentile(values, 0.5), percentile(values, 0.95), percentile(values, 0.99)) == (50.0, 95.0, 99.0)
+    assert percentile([], 0.5) == 0.0
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=_app), base_url="http://test") as client:
+            closed = await run_load(client, SCENARIOS, requests, duration=0.2, concurrency=4, seed=1)
+            opened = await run_load(client, {"sync": SCENARIOS["sync"]}, requests, duration=0.2, rate=100, seed=1)
+        return closed, opened
+
+    closed, opened = asyncio.run(run())
+    report = closed.report(0.2)
+    print(f"Closed loop: {sum(closed.scenarios.values())} scenarios, {sum(stats['requests'] for stats in report.values())} requests")
+    assert report["POST /customers"]["requests"] > 0 and report["DELETE /customers/{id}"]["requests"] > 0
+    assert all(stats["server_errors"] == 0 for stats in report.values())
+    assert list(opened.report(0.2)) == ["GET /sync"] and opened.scenarios["sync"] > 0
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_load_test()
@@ -0,0 +1,242 @@
+import asyncio
+import gzip
+import json
+import time
+
+import brotli
+import httpx
+import msgpack
+from fastapi import FastAPI
+
+from middleware import (
+    AdmissionControlMiddleware, CompressionMiddleware, ConcurrencyLimiter, MsgPackMiddleware, choose_encoding,
+    parse_admission_limits, prefers_msgpack
+)
+
+# A JSON body well above the compression threshold
+ITEMS = [{"id": n, "name": f"Customer {n}", "status": "lead"} for n in range(100)]
+
+async def json_app(scope, receive, send):
+    """
+    An ASGI app answering with ITEMS and ETag "3", or 304 if If-None-Match names it.
+    """
+    headers = dict(scope["headers"])
+    if headers.get(b"if-none-match") == b'"3"':
+        await send({"type": "http.response.start", "status": 304, "headers": [(b"etag", b'"3"')]})
+        await send({"type": "http.response.body", "body": b""})
+        return
+    body = json.dumps(ITEMS).encode()
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"etag", b'"3"'),
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+def call(app, headers, path="/"):
+    """
+    Run one GET request through an ASGI app and collect the messages it sends.
+    """
+    scope = {
+        "type": "http", "method": "GET", "path": path,
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start, *body = messages
+    return start["status"], {name.decode(): value.decode() for name, value in start["headers"]}, body
+
+def test_content_negotiation():
+    """
+    Test the Accept and Accept-Encoding negotiation of the response middleware.
+    """
+    print("Testing content negotiation...")
+
+    assert choose_encoding("gzip, deflate, br", ["br", "gzip"]) == "br"
+    assert choose_encoding("gzip;q=1.0, br;q=0.5", ["br", "gzip"]) == "gzip"
+    assert choose_encoding("br;q=0, *", ["br", "gzip"]) == "gzip"
+    assert choose_encoding("identity", ["br", "gzip"]) is None
+    assert choose_encoding("", ["br", "gzip"]) is None
+
+    assert prefers_msgpack("application/msgpack")
+    assert prefers_msgpack("application/x-msgpack, */*;q=0.1")
+    assert prefers_msgpack("application/msgpack, application/json;q=0.5")
+    assert not prefers_msgpack("application/json, application/msgpack;q=0.5")
+    assert not prefers_msgpack("*/*")
+
+    print("Test completed.")
+
+def test_admission_control():
+    """
+    Test route classification, limit parsing and the concurrency limiter.
+    """
+    print("Testing admission control...")
+
+    assert parse_admission_limits("scan=4:16, point=64") == {"scan": (4, 16), "point": (64, 0)}
+    for invalid in ("scan", "scan=x", "=4", "scan=-1"):
+        try:
+            parse_admission_limits(invalid)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"Invalid limit accepted: {invalid}")
+
+    middleware = AdmissionControlMiddleware(None)
+    assert middleware.classify("GET", "/opportunities") == "scan"
+    assert middleware.classify("GET", "/analytics/forecast") == "scan"
+    assert middleware.classify("GET", "/api/dashboard/cards/summary") == "scan"
+    assert middleware.classify("GET", "/customers/42") == "point"
+    assert middleware.classify("GET", "/customers/42/activities") == "point"
+    assert middleware.classify("PUT", "/customers/42") == "write"
+    assert middleware.classify("GET", "/metrics") is None
+
+    async def run():
+        limiter = ConcurrencyLimiter("test", max_concurrent=1, max_queued=1, queue_timeout=0.05)
+        assert await limiter.acquire() is None
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        # One running, one queued: the next request is shed at once
+        assert await limiter.acquire() == "queue_full"
+        limiter.release()
+        assert await waiting is None
+        # The queued request times out while the slot stays taken
+        assert await limiter.acquire() == "timeout"
+        limiter.release()
+        assert limiter.active == 0
+
+    asyncio.run(run())
+
+    print("Test completed.")
+
+def test_response_encoding():
+    """
+    Test that the middleware compresses and re-encodes bodies with representation-specific
+    ETags, and matches those ETags in If-None-Match.
+    """
+    print("Testing response encoding...")
+
+    app = CompressionMiddleware(MsgPackMiddleware(json_app), minimum_size=100)
+
+    for encoding, decompress in (("gzip", gzip.decompress), ("br", brotli.decompress)):
+        status, headers, body = call(app, {"Accept-Encoding": encoding})
+        print(f"{encoding}: {headers['content-length']} bytes, ETag {headers['etag']}")
+        assert status == 200 and headers["content-encoding"] == encoding and headers["vary"] == "Accept-Encoding"
+        assert headers["etag"] == f'"3-{encoding}"'
+        assert json.loads(decompress(body[0]["body"])) == ITEMS
+        assert int(headers["content-length"]) == len(body[0]["body"])
+
+        # The representation's own ETag revalidates it
+        status, headers, _ = call(app, {"Accept-Encoding": encoding, "If-None-Match": f'"3-{encoding}"'})
+        assert status == 304 and headers["etag"] == f'"3-{encoding}"'
+
+    status, headers, body = call(app, {"Accept": "application/msgpack", "Accept-Encoding": "gzip"})
+    assert headers["content-type"] == "application/msgpack" and headers["etag"] == '"3-msgpack-gzip"'
+    assert set(headers["vary"].replace(" ", "").split(",")) == {"Accept", "Accept-Encoding"}
+    assert msgpack.unpackb(gzip.decompress(body[0]["body"])) == ITEMS
+    status, _, _ = call(app, {"Accept": "application/msgpack", "Accept-Encoding": "gzip", "If-None-Match": '"3-msgpack-gzip"'})
+    assert status == 304
+
+    # Identity responses keep the handler's ETag
+    status, headers, body = call(app, {})
+    assert "content-encoding" not in headers and headers["etag"] == '"3"'
+    assert json.loads(body[0]["body"]) == ITEMS
+    small = CompressionMiddleware(json_app, minimum_size=100000)
+    assert call(small, {"Accept-Encoding": "gzip"})[1]["etag"] == '"3"'
+    status, headers, _ = call(small, {"Accept-Encoding": "gzip", "If-None-Match": '"3"'})
+    assert status == 304 and headers["etag"] == '"3"'
+
+    print("Test completed.")
+
+def test_event_stream_passthrough():
+    """
+    Test that server-sent events pass the compression middleware unbuffered and uncompressed.
+    """
+    print("Testing event stream passthrough...")
+
+    events = []
+
+    async def stream_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]})
+        for n in range(3):
+            await send({"type": "http.response.body", "body": f"data: {n}\n\n".encode() * 50, "more_body": True})
+            events.append(f"sent {n}")
+        await send({"type": "http.response.body", "body": b""})
+
+    async def record(app, scope, receive, send):
+        async def send_recorded(message):
+            if message.get("body"):
+                events.append(f"received {message['body'][6:7].decode()}")
+            await send(message)
+        await app(scope, receive, send_recorded)
+
+    app = CompressionMiddleware(stream_app, minimum_size=10)
+    status, headers, body = call(lambda scope, receive, send: record(app, scope, receive, send), {"Accept-Encoding": "gzip"})
+    print(f"Events: {events}")
+    assert "content-encoding" not in headers
+    # Each chunk reached the client before the app produced the next one
+    assert events == ["received 0", "sent 0", "received 1", "sent 1", "received 2", "sent 2"]
+    assert body[0]["body"].startswith(b"data: 0")
+
+    print("Test completed.")
+
+def test_admission_control_sheds_slow_scans():
+    """
+    Test that a scan arriving while the only scan slot is taken by a slow route is answered
+    at once with 503 and Retry-After, while point reads go on.
+    """
+    print("Testing admission control of slow scans...")
+
+    app = FastAPI()
+
+    # Blocking like the Redis-backed scan routes, so run in the threadpool like them
+    @app.get("/contacts")
+    def list_contacts():
+        time.sleep(0.5)
+        return []
+
+    @app.get("/contacts/{contact_id}")
+    def get_contact(contact_id: str):
+        return {"id": contact_id}
+
+    async def run():
+        middleware = AdmissionControlMiddleware(app, limits={"scan": (1, 0)}, retry_after=7)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=middleware), base_url="http://test") as client:
+            slow = asyncio.ensure_future(client.get("/contacts"))
+            await asyncio.sleep(0.1)
+            started = time.perf_counter()
+            shed = await client.get("/contacts")
+            point = await client.get("/contacts/42")
+            elapsed = time.perf_counter() - started
+            return (await slow), shed, point, elapsed
+
+    slow, shed, point, elapsed = asyncio.run(run())
+    print(f"Shed: {shed.status_code} Retry-After {shed.headers.get('Retry-After')} in {elapsed:.3f}s")
+    assert slow.status_code == 200
+    assert shed.status_code == 503 and shed.headers["Retry-After"] == "7"
+    assert point.status_code == 200
+    # Neither waited for the slow scan
+    assert elapsed < 0.3
+
+    # The scan routes of the application run in the threadpool too
+    from main import router
+
+    classifier = AdmissionControlMiddleware(None)
+    scans = [
+        route for route in router.routes
+        if "GET" in route.methods and classifier.classify("GET", route.path) == "scan"
+    ]
+    assert scans and not any(asyncio.iscoroutinefunction(route.endpoint) for route in scans)
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_content_negotiation()
+    test_admission_control()
+    test_admission_control_sheds_slow_scans()
+    test_response_encoding()
+    test_event_stream_passthrough()
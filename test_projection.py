@@ -0,0 +1,27 @@
+import json
+
+from models.customer import Customer
+from models.projection import dump_projection, model_field_names, projection_model
+
+def test_projection():
+    """
+    Test building and serializing field projections of a model.
+    """
+    print("Testing field projections...")
+
+    assert "email" in model_field_names(Customer)
+
+    projected = projection_model(Customer, ("id", "name"))
+    assert projection_model(Customer, ("id", "name")) is projected
+    assert sorted(model_field_names(projected)) == ["id", "name"]
+
+    record = {"id": "8f14e45f-ceea-467f-a8c5-0f4a2b3c9d10", "name": "Acme"}
+    assert json.loads(dump_projection(Customer, ("id", "name"), record)) == record
+    assert json.loads(dump_projection(Customer, ("id", "name"), [record, {"id": None, "name": "B"}])) == [
+        record, {"id": None, "name": "B"}
+    ]
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_projection()
@@ -0,0 +1,123 @@
+import json
+from uuid import uuid4
+from fastapi.testclient import TestClient
+
+from main import create_app
+from models.opportunity import Opportunity, OpportunityStage
+from service.query import Condition, matches, parse_query
+from service.redis_manager import RedisManager
+
+# A model type of its own, so the indexes and records of the tests stay apart
+QUERY_MODEL_TYPE = "querytest"
+
+def test_parse_query():
+    """
+    Test parsing filter/sort parameters and planning their score ranges.
+    """
+    print("Testing filter/sort query parsing...")
+
+    query = parse_query(Opportunity, "stage:proposal|negotiation, amount>=1000,amount<5000", "-amount", 10, 5)
+    print(f"Parsed query: {query}")
+    assert query.conditions[0] == Condition("stage", ":", (OpportunityStage.PROPOSAL, OpportunityStage.NEGOTIATION))
+    assert query.conditions[1] == Condition("amount", ">=", (1000.0,))
+    assert (query.sort, query.descending, query.offset, query.limit) == ("amount", True, 10, 5)
+    assert str(query.conditions[0]) == "stage:proposal|negotiation"
+
+    assert matches(query.conditions[1], 1000.0)
+    assert not matches(query.conditions[2], None)
+    assert parse_query(Opportunity).conditions == ()
+
+    for filter, sort in (("bogus:1", None), ("amount>=abc", None), ("amount", None), (None, "bogus")):
+        try:
+            parse_query(Opportunity, filter, sort)
+        except ValueError:
+            continue
+        raise AssertionError(f"{filter!r} {sort!r} should not parse")
+
+    manager = RedisManager()
+    bounds = None
+    for condition in query.conditions[1:] + (Condition("amount", ">", (2000.0,)), Condition("amount", "<=", (5000.0,))):
+        bounds = manager._narrow_bounds(bounds, condition)
+    low, high = bounds
+    assert (manager._score_bound(low), manager._score_bound(high)) == ("(2000.0", "(5000.0")
+
+    print("Test completed.")
+
+def test_query():
+    """
+    Test index, range, union and scan-fallback plans of queries run against Redis, and the
+    order of records without a value for the sort field.
+    """
+    print("Testing queries...")
+
+    manager = RedisManager()
+    manager.register_index(QUERY_MODEL_TYPE, "stage")
+    manager.register_sorted_index(QUERY_MODEL_TYPE, "amount")
+    customer_id = uuid4()
+    records = {
+        name: manager.create(QUERY_MODEL_TYPE, Opportunity(
+            name=name, customer_id=customer_id, stage=stage, amount=amount, probability=probability
+        ))
+        for name, stage, amount, probability in [
+            ("A", OpportunityStage.PROPOSAL, 500.0, 10),
+            ("B", OpportunityStage.PROPOSAL, 1500.0, 50),
+            ("C", OpportunityStage.NEGOTIATION, 3000.0, 50),
+            ("D", OpportunityStage.NEGOTIATION, None, 90),
+            ("E", OpportunityStage.CLOSED_WON, 2000.0, 100),
+        ]
+    }
+    names = {str(record.id): name for name, record in records.items()}
+
+    def run(filter=None, sort=None, offset=0, limit=None):
+        result = manager.query(QUERY_MODEL_TYPE, Opportunity, parse_query(Opportunity, filter, sort, offset, limit))
+        return [names[id] for id in result.items], result.total, result.plan
+
+    # Index set
+    found, total, plan = run("stage:proposal", "amount")
+    print(f"stage:proposal: {found} {plan}")
+    assert (found, total) == (["A", "B"], 2)
+    assert plan["index"] == ["stage:proposal"] and plan["scan"] == [] and plan["scanned"] == 0
+
+    # Score range, sorted by the same index
+    found, total, plan = run("amount>=1000,amount<3000", "amount")
+    assert (found, total) == (["B", "E"], 2) and plan["sort"]["using"] == "index"
+
+    # Union of index sets, paged in Redis; records without an amount sort lowest
+    assert run("stage:proposal|negotiation", "amount")[0] == ["D", "A", "B", "C"]
+    found, total, plan = run("stage:proposal|negotiation", "-amount", offset=1, limit=2)
+    print(f"Page of the union by -amount: {found} of {total}")
+    assert (found, total) == (["B", "A"], 4) and plan["scanned"] == 0
+
+    # Unindexed condition and sort: the candidates are scanned
+    found, total, plan = run("stage:negotiation|closed_won,probability>=50", "-name")
+    print(f"Scan fallback: {found} {plan}")
+    assert (found, total) == (["E", "D", "C"], 3)
+    assert plan["scan"] == ["probability>=50"] and plan["sort"]["using"] == "scan" and plan["scanned"] == 3
+
+    # The temporary keys are gone
+    for shard in manager._get_shards():
+        assert not manager.redis_client.keys(f"{manager._get_prefix(QUERY_MODEL_TYPE, shard)}query:*")
+
+    # Clean up
+    for record in records.values():
+        manager.delete(QUERY_MODEL_TYPE, record.id)
+
+    print("Test completed.")
+
+def test_query_plan_header():
+    """
+    Test that only an app created with query_plan reports the plan of filtered lists.
+    """
+    print("Testing the X-Query-Plan header...")
+
+    url = "/opportunities?filter=stage:proposal&limit=1"
+    response = TestClient(create_app(query_plan=True)).get(url)
+    assert response.status_code == 200 and json.loads(response.headers["X-Query-Plan"])["index"] == ["stage:proposal"]
+    assert "X-Query-Plan" not in TestClient(create_app(query_plan=False)).get(url).headers
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_parse_query()
+    test_query()
+    test_query_plan_header()
@@ -0,0 +1,96 @@
+from models.customer import Customer
+from models.opportunity import Opportunity
+from service import dedupe, rebuild
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.redis_manager import redis_manager
+
+def test_rebuild():
+    """
+    Test that the rebuild finds and repairs drifted collection sets, indexes and rollups.
+    """
+    print("Testing rebuild...")
+
+    client = redis_manager.redis_client
+    customer = redis_manager.create("customer", Customer(name="Rebuild Test"))
+    opportunity = redis_manager.create(OPPORTUNITY_MODEL_TYPE, Opportunity(name="Drifted", customer_id=customer.id, amount=500))
+    gone = redis_manager.create(OPPORTUNITY_MODEL_TYPE, Opportunity(name="Gone", customer_id=customer.id))
+    opportunity_id, gone_id = str(opportunity.id), str(gone.id)
+    shard = redis_manager._get_shard(opportunity_id)
+
+    collection_key = redis_manager._get_collection_key(OPPORTUNITY_MODEL_TYPE, shard)
+    index_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "customer_id", customer.id, shard)
+    amount_key = redis_manager._get_sorted_index_key(OPPORTUNITY_MODEL_TYPE, "amount", shard)
+    stale_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "stage", "closed_won", shard)
+
+    # Drift: the record left its collection and index, a stale index entry and the record
+    # key of another opportunity are gone, the rollups are off
+    client.srem(collection_key, opportunity_id)
+    client.srem(index_key, opportunity_id)
+    client.zrem(amount_key, opportunity_id)
+    client.sadd(stale_key, opportunity_id)
+    client.delete(redis_manager._get_key(OPPORTUNITY_MODEL_TYPE, gone_id))
+    client.hincrbyfloat(redis_manager._get_rollup_key(OPPORTUNITY_MODEL_TYPE, None), "count:closed_won", 1)
+
+    report = rebuild.rebuild_model(OPPORTUNITY_MODEL_TYPE, dry_run=True, workers=2)
+    print(f"Dry run: {report}")
+    for kind in ("not_in_collection", "missing_index_entry", "stale_index_entry", "orphaned", "rollup_drift"):
+        assert report.issues[kind] >= 1, kind
+    assert report.repaired == 0
+    assert not client.sismember(collection_key, opportunity_id)
+
+    report = rebuild.rebuild_model(OPPORTUNITY_MODEL_TYPE, workers=2)
+    print(f"Rebuild: {report}")
+    assert report.repaired >= 4
+    assert client.sismember(collection_key, opportunity_id)
+    assert client.sismember(index_key, opportunity_id)
+    assert client.zscore(amount_key, opportunity_id) == 500
+    assert not client.sismember(stale_key, opportunity_id)
+    assert gone_id not in redis_manager.get_ids_by_field(OPPORTUNITY_MODEL_TYPE, "customer_id", customer.id)
+    assert client.zscore(redis_manager._get_tombstone_key(OPPORTUNITY_MODEL_TYPE, shard), gone_id) is not None
+
+    report = rebuild.rebuild_model(OPPORTUNITY_MODEL_TYPE, dry_run=True, workers=2)
+    print(f"Dry run after the rebuild: {report}")
+    assert report.consistent
+
+    # Clean up
+    redis_manager.delete(OPPORTUNITY_MODEL_TYPE, opportunity.id)
+    redis_manager.delete("customer", customer.id)
+
+    print("Test completed.")
+
+def test_rebuild_dedupe_index():
+    """
+    Test that the rebuild removes the duplicate check index entries of deleted records.
+    """
+    print("Testing rebuild of the duplicate check index...")
+
+    client = redis_manager.redis_client
+    kept = redis_manager.create("customer", Customer(name="Rebuild Dedupe", email="rebuild-dedupe@example.com"))
+    gone = redis_manager.create("customer", Customer(name="Rebuild Dedupe", email="rebuild-dedupe@example.com"))
+    for customer in (kept, gone):
+        dedupe.index_record("customer", customer)
+    email_key = dedupe._index_key("customer", "email:rebuild-dedupe@example.com")
+    gone_keys_key = dedupe._record_keys_key("customer", str(gone.id))
+
+    # Drift: a record key is gone, but its duplicate check entries are left
+    client.delete(redis_manager._get_key("customer", gone.id))
+
+    report = rebuild.rebuild_model("customer", dry_run=True, workers=2)
+    print(f"Dry run: {report.issues['stale_dedupe_entry']} stale duplicate check entries")
+    assert report.issues["stale_dedupe_entry"] >= 2
+    assert str(gone.id) in client.smembers(email_key)
+
+    rebuild.rebuild_model("customer", workers=2)
+    assert client.smembers(email_key) == {str(kept.id)}
+    assert not client.exists(gone_keys_key)
+    assert rebuild.rebuild_model("customer", dry_run=True, workers=2).issues["stale_dedupe_entry"] == 0
+
+    # Clean up
+    dedupe.remove_record("customer", kept.id)
+    redis_manager.delete("customer", kept.id)
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_rebuild()
+    test_rebuild_dedupe_index()
@@ -0,0 +1,39 @@
+from uuid import uuid4
+from redis.crc import key_slot
+from service.redis_manager import RedisManager
+from models.opportunity import Opportunity
+
+def test_cluster_key_layout():
+    """
+    Test that in cluster mode a record's keys share one slot, and that the single-instance
+    layout is unchanged.
+    """
+    print("Testing cluster key layout...")
+
+    manager = RedisManager(cluster=True, cluster_shards=16)
+    manager.register_index("opportunity", "customer_id")
+    opportunity = Opportunity(name="Deal", customer_id=uuid4())
+
+    keys = [
+        manager._get_key("opportunity", opportunity.id),
+        manager._get_meta_key("opportunity", opportunity.id),
+        manager._get_collection_key("opportunity", manager._get_shard(opportunity.id)),
+        manager._index_args("opportunity", opportunity)[1],
+    ]
+    print(f"Keys: {keys}")
+    assert len({key_slot(key.encode()) for key in keys}) == 1
+
+    # Collections and index sets are sharded over distinct slots
+    collection_slots = {key_slot(key.encode()) for key in manager._get_collection_keys("opportunity")}
+    assert len(collection_slots) == 16
+    assert len(manager._get_index_keys("opportunity", "customer_id", opportunity.customer_id)) == 16
+
+    single = RedisManager(cluster=False)
+    assert single._get_key("opportunity", opportunity.id) == f"opportunity:{opportunity.id}"
+    assert single._get_collection_keys("opportunity") == ["opportunity:all"]
+    assert single._get_meta_key("opportunity", opportunity.id) == f"opportunity:{opportunity.id}:meta"
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_cluster_key_layout()
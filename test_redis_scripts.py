@@ -0,0 +1,237 @@
+from uuid import uuid4
+from models.customer import Customer
+from models.opportunity import Opportunity
+from service.opportunities import OPPORTUNITY_MODEL_TYPE, get_opportunities_by_customer
+from service.changes import ChangeConsumer
+from service.redis_manager import redis_manager, VersionConflictError
+
+def test_atomic_create_delete_with_index():
+    """
+    Test that create, update and delete keep the collection set and index entries in sync.
+    """
+    print("Testing Lua script based create/update/delete...")
+
+    redis_manager.load_scripts()
+
+    customer = redis_manager.create("customer", Customer(name="Index Test Customer"))
+    other_customer = redis_manager.create("customer", Customer(name="Other Customer"))
+
+    opportunity = Opportunity(name="Indexed deal", customer_id=customer.id, amount=1000)
+    redis_manager.create(OPPORTUNITY_MODEL_TYPE, opportunity)
+
+    index_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "customer_id", customer.id)
+    print(f"Index members after create: {redis_manager.redis_client.smembers(index_key)}")
+    assert str(opportunity.id) in redis_manager.redis_client.smembers(index_key)
+
+    found = get_opportunities_by_customer(customer.id)
+    print(f"Opportunities for customer: {found}")
+    assert [opp.id for opp in found] == [opportunity.id]
+
+    # Moving the opportunity to another customer moves its index entry
+    redis_manager.update(OPPORTUNITY_MODEL_TYPE, opportunity.id, {"customer_id": other_customer.id}, Opportunity)
+    assert get_opportunities_by_customer(customer.id) == []
+    assert [opp.id for opp in get_opportunities_by_customer(other_customer.id)] == [opportunity.id]
+
+    # Deleting removes the record, its meta hash, collection membership and index entry
+    assert redis_manager.delete(OPPORTUNITY_MODEL_TYPE, opportunity.id)
+    assert not redis_manager.delete(OPPORTUNITY_MODEL_TYPE, opportunity.id)
+    collection_key = redis_manager._get_collection_key(OPPORTUNITY_MODEL_TYPE)
+    assert not redis_manager.redis_client.sismember(collection_key, str(opportunity.id))
+    assert not redis_manager.redis_client.exists(redis_manager._get_meta_key(OPPORTUNITY_MODEL_TYPE, opportunity.id))
+    assert get_opportunities_by_customer(other_customer.id) == []
+
+    # Clean up
+    redis_manager.delete("customer", customer.id)
+    redis_manager.delete("customer", other_customer.id)
+
+    print("Test completed.")
+
+def test_declared_index_keys():
+    """
+    Test that the save and delete scripts refuse to touch index keys that were not passed in
+    KEYS, and that update and delete read the meta hash again and retry when it changed.
+    """
+    print("Testing declared index keys...")
+
+    client = redis_manager.redis_client
+    customer = redis_manager.create("customer", Customer(name="Declared Keys Customer"))
+    moved_to = redis_manager.create("customer", Customer(name="Moved To Customer"))
+    opportunity = redis_manager.create(OPPORTUNITY_MODEL_TYPE, Opportunity(name="Deal", customer_id=customer.id))
+    meta_key = redis_manager._get_meta_key(OPPORTUNITY_MODEL_TYPE, opportunity.id)
+    index_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "customer_id", customer.id)
+    moved_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "customer_id", moved_to.id)
+
+    # A delete that declares no index keys while the meta hash names one changes nothing
+    keys = [
+        redis_manager._get_key(OPPORTUNITY_MODEL_TYPE, opportunity.id),
+        meta_key,
+        redis_manager._get_collection_key(OPPORTUNITY_MODEL_TYPE),
+        redis_manager._get_revision_key(OPPORTUNITY_MODEL_TYPE),
+        redis_manager._get_change_stream_key(OPPORTUNITY_MODEL_TYPE),
+        redis_manager._get_updated_key(OPPORTUNITY_MODEL_TYPE),
+        redis_manager._get_tombstone_key(OPPORTUNITY_MODEL_TYPE),
+    ]
+    status = redis_manager._run_script("delete", keys, [str(opportunity.id), 0])
+    print(f"Delete with undeclared index keys: {status}")
+    assert status == -1
+    assert client.exists(keys[0]) and client.sismember(index_key, str(opportunity.id))
+
+    # The index entry moves behind the back of a writer: update and delete follow the meta hash
+    client.smove(index_key, moved_key, str(opportunity.id))
+    client.hset(meta_key, "idx:customer_id", moved_key)
+    status, _ = redis_manager._save(
+        OPPORTUNITY_MODEL_TYPE, opportunity.id, opportunity, redis_manager._encode(OPPORTUNITY_MODEL_TYPE, opportunity),
+        "update", 1, {"idx:customer_id": index_key}
+    )
+    assert status == -1
+
+    redis_manager.update(OPPORTUNITY_MODEL_TYPE, opportunity.id, {"name": "Renamed"}, Opportunity, expected_version=1)
+    assert client.sismember(index_key, str(opportunity.id)) and not client.sismember(moved_key, str(opportunity.id))
+
+    client.smove(index_key, moved_key, str(opportunity.id))
+    client.hset(meta_key, "idx:customer_id", moved_key)
+    assert redis_manager.delete(OPPORTUNITY_MODEL_TYPE, opportunity.id)
+    assert not client.sismember(moved_key, str(opportunity.id))
+
+    # Clean up
+    redis_manager.delete("customer", customer.id)
+    redis_manager.delete("customer", moved_to.id)
+
+    print("Test completed.")
+
+def test_declared_repair_and_purge_keys():
+    """
+    Test that the rebuild's repair and purge scripts only touch the index keys passed in
+    KEYS, and that repair and purge follow the index keys the meta hashes name.
+    """
+    print("Testing declared index keys of repair and purge...")
+
+    client = redis_manager.redis_client
+    customer = redis_manager.create("customer", Customer(name="Repair Keys Customer"))
+    moved_to = redis_manager.create("customer", Customer(name="Repair Moved To Customer"))
+    opportunity = redis_manager.create(OPPORTUNITY_MODEL_TYPE, Opportunity(name="Deal", customer_id=customer.id))
+    id = str(opportunity.id)
+    key = redis_manager._get_key(OPPORTUNITY_MODEL_TYPE, id)
+    meta_key = redis_manager._get_meta_key(OPPORTUNITY_MODEL_TYPE, id)
+    index_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "customer_id", customer.id)
+    moved_key = redis_manager._get_index_key(OPPORTUNITY_MODEL_TYPE, "customer_id", moved_to.id)
+    shared_keys = [
+        redis_manager._get_collection_key(OPPORTUNITY_MODEL_TYPE),
+        redis_manager._get_revision_key(OPPORTUNITY_MODEL_TYPE),
+        redis_manager._get_change_stream_key(OPPORTUNITY_MODEL_TYPE),
+        redis_manager._get_updated_key(OPPORTUNITY_MODEL_TYPE),
+        redis_manager._get_tombstone_key(OPPORTUNITY_MODEL_TYPE),
+    ]
+
+    # Drift: the meta hash and the index entry point at the wrong customer
+    client.smove(index_key, moved_key, id)
+    client.hset(meta_key, "idx:customer_id", moved_key)
+    value = client.get(key)
+
+    # A repair that declares no old index key while the meta hash names one changes nothing
+    status = redis_manager._run_script("repair", [key, meta_key, *shared_keys], [id, value, 1, 0, "idx:customer_id", 0, 0, ""])
+    print(f"Repair with undeclared index keys: {status}")
+    assert status == -1 and client.sismember(moved_key, id)
+
+    assert redis_manager.repair(OPPORTUNITY_MODEL_TYPE, opportunity, value)
+    assert client.sismember(index_key, id) and not client.sismember(moved_key, id)
+    assert client.hget(meta_key, "idx:customer_id") == index_key
+
+    # The record key is lost: a purge that declares no index keys leaves the record alone
+    client.delete(key)
+    status = redis_manager._run_script("purge", [*shared_keys, key, meta_key], [0, id, 0])
+    print(f"Purge with undeclared index keys: {status}")
+    assert status == 0 and client.sismember(index_key, id)
+
+    assert redis_manager.purge(OPPORTUNITY_MODEL_TYPE, None, [id]) == 1
+    assert not client.sismember(index_key, id) and not client.exists(meta_key)
+
+    # Clean up
+    redis_manager.delete("customer", customer.id)
+    redis_manager.delete("customer", moved_to.id)
+
+    print("Test completed.")
+
+def test_update_version_conflict():
+    """
+    Test that updates are compare-and-set on the record version.
+    """
+    print("Testing versioned updates...")
+
+    customer = redis_manager.create("customer", Customer(name="Version Test"))
+    print(f"Version after create: {customer.version} (expected: 1)")
+    assert customer.version == 1
+
+    updated = redis_manager.update("customer", customer.id, {"name": "First"}, Customer, expected_version=1)
+    print(f"Version after update: {updated.version} (expected: 2)")
+    assert updated.version == 2
+
+    # A second writer that still holds version 1 gets a conflict instead of overwriting
+    try:
+        redis_manager.update("customer", customer.id, {"name": "Stale"}, Customer, expected_version=1)
+        assert False, "expected a version conflict"
+    except VersionConflictError as e:
+        print(f"Conflict: {e}")
+        assert e.current_version == 2
+
+    stored, version = redis_manager.get_with_version("customer", customer.id, Customer)
+    assert stored.name == "First" and version == 2
+
+    # Clean up
+    redis_manager.delete("customer", customer.id)
+
+    print("Test completed.")
+
+def test_revision_counter():
+    """
+    Test that the collection revision and record version change with every write.
+    """
+    print("Testing revision counters...")
+
+    revision = redis_manager.get_revision("customer")
+    customer = redis_manager.create("customer", Customer(name="Revision Test Customer"))
+    assert redis_manager.get_revision("customer") == revision + 1
+    assert redis_manager.get_version("customer", customer.id) == 1
+
+    redis_manager.update("customer", customer.id, {"name": "Renamed"}, Customer)
+    assert redis_manager.get_revision("customer") == revision + 2
+    assert redis_manager.get_version("customer", customer.id) == 2
+
+    redis_manager.delete("customer", customer.id)
+    print(f"Revision: {revision} -> {redis_manager.get_revision('customer')}")
+    assert redis_manager.get_revision("customer") == revision + 3
+    assert redis_manager.get_version("customer", customer.id) is None
+
+    print("Test completed.")
+
+def test_change_stream():
+    """
+    Test that every write appends a change event that a consumer group can read and acknowledge.
+    """
+    print("Testing change stream...")
+
+    consumer = ChangeConsumer(redis_manager, f"test-{uuid4()}", "test-consumer", ["customer"])
+    consumer.create_group()
+
+    customer = redis_manager.create("customer", Customer(name="Change Stream Customer"))
+    redis_manager.update("customer", customer.id, {"name": "Renamed"}, Customer)
+    redis_manager.delete("customer", customer.id)
+
+    changes = [change for change in consumer.read() if change.id == str(customer.id)]
+    print(f"Changes: {changes}")
+    assert [(change.op, change.version) for change in changes] == [("create", 1), ("update", 2), ("delete", 2)]
+    assert consumer.ack(changes) == 3
+    assert consumer.claim(0) == []
+
+    for key in consumer.streams:
+        redis_manager.redis_client.xgroup_destroy(key, consumer.group)
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_atomic_create_delete_with_index()
+    test_declared_index_keys()
+    test_declared_repair_and_purge_keys()
+    test_update_version_conflict()
+    test_revision_counter()
+    test_change_stream()
@@ -0,0 +1,146 @@
+from contextvars import Context
+
+import redis
+from fastapi.testclient import TestClient
+
+from main import app
+from models.customer import Customer
+from models.opportunity import Opportunity
+from service import redis_scripts
+from service.opportunities import OPPORTUNITY_MODEL_TYPE
+from service.redis_manager import RedisManager, redis_manager
+from service.replicas import HEARTBEAT_KEY, ReplicaSet
+
+# Databases of the test server standing in for the replicas
+FRESH_DB = 14
+STALE_DB = 15
+
+class DownReplica(redis.Redis):
+    """
+    A replica that cannot be reached.
+    """
+    def execute_command(self, *args, **options):
+        raise redis.exceptions.ConnectionError("replica down")
+
+def make_replica_set(manager: RedisManager, clients) -> ReplicaSet:
+    """
+    Build a replica set of the given clients for a manager, without the health check thread.
+    """
+    replicas = ReplicaSet([], {}, max_lag=5.0, check_interval=1.0)
+    replicas._heartbeat = manager.redis_client.register_script(redis_scripts.HEARTBEAT)
+    replicas.clients = clients
+    return replicas
+
+def test_replica_health():
+    """
+    Test that only replicas whose heartbeat is recent enough are used.
+    """
+    print("Testing replica health checks...")
+
+    manager = RedisManager()
+    primary = manager.redis_client
+    fresh = redis.Redis(**dict(manager.connection_kwargs, db=FRESH_DB))
+    stale = redis.Redis(**dict(manager.connection_kwargs, db=STALE_DB))
+    replicas = make_replica_set(manager, [fresh, stale])
+
+    # Without a heartbeat a replica's lag is unknown
+    replicas.check()
+    assert replicas.choose() is None
+
+    stamp = float(primary.get(HEARTBEAT_KEY))
+    fresh.set(HEARTBEAT_KEY, stamp)
+    stale.set(HEARTBEAT_KEY, stamp - 60)
+    replicas.check()
+    print(f"Lag: {replicas.lag}")
+    assert replicas.lag[0] < 1 and replicas.lag[1] > 60
+    assert replicas._healthy == [fresh]
+    assert replicas.choose() is fresh
+
+    replicas.mark_unhealthy(fresh)
+    assert replicas.choose() is None
+
+    # Clean up
+    fresh.delete(HEARTBEAT_KEY)
+    stale.delete(HEARTBEAT_KEY)
+
+    print("Test completed.")
+
+def test_replica_reads():
+    """
+    Test that reads go to a healthy replica, except right after a write of the same context,
+    and fall back to the primary when the replica fails.
+    """
+    print("Testing replica reads...")
+
+    manager = RedisManager()
+    primary = manager.redis_client
+    replica = redis.Redis(**dict(manager.connection_kwargs, db=FRESH_DB))
+    manager.replicas = make_replica_set(manager, [replica])
+    manager.replicas._healthy = [replica]
+
+    writer = Context()
+    customer = writer.run(manager.create, "customer", Customer(name="Primary copy"))
+    key = manager._get_key("customer", customer.id)
+    replica.set(key, primary.get(key).replace("Primary copy", "Replica copy"))
+
+    read = Context().run(manager.get, "customer", customer.id, Customer)
+    print(f"Read in another context: {read.name}")
+    assert read.name == "Replica copy"
+
+    # Read-your-writes: the writing context keeps reading from the primary
+    assert writer.run(manager.get, "customer", customer.id, Customer).name == "Primary copy"
+
+    # A replica that fails is dropped and the read is retried on the primary
+    down = DownReplica(**dict(manager.connection_kwargs, db=FRESH_DB))
+    manager.replicas._healthy = [down]
+    read = Context().run(manager.get, "customer", customer.id, Customer)
+    print(f"Read with the replica down: {read.name}")
+    assert read.name == "Primary copy"
+    assert manager.replicas.choose() is None
+
+    # Clean up
+    replica.delete(key)
+    manager.replicas = None
+    manager.delete("customer", customer.id)
+
+    print("Test completed.")
+
+def test_parent_checks_on_primary():
+    """
+    Test that creates and updates check that the records they reference exist on the primary,
+    not on a replica that has not seen them yet.
+    """
+    print("Testing parent existence checks with a lagging replica...")
+
+    customer = Context().run(redis_manager.create, "customer", Customer(name="Just created"))
+    opportunity = Context().run(
+        redis_manager.create, OPPORTUNITY_MODEL_TYPE, Opportunity(name="Deal", customer_id=customer.id)
+    )
+
+    # The replica has not replicated the customer and the opportunity yet
+    lagging = redis.Redis(**dict(redis_manager.connection_kwargs, db=FRESH_DB))
+    redis_manager.replicas = make_replica_set(redis_manager, [lagging])
+    redis_manager.replicas._healthy = [lagging]
+    try:
+        assert Context().run(redis_manager.get, "customer", customer.id, Customer) is None
+        # Each request in a new context, so that none follows a recent write
+        client = TestClient(app)
+        responses = [
+            Context().run(client.post, "/opportunities", json={"name": "Other deal", "customer_id": str(customer.id)}),
+            Context().run(client.post, "/notes", json={"content": "Call back", "opportunity_id": str(opportunity.id)}),
+            Context().run(client.put, f"/opportunities/{opportunity.id}", json={"customer_id": str(customer.id)}),
+        ]
+        print(f"Status codes: {[response.status_code for response in responses]}")
+        assert [response.status_code for response in responses] == [201, 201, 200]
+    finally:
+        redis_manager.replicas = None
+
+    # Clean up
+    client.delete(f"/customers/{customer.id}?cascade=true")
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_replica_health()
+    test_replica_reads()
+    test_parent_checks_on_primary()
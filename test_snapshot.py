@@ -0,0 +1,106 @@
+import os
+import tempfile
+from uuid import uuid4
+import numpy as np
+from models.customer import CustomerStatus
+from models.opportunity import OpportunityStage
+from models.opportunity import OpportunityCreate, OpportunityUpdate
+from service import opportunities
+from service.analytics import compute_forecast, load_opportunity_columns
+from service.snapshot import Snapshot, SnapshotBuilder, SnapshotStore, make_row, write_snapshot
+
+def test_snapshot_roundtrip():
+    """
+    Test that a snapshot file can be written and read back through mmap.
+    """
+    print("Testing columnar snapshot...")
+
+    customers = [
+        make_row("customer", {"id": "c1", "name": "Acme", "status": "customer", "version": 3}),
+        make_row("customer", {"id": "c2", "name": "Startup", "status": CustomerStatus.LEAD}),
+    ]
+    opportunities = [
+        make_row("opportunity", {"id": "o1", "name": "Big deal", "customer_id": "c1", "amount": 1000.0,
+                                 "probability": 50, "stage": "proposal",
+                                 "expected_close_date": "2024-03-15T10:00:00.123456"}),
+        make_row("opportunity", {"id": "o2", "name": "Small deal", "customer_id": "c2", "amount": 10.5,
+                                 "stage": OpportunityStage.CLOSED_WON}),
+        make_row("opportunity", {"id": "o3", "name": "Orphan", "customer_id": "gone"}),
+    ]
+
+    path = os.path.join(tempfile.mkdtemp(), "snapshot.bin")
+    write_snapshot(path, {"customer": customers, "opportunity": opportunities})
+    snapshot = Snapshot(path)
+
+    print(f"Opportunity rows: {snapshot.rows('opportunity')} (expected: 3)")
+    assert snapshot.rows("opportunity") == 3
+    assert snapshot.rows("activity") == 0
+    assert snapshot.strings(snapshot.column("opportunity", "name")) == ["Big deal", "Small deal", "Orphan"]
+    assert snapshot.column("customer", "version").tolist() == [3, 0]
+    assert np.isnan(snapshot.column("opportunity", "amount")[2])
+    assert str(snapshot.column("opportunity", "expected_close_date")[0]) == "2024-03-15T10:00:00"
+    assert snapshot.string_code("c1") == snapshot.column("customer", "id")[0]
+
+    forecast = compute_forecast(load_opportunity_columns(snapshot))
+    print(f"Forecast by customer status: {forecast.by_customer_status}")
+    assert forecast.weighted_amount == 500.0
+    assert {group.key: group.count for group in forecast.by_customer_status} == {"lead": 1, "customer": 1, "unknown": 1}
+    assert [group.key for group in forecast.by_close_month] == ["2024-03"]
+
+    print("Test completed.")
+
+def test_snapshot_builder_applies_changes():
+    """
+    Test that a rebuild applies only the changes since the last build, and keeps the file if
+    there were none.
+    """
+    print("Testing incremental snapshot builds...")
+
+    customer_id = uuid4()
+    kept = opportunities.create_opportunity(OpportunityCreate(name="Snapshot kept", customer_id=customer_id))
+    changed = opportunities.create_opportunity(OpportunityCreate(name="Snapshot changed", customer_id=customer_id))
+    removed = opportunities.create_opportunity(OpportunityCreate(name="Snapshot removed", customer_id=customer_id))
+
+    builder = SnapshotBuilder(os.path.join(tempfile.mkdtemp(), "snapshot.bin"))
+    snapshot = builder.build()
+    names = snapshot.strings(snapshot.column("opportunity", "name"))
+    assert {"Snapshot kept", "Snapshot changed", "Snapshot removed"} <= set(names)
+    assert builder.build() is None
+
+    opportunities.update_opportunity(changed.id, OpportunityUpdate(name="Snapshot updated"))
+    opportunities.delete_opportunity(removed.id)
+    snapshot = builder.build()
+    names = snapshot.strings(snapshot.column("opportunity", "name"))
+    print(f"Snapshot opportunity rows after the changes: {snapshot.rows('opportunity')}")
+    assert "Snapshot kept" in names and "Snapshot updated" in names
+    assert "Snapshot changed" not in names and "Snapshot removed" not in names
+    assert builder.build() is None
+
+    # Clean up
+    opportunities.delete_opportunity(kept.id)
+    opportunities.delete_opportunity(changed.id)
+
+    print("Test completed.")
+
+def test_snapshot_store_refresher():
+    """
+    Test that the first snapshot read starts the refresher, and that it can be stopped.
+    """
+    print("Testing the snapshot refresher...")
+
+    store = SnapshotStore(os.path.join(tempfile.mkdtemp(), "snapshot.bin"), refresh_seconds=0.01)
+    assert store._thread is None
+    snapshot = store.current()
+    thread = store._thread
+    assert snapshot is not None and thread is not None and thread.is_alive()
+
+    store.stop()
+    print(f"Refresher alive after stop: {thread.is_alive()}")
+    assert not thread.is_alive() and store._thread is None
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_snapshot_roundtrip()
+    test_snapshot_builder_applies_changes()
+    test_snapshot_store_refresher()
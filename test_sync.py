@@ -0,0 +1,130 @@
+from contextvars import Context
+from uuid import uuid4
+
+import redis
+
+from models.customer import Customer
+from service.changes import ChangeLog
+from service.redis_manager import RedisManager
+from service.replicas import ReplicaSet
+from service.sync import decode_cursor, encode_cursor
+
+def test_changelog():
+    """
+    Test the delta sync change order of an in-memory store.
+    """
+    print("Testing change log...")
+
+    log = ChangeLog(max_tombstones=2)
+    start = log.cursor()
+    for key in (1, 2, 3):
+        log.updated(key)
+    log.updated(1)
+    log.deleted(2)
+
+    cursor, updated, deleted, has_more = log.changes(start, limit=10)
+    print(f"Changes: updated {updated}, deleted {deleted}")
+    assert (updated, deleted, has_more) == ([3, 1], [2], False)
+    assert log.changes(cursor, limit=10)[1:] == ([], [], False)
+
+    # Paging returns the oldest changes first
+    cursor, updated, deleted, has_more = log.changes(start, limit=2)
+    assert (updated, deleted, has_more) == ([3, 1], [], True)
+    assert log.changes(cursor, limit=2)[1:] == ([], [2], False)
+
+    # Cursors of another process or older than the dropped tombstones cannot be continued
+    assert log.changes([log.epoch + 1, 0], limit=10) is None
+    log.deleted(3)
+    log.deleted(1)
+    assert log.changes(start, limit=10) is None
+
+    positions = {"customers": [3, 0], "activities": [log.epoch, 7]}
+    assert decode_cursor(encode_cursor(positions)) == positions
+    try:
+        decode_cursor("not a cursor")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Invalid cursor was accepted")
+
+    print("Test completed.")
+
+def test_redis_changes():
+    """
+    Test delta sync of a Redis model type: deltas, tombstones, paging and full resyncs.
+    """
+    print("Testing Redis delta sync...")
+
+    # A single instance has one revision per model type, so cursors are [revision]
+    manager = RedisManager(cluster=False)
+    model_type = f"synctest{uuid4().hex[:8]}"
+    start = manager.get_sync_cursor(model_type)
+    assert start == [0]
+
+    a, b, c = (manager.create(model_type, Customer(name=name)) for name in ("A", "B", "C"))
+    manager.update(model_type, a.id, {"name": "A2"}, Customer)
+    manager.delete(model_type, b.id)
+
+    changes = manager.get_changes(model_type, Customer, start)
+    print(f"Changes: updated {[customer.name for customer in changes.updated]}, deleted {changes.deleted}")
+    assert changes.cursor == [5] and not changes.has_more and not changes.reset
+    assert {customer.name for customer in changes.updated} == {"A2", "C"}
+    assert changes.deleted == [str(b.id)]
+    assert manager.get_changes(model_type, Customer, changes.cursor)[1:] == ([], [], False, False, [])
+
+    # Pages end at the revision of their last change: C (3) and A (4), then the tombstone of B (5)
+    page = manager.get_changes(model_type, Customer, start, limit=2)
+    assert page.cursor == [4] and page.has_more and page.deleted == []
+    assert [customer.name for customer in page.updated] == ["C", "A2"]
+    page = manager.get_changes(model_type, Customer, page.cursor, limit=2)
+    assert page.cursor == [5] and not page.has_more and page.updated == [] and page.deleted == [str(b.id)]
+
+    # Cursors before the trimmed tombstones, ahead of the data or missing resync fully
+    assert manager.trim_tombstones(model_type, keep=0) == 1
+    for since in (start, [99], None):
+        changes = manager.get_changes(model_type, Customer, since)
+        assert changes.reset and changes.cursor == [5] and changes.deleted == []
+        assert {customer.name for customer in changes.updated} == {"A2", "C"}
+    assert not manager.get_changes(model_type, Customer, [5]).reset
+
+    # Clean up
+    manager.redis_client.delete(*manager.redis_client.keys(f"{model_type}:*"))
+
+    print("Test completed.")
+
+def test_redis_changes_with_lagging_replica():
+    """
+    Test that delta and full syncs read their records from the primary, where their cursor
+    comes from, not from a replica that has not seen the changes yet.
+    """
+    print("Testing Redis delta sync with a lagging replica...")
+
+    manager = RedisManager(cluster=False)
+    model_type = f"synctest{uuid4().hex[:8]}"
+    start = manager.get_sync_cursor(model_type)
+    a, b = (manager.create(model_type, Customer(name=name)) for name in ("A", "B"))
+
+    # The replica has not replicated any record yet
+    lagging = redis.Redis(**dict(manager.connection_kwargs, db=14))
+    manager.replicas = ReplicaSet([], {}, max_lag=5.0)
+    manager.replicas.clients = manager.replicas._healthy = [lagging]
+    try:
+        # Another request, which did not write itself
+        assert Context().run(manager.get, model_type, a.id, Customer) is None
+        for since in (start, None):
+            changes = Context().run(manager.get_changes, model_type, Customer, since)
+            print(f"Since {since}: cursor {changes.cursor}, updated {[customer.name for customer in changes.updated]}")
+            assert changes.cursor == [2]
+            assert sorted(customer.name for customer in changes.updated) == ["A", "B"]
+    finally:
+        manager.replicas = None
+
+    # Clean up
+    manager.redis_client.delete(*manager.redis_client.keys(f"{model_type}:*"))
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_changelog()
+    test_redis_changes()
+    test_redis_changes_with_lagging_replica()
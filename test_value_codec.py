@@ -0,0 +1,50 @@
+import json
+
+from service.memory_report import ModelMemoryUsage, node_capacity
+from service.value_codec import ValueCodec
+
+def test_value_codec():
+    """
+    Test the compact value encoding and its compression.
+    """
+    print("Testing value codec...")
+
+    codec = ValueCodec(compact=True, compress_min_size=200, compression="zlib")
+    codec.register_fields("customer", ["id", "version", "name", "notes", "status"])
+    record = {"id": "c1", "version": 2, "name": "Acme", "notes": None, "status": "lead"}
+
+    encoded = codec.encode("customer", record)
+    print(f"Compact: {encoded}")
+    assert encoded == '#{"0":"c1","1":2,"2":"Acme","4":"lead"}'
+    assert codec.decode("customer", encoded) == record
+
+    # Plain JSON stays readable; fields without a code keep their name
+    assert codec.decode("customer", json.dumps(record)) == record
+    assert codec.decode("customer", codec.encode("customer", dict(record, extra=1)))["extra"] == 1
+
+    # Large values are compressed, but only if that saves space
+    long = dict(record, notes="Call back about the renewal. " * 20)
+    compressed = codec.encode("customer", long)
+    print(f"Compressed {len(json.dumps(long))} bytes of JSON to {len(compressed)}")
+    assert compressed.startswith("z") and len(compressed) < 200
+    assert codec.decode("customer", compressed) == long
+
+    try:
+        codec.register_fields("customer", ["id", "name"])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Field dictionary was reordered")
+
+    usages = [
+        ModelMemoryUsage("customer", 300, 100, value_bytes=400, compact_bytes=200, meta_bytes=100),
+        ModelMemoryUsage("opportunity", 100, 100, value_bytes=500, compact_bytes=300, meta_bytes=100),
+    ]
+    capacity = node_capacity(usages, 1_000_000)
+    print(f"Capacity: {capacity}")
+    assert capacity == {"records": 1904, "compact_records": 3076, "increase": 3076 / 1904 - 1}
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_value_codec()
@@ -0,0 +1,141 @@
+from contextvars import Context
+from uuid import uuid4
+
+import redis
+
+from models.activity import ActivityCreate
+from models.customer import Customer
+from service import activities
+from service.metrics import Registry
+from service.redis_manager import redis_manager
+from service.replicas import ReplicaSet
+from service.write_behind import QueueFullError, QueueInUseError, WriteBehindQueue
+
+def test_write_behind_queue():
+    """
+    Test batching, backpressure and metrics of an in-memory write-behind queue.
+    """
+    print("Testing write-behind queue...")
+
+    batches = []
+    queue = WriteBehindQueue("test", batches.append, str, int, max_pending=5, batch_size=2)
+    for item in range(5):
+        queue.submit(item)
+    try:
+        queue.submit(5)
+    except QueueFullError:
+        pass
+    else:
+        raise AssertionError("Full queue accepted an item")
+
+    assert queue.flush() == 5
+    print(f"Batches: {batches}")
+    assert batches == [[0, 1], [2, 3], [4]]
+    assert len(queue) == 0
+
+    # A failed batch stays queued, in order
+    def fail(batch):
+        raise RuntimeError("unavailable")
+
+    queue.apply = fail
+    queue.submit(6)
+    try:
+        queue.flush()
+    except RuntimeError:
+        pass
+    queue.apply = batches.append
+    queue.close()
+    assert batches[-1] == [6]
+
+    registry = Registry()
+    latency = registry.histogram("flush_seconds", "Flush duration", ("queue",), buckets=(0.1, 1.0))
+    latency.observe(0.05, queue="test")
+    latency.observe(0.5, queue="test")
+    text = registry.render()
+    print(text)
+    assert 'flush_seconds_bucket{queue="test",le="0.1"} 1' in text
+    assert 'flush_seconds_count{queue="test"} 2' in text
+    assert latency.quantile(0.5, queue="test") == 0.1
+
+    print("Test completed.")
+
+def test_durable_write_behind_queue():
+    """
+    Test that the items a crashed process left in its durable list are applied by its
+    successor, and that a live process keeps its list to itself.
+    """
+    print("Testing durable write-behind queue...")
+
+    key = f"test:write-behind:{uuid4().hex}"
+    batches = []
+
+    def queue(**kwargs):
+        return WriteBehindQueue(
+            "durable-test", batches.append, str, int, manager=redis_manager, durable_key=key,
+            flush_interval=60, lease_seconds=0.5, **kwargs
+        )
+
+    crashed = queue()
+    crashed.start()
+    for item in (1, 2, 3):
+        crashed.submit(item)
+    # Crash: the flush thread stops without applying anything or releasing the lease
+    crashed._stop.set()
+    crashed._wakeup.set()
+    crashed._thread.join()
+    assert batches == [] and redis_manager.redis_client.llen(key) == 3
+
+    successor = queue()
+    recovered = successor.start()
+    print(f"Recovered {recovered} items")
+    assert recovered == 3
+    try:
+        queue(batch_size=10).start()
+    except QueueInUseError as e:
+        print(f"Second process: {e}")
+    else:
+        raise AssertionError("Two processes share a durable list")
+
+    successor.submit(4)
+    assert successor.flush() == 4
+    assert batches == [[1, 2, 3, 4]] and redis_manager.redis_client.llen(key) == 0
+    successor.close()
+    assert not redis_manager.redis_client.exists(f"{key}:owner")
+
+    print("Test completed.")
+
+def test_write_behind_reference_check_reads_primary():
+    """
+    Test that queued activities are checked against the primary, not a lagging replica.
+    """
+    print("Testing write-behind reference checks with a lagging replica...")
+
+    customer = redis_manager.create("customer", Customer(name="Write-Behind Customer"))
+    lagging = redis.Redis(**dict(redis_manager.connection_kwargs, db=14))
+    replicas = ReplicaSet([], {}, max_lag=5.0)
+    replicas.clients = replicas._healthy = [lagging]
+    redis_manager.replicas = replicas
+    try:
+        assert Context().run(redis_manager.get, "customer", customer.id, Customer) is None
+        queue = activities.enable_write_behind(flush_interval=60)
+        activity = activities.create_activity(
+            ActivityCreate(title="Queued call", activity_type="call", customer_id=customer.id)
+        )
+        # The flush thread never wrote, so nothing sends its reads to the primary
+        Context().run(queue.flush)
+        print(f"Stored: {activities.get_activity(activity.id) is not None}")
+        assert activities.get_activity(activity.id) is not None
+    finally:
+        activities.disable_write_behind()
+        redis_manager.replicas = None
+
+    # Clean up
+    activities.delete_activity(activity.id)
+    redis_manager.delete("customer", customer.id)
+
+    print("Test completed.")
+
+if __name__ == "__main__":
+    test_write_behind_queue()
+    test_durable_write_behind_queue()
+    test_write_behind_reference_check_reads_primary()